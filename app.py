@@ -11,6 +11,33 @@
 # 8. [NOVA FEATURE] Adicionada função de troca de profissional para agendamentos individuais.
 # 9. [BUGFIX] Corrigido erro de digitação na variável `atendimentos_por_dia` no Dashboard (Gráfico de Linha).
 # 10. [REESTRUTURAÇÃO UX] Movida a navegação principal (`st.radio`) para a barra lateral (`st.sidebar`) para melhor organização do layout (como solicitado).
+# 11. [NOVA FEATURE] Busca de "próximos horários livres" no formulário de agendamento individual.
+# 12. [NOVA FEATURE] Opção "Qualquer profissional" no agendamento individual (horários da clínica inteira).
+# 13. [DESEMPENHO] `ContextoDia` compartilhado entre a listagem de horários, a pré-confirmação e a submissão (sem recarregar o catálogo).
+# 14. [FERIADOS] Cadastro de períodos bloqueados (data inicial/final) e exibição do período na lista.
+# 15. [SÉRIES] Agendamento recorrente (semanal/quinzenal) com relatório de datas não agendadas; alterar/cancelar série em lote.
+# 16. [TURMAS] Matrícula em lote de um cliente numa turma por período, com os créditos debitados junto das reservas.
+# 17. [TURMAS] Vaga da turma reservada na gravação (contador transacional em `salvar_agendamento`); botão para recalcular as vagas ocupadas.
+# 18. [PACOTES] Crédito debitado na transação do agendamento (extrato idempotente); cancelamentos estornam o crédito.
+# 19. [PACOTES] Status dos pacotes lido do campo pré-calculado (recalculado só se ausente ou já vencido); resumo da clínica (vencendo/expirados/esgotados) em Gerenciar Pacotes.
+# 20. [DESEMPENHO] Visões da agenda (diária/semanal/comparativa) escolhidas por `st.radio`: só a visível consulta a base,
+#     e cada uma guarda o último resultado por entradas (`visoes_agenda_cache`), invalidado nas escritas de agendamentos.
+# 21. [DESEMPENHO] Visões semanal e comparativa montadas da mesma grade da semana (`obter_grade_semana`), carregada uma vez.
+# 22. [DESEMPENHO] Troca de profissional lê só o agendamento (`buscar_agendamento_por_id`), sem recarregar o dia;
+#     ações sobre os selecionados não recarregam o dia: cada agendamento é conferido na transação do novo status.
+# 23. [DESEMPENHO] Formulário de agendamento, agenda diária (lista e cada linha) e detalhes dos clientes como
+#     `st.fragment`: uma ação re-executa só a linha/seção. Handlers dessas seções guardam as mensagens em
+#     `mensagens_secoes` (callbacks de fragmento não devem desenhar elementos) e o novo status em `acoes_agendamentos`.
+# 24. [DESEMPENHO] Agenda diária em modo tabela (padrão acima de LIMITE_LINHAS_MODO_LISTA atendimentos): um único
+#     `st.dataframe` com seleção de linhas e ações em lote; detalhes, mensagem e troca só da linha selecionada.
+# 25. [DESEMPENHO] Detalhes do cliente (pacotes e agendamentos futuros) só com o expander aberto, carregados em lote
+#     para o cliente e os vizinhos da lista (`obter_detalhes_cliente`) e guardados em `detalhes_clientes_cache`.
+# 26. [DESEMPENHO] Clientes paginados no servidor (`listar_clientes_pagina`) em vez de carregar a base a cada rerun:
+#     aba de clientes com busca e páginas (pilha de cursores em `clientes_pagina_cursores`); seletores de cliente
+#     do agendamento e da matrícula mostram a primeira página da busca.
+# 27. [SUPER ADMIN] Clínicas paginadas e análise de uso por clínica (agendamentos por mês, clientes cadastrados e
+#     ativos, pacotes ativos, profissionais e leituras estimadas por dia) calculada com agregações `count()` em cache.
+# 28. [PARTICIONAMENTO] Ações do admin e troca de profissional informam o `clinic_id` (agendamentos por clínica).
 
 import streamlit as st
 from datetime import datetime, time, date, timedelta
@@ -19,6 +46,7 @@ from zoneinfo import ZoneInfo
 import plotly.graph_objects as go
 import numpy as np
 import sys # <-- Adicionado para corrigir NameError na função de log
+import time as time_mod
 
 # IMPORTAÇÕES CORRIGIDAS E ADICIONADAS PARA O NOVO MODELO
 from database import (
@@ -29,11 +57,14 @@ from database import (
     remover_profissional as db_remover_profissional,
     salvar_agendamento, # Modificado para aceitar cliente_id
     buscar_agendamento_por_pin,
+    buscar_agendamento_por_id,
     atualizar_horario_profissional,
     adicionar_feriado,
     listar_feriados,
     remover_feriado as db_remover_feriado,
-    listar_clientes,
+    listar_clientes_pagina,
+    buscar_cliente_por_nome,
+    buscar_clientes_por_ids,
     adicionar_cliente,
     remover_cliente as db_remover_cliente,
     listar_servicos,
@@ -45,19 +76,26 @@ from database import (
     remover_turma as db_remover_turma,
     atualizar_turma,
     verificar_cliente_em_turma, # <-- NOVO: Para checagem de duplicidade
+    reconstruir_ocupacao_turmas,
     atualizar_profissional_agendamento, # <-- NOVO: Para troca de profissional
     # Funções para o Super Admin
-    listar_clinicas,
+    listar_clinicas_pagina,
+    contar_metricas_clinica_cache,
+    invalidar_metricas_clinicas,
+    DIAS_CLIENTE_ATIVO,
     adicionar_clinica,
     toggle_status_clinica,
     # Funções de Pacotes (DATABASE)
     listar_pacotes_modelos,
     adicionar_pacote_modelo,
     remover_pacote_modelo as db_remover_pacote_modelo,
+    listar_pacotes_de_clientes,
     listar_pacotes_do_cliente,
-    deduzir_credito_pacote_cliente,
-    # Função de agendamentos futuros modificada para usar cliente_id
-    buscar_agendamentos_futuros_por_cliente
+    calcular_status_pacote,
+    buscar_resumo_pacotes,
+    # Agendamentos futuros de vários clientes (por cliente_id)
+    buscar_agendamentos_futuros_de_clientes,
+    LIMITE_FILTRO_IN
 )
 from logica_negocio import (
     gerar_token_unico,
@@ -68,14 +106,23 @@ from logica_negocio import (
     processar_remarcacao,
     importar_feriados_nacionais,
     gerar_horarios_disponiveis,
+    gerar_horarios_disponiveis_clinica,
+    ContextoDia,
+    criar_serie_agendamentos,
+    cancelar_serie_agendamentos,
+    alterar_serie_agendamentos,
+    matricular_cliente_em_turma,
+    buscar_proximos_horarios_disponiveis,
     # Função para Turmas
     gerar_turmas_disponiveis,
     get_dados_dashboard,
     gerar_visao_semanal,
     gerar_visao_comparativa,
+    carregar_grade_semana,
     # Funções de Pacotes (LÓGICA)
     buscar_pacotes_validos_cliente,
-    associar_pacote_cliente
+    associar_pacote_cliente,
+    STATUS_ACOES_ADMIN
 )
 
 # --- Configuração ---
@@ -85,6 +132,7 @@ DIAS_SEMANA = {"seg": "Segunda", "ter": "Terça", "qua": "Quarta", "qui": "Quint
                "sex": "Sexta", "sab": "Sábado", "dom": "Domingo"}
 DIAS_SEMANA_MAP_REV = {v: k for k, v in DIAS_SEMANA.items()}
 DIAS_SEMANA_LISTA = ["Segunda", "Terça", "Quarta", "Quinta", "Sexta", "Sábado", "Domingo"]
+OPCAO_QUALQUER_PROFISSIONAL = "Qualquer profissional"
 
 # Inicialização do DB
 db_client = get_firestore_client()
@@ -128,14 +176,47 @@ if 'agenda_cliente_id_selecionado' not in st.session_state:
     st.session_state.agenda_cliente_id_selecionado = None
 if 'pacotes_validos_cliente' not in st.session_state:
     st.session_state.pacotes_validos_cliente = []
-if 'pacote_status_placeholder' not in st.session_state:
-    st.session_state.pacote_status_placeholder = None
+
+# State para a busca de próximos horários livres
+if 'proximos_horarios' not in st.session_state:
+    st.session_state.proximos_horarios = {}
+# State para "Qualquer profissional" (hora -> profissionais livres)
+if 'profissionais_por_horario' not in st.session_state:
+    st.session_state.profissionais_por_horario = {}
+# Resultado da última matrícula em lote numa turma
+if 'resultado_matricula_turma' not in st.session_state:
+    st.session_state.resultado_matricula_turma = None
+# Contexto do dia do formulário de agendamento (compartilhado com a confirmação/submissão)
+if 'contexto_dia' not in st.session_state:
+    st.session_state.contexto_dia = None
+# Último resultado de cada visão da agenda: visão -> {'chave', 'expira', 'valor'}
+if 'visoes_agenda_cache' not in st.session_state:
+    st.session_state.visoes_agenda_cache = {}
+if 'comparativa_data_select' not in st.session_state:
+    st.session_state.comparativa_data_select = datetime.now(TZ_SAO_PAULO).date()
+# Mensagens pendentes por seção (fragmento) e alterações locais das linhas da agenda: id -> campos
+if 'mensagens_secoes' not in st.session_state:
+    st.session_state.mensagens_secoes = {}
+if 'acoes_agendamentos' not in st.session_state:
+    st.session_state.acoes_agendamentos = {}
+# Modo da agenda diária escolhido pelo usuário (senão segue o volume do dia) e versão da seleção da tabela
+if 'agenda_diaria_modo_manual' not in st.session_state:
+    st.session_state.agenda_diaria_modo_manual = False
+if 'agenda_tabela_versao' not in st.session_state:
+    st.session_state.agenda_tabela_versao = 0
+# Pacotes e agendamentos futuros dos clientes já abertos: cliente_id -> {'pacotes', 'agendamentos_futuros', 'expira'}
+if 'detalhes_clientes_cache' not in st.session_state:
+    st.session_state.detalhes_clientes_cache = {}
+# Cursores das páginas já visitadas na aba de clientes (o último é o da página atual)
+if 'clientes_pagina_cursores' not in st.session_state:
+    st.session_state.clientes_pagina_cursores = [None]
+# Idem para a lista de clínicas do super admin
+if 'sa_clinicas_cursores' not in st.session_state:
+    st.session_state.sa_clinicas_cursores = [None]
 
 # States para Remarcação na tela de Cliente
 if 'remarcando_cliente_ag_id' not in st.session_state:
     st.session_state.remarcando_cliente_ag_id = None
-if 'remarcacao_cliente_status' not in st.session_state:
-    st.session_state.remarcacao_cliente_status = {}
 if 'remarcacao_cliente_form_data' not in st.session_state:
     st.session_state.remarcacao_cliente_form_data = {}
 if 'remarcacao_cliente_form_hora' not in st.session_state:
@@ -181,8 +262,13 @@ def handle_logout():
                      'active_tab', 'agenda_cliente_select', 'c_tel_input', 'confirmando_agendamento',
                      'detalhes_agendamento', 'form_data_selecionada', 'filter_data_selecionada',
                      'is_super_admin', 'agenda_cliente_id_selecionado', 'pacotes_validos_cliente',
-                     'pacote_status_placeholder', 'remarcando_cliente_ag_id', 'remarcacao_cliente_status',
-                     'remarcacao_cliente_form_data', 'remarcacao_cliente_form_hora']
+                     'remarcando_cliente_ag_id',
+                     'remarcacao_cliente_form_data', 'remarcacao_cliente_form_hora', 'proximos_horarios',
+                     'profissionais_por_horario', 'contexto_dia', 'resultado_matricula_turma',
+                     'visoes_agenda_cache', 'agenda_visao', 'semanal_prof_select', 'comparativa_data_select',
+                     'mensagens_secoes', 'acoes_agendamentos', 'agenda_diaria_modo', 'agenda_diaria_modo_manual',
+                     'agenda_tabela_versao', 'detalhes_clientes_cache', 'clientes_pagina_cursores', 'clientes_busca',
+                     'agenda_cliente_busca', 'matricula_cliente_busca', 'sa_clinicas_cursores']
     for key in keys_to_clear:
         if key in st.session_state:
             del st.session_state[key]
@@ -212,6 +298,14 @@ def handle_toggle_status_clinica(clinic_id, status_atual):
     else:
         st.error("Erro ao alterar o status da clínica.")
 
+def handle_pagina_clinicas(cursor_proximo: tuple = None):
+    """Avança para a página de clínicas após `cursor_proximo`, ou volta uma página se não for informado."""
+    cursores = st.session_state.sa_clinicas_cursores
+    if cursor_proximo:
+        cursores.append(cursor_proximo)
+    elif len(cursores) > 1:
+        cursores.pop()
+
 def handle_add_profissional():
     """Adiciona um novo profissional para a clínica logada."""
     nome_profissional = st.session_state.nome_novo_profissional
@@ -228,8 +322,7 @@ def handle_selecao_cliente():
     """Callback para atualizar telefone e ID do cliente e verificar pacotes."""
     cliente_selecionado = st.session_state.agenda_cliente_select
     if cliente_selecionado != "Novo Cliente":
-        clientes = listar_clientes(st.session_state.clinic_id)
-        cliente_data = next((c for c in clientes if c['nome'] == cliente_selecionado), None)
+        cliente_data = buscar_cliente_por_nome(st.session_state.clinic_id, cliente_selecionado)
         if cliente_data:
             st.session_state.c_tel_input = cliente_data.get('telefone', '')
             st.session_state.agenda_cliente_id_selecionado = cliente_data.get('id')
@@ -244,72 +337,142 @@ def handle_selecao_cliente():
     handle_verificar_pacotes()
 
 
+def obter_contexto_dia(data_selecionada: date, servicos: list = None) -> ContextoDia:
+    """
+    Contexto do dia da sessão, único ponto de criação de `ContextoDia`. O formulário passa o catálogo já carregado
+    (`servicos`) e recebe um contexto novo a cada render; os handlers reaproveitam o dele, ou criam um se a clínica/data mudou.
+    """
+    contexto = st.session_state.get('contexto_dia')
+    if servicos is not None or not contexto or (contexto.clinic_id, contexto.data) != (st.session_state.clinic_id, data_selecionada):
+        contexto = ContextoDia(st.session_state.clinic_id, data_selecionada, servicos)
+        st.session_state.contexto_dia = contexto
+    return contexto
+
+VISOES_AGENDA = ["Visão Diária (Lista)", "Visão Semanal (Profissional)", "Visão Comparativa (Diária)"]
+# Outras sessões também escrevem agendamentos; o resultado guardado expira para não ficar defasado
+VALIDADE_CACHE_VISAO_SEGUNDOS = 60
+
+def obter_visao_agenda(visao: str, chave: tuple, carregar):
+    """Devolve o último resultado da visão se as entradas (`chave`) não mudaram, ou chama `carregar()`."""
+    cache = st.session_state.visoes_agenda_cache
+    item = cache.get(visao)
+    agora = time_mod.monotonic()
+    if item and item['chave'] == chave and item['expira'] > agora:
+        return item['valor']
+    valor = carregar()
+    for nome in [nome for nome, guardado in cache.items() if guardado['expira'] <= agora]:
+        del cache[nome]
+    cache[visao] = {'chave': chave, 'expira': agora + VALIDADE_CACHE_VISAO_SEGUNDOS, 'valor': valor}
+    return valor
+
+def obter_grade_semana(data_referencia: date):
+    """
+    Células da semana que contém `data_referencia`, compartilhadas pelas visões semanal e comparativa.
+    Cada semana tem a sua entrada, para as duas visões em semanas diferentes não se descartarem a cada troca.
+    """
+    start_of_week = data_referencia - timedelta(days=data_referencia.weekday())
+    clinic_id = st.session_state.clinic_id
+    return obter_visao_agenda(f"Grade semanal {start_of_week.isoformat()}", (clinic_id, start_of_week),
+                              lambda: carregar_grade_semana(clinic_id, start_of_week))
+
+def invalidar_visoes_agenda():
+    """
+    Descarta os resultados guardados das visões e dos detalhes de clientes
+    (chamada pelos handlers que alteram agendamentos).
+    """
+    st.session_state.visoes_agenda_cache = {}
+    st.session_state.detalhes_clientes_cache = {}
+
+def obter_detalhes_cliente(clinic_id: str, cliente_id: str, ids_pagina: list) -> dict:
+    """
+    Pacotes e agendamentos futuros do cliente. Sem cache válido, carrega em lote (duas consultas) o cliente e os
+    próximos clientes da lista ainda não carregados, até LIMITE_FILTRO_IN, antecipando os próximos a serem abertos.
+    Clientes sem pacotes na consulta em lote (que depende do `cliente_id` gravado no pacote) têm os pacotes relidos
+    da subcoleção deles quando são abertos: pacotes antigos só recebem o campo na tarefa `atualizar-pacotes`.
+    """
+    cache = st.session_state.detalhes_clientes_cache
+    agora = time_mod.monotonic()
+    item = cache.get(cliente_id)
+    if item and item['expira'] > agora:
+        if item['pacotes'] is None:
+            item['pacotes'] = listar_pacotes_do_cliente(clinic_id, cliente_id)
+        return item
+
+    posicao = ids_pagina.index(cliente_id) if cliente_id in ids_pagina else len(ids_pagina)
+    vizinhos = [c for c in ids_pagina[posicao + 1:] + ids_pagina[:posicao]
+                if c not in cache or cache[c]['expira'] <= agora]
+    lote = [cliente_id] + vizinhos[:LIMITE_FILTRO_IN - 1]
+
+    pacotes = listar_pacotes_de_clientes(clinic_id, lote)
+    agendamentos = buscar_agendamentos_futuros_de_clientes(clinic_id, lote)
+    for c in lote:
+        # None: nenhum pacote no lote, conferido pela subcoleção na abertura
+        cache[c] = {'pacotes': pacotes.get(c) or None, 'agendamentos_futuros': agendamentos.get(c, []),
+                    'expira': agora + VALIDADE_CACHE_VISAO_SEGUNDOS}
+    item = cache[cliente_id]
+    if item['pacotes'] is None:
+        item['pacotes'] = listar_pacotes_do_cliente(clinic_id, cliente_id)
+    return item
+
+def registrar_mensagem(secao: str, tipo: str, texto: str):
+    """Guarda uma mensagem ('success', 'warning', 'error', 'info') para a seção exibir no próximo render."""
+    st.session_state.mensagens_secoes.setdefault(secao, []).append((tipo, texto))
+
+def exibir_mensagens(secao: str):
+    """Exibe (e descarta) as mensagens pendentes da seção."""
+    for tipo, texto in st.session_state.mensagens_secoes.pop(secao, []):
+        getattr(st, tipo)(texto)
+
 def handle_verificar_pacotes():
-    """Verifica pacotes válidos quando cliente ou serviço mudam."""
+    """Verifica pacotes válidos quando cliente ou serviço mudam (o formulário exibe o primeiro da lista)."""
     cliente_id = st.session_state.get('agenda_cliente_id_selecionado')
     servico_nome = st.session_state.get('c_servico_input')
 
-    # Cria o placeholder se não existir
-    if 'pacote_status_placeholder' not in st.session_state or st.session_state.pacote_status_placeholder is None:
-        try:
-            st.session_state.pacote_status_placeholder = st.empty()
-        except Exception as e:
-            print(f"Erro ao criar placeholder: {e}", file=sys.stderr)
-            return # Sai se não conseguir criar
-
-    placeholder = st.session_state.pacote_status_placeholder
-
     # Busca o ID do serviço
-    servicos_clinica = listar_servicos(st.session_state.clinic_id)
-    servico_obj = next((s for s in servicos_clinica if s.get('nome') == servico_nome), None)
+    servico_obj = obter_contexto_dia(st.session_state.form_data_selecionada).servico(servico_nome)
     servico_id = servico_obj['id'] if servico_obj else None
 
-    # Limpa a lista e a mensagem se não houver cliente ou serviço válido
+    # Limpa a lista se não houver cliente ou serviço válido
     if not cliente_id or not servico_id:
         st.session_state.pacotes_validos_cliente = []
-        try:
-            placeholder.empty()
-        except Exception as e:
-            print(f"Erro ao limpar placeholder (sem cliente/serviço): {e}", file=sys.stderr) # Log erro
         return
 
     # Busca pacotes válidos se tiver cliente e serviço
     try:
-        pacotes_validos = buscar_pacotes_validos_cliente(
+        st.session_state.pacotes_validos_cliente = buscar_pacotes_validos_cliente(
             st.session_state.clinic_id,
             cliente_id,
             servico_id
         )
-        st.session_state.pacotes_validos_cliente = pacotes_validos
-
-        # Mostra a mensagem se encontrar pacotes
-        if pacotes_validos:
-            pacote = pacotes_validos[0] # Pega o primeiro pacote válido
-            expiracao_str = "Data Inválida"
-            if isinstance(pacote.get('data_expiracao'), datetime):
-                expiracao_str = pacote['data_expiracao'].strftime('%d/%m/%Y')
-
-            msg = f"ℹ️ Cliente possui Pacote '{pacote.get('nome_pacote','N/A')}' com {pacote.get('creditos_restantes','N/A')}/{pacote.get('creditos_total','N/A')} créditos (válido até {expiracao_str})."
-
-            try:
-                placeholder.info(msg)
-            except Exception as e:
-                print(f"Erro ao atualizar placeholder (com pacote): {e}", file=sys.stderr) # Log erro
-        else:
-            try:
-                placeholder.empty() # Limpa se não encontrar pacotes
-            except Exception as e:
-                print(f"Erro ao limpar placeholder (sem pacote): {e}", file=sys.stderr) # Log erro
-
     except Exception as e:
         print(f"Erro ao buscar pacotes válidos: {e}", file=sys.stderr)
         st.session_state.pacotes_validos_cliente = []
-        try:
-            placeholder.empty() # Limpa em caso de erro na busca
-        except Exception as e_clear:
-            print(f"Erro ao limpar placeholder (erro na busca): {e_clear}", file=sys.stderr) # Log erro
 
 
+def handle_buscar_proximos_horarios(servico_nome: str, duracao_servico: int):
+    """Busca os próximos horários livres para o serviço (um profissional ou todos)."""
+    todos = st.session_state.get('proximos_todos_profissionais', False)
+    profissional_nome = st.session_state.get('c_prof_input')
+    if todos or profissional_nome == OPCAO_QUALQUER_PROFISSIONAL:
+        profissional_nome = None
+    opcoes = buscar_proximos_horarios_disponiveis(
+        st.session_state.clinic_id,
+        duracao_servico,
+        profissional_nome=profissional_nome,
+        data_inicio=st.session_state.form_data_selecionada,
+        dias=st.session_state.get('proximos_dias', 14),
+        limite=5
+    )
+    # Guarda junto o serviço e o filtro usados, para não exibir resultados de outra busca
+    st.session_state.proximos_horarios = {'servico': servico_nome, 'profissional': profissional_nome, 'opcoes': opcoes}
+
+def handle_usar_proximo_horario(opcao: dict):
+    """Preenche data, profissional e hora do formulário com a opção escolhida."""
+    st.session_state.form_data_selecionada = opcao['data']
+    st.session_state.c_prof_input = opcao['profissional_nome']
+    st.session_state.c_hora_input = opcao['hora']
+    st.session_state.proximos_horarios = {}
+
 def handle_pre_agendamento():
     """Coleta os dados do formulário e abre o diálogo de confirmação."""
     cliente_selecionado = st.session_state.agenda_cliente_select
@@ -323,11 +486,10 @@ def handle_pre_agendamento():
         cliente_id = st.session_state.get('agenda_cliente_id_selecionado') # Cliente existente tem ID
 
     servico_nome = st.session_state.c_servico_input
-    servicos_clinica = listar_servicos(st.session_state.clinic_id)
-    servico_obj = next((s for s in servicos_clinica if s['nome'] == servico_nome), None)
+    servico_obj = obter_contexto_dia(st.session_state.form_data_selecionada).servico(servico_nome)
 
     if not servico_obj:
-        st.error("Serviço não encontrado.")
+        registrar_mensagem("formulario_agendamento", "error", "Serviço não encontrado.")
         return
 
     is_turma = servico_obj.get('tipo', 'Individual') == 'Em Grupo'
@@ -335,7 +497,7 @@ def handle_pre_agendamento():
     hora_consulta_raw = st.session_state.get('c_hora_input')
 
     if not cliente or not telefone or not hora_consulta_raw:
-        st.warning("Por favor, preencha o nome do cliente, telefone e selecione um horário/turma válido.")
+        registrar_mensagem("formulario_agendamento", "warning", "Por favor, preencha o nome do cliente, telefone e selecione um horário/turma válido.")
         return
 
     turma_id = None
@@ -346,27 +508,50 @@ def handle_pre_agendamento():
         if isinstance(hora_consulta_raw, tuple) and len(hora_consulta_raw) == 2:
             turma_id, hora_consulta = hora_consulta_raw
         else:
-            st.warning("Seleção de turma inválida.")
+            registrar_mensagem("formulario_agendamento", "warning", "Seleção de turma inválida.")
             return
     else:
         # Para individual, o input é um time object
         if isinstance(hora_consulta_raw, time):
             hora_consulta = hora_consulta_raw
         else:
-            st.warning("Seleção de horário inválida.")
+            registrar_mensagem("formulario_agendamento", "warning", "Seleção de horário inválida.")
             return
 
+    profissional_nome = st.session_state.c_prof_input
+    if not is_turma and profissional_nome == OPCAO_QUALQUER_PROFISSIONAL:
+        # Atribui o primeiro profissional livre no horário escolhido
+        livres = st.session_state.profissionais_por_horario.get(hora_consulta, [])
+        if not livres:
+            registrar_mensagem("formulario_agendamento", "warning", "Nenhum profissional livre no horário selecionado.")
+            return
+        profissional_nome = livres[0]
+
+    recorrencia = None
+    if not is_turma and st.session_state.get('serie_ativa'):
+        por_data = st.session_state.get('serie_modo_fim') == "Até a data"
+        recorrencia = {
+            'intervalo_semanas': 2 if st.session_state.get('serie_frequencia') == "Quinzenal" else 1,
+            'ocorrencias': None if por_data else int(st.session_state.get('serie_ocorrencias', 4)),
+            'data_fim': st.session_state.get('serie_data_fim') if por_data else None,
+        }
+
     pacote_para_debitar_id = None
     pacote_info_msg = None
+    pacote_creditos = None
     if st.session_state.pacotes_validos_cliente:
         pacote = st.session_state.pacotes_validos_cliente[0]
         pacote_para_debitar_id = pacote['id']
-        pacote_info_msg = f"Será debitado 1 crédito do pacote '{pacote.get('nome_pacote','N/A')}'."
+        pacote_creditos = pacote.get('creditos_restantes')
+        if recorrencia:
+            pacote_info_msg = f"Cada sessão da série debita 1 crédito do pacote '{pacote.get('nome_pacote','N/A')}' (até {pacote_creditos} créditos restantes)."
+        else:
+            pacote_info_msg = f"Será debitado 1 crédito do pacote '{pacote.get('nome_pacote','N/A')}'."
 
     st.session_state.detalhes_agendamento = {
         'cliente': cliente,
         'telefone': telefone,
-        'profissional': st.session_state.c_prof_input,
+        'profissional': profissional_nome,
         'servico': servico_nome,
         'data': st.session_state.form_data_selecionada,
         'hora': hora_consulta,
@@ -375,21 +560,28 @@ def handle_pre_agendamento():
         'cliente_id': cliente_id, # <-- Passa o ID obtido (PODE SER NONE AQUI SE ERA NOVO)
         'servico_id': servico_obj['id'],
         'pacote_cliente_id': pacote_para_debitar_id,
-        'pacote_info_msg': pacote_info_msg
+        'pacote_creditos': pacote_creditos,
+        'pacote_info_msg': pacote_info_msg,
+        'recorrencia': recorrencia
     }
     st.session_state.filter_data_selecionada = st.session_state.form_data_selecionada
-    st.session_state.confirmando_agendamento = True
-    st.rerun()
+    st.session_state.confirmando_agendamento = True # O fragmento do formulário passa a mostrar a confirmação
+
+def handle_voltar_agendamento():
+    """Volta da confirmação para o formulário (mantendo os dados preenchidos)."""
+    st.session_state.confirmando_agendamento = False
 
 def handle_agendamento_submission():
     """Lida com a criação de um novo agendamento após a confirmação."""
+    invalidar_visoes_agenda()
     detalhes = st.session_state.detalhes_agendamento
     if not detalhes:
         return
 
     clinic_id = st.session_state.clinic_id
-    servicos_clinica = listar_servicos(clinic_id)
-    servico_data = next((s for s in servicos_clinica if s['nome'] == detalhes['servico']), None)
+    # Mesmo contexto usado para listar os horários: catálogo/agendas/feriado já carregados
+    contexto = obter_contexto_dia(detalhes['data'])
+    servico_data = contexto.servico(detalhes['servico'])
     duracao_servico = servico_data['duracao_min'] if servico_data else 30
 
     dt_consulta_naive = datetime.combine(detalhes['data'], detalhes['hora'])
@@ -413,6 +605,48 @@ def handle_agendamento_submission():
             st.session_state.confirmando_agendamento = False
             return
             
+    # 2a. SÉRIE RECORRENTE: conflitos de todas as datas numa passada e gravação em lote
+    if detalhes.get('recorrencia') and not detalhes['turma_id']:
+        recorrencia = detalhes['recorrencia']
+        dados_serie = {
+            'profissional_nome': detalhes['profissional'],
+            'cliente': detalhes['cliente'],
+            'cliente_id': cliente_id_para_salvar,
+            'telefone': detalhes['telefone'],
+            'servico_nome': detalhes['servico'],
+            'duracao_min': duracao_servico,
+            'turma_id': None,
+            'pacote_cliente_id': detalhes.get('pacote_cliente_id') if cliente_id_para_salvar else None
+        }
+        resultado_serie = criar_serie_agendamentos(
+            clinic_id,
+            dados_serie,
+            detalhes['data'],
+            detalhes['hora'],
+            intervalo_semanas=recorrencia['intervalo_semanas'],
+            data_fim=recorrencia['data_fim'],
+            ocorrencias=recorrencia['ocorrencias'],
+            creditos_pacote=detalhes.get('pacote_creditos')
+        )
+        if resultado_serie['criados']:
+            primeiro = resultado_serie['criados'][0]
+            st.session_state.last_agendamento_info = {
+                'cliente': detalhes['cliente'],
+                'link_gestao': f"https://agendafit.streamlit.app?pin={primeiro['pin_code']}",
+                'pin_code': primeiro['pin_code'],
+                'status': True,
+                'serie_criados': len(resultado_serie['criados']),
+                'serie_falhas': resultado_serie['falhas']
+            }
+            st.session_state.form_data_selecionada = detalhes['data']
+            st.session_state.filter_data_selecionada = detalhes['data']
+        else:
+            motivos = "; ".join(f"{f['data'].strftime('%d/%m')}: {f['motivo']}" for f in resultado_serie['falhas'][:5])
+            st.session_state.last_agendamento_info = {'cliente': detalhes['cliente'], 'status': f"Nenhuma sessão da série pôde ser agendada. {motivos}"}
+        resetar_formulario_agendamento()
+        st.rerun()
+        return
+
     # 2. VERIFICAÇÕES DE DISPONIBILIDADE
     
     if detalhes['turma_id']:
@@ -427,10 +661,11 @@ def handle_agendamento_submission():
             disponivel = False
             msg_disponibilidade = "Erro interno: ID do cliente ausente para agendamento de turma."
             
-        # Não precisa de check de vagas, pois a lista de turmas já filtra por vagas disponíveis > 0
+        # A vaga é conferida e reservada na própria gravação (transação em `salvar_agendamento`),
+        # pois outra sessão pode ter ocupado a última vaga depois da listagem.
     
     else: # Agendamento Individual
-        disponivel, msg_disponibilidade = verificar_disponibilidade_com_duracao(clinic_id, detalhes['profissional'], dt_consulta_local, duracao_servico)
+        disponivel, msg_disponibilidade = verificar_disponibilidade_com_duracao(clinic_id, detalhes['profissional'], dt_consulta_local, duracao_servico, contexto=contexto)
 
     # 3. SUBMISSÃO
     if disponivel:
@@ -450,23 +685,8 @@ def handle_agendamento_submission():
         resultado = salvar_agendamento(clinic_id, dados, pin_code)
 
         if resultado is True:
-            # Tenta deduzir o crédito se um pacote e um ID de cliente estiverem disponíveis
-            if detalhes.get('pacote_cliente_id') and cliente_id_para_salvar:
-                try:
-                    deduzido = deduzir_credito_pacote_cliente(
-                        clinic_id,
-                        cliente_id_para_salvar, # Usa o ID obtido (novo ou existente)
-                        detalhes['pacote_cliente_id']
-                    )
-                    if deduzido:
-                        print(f"LOG: Crédito deduzido do pacote {detalhes['pacote_cliente_id']} para cliente {cliente_id_para_salvar}", file=sys.stderr)
-                    else:
-                        print(f"ERRO: Falha ao deduzir crédito do pacote {detalhes['pacote_cliente_id']} para cliente {cliente_id_para_salvar}", file=sys.stderr)
-                        st.warning("Agendamento salvo, mas falha ao deduzir o crédito do pacote.")
-                except Exception as e:
-                    print(f"ERRO AO DEDUZIR CRÉDITO (mas agendamento salvo): {e}", file=sys.stderr)
-                    st.warning(f"Agendamento salvo, mas ocorreu um erro ao deduzir o crédito: {e}")
-            elif detalhes.get('pacote_cliente_id') and not cliente_id_para_salvar:
+            # O crédito do pacote (se houver) já foi debitado na transação de `salvar_agendamento`
+            if detalhes.get('pacote_cliente_id') and not cliente_id_para_salvar:
                 print("AVISO: Pacote selecionado, mas ID do cliente não disponível para dedução (não deveria ocorrer após o fix).", file=sys.stderr)
                 st.warning("Agendamento salvo, mas o crédito do pacote não pôde ser deduzido automaticamente.")
 
@@ -481,37 +701,39 @@ def handle_agendamento_submission():
     else:
         st.session_state.last_agendamento_info = {'cliente': detalhes['cliente'], 'status': msg_disponibilidade}
 
-    # Reset state
+    resetar_formulario_agendamento()
+    st.rerun()
+
+def resetar_formulario_agendamento():
+    """Limpa o estado do formulário após uma submissão (avulsa ou série)."""
     st.session_state.agenda_cliente_select = "Novo Cliente"
     st.session_state.c_tel_input = ""
     st.session_state.confirmando_agendamento = False
     st.session_state.detalhes_agendamento = {}
     st.session_state.pacotes_validos_cliente = []
-    if st.session_state.pacote_status_placeholder:
-        try: st.session_state.pacote_status_placeholder.empty()
-        except: pass
     st.session_state.agenda_cliente_id_selecionado = None
-    st.rerun()
+    st.session_state.serie_ativa = False
 
-def handle_troca_profissional(agendamento_id: str, profissional_antigo: str, novo_profissional_nome: str):
+def handle_troca_profissional(agendamento_id: str, profissional_antigo: str):
     """
-    Handler para trocar o profissional de um agendamento individual,
-    verificando a disponibilidade no horário original.
+    Handler para trocar o profissional de um agendamento individual (novo profissional no
+    selectbox da linha), verificando a disponibilidade no horário original.
     """
-    if profissional_antigo == novo_profissional_nome:
-        st.warning("O profissional selecionado já está atribuído a este agendamento.")
+    invalidar_visoes_agenda()
+    novo_profissional_nome = st.session_state.get(f"troca_prof_select_{agendamento_id}")
+    if not novo_profissional_nome or profissional_antigo == novo_profissional_nome:
+        registrar_mensagem(agendamento_id, "warning", "O profissional selecionado já está atribuído a este agendamento.")
         return
-        
-    # Busca agendamento original para obter dados de horário e duração
+
+    # Busca agendamento original (uma leitura) para obter dados de horário e duração
     # Nota: Poderíamos passar mais dados via args, mas buscar garante que o status está correto.
-    from database import buscar_agendamento_por_pin # Usamos o PIN handler, mas precisamos do ID para atualização
-    agendamento_original = next((ag for ag in buscar_agendamentos_por_data(st.session_state.clinic_id, st.session_state.filter_data_selecionada).to_dict('records') if ag.get('id') == agendamento_id), None)
-    
-    if not agendamento_original:
-        st.error("Agendamento não encontrado para troca.")
+    clinic_id = st.session_state.clinic_id
+    agendamento_original = buscar_agendamento_por_id(agendamento_id, clinic_id)
+
+    if not agendamento_original or agendamento_original.get('status') != "Confirmado":
+        registrar_mensagem(agendamento_id, "error", "Agendamento não encontrado para troca.")
         return
 
-    clinic_id = st.session_state.clinic_id
     horario_ag = agendamento_original.get('horario')
     duracao = agendamento_original.get('duracao_min', 30)
     
@@ -525,15 +747,14 @@ def handle_troca_profissional(agendamento_id: str, profissional_antigo: str, nov
     )
 
     if disponivel:
-        # 2. Atualiza o agendamento no banco de dados
-        if atualizar_profissional_agendamento(agendamento_id, novo_profissional_nome):
-            st.success(f"Profissional alterado com sucesso! De {profissional_antigo} para {novo_profissional_nome}.")
+        # 2. Atualiza o agendamento no banco de dados; a linha passa a mostrar o novo profissional
+        if atualizar_profissional_agendamento(agendamento_id, novo_profissional_nome, clinic_id):
+            st.session_state.acoes_agendamentos.setdefault(agendamento_id, {})['profissional_nome'] = novo_profissional_nome
+            registrar_mensagem(agendamento_id, "success", f"Profissional alterado com sucesso! De {profissional_antigo} para {novo_profissional_nome}.")
         else:
-            st.error("Erro ao atualizar o profissional no banco de dados.")
+            registrar_mensagem(agendamento_id, "error", "Erro ao atualizar o profissional no banco de dados.")
     else:
-        st.error(f"Não foi possível trocar para {novo_profissional_nome}: {msg}")
-        
-    st.rerun() # Força a atualização da lista
+        registrar_mensagem(agendamento_id, "error", f"Não foi possível trocar para {novo_profissional_nome}: {msg}")
 
 
 def handle_salvar_horarios_profissional(prof_id):
@@ -560,13 +781,18 @@ def handle_salvar_horarios_profissional(prof_id):
 
 def handle_adicionar_feriado():
     data = st.session_state.nova_data_feriado
+    data_fim = st.session_state.get('nova_data_fim_feriado')
     descricao = st.session_state.descricao_feriado
     if data and descricao:
-        if adicionar_feriado(st.session_state.clinic_id, data, descricao):
-            st.success(f"Feriado '{descricao}' em {data.strftime('%d/%m/%Y')} adicionado.")
+        if data_fim and data_fim < data:
+            st.warning("A data final do período deve ser igual ou posterior à data inicial.")
+            return
+        if adicionar_feriado(st.session_state.clinic_id, data, descricao, data_fim):
+            periodo = f"de {data.strftime('%d/%m/%Y')} a {data_fim.strftime('%d/%m/%Y')}" if data_fim and data_fim != data else f"em {data.strftime('%d/%m/%Y')}"
+            st.success(f"Feriado '{descricao}' {periodo} adicionado.")
             st.rerun()
         else:
-            st.error("Erro ao adicionar feriado.")
+            st.error("Erro ao adicionar feriado (períodos podem ter no máximo 62 dias).")
     else:
         st.warning("Data e Descrição são obrigatórias.")
 
@@ -580,8 +806,9 @@ def handle_importar_feriados():
         st.warning(f"Não foi possível importar feriados para {ano}. Verifique se já não foram importados ou erro na API externa.")
 
 
-def handle_remarcar_confirmacao(pin, agendamento_id, profissional_nome):
+def handle_remarcar_confirmacao(pin, agendamento_id, profissional_nome, clinic_id=None):
     """Handler para a página de gestão (PIN)"""
+    invalidar_visoes_agenda()
     nova_data = st.session_state.nova_data_remarcacao
     nova_hora = st.session_state.nova_hora_remarcacao
 
@@ -591,46 +818,101 @@ def handle_remarcar_confirmacao(pin, agendamento_id, profissional_nome):
 
     novo_horario_naive = datetime.combine(nova_data, nova_hora)
     novo_horario_local = novo_horario_naive.replace(tzinfo=TZ_SAO_PAULO)
-    sucesso, mensagem = processar_remarcacao(pin, agendamento_id, profissional_nome, novo_horario_local)
+    sucesso, mensagem = processar_remarcacao(pin, agendamento_id, profissional_nome, novo_horario_local, clinic_id)
     st.session_state.remarcacao_status = {'sucesso': sucesso, 'mensagem': mensagem}
     if sucesso:
         st.session_state.remarcando = False # Sai do modo remarcação na página PIN
 
-def handle_cancelar_selecionados():
-    ids_para_cancelar = [ag_id for ag_id, selecionado in st.session_state.agendamentos_selecionados.items() if selecionado]
-    if not ids_para_cancelar:
-        st.warning("Nenhum agendamento selecionado.")
-        return
+# Ação do admin -> particípio usado nas mensagens das ações em lote
+ROTULOS_ACOES_LOTE = {"cancelar": "cancelados", "finalizar": "finalizados", "no-show": "marcados como falta"}
 
+def aplicar_acao_admin_em_lote(ids: list, acao: str):
+    """
+    Aplica a ação aos agendamentos e registra o resultado na agenda diária. O novo status vai para
+    `acoes_agendamentos`, como nas ações de cada linha. Retorna (sucessos, falhas).
+    """
     sucessos = 0
     falhas = 0
-    for ag_id in ids_para_cancelar:
-        if acao_admin_agendamento(ag_id, "cancelar"):
+    for ag_id in ids:
+        # A transação de cada um já lê o agendamento: os que não são da clínica ou não estão confirmados falham
+        if acao_admin_agendamento(ag_id, acao, st.session_state.clinic_id, somente_confirmado=True):
+            st.session_state.acoes_agendamentos.setdefault(ag_id, {})['status'] = STATUS_ACOES_ADMIN[acao]
             sucessos += 1
         else:
             falhas += 1
     if sucessos > 0:
-        st.success(f"{sucessos} agendamentos cancelados com sucesso.")
+        registrar_mensagem("agenda_diaria", "success", f"{sucessos} agendamentos {ROTULOS_ACOES_LOTE[acao]} com sucesso.")
     if falhas > 0:
-        st.error(f"{falhas} agendamentos falharam ao cancelar.")
+        registrar_mensagem("agenda_diaria", "error", f"{falhas} agendamentos falharam na ação '{acao.upper()}'.")
+    return sucessos, falhas
+
+def handle_cancelar_selecionados():
+    invalidar_visoes_agenda()
+    ids_para_cancelar = [ag_id for ag_id, selecionado in st.session_state.agendamentos_selecionados.items() if selecionado]
+    if not ids_para_cancelar:
+        registrar_mensagem("agenda_diaria", "warning", "Nenhum agendamento selecionado.")
+        return
 
+    aplicar_acao_admin_em_lote(ids_para_cancelar, "cancelar")
     st.session_state.agendamentos_selecionados.clear()
-    st.rerun()
 
-def handle_admin_action(id_agendamento: str, acao: str):
-    """Handler genérico para ações de admin (cancelar, finalizar, no-show)"""
+def handle_acao_tabela_agenda(acao: str, ids: list):
+    """Ação em lote sobre as linhas selecionadas na tabela da agenda diária."""
+    invalidar_visoes_agenda()
+    if not ids:
+        registrar_mensagem("agenda_diaria", "warning", "Nenhum agendamento selecionado.")
+        return
+
+    aplicar_acao_admin_em_lote(ids, acao)
+    # Só a tabela é re-executada, com as mesmas linhas e os novos status; uma nova key
+    # do dataframe limpa a seleção, para a próxima ação não repetir as linhas já processadas
+    st.session_state.agenda_tabela_versao += 1
+
+def handle_modo_agenda_diaria():
+    """Depois de escolhido pelo usuário, o modo da agenda diária deixa de seguir o volume do dia."""
+    st.session_state.agenda_diaria_modo_manual = True
+
+def handle_cancelar_serie(serie_id: str, a_partir_de: date):
+    """Cancela em lote as sessões confirmadas da série a partir da data."""
+    invalidar_visoes_agenda()
+    cancelados = cancelar_serie_agendamentos(st.session_state.clinic_id, serie_id, a_partir_de)
+    if cancelados:
+        registrar_mensagem("agenda_diaria", "success", f"{cancelados} sessões da série canceladas a partir de {a_partir_de.strftime('%d/%m/%Y')}.")
+    else:
+        registrar_mensagem("agenda_diaria", "warning", "Nenhuma sessão confirmada da série foi cancelada.")
+
+def handle_alterar_serie(serie_id: str, a_partir_de: date, ag_id: str):
+    """Altera em lote o horário das sessões da série a partir da data (conflitos checados numa passada)."""
+    invalidar_visoes_agenda()
+    nova_hora = st.session_state.get(f"serie_nova_hora_{ag_id}")
+    if not isinstance(nova_hora, time):
+        registrar_mensagem("agenda_diaria", "warning", "Selecione o novo horário da série.")
+        return
+    resultado = alterar_serie_agendamentos(st.session_state.clinic_id, serie_id, nova_hora=nova_hora, a_partir_de=a_partir_de)
+    if resultado['alterados']:
+        registrar_mensagem("agenda_diaria", "success", f"{resultado['alterados']} sessões da série movidas para {nova_hora.strftime('%H:%M')}.")
+    if resultado['falhas']:
+        registrar_mensagem("agenda_diaria", "warning", "Não alteradas: " + "; ".join(f"{f['data'].strftime('%d/%m')} ({f['motivo']})" for f in resultado['falhas']))
+
+def handle_admin_action(id_agendamento: str, acao: str, secao: str = None):
+    """
+    Handler genérico para ações de admin (cancelar, finalizar, no-show).
+    A mensagem vai para `secao` (padrão: a linha do próprio agendamento na agenda diária).
+    """
+    invalidar_visoes_agenda()
+    secao = secao or id_agendamento
     if not id_agendamento:
-        st.error("Erro interno: ID do agendamento não fornecido para a ação.")
+        registrar_mensagem(secao or "agenda_diaria", "error", "Erro interno: ID do agendamento não fornecido para a ação.")
         return
 
-    if acao_admin_agendamento(id_agendamento, acao):
-        st.success(f"Ação '{acao.upper()}' registrada com sucesso!")
+    if acao_admin_agendamento(id_agendamento, acao, st.session_state.clinic_id):
+        st.session_state.acoes_agendamentos.setdefault(id_agendamento, {})['status'] = STATUS_ACOES_ADMIN[acao]
+        registrar_mensagem(secao, "success", f"Ação '{acao.upper()}' registrada com sucesso!")
         # Se estava remarcando este agendamento na tela do cliente, cancela a remarcação
         if st.session_state.remarcando_cliente_ag_id == id_agendamento:
             handle_cancelar_remarcacao_cliente(id_agendamento)
-        st.rerun() # Atualiza a UI
     else:
-        st.error("Falha ao registrar a ação no sistema.")
+        registrar_mensagem(secao, "error", "Falha ao registrar a ação no sistema.")
 
 
 def entrar_modo_edicao(prof_id):
@@ -701,6 +983,45 @@ def handle_add_turma():
     else:
         st.error("Ocorreu um erro ao criar a turma.")
 
+def handle_matricula_turma(turmas_clinica: list, servicos_clinica: list):
+    """Matricula um cliente em todas as aulas de uma turma no período escolhido (gravação em lote)."""
+    invalidar_visoes_agenda()
+    clinic_id = st.session_state.clinic_id
+    turma = next((t for t in turmas_clinica if t.get('id') == st.session_state.get('matricula_turma_id')), None)
+    cliente = buscar_clientes_por_ids(clinic_id, [st.session_state.get('matricula_cliente_id')]).get(st.session_state.get('matricula_cliente_id'))
+    periodo = st.session_state.get('matricula_periodo')
+    if not turma or not cliente or not isinstance(periodo, (list, tuple)) or len(periodo) != 2:
+        st.warning("Selecione a turma, o cliente e o período (data inicial e final).")
+        return
+
+    servico = next((s for s in servicos_clinica if s.get('id') == turma.get('servico_id')), None)
+    pacote = None
+    if st.session_state.get('matricula_usar_pacote'):
+        pacotes = buscar_pacotes_validos_cliente(clinic_id, cliente['id'], turma.get('servico_id'))
+        pacote = pacotes[0] if pacotes else None
+
+    resultado = matricular_cliente_em_turma(
+        clinic_id,
+        turma,
+        cliente['id'],
+        cliente.get('nome', 'N/A'),
+        cliente.get('telefone', ''),
+        periodo[0],
+        periodo[1],
+        duracao_min=servico.get('duracao_min', 60) if servico else 60,
+        pacote_cliente_id=pacote['id'] if pacote else None,
+        creditos_pacote=pacote.get('creditos_restantes') if pacote else None
+    )
+    resultado['turma_nome'] = turma.get('nome', 'N/A')
+    resultado['cliente_nome'] = cliente.get('nome', 'N/A')
+    resultado['sem_pacote'] = bool(st.session_state.get('matricula_usar_pacote')) and not pacote
+    st.session_state.resultado_matricula_turma = resultado
+
+def handle_recalcular_vagas_turmas():
+    """Recalcula os contadores de vagas ocupadas das aulas futuras a partir dos agendamentos confirmados."""
+    total = reconstruir_ocupacao_turmas(st.session_state.clinic_id)
+    st.success(f"Vagas ocupadas recalculadas para {total} aulas.")
+
 def handle_update_turma(turma_id: str):
     """Salva as alterações de uma turma existente."""
     clinic_id = st.session_state.clinic_id
@@ -741,6 +1062,18 @@ def handle_remove_profissional(clinic_id: str, prof_id: str):
     else:
         st.error("Erro ao remover profissional. Verifique os logs.")
 
+def handle_busca_clientes():
+    """Nova busca na aba de clientes: volta para a primeira página."""
+    st.session_state.clientes_pagina_cursores = [None]
+
+def handle_pagina_clientes(cursor_proximo: tuple = None):
+    """Avança para a página que começa após `cursor_proximo`, ou volta uma página se não for informado."""
+    cursores = st.session_state.clientes_pagina_cursores
+    if cursor_proximo:
+        cursores.append(cursor_proximo)
+    elif len(cursores) > 1:
+        cursores.pop()
+
 def handle_remove_cliente(clinic_id: str, cliente_id: str):
     if db_remover_cliente(clinic_id, cliente_id):
         st.success("Cliente removido com sucesso!")
@@ -814,16 +1147,14 @@ def handle_associar_pacote_cliente(cliente_id: str):
     pacote_modelo_id = st.session_state.get(f"pacote_assoc_select_{cliente_id}")
 
     if not pacote_modelo_id:
-        st.warning("Selecione um pacote para associar.")
+        registrar_mensagem(f"cliente_{cliente_id}", "warning", "Selecione um pacote para associar.")
         return
 
     # A lógica de cálculo de data e créditos está em `logica_negocio.associar_pacote_cliente`
+    # (a seção do cliente é re-executada em seguida e relê os pacotes)
     sucesso, msg = associar_pacote_cliente(clinic_id, cliente_id, pacote_modelo_id)
-    if sucesso:
-        st.success(msg)
-        st.rerun() # Atualiza a lista de pacotes do cliente
-    else:
-        st.error(msg)
+    st.session_state.detalhes_clientes_cache.pop(cliente_id, None)
+    registrar_mensagem(f"cliente_{cliente_id}", "success" if sucesso else "error", msg)
 
 
 # Handlers para Remarcação na tela de Cliente
@@ -833,7 +1164,6 @@ def handle_iniciar_remarcacao_cliente(agendamento: dict):
     if not ag_id: return # Segurança
 
     st.session_state.remarcando_cliente_ag_id = ag_id
-    st.session_state.remarcacao_cliente_status[ag_id] = {} # Limpa status anterior
 
     # Define a data inicial do formulário como a data atual do agendamento
     data_atual = date.today() # Padrão
@@ -849,21 +1179,20 @@ def handle_iniciar_remarcacao_cliente(agendamento: dict):
     # Limpa a hora selecionada anteriormente para este agendamento
     if ag_id in st.session_state.remarcacao_cliente_form_hora:
         del st.session_state.remarcacao_cliente_form_hora[ag_id]
-
-    st.rerun() # Força rerender para mostrar o formulário
+    # A seção do cliente é re-executada em seguida e mostra o formulário
 
 def handle_cancelar_remarcacao_cliente(ag_id: str):
     """Esconde o formulário de remarcação."""
     if st.session_state.remarcando_cliente_ag_id == ag_id:
         st.session_state.remarcando_cliente_ag_id = None
-        st.session_state.remarcacao_cliente_status[ag_id] = {} # Limpa status
-        st.rerun() # Força rerender para esconder o formulário
 
 def handle_confirmar_remarcacao_cliente(agendamento: dict):
-    """Processa a remarcação a partir da tela do cliente."""
+    """Processa a remarcação a partir da tela do cliente (o resultado aparece no topo da seção do cliente)."""
+    invalidar_visoes_agenda()
     ag_id = agendamento.get('id')
+    secao = f"cliente_{agendamento.get('cliente_id')}"
     if not ag_id:
-        st.error("Erro interno: ID do agendamento inválido.")
+        registrar_mensagem(secao, "error", "Erro interno: ID do agendamento inválido.")
         return
 
     nova_data = st.session_state.remarcacao_cliente_form_data.get(ag_id)
@@ -871,8 +1200,7 @@ def handle_confirmar_remarcacao_cliente(agendamento: dict):
 
     # Verifica se data e hora foram selecionadas
     if not isinstance(nova_hora, time) or not isinstance(nova_data, date):
-        st.session_state.remarcacao_cliente_status[ag_id] = {'sucesso': False, 'mensagem': "Selecione uma data e um horário válidos."}
-        st.rerun()
+        registrar_mensagem(secao, "error", "Selecione uma data e um horário válidos.")
         return
 
     novo_horario_naive = datetime.combine(nova_data, nova_hora)
@@ -880,34 +1208,17 @@ def handle_confirmar_remarcacao_cliente(agendamento: dict):
 
     clinic_id = agendamento.get('clinic_id')
     profissional_nome = agendamento.get('profissional_nome')
-    duracao = agendamento.get('duracao_min', 30)
 
     # Verifica se os dados necessários estão presentes
-    if not all([clinic_id, profissional_nome, duracao]):
-        st.session_state.remarcacao_cliente_status[ag_id] = {'sucesso': False, 'mensagem': "Erro interno: Dados do agendamento incompletos."}
-        st.rerun()
+    if not all([clinic_id, profissional_nome]):
+        registrar_mensagem(secao, "error", "Erro interno: Dados do agendamento incompletos.")
         return
 
-    # Verifica disponibilidade
-    disponivel, msg = verificar_disponibilidade_com_duracao(
-        clinic_id,
-        profissional_nome,
-        novo_horario_local,
-        duracao,
-        agendamento_id_excluir=ag_id # Exclui o próprio agendamento da verificação
-    )
-
-    if not disponivel:
-        st.session_state.remarcacao_cliente_status[ag_id] = {'sucesso': False, 'mensagem': msg}
-    else:
-        # Tenta atualizar no banco de dados
-        if atualizar_horario_agendamento(ag_id, novo_horario_local):
-            st.session_state.remarcacao_cliente_status[ag_id] = {'sucesso': True, 'mensagem': "Remarcado com sucesso!"}
-            st.session_state.remarcando_cliente_ag_id = None # Esconde o formulário
-        else:
-            st.session_state.remarcacao_cliente_status[ag_id] = {'sucesso': False, 'mensagem': "Erro ao salvar no banco de dados."}
-
-    st.rerun() # Atualiza a UI
+    # Mesmo fluxo da página do PIN: relê o agendamento na coleção da clínica, verifica a disponibilidade e grava
+    sucesso, mensagem = processar_remarcacao(agendamento.get('pin_code'), ag_id, profissional_nome, novo_horario_local, clinic_id)
+    registrar_mensagem(secao, "success" if sucesso else "error", mensagem)
+    if sucesso:
+        st.session_state.remarcando_cliente_ag_id = None # Esconde o formulário
 
 
 # --- RENDERIZAÇÃO DAS PÁGINAS ---
@@ -998,7 +1309,7 @@ def render_agendamento_seguro():
             st.form_submit_button(
                 "✅ Confirmar Remarcação",
                 on_click=handle_remarcar_confirmacao,
-                args=(pin, ag_id, agendamento.get('profissional_nome')), # Passa os args corretos
+                args=(pin, ag_id, agendamento.get('profissional_nome'), agendamento.get('clinic_id')), # Passa os args corretos
                 disabled=not pode_remarcar
             )
 
@@ -1055,6 +1366,28 @@ def render_gerenciar_pacotes(servicos_clinica):
 
             st.form_submit_button("Criar Pacote", on_click=handle_add_pacote_modelo)
 
+    resumo = buscar_resumo_pacotes(st.session_state.clinic_id)
+    if resumo:
+        st.divider()
+        st.subheader("Resumo dos Pacotes Vendidos")
+        r1, r2, r3, r4 = st.columns(4)
+        r1.metric("Ativos", resumo.get('ativos', 0))
+        r2.metric(f"Vencem em {resumo.get('dias_aviso', 7)} dias", resumo.get('expirando', 0))
+        r3.metric("Expirados", resumo.get('expirados', 0))
+        r4.metric("Esgotados", resumo.get('esgotados', 0))
+        if resumo.get('pacotes_expirando'):
+            clientes_resumo = buscar_clientes_por_ids(st.session_state.clinic_id, [p.get('cliente_id') for p in resumo['pacotes_expirando']])
+            nomes_clientes = {cliente_id: c.get('nome', 'N/A') for cliente_id, c in clientes_resumo.items()}
+            with st.expander("Pacotes perto do vencimento"):
+                st.dataframe(pd.DataFrame([{
+                    "Cliente": nomes_clientes.get(p.get('cliente_id'), 'Cliente Removido'),
+                    "Pacote": p.get('nome_pacote', 'Pacote'),
+                    "Créditos": p.get('creditos_restantes', 0),
+                    "Expira em": p['data_expiracao'].strftime('%d/%m/%Y') if isinstance(p.get('data_expiracao'), datetime) else 'N/A'
+                } for p in resumo['pacotes_expirando']]), use_container_width=True, hide_index=True)
+        if isinstance(resumo.get('atualizado_em'), datetime):
+            st.caption(f"Atualizado em {resumo['atualizado_em'].strftime('%d/%m/%Y %H:%M')}.")
+
     st.divider()
     st.subheader("Modelos de Pacotes Existentes")
     modelos_pacotes = listar_pacotes_modelos(st.session_state.clinic_id)
@@ -1080,6 +1413,705 @@ def render_gerenciar_pacotes(servicos_clinica):
                 st.button("Remover", key=f"del_pacote_{pacote_id}", on_click=handle_remove_pacote_modelo, args=(st.session_state.clinic_id, pacote_id))
 
 
+@st.fragment
+def render_formulario_agendamento(clinic_id, profissionais_clinica, servicos_clinica, turmas_clinica):
+    """
+    Formulário de agendamento e confirmação. Como fragmento, trocar cliente, serviço, data ou hora
+    re-executa só o formulário; a confirmação do agendamento re-executa a página (a agenda muda).
+    """
+    # Se estiver confirmando um agendamento, mostra o diálogo de confirmação
+    if st.session_state.get('confirmando_agendamento', False):
+        st.subheader("Revisar e Confirmar Agendamento")
+        detalhes = st.session_state.detalhes_agendamento
+        # Mostra detalhes do agendamento
+        st.write(f"**Cliente:** {detalhes.get('cliente','N/A')}")
+        st.write(f"**Telefone:** {detalhes.get('telefone','N/A')}")
+        st.write(f"**Profissional:** {detalhes.get('profissional','N/A')}")
+        st.write(f"**Serviço:** {detalhes.get('servico','N/A')}")
+        data_ag = detalhes.get('data')
+        hora_ag = detalhes.get('hora')
+        data_str = data_ag.strftime('%d/%m/%Y') if isinstance(data_ag, date) else "Data Inválida"
+        hora_str = hora_ag.strftime('%H:%M') if isinstance(hora_ag, time) else "Hora Inválida"
+        st.write(f"**Data:** {data_str}")
+        st.write(f"**Horário:** {hora_str}")
+
+        if detalhes.get('turma_id'):
+            st.write("**Modalidade:** Em Grupo / Turma")
+        if detalhes.get('recorrencia'):
+            rec = detalhes['recorrencia']
+            frequencia = "quinzenal" if rec['intervalo_semanas'] == 2 else "semanal"
+            fim = f"até {rec['data_fim'].strftime('%d/%m/%Y')}" if rec.get('data_fim') else f"{rec['ocorrencias']} sessões"
+            st.write(f"**Recorrência:** {frequencia}, {fim}")
+        # Mostra info sobre débito de pacote
+        if detalhes.get('pacote_info_msg'):
+            st.info(detalhes['pacote_info_msg'])
+
+        # Botões de Confirmar/Voltar
+        c1, c2 = st.columns(2)
+        if c1.button("✅ Confirmar Agendamento", type="primary"):
+            handle_agendamento_submission()
+        c2.button("❌ Voltar", on_click=handle_voltar_agendamento)
+
+    # Se não estiver confirmando, mostra o formulário de agendamento
+    elif not profissionais_clinica or not servicos_clinica:
+        st.warning("É necessário ter ao menos um profissional e um serviço cadastrado para realizar agendamentos.")
+    else:
+        # Exibe mensagens de sucesso/erro do último agendamento
+        if st.session_state.get('last_agendamento_info'):
+            info = st.session_state.last_agendamento_info
+            if info.get('status') is True:
+                st.success(f"Agendado para {info.get('cliente')} com sucesso!")
+                st.markdown(f"**LINK DE GESTÃO:** `{info.get('link_gestao', 'N/A')}` (PIN: **{info.get('pin_code', 'N/A')}**)")
+                if info.get('serie_criados'):
+                    st.info(f"Série recorrente: {info['serie_criados']} sessões agendadas (cada sessão tem seu próprio PIN).")
+                if info.get('serie_falhas'):
+                    st.warning("Datas não agendadas: " + "; ".join(f"{f['data'].strftime('%d/%m/%Y')} ({f['motivo']})" for f in info['serie_falhas']))
+            else:
+                st.error(f"Erro ao agendar para {info.get('cliente', 'cliente não informado')}: {info.get('status', 'Erro desconhecido')}")
+            st.session_state.last_agendamento_info = None # Limpa a mensagem
+        exibir_mensagens("formulario_agendamento")
+
+        # --- Formulário de Agendamento ---
+        st.subheader("1. Selecione o Cliente")
+        busca_cliente = st.text_input("Buscar cliente (início do nome)", key="agenda_cliente_busca")
+        pagina_clientes = listar_clientes_pagina(clinic_id, prefixo_nome=busca_cliente)
+        opcoes_clientes = ["Novo Cliente"] + [c.get('nome','Nome Inválido') for c in pagina_clientes['clientes']]
+        # Mantém o cliente já escolhido entre as opções quando a busca muda
+        if st.session_state.agenda_cliente_select not in opcoes_clientes:
+            opcoes_clientes.insert(1, st.session_state.agenda_cliente_select)
+        st.selectbox("Cliente:", options=opcoes_clientes, key="agenda_cliente_select", on_change=handle_selecao_cliente)
+        if pagina_clientes['cursor_proximo']:
+            st.caption(f"Mostrando os primeiros {len(pagina_clientes['clientes'])} clientes; refine a busca para encontrar outros.")
+
+        # Mensagem sobre pacotes (lista preenchida por `handle_verificar_pacotes` no on_change do cliente e serviço)
+        if st.session_state.pacotes_validos_cliente:
+            pacote = st.session_state.pacotes_validos_cliente[0] # Pega o primeiro pacote válido
+            expiracao_str = pacote['data_expiracao'].strftime('%d/%m/%Y') if isinstance(pacote.get('data_expiracao'), datetime) else "Data Inválida"
+            st.info(f"ℹ️ Cliente possui Pacote '{pacote.get('nome_pacote','N/A')}' com {pacote.get('creditos_restantes','N/A')}/{pacote.get('creditos_total','N/A')} créditos (válido até {expiracao_str}).")
+
+
+        st.subheader("2. Preencha os Detalhes do Agendamento")
+
+        # Inputs para Nome (se novo cliente) e Telefone
+        if st.session_state.agenda_cliente_select == "Novo Cliente":
+            col_nome, col_tel = st.columns(2)
+            col_nome.text_input("Nome do Novo Cliente", key="c_nome_novo_cliente_input")
+            col_tel.text_input("Telefone", key="c_tel_input")
+        else:
+            st.markdown(f"**Agendando para:** {st.session_state.agenda_cliente_select}")
+            st.text_input("Telefone (edite se necessário)", key="c_tel_input")
+
+        st.divider()
+
+        # Inputs para Profissional, Data, Serviço, Hora/Turma
+        form_cols = st.columns(3)
+        # Data Input (sempre visível)
+        form_cols[1].date_input("Data:", key="form_data_selecionada", min_value=date.today())
+        # Serviço Selectbox (sempre visível)
+        servico_selecionado_nome = form_cols[2].selectbox(
+            "Serviço:",
+            [s.get('nome','Serviço Inválido') for s in servicos_clinica],
+            key="c_servico_input",
+            on_change=handle_verificar_pacotes # Verifica pacotes quando o serviço muda
+        )
+
+        # Contexto do dia: compartilhado com a verificação e a submissão deste agendamento
+        contexto_dia = obter_contexto_dia(st.session_state.form_data_selecionada, servicos_clinica)
+
+        # Busca dados do serviço selecionado
+        servico_data = contexto_dia.servico(servico_selecionado_nome)
+
+        pode_agendar = False # Flag para habilitar o botão de agendar
+
+        if servico_data:
+            tipo_servico = servico_data.get('tipo', 'Individual')
+            duracao_servico = servico_data.get('duracao_min', 30)
+
+            # Lógica para Serviço "Em Grupo"
+            if tipo_servico == 'Em Grupo':
+                turmas_disponiveis = gerar_turmas_disponiveis(
+                    clinic_id,
+                    st.session_state.form_data_selecionada,
+                    turmas_clinica, # Lista já populada com nomes
+                )
+
+                # Cria dicionário {Label: (turma_id, horario_obj)} para o selectbox
+                opcoes_turmas = {
+                    f"{t.get('horario_str','HH:MM')} - {t.get('nome','Turma Inválida')} ({t.get('profissional_nome','N/A')}) - {t.get('vagas_ocupadas',0)}/{t.get('capacidade_maxima',0)} vagas":
+                    (t.get('id'), t.get('horario_obj'))
+                    for t in turmas_disponiveis
+                }
+
+                profissional_nome_turma = "-- (Selecione uma turma) --"
+
+                # Selectbox de Turma
+                if opcoes_turmas:
+                    selecao_label = form_cols[1].selectbox(
+                        "Turma:",
+                        options=list(opcoes_turmas.keys()), # Garante que é uma lista
+                        key="c_hora_input_raw" # Chave diferente para o label
+                    )
+                    # Guarda a tupla (id, time_obj) no estado
+                    st.session_state.c_hora_input = opcoes_turmas.get(selecao_label)
+
+                    # Busca nome do profissional da turma selecionada
+                    if st.session_state.c_hora_input:
+                        turma_id_selecionado = st.session_state.c_hora_input[0]
+                        turma_selecionada_obj = next((t for t in turmas_clinica if t.get('id') == turma_id_selecionado), None)
+                        if turma_selecionada_obj:
+                            profissional_nome_turma = turma_selecionada_obj.get('profissional_nome', 'N/A')
+                    pode_agendar = True # Pode agendar se houver turmas
+                else:
+                    # Mostra mensagem se não houver turmas
+                    if turmas_clinica: # Havia turmas, mas sem vagas ou não neste dia
+                         form_cols[1].selectbox("Turma:", options=["Nenhuma turma com vagas disponíveis"], key="c_hora_input", disabled=True)
+                    else: # Não havia turmas nesse dia/horário
+                         form_cols[1].selectbox("Turma:", options=["Nenhuma turma disponível para este dia"], key="c_hora_input", disabled=True)
+                    st.session_state.c_hora_input = None # Garante que o horário está limpo
+                    pode_agendar = False
+
+                # Input (desabilitado) para mostrar o profissional da turma
+                form_cols[0].text_input("Profissional:", value=profissional_nome_turma, disabled=True, key="c_prof_input_turma_display")
+                st.session_state.c_prof_input = profissional_nome_turma # Guarda o nome para salvar
+
+            # Lógica para Serviço "Individual"
+            else:
+                # Selectbox de Profissional (com opção "Qualquer profissional")
+                prof_selecionado_nome = form_cols[0].selectbox(
+                    "Profissional:",
+                    [OPCAO_QUALQUER_PROFISSIONAL] + [p.get('nome','Prof. Inválido') for p in profissionais_clinica],
+                    key="c_prof_input"
+                )
+                if prof_selecionado_nome == OPCAO_QUALQUER_PROFISSIONAL:
+                    # União dos horários livres de todos os profissionais (uma consulta para o dia)
+                    horarios_clinica = gerar_horarios_disponiveis_clinica(
+                        clinic_id,
+                        st.session_state.form_data_selecionada,
+                        duracao_servico
+                    )
+                    st.session_state.profissionais_por_horario = {h['hora']: h['profissionais'] for h in horarios_clinica}
+                    horarios_disponiveis = [h['hora'] for h in horarios_clinica]
+                    formatar_hora = lambda t: f"{t.strftime('%H:%M')} ({len(st.session_state.profissionais_por_horario.get(t, []))} prof.)" if isinstance(t, time) else "Inválido"
+                else:
+                    # Gera horários disponíveis
+                    horarios_disponiveis = gerar_horarios_disponiveis(
+                        clinic_id,
+                        prof_selecionado_nome, # Usa o nome selecionado
+                        st.session_state.form_data_selecionada,
+                        duracao_servico,
+                        contexto=contexto_dia
+                    )
+                    formatar_hora = lambda t: t.strftime('%H:%M') if isinstance(t, time) else "Inválido"
+                # Selectbox de Hora
+                if horarios_disponiveis:
+                    hora_selecionada = form_cols[1].selectbox(
+                        "Hora:",
+                        options=horarios_disponiveis,
+                        key="c_hora_input", # Guarda o time object
+                        format_func=formatar_hora
+                    )
+                    if prof_selecionado_nome == OPCAO_QUALQUER_PROFISSIONAL and isinstance(hora_selecionada, time):
+                        st.caption("Livres neste horário: " + ", ".join(st.session_state.profissionais_por_horario.get(hora_selecionada, [])))
+                    pode_agendar = True
+                else:
+                    form_cols[1].selectbox("Hora:", options=["Nenhum horário disponível"], key="c_hora_input", disabled=True)
+                    pode_agendar = False
+
+                # Busca do próximo horário livre (evita clicar data a data)
+                with st.expander("🔎 Próximos horários livres"):
+                    busca_cols = st.columns([0.4, 0.3, 0.3])
+                    busca_cols[0].checkbox("Todos os profissionais", key="proximos_todos_profissionais")
+                    busca_cols[1].number_input("Dias à frente", min_value=1, max_value=60, value=14, step=1, key="proximos_dias")
+                    busca_cols[2].button(
+                        "Buscar",
+                        key="btn_buscar_proximos",
+                        on_click=handle_buscar_proximos_horarios,
+                        args=(servico_selecionado_nome, duracao_servico)
+                    )
+
+                    resultado_busca = st.session_state.proximos_horarios
+                    if resultado_busca and resultado_busca.get('servico') == servico_selecionado_nome:
+                        if not resultado_busca.get('opcoes'):
+                            st.info("Nenhum horário livre encontrado no período.")
+                        for i, opcao in enumerate(resultado_busca.get('opcoes', [])):
+                            rotulo = f"{DIAS_SEMANA_LISTA[opcao['data'].weekday()]} {opcao['data'].strftime('%d/%m')} às {opcao['hora'].strftime('%H:%M')} - {opcao['profissional_nome']}"
+                            st.button(rotulo, key=f"usar_proximo_{i}", on_click=handle_usar_proximo_horario, args=(opcao,))
+
+                # Série recorrente (planos semanais)
+                with st.expander("🔁 Repetir (série recorrente)"):
+                    st.checkbox("Criar série recorrente a partir desta data", key="serie_ativa")
+                    serie_cols = st.columns(3)
+                    serie_cols[0].radio("Frequência", ["Semanal", "Quinzenal"], key="serie_frequencia")
+                    serie_cols[1].radio("Terminar", ["Nº de sessões", "Até a data"], key="serie_modo_fim")
+                    if st.session_state.get('serie_modo_fim') == "Até a data":
+                        serie_cols[2].date_input("Última data", key="serie_data_fim", min_value=st.session_state.form_data_selecionada, value=st.session_state.form_data_selecionada + timedelta(weeks=8))
+                    else:
+                        serie_cols[2].number_input("Sessões", min_value=2, max_value=52, value=4, step=1, key="serie_ocorrencias")
+
+        # Botão de Agendar (habilitado/desabilitado pela flag pode_agendar)
+        st.button("AGENDAR NOVA SESSÃO", type="primary", disabled=not pode_agendar, on_click=handle_pre_agendamento)
+
+
+@st.fragment
+def render_linha_agendamento(row: dict, profissionais_nomes: list):
+    """Linha de um atendimento individual da agenda diária; as ações re-executam só esta linha."""
+    ag_id = row.get('id', f"NO_ID_{row.get('cliente')}") # Usa ID ou fallback
+    # Alterações feitas pelas ações desta linha (a linha é re-executada sem recarregar o dia)
+    row = {**row, **st.session_state.acoes_agendamentos.get(ag_id, {})}
+    horario_ag = row.get('horario')
+    horario_ag_str = horario_ag.strftime('%H:%M') if isinstance(horario_ag, datetime) else "HH:MM"
+    profissional_nome = row.get('profissional_nome', 'N/A') # Nome do profissional atual
+
+    # Agendamento já finalizado/cancelado nesta linha: mostra só o resultado
+    if row.get('status', 'Confirmado') != 'Confirmado':
+        st.session_state.agendamentos_selecionados.pop(ag_id, None)
+        st.write(f"~~{row.get('cliente','N/A')}~~ - {profissional_nome} - {horario_ag_str} · **{row['status']}**")
+        exibir_mensagens(ag_id)
+        return
+
+    # Layout das colunas para cada agendamento
+    # Ajustado para 6 colunas para incluir o botão de Troca (Shift)
+    data_cols = st.columns([0.1, 0.35, 0.25, 0.3]) 
+
+    # Checkbox de seleção (coluna 0)
+    selecionado = data_cols[0].checkbox(" ", key=f"select_{ag_id}", label_visibility="collapsed")
+    st.session_state.agendamentos_selecionados[ag_id] = selecionado
+
+    # Info Cliente/Serviço (coluna 1)
+    data_cols[1].write(f"**{row.get('cliente','N/A')}**<br><small>{row.get('servico_nome', 'N/A')}</small>", unsafe_allow_html=True)
+    # Info Profissional/Hora (coluna 2)
+    data_cols[2].write(f"{profissional_nome} - {horario_ag_str}")
+
+    # Botões de Ação (coluna 3)
+    with data_cols[3]:
+        # 6 colunas internas para os botões de ação e a troca
+        action_cols = st.columns(6) 
+
+        # Popover Detalhes (ℹ️)
+        detalhes_popover = action_cols[0].popover("ℹ️", help="Ver Detalhes")
+        with detalhes_popover:
+            pin = row.get('pin_code', 'N/A')
+            link = f"https://agendafit.streamlit.app?pin={pin}" if pin != 'N/A' else 'N/A'
+            st.markdown(f"**Serviço:** {row.get('servico_nome', 'N/A')}")
+            st.markdown(f"**Telefone:** {row.get('telefone', 'N/A')}")
+            st.markdown(f"**Profissional:** {profissional_nome}")
+            st.markdown(f"**PIN:** `{pin}`")
+            st.markdown(f"**Link:** `{link}`")
+            if pd.notna(row.get('pacote_cliente_id')):
+                st.markdown("**Usou Pacote:** Sim")
+            serie_id = row.get('serie_id')
+            if isinstance(serie_id, str) and serie_id:
+                data_ag = horario_ag.date() if isinstance(horario_ag, datetime) else st.session_state.filter_data_selecionada
+                st.markdown("**Série recorrente:** Sim")
+                st.time_input("Novo horário da série", key=f"serie_nova_hora_{ag_id}", value=horario_ag.time() if isinstance(horario_ag, datetime) else None, step=900)
+                # A série muda outras linhas e datas: recarrega a página inteira
+                if st.button("Alterar série a partir desta data", key=f"alterar_serie_{ag_id}"):
+                    handle_alterar_serie(serie_id, data_ag, ag_id)
+                    st.rerun()
+                if st.button("Cancelar série a partir desta data", key=f"cancelar_serie_{ag_id}"):
+                    handle_cancelar_serie(serie_id, data_ag)
+                    st.rerun()
+
+        # Popover WPP (💬): a mensagem só é montada com o popover aberto (re-executa a linha ao abrir)
+        wpp_popover = action_cols[1].popover("💬", help="Gerar Mensagem WhatsApp", key=f"wpp_popover_{ag_id}", on_change="rerun")
+        if wpp_popover.open:
+            with wpp_popover:
+                pin = row.get('pin_code', 'N/A')
+                link_gestao = f"https://agendafit.streamlit.app?pin={pin}" if pin != 'N/A' else 'N/A'
+                horario_str_msg = horario_ag.strftime('%d/%m/%Y às %H:%M') if isinstance(horario_ag, datetime) else "Data/Hora Inválida"
+                mensagem = (
+                    f"Olá, {row.get('cliente','Cliente')}! Tudo bem?\n\n"
+                    f"Este é um lembrete do seu agendamento na {st.session_state.clinic_name} com o(a) profissional {profissional_nome} "
+                    f"no dia {horario_str_msg}.\n\n"
+                    f"Para confirmar, remarcar ou cancelar, por favor, use este link: {link_gestao}"
+                )
+                st.text_area("Mensagem:", value=mensagem, height=200, key=f"wpp_msg_{ag_id}")
+                st.write("Copie a mensagem acima e envie para o cliente.")
+
+        # Botões de Ação Direta
+        action_cols[2].button("✅", key=f"finish_{ag_id}", on_click=handle_admin_action, args=(ag_id, "finalizar"), help="Sessão Concluída")
+        action_cols[3].button("🚫", key=f"noshow_{ag_id}", on_click=handle_admin_action, args=(ag_id, "no-show"), help="Marcar Falta")
+        action_cols[4].button("❌", key=f"cancel_{ag_id}", on_click=handle_admin_action, args=(ag_id, "cancelar"), help="Cancelar Agendamento")
+
+        # Botão de Troca de Profissional (Transferência) - SÓ PARA INDIVIDUAIS
+        troca_popover = action_cols[5].popover("🔄", help="Trocar Profissional")
+        with troca_popover:
+            st.write(f"Trocar profissional de **{row.get('cliente','N/A')}**")
+            st.selectbox(
+                "Novo Profissional:",
+                options=[p for p in profissionais_nomes if p != profissional_nome], # Exclui o atual
+                key=f"troca_prof_select_{ag_id}"
+            )
+            st.button("Confirmar Troca", key=f"troca_btn_{ag_id}", type="primary", on_click=handle_troca_profissional, args=(ag_id, profissional_nome))
+
+    exibir_mensagens(ag_id)
+    # Mostra se usou pacote abaixo do agendamento
+    if row.get('pacote_cliente_id'):
+        st.caption("💳 Agendamento via Pacote")
+
+MODOS_AGENDA_DIARIA = ["Lista", "Tabela"]
+# Acima disso a lista (widgets e popovers por linha) fica lenta: o dia abre em modo tabela
+LIMITE_LINHAS_MODO_LISTA = 30
+
+@st.fragment
+def render_tabela_agenda(agendamentos_individuais: list, profissionais_nomes: list):
+    """
+    Atendimentos do dia numa única tabela com seleção de linhas. As ações valem para as linhas
+    selecionadas; detalhes, mensagem e troca de profissional são montados só para a linha aberta.
+    As ações em lote re-executam só a tabela, que por isso exibe as mensagens da agenda diária.
+    """
+    exibir_mensagens("agenda_diaria")
+    linhas = []
+    for row in agendamentos_individuais:
+        row = {**row, **st.session_state.acoes_agendamentos.get(row.get('id'), {})}
+        horario_ag = row.get('horario')
+        serie_id = row.get('serie_id')
+        linhas.append({
+            "Hora": horario_ag.strftime('%H:%M') if isinstance(horario_ag, datetime) else "HH:MM",
+            "Cliente": row.get('cliente', 'N/A'),
+            "Serviço": row.get('servico_nome', 'N/A'),
+            "Profissional": row.get('profissional_nome', 'N/A'),
+            "Telefone": row.get('telefone', 'N/A'),
+            "Status": row.get('status', 'Confirmado'),
+            "Pacote": "💳" if isinstance(row.get('pacote_cliente_id'), str) and row.get('pacote_cliente_id') else "",
+            "Série": "🔁" if isinstance(serie_id, str) and serie_id else "",
+        })
+
+    evento = st.dataframe(
+        pd.DataFrame(linhas),
+        hide_index=True,
+        use_container_width=True,
+        on_select="rerun",
+        selection_mode="multi-row",
+        key=f"agenda_tabela_{st.session_state.agenda_tabela_versao}"
+    )
+    selecionados = [agendamentos_individuais[i] for i in evento.selection.rows if i < len(agendamentos_individuais)]
+    ids_selecionados = [row.get('id') for row in selecionados if row.get('id')]
+
+    acoes_cols = st.columns([0.25, 0.25, 0.25, 0.25])
+    acoes_cols[0].caption(f"{len(ids_selecionados)} selecionado(s)")
+    acoes_cols[1].button("✅ Finalizar", key="tabela_finalizar", on_click=handle_acao_tabela_agenda, args=("finalizar", ids_selecionados), disabled=not ids_selecionados)
+    acoes_cols[2].button("🚫 Marcar Falta", key="tabela_noshow", on_click=handle_acao_tabela_agenda, args=("no-show", ids_selecionados), disabled=not ids_selecionados)
+    acoes_cols[3].button("❌ Cancelar", key="tabela_cancelar", on_click=handle_acao_tabela_agenda, args=("cancelar", ids_selecionados), disabled=not ids_selecionados)
+
+    if len(selecionados) == 1:
+        st.markdown("**Agendamento selecionado**")
+        render_linha_agendamento(selecionados[0], profissionais_nomes)
+    elif selecionados:
+        st.caption("Selecione uma única linha para ver detalhes, mensagem e troca de profissional.")
+
+@st.fragment
+def render_agenda_diaria(clinic_id, turmas_clinica, profissionais_nomes):
+    """Visão diária da agenda. Trocar a data ou cancelar em lote re-executa só a lista."""
+    st.date_input("Filtrar por data:", key='filter_data_selecionada', format="DD/MM/YYYY")
+
+    exibir_mensagens("agenda_diaria")
+
+    def carregar_agenda_do_dia():
+        # Lista nova da base: descarta as alterações locais das linhas (e as mensagens que elas não chegaram a exibir)
+        for ag_id in st.session_state.acoes_agendamentos:
+            st.session_state.mensagens_secoes.pop(ag_id, None)
+        st.session_state.acoes_agendamentos = {}
+        return buscar_agendamentos_por_data(clinic_id, st.session_state.filter_data_selecionada)
+
+    # Busca agendamentos confirmados para a data selecionada
+    agenda_do_dia = obter_visao_agenda(VISOES_AGENDA[0], (clinic_id, st.session_state.filter_data_selecionada), carregar_agenda_do_dia)
+
+    if not agenda_do_dia.empty:
+        # Separa agendamentos de turma e individuais
+        turmas_na_agenda = {}
+        agendamentos_individuais = []
+
+        for _, row_series in agenda_do_dia.iterrows():
+            # Converte Series para dict para facilitar acesso com .get()
+            row = row_series.to_dict()
+
+            # Verifica se é de turma
+            if pd.notna(row.get('turma_id')):
+                turma_id = row['turma_id']
+                # Usa o horário do agendamento (que é datetime) para agrupar
+                horario_ag = row.get('horario')
+                if isinstance(horario_ag, datetime):
+                    horario_key = horario_ag.strftime('%H:%M') # Chave como string HH:MM
+                    key = (turma_id, horario_key) # Chave composta
+
+                    # Se for o primeiro cliente dessa turma/horário, busca infos da turma
+                    if key not in turmas_na_agenda:
+                        turma_info = next((t for t in turmas_clinica if t.get('id') == turma_id), None)
+                        turmas_na_agenda[key] = {
+                            'nome_turma': turma_info.get('nome', 'Turma Removida') if turma_info else 'Turma Removida',
+                            'profissional_nome': turma_info.get('profissional_nome', 'N/A') if turma_info else 'N/A',
+                            'horario': horario_ag, # Guarda o datetime original
+                            'capacidade': turma_info.get('capacidade_maxima', 'N/A') if turma_info else 'N/A',
+                            'clientes': []
+                        }
+                    # Adiciona o cliente (como dict) à lista da turma
+                    turmas_na_agenda[key]['clientes'].append(row)
+                else:
+                    print(f"WARN: Agendamento de turma ID {row.get('id')} sem horário válido.", file=sys.stderr)
+            else:
+                # Adiciona agendamento individual (como dict) à lista
+                agendamentos_individuais.append(row)
+
+        # Renderiza Turmas (se houver)
+        if turmas_na_agenda:
+            st.subheader("Aulas em Grupo")
+            # Ordena as turmas pelo horário
+            for (turma_id, _), turma_data in sorted(turmas_na_agenda.items(), key=lambda item: item[1]['horario']):
+                horario_turma = turma_data['horario']
+                horario_turma_str = horario_turma.strftime('%H:%M') if isinstance(horario_turma, datetime) else "HH:MM"
+                expander_title = f"{horario_turma_str} - {turma_data.get('nome_turma','N/A')} ({turma_data.get('profissional_nome','N/A')}) - {len(turma_data.get('clientes',[]))}/{turma_data.get('capacidade','N/A')} vagas"
+                with st.expander(expander_title):
+                    for cliente_row in turma_data.get('clientes',[]):
+                        # Exibe nome, serviço e telefone do cliente na turma
+                        st.write(f" - {cliente_row.get('cliente','N/A')} ({cliente_row.get('servico_nome', 'N/A')}) (Tel: {cliente_row.get('telefone', 'N/A')})")
+            st.divider()
+
+        # Renderiza Agendamentos Individuais (se houver)
+        if agendamentos_individuais:
+            st.subheader("Atendimentos Individuais")
+            # Ordena agendamentos individuais pelo horário
+            agendamentos_individuais.sort(key=lambda r: r.get('horario', datetime.min.replace(tzinfo=TZ_SAO_PAULO)))
+
+            # Dias cheios abrem em tabela, a menos que o usuário tenha escolhido o modo
+            if not st.session_state.agenda_diaria_modo_manual:
+                st.session_state.agenda_diaria_modo = MODOS_AGENDA_DIARIA[1] if len(agendamentos_individuais) > LIMITE_LINHAS_MODO_LISTA else MODOS_AGENDA_DIARIA[0]
+            modo = st.radio("Exibição", MODOS_AGENDA_DIARIA, key="agenda_diaria_modo", horizontal=True, on_change=handle_modo_agenda_diaria)
+
+            if modo == MODOS_AGENDA_DIARIA[1]:
+                render_tabela_agenda(agendamentos_individuais, profissionais_nomes)
+            else:
+                for row in agendamentos_individuais:
+                    render_linha_agendamento(row, profissionais_nomes)
+
+                # Sempre visível: marcar uma linha re-executa só a linha, não este botão
+                st.button("❌ Cancelar Selecionados", type="primary", on_click=handle_cancelar_selecionados)
+
+    # Mensagem se não houver agendamentos no dia
+    else:
+        st.info(f"Nenhuma consulta confirmada para {st.session_state.filter_data_selecionada.strftime('%d/%m/%Y')}.")
+
+@st.fragment
+def render_detalhes_cliente(clinic_id, cliente_id, modelos_pacotes_map, turmas_map, ids_pagina):
+    """
+    Pacotes e agendamentos futuros de um cliente (montado só com o expander aberto).
+    Associar pacotes e as ações re-executam só esta seção.
+    """
+    st.divider()
+    exibir_mensagens(f"cliente_{cliente_id}")
+    detalhes = obter_detalhes_cliente(clinic_id, cliente_id, ids_pagina)
+    st.subheader("Pacotes do Cliente")
+
+    # Exibe pacotes do cliente
+    pacotes_do_cliente = detalhes['pacotes']
+    if not pacotes_do_cliente:
+        st.info("Cliente não possui pacotes.")
+    else:
+        data_pacotes = [] # Lista para o DataFrame
+        agora = datetime.now(TZ_SAO_PAULO)
+        for p in pacotes_do_cliente:
+            data_exp = p.get('data_expiracao')
+            # Usa o status gravado (tarefa diária e débitos); recalcula só o ausente ou o "Ativo" que venceu desde a tarefa
+            if 'status' not in p or (p['status'] == 'Ativo' and isinstance(data_exp, datetime) and data_exp < agora):
+                p.update(calcular_status_pacote(p, agora))
+            status = p['status'] + (" ⚠️ expira em breve" if p.get('expirando') else "")
+            creditos_rest = p.get('creditos_restantes', 0)
+
+            # Formata dados para o DataFrame
+            data_pacotes.append({
+                "Pacote": p.get('nome_pacote_modelo', 'Nome Indisponível'),
+                "Créditos": f"{creditos_rest} / {p.get('creditos_total','N/A')}",
+                "Expira em": data_exp.strftime('%d/%m/%Y') if isinstance(data_exp, datetime) else 'N/A',
+                "Status": status
+            })
+        # Exibe DataFrame com os pacotes
+        if data_pacotes:
+            st.dataframe(pd.DataFrame(data_pacotes), use_container_width=True, hide_index=True)
+
+
+    # Seção para Associar Novo Pacote
+    st.subheader("Associar Novo Pacote")
+    if not modelos_pacotes_map:
+        st.warning("Nenhum modelo de pacote criado. Crie um na aba '🛍️ Gerenciar Pacotes'.")
+    else:
+        cols_assoc = st.columns([0.7, 0.3])
+        # Selectbox para escolher o modelo de pacote
+        pacote_nome_selecionado = cols_assoc[0].selectbox(
+            "Selecione o Pacote Modelo:",
+            options=[""] + sorted(list(modelos_pacotes_map.keys())), # Ordena nomes
+            key=f"pacote_assoc_select_nome_{cliente_id}", # Chave única por cliente
+            label_visibility="collapsed"
+        )
+        # Guarda o ID do pacote selecionado no estado
+        st.session_state[f"pacote_assoc_select_{cliente_id}"] = modelos_pacotes_map.get(pacote_nome_selecionado)
+
+        # Botão para associar o pacote selecionado
+        cols_assoc[1].button(
+            "Associar Pacote",
+            key=f"btn_assoc_{cliente_id}", # Chave única
+            on_click=handle_associar_pacote_cliente,
+            args=(cliente_id,) # Passa o ID do cliente
+        )
+
+    st.divider()
+    st.subheader("Agendamentos Futuros")
+
+    # Agendamentos futuros do cliente (carregados junto com os pacotes)
+    agendamentos_futuros = detalhes['agendamentos_futuros']
+
+    # Exibe mensagem se não houver agendamentos
+    if not agendamentos_futuros:
+        st.info("Cliente não possui agendamentos futuros confirmados.")
+    else:
+        # Loop para exibir cada agendamento futuro
+        for ag in agendamentos_futuros:
+            ag_id = ag.get('id')
+            if not ag_id: continue # Pula se não houver ID
+
+            horario_ag = ag.get('horario')
+            horario_str = horario_ag.strftime('%d/%m/%Y às %H:%M') if isinstance(horario_ag, datetime) else "Horário Inválido"
+
+            # Determina se é turma ou individual e se pode remarcar
+            if ag.get('turma_id'):
+                tipo_ag = f"Turma: {turmas_map.get(ag['turma_id'], 'N/A')}"
+                pode_remarcar = False
+            else:
+                tipo_ag = f"Serviço: {ag.get('servico_nome', 'N/A')}"
+                pode_remarcar = True # Só pode remarcar individual
+
+            # Layout para infos e botões
+            info_cols, button_cols = st.columns([0.6, 0.4])
+
+            # Exibe informações do agendamento
+            with info_cols:
+                st.write(f"**{horario_str}**")
+                st.write(f"<small>{ag.get('profissional_nome','N/A')} ({tipo_ag})</small>", unsafe_allow_html=True)
+                if ag.get('pacote_cliente_id'):
+                    st.caption("💳 Agendamento via Pacote")
+
+            # Exibe botões de ação
+            with button_cols:
+                num_cols = 6 if pode_remarcar else 5 # 6 botões se puder remarcar
+                action_cols = st.columns(num_cols)
+
+                # Popover Detalhes (ℹ️) - CORRIGIDO: sem 'key'
+                detalhes_popover = action_cols[0].popover("ℹ️", help="Ver Detalhes")
+                with detalhes_popover:
+                    pin = ag.get('pin_code', 'N/A')
+                    link = f"https://agendafit.streamlit.app?pin={pin}" if pin != 'N/A' else 'N/A'
+                    st.markdown(f"**Serviço:** {ag.get('servico_nome', 'N/A')}")
+                    st.markdown(f"**Telefone:** {ag.get('telefone', 'N/A')}")
+                    st.markdown(f"**PIN:** `{pin}`")
+                    st.markdown(f"**Link:** `{link}`")
+                    if pd.notna(ag.get('pacote_cliente_id')):
+                        st.markdown("**Usou Pacote:** Sim")
+
+                # Popover WPP (💬) - CORRIGIDO: sem 'key'
+                wpp_popover = action_cols[1].popover("💬", help="Gerar Mensagem WhatsApp")
+                with wpp_popover:
+                    pin = ag.get('pin_code', 'N/A')
+                    link_gestao = f"https://agendafit.streamlit.app?pin={pin}" if pin != 'N/A' else 'N/A'
+                    horario_str_msg = horario_ag.strftime('%d/%m/%Y às %H:%M') if isinstance(horario_ag, datetime) else "Data/Hora Inválida"
+                    mensagem = (
+                        f"Olá, {ag.get('cliente','Cliente')}! Tudo bem?\n\n"
+                        f"Este é um lembrete do seu agendamento na {st.session_state.clinic_name} com o(a) profissional {ag.get('profissional_nome','N/A')} "
+                        f"no dia {horario_str_msg}.\n\n"
+                        f"Para confirmar, remarcar ou cancelar, por favor, use este link: {link_gestao}"
+                    )
+                    st.text_area("Mensagem:", value=mensagem, height=200, key=f"cl_wpp_msg_{ag_id}") # Key aqui é necessário
+                    st.write("Copie a mensagem acima e envie para o cliente.")
+
+                # Botões de Ação Direta (Finalizar, No-Show, Cancelar)
+                action_cols[2].button("✅", key=f"cl_finish_{ag_id}", on_click=handle_admin_action, args=(ag_id, "finalizar", f"cliente_{cliente_id}"), help="Sessão Concluída")
+                action_cols[3].button("🚫", key=f"cl_noshow_{ag_id}", on_click=handle_admin_action, args=(ag_id, "no-show", f"cliente_{cliente_id}"), help="Marcar Falta")
+                action_cols[4].button("❌", key=f"cl_cancel_{ag_id}", on_click=handle_admin_action, args=(ag_id, "cancelar", f"cliente_{cliente_id}"), help="Cancelar Agendamento")
+
+                # Botão Remarcar (🔄) - Condicional
+                if pode_remarcar:
+                    action_cols[5].button(
+                        "🔄",
+                        key=f"cl_remarcar_{ag_id}",
+                        on_click=handle_iniciar_remarcacao_cliente,
+                        args=(ag,), # Passa o dict do agendamento
+                        help="Remarcar Horário",
+                        # Desabilita se já estiver remarcando este
+                        disabled=(st.session_state.remarcando_cliente_ag_id == ag_id)
+                    )
+
+                # --- Formulário de Remarcação (Condicional) ---
+                # Mostra apenas se o botão Remarcar foi clicado para ESTE agendamento
+                if st.session_state.remarcando_cliente_ag_id == ag_id:
+                    with st.form(key=f"form_remarcacao_cliente_{ag_id}"):
+                        st.write(f"Remarcando agendamento de {horario_str}")
+
+                        # Input Data Remarcação
+                        # Usa o valor do estado ou o padrão (data atual do ag. ou hoje)
+                        data_default_rem = st.session_state.remarcacao_cliente_form_data.get(ag_id, date.today())
+                        nova_data = st.date_input(
+                            "Nova Data",
+                            key=f"rem_data_{ag_id}", # Key única
+                            value=data_default_rem,
+                            min_value=date.today()
+                        )
+                        # Atualiza o estado da data SE ela mudar no input
+                        if nova_data != data_default_rem:
+                            st.session_state.remarcacao_cliente_form_data[ag_id] = nova_data
+                            # Limpa a hora selecionada se a data mudou
+                            if ag_id in st.session_state.remarcacao_cliente_form_hora:
+                                del st.session_state.remarcacao_cliente_form_hora[ag_id]
+
+
+                        # Gera horários disponíveis para a nova data
+                        horarios_disp = gerar_horarios_disponiveis(
+                            clinic_id,
+                            ag.get('profissional_nome','N/A'),
+                            nova_data, # Usa a data do input
+                            ag.get('duracao_min', 30),
+                            agendamento_id_excluir=ag_id # Exclui o próprio agendamento
+                        )
+
+                        # Selectbox Hora Remarcação
+                        hora_selecionada_rem = None
+                        pode_confirmar = False
+                        if horarios_disp:
+                            # Tenta manter a hora selecionada se ainda for válida
+                            hora_atual_rem = st.session_state.remarcacao_cliente_form_hora.get(ag_id)
+                            default_hora_index_rem = 0
+                            if hora_atual_rem in horarios_disp:
+                                try:
+                                    default_hora_index_rem = horarios_disp.index(hora_atual_rem)
+                                except ValueError: pass # Mantém 0 se não encontrar
+
+                            hora_selecionada_rem = st.selectbox(
+                                "Nova Hora", options=horarios_disp,
+                                key=f"rem_hora_sel_{ag_id}", # Key única
+                                index=default_hora_index_rem,
+                                format_func=lambda t: t.strftime('%H:%M') if isinstance(t, time) else "Inválido"
+                            )
+                            # Atualiza o estado da hora
+                            st.session_state.remarcacao_cliente_form_hora[ag_id] = hora_selecionada_rem
+                            pode_confirmar = True
+                        else:
+                            st.selectbox("Nova Hora", options=["Nenhum horário disponível"], disabled=True, key=f"rem_hora_sel_{ag_id}")
+                            st.session_state.remarcacao_cliente_form_hora[ag_id] = None # Limpa hora no estado
+                            pode_confirmar = False
+
+                        # Botões Confirmar/Voltar do formulário
+                        form_cols_rem = st.columns(2)
+                        form_cols_rem[0].form_submit_button(
+                            "✅ Confirmar",
+                            on_click=handle_confirmar_remarcacao_cliente,
+                            args=(ag,), # Passa o dict do agendamento
+                            disabled=not pode_confirmar
+                        )
+                        form_cols_rem[1].form_submit_button(
+                            "Voltar",
+                            on_click=handle_cancelar_remarcacao_cliente,
+                            args=(ag_id,) # Passa o ID para cancelar
+                        )
+
+            st.divider() # Divisor entre agendamentos futuros
+
 def render_backoffice_clinica():
     clinic_id = st.session_state.clinic_id
 
@@ -1112,7 +2144,6 @@ def render_backoffice_clinica():
 
     # Carrega dados essenciais uma vez por renderização
     profissionais_clinica = listar_profissionais(clinic_id)
-    clientes_clinica = listar_clientes(clinic_id)
     servicos_clinica = listar_servicos(clinic_id)
     # Passa as listas para `listar_turmas` popular nomes
     turmas_clinica = listar_turmas(clinic_id, profissionais_clinica, servicos_clinica)
@@ -1125,326 +2156,28 @@ def render_backoffice_clinica():
     if active_tab == "🗓️ Agenda e Agendamento":
         st.header("📝 Agendamento Rápido e Manual")
 
-        # Se estiver confirmando um agendamento, mostra o diálogo de confirmação
-        if st.session_state.get('confirmando_agendamento', False):
-            st.subheader("Revisar e Confirmar Agendamento")
-            detalhes = st.session_state.detalhes_agendamento
-            # Mostra detalhes do agendamento
-            st.write(f"**Cliente:** {detalhes.get('cliente','N/A')}")
-            st.write(f"**Telefone:** {detalhes.get('telefone','N/A')}")
-            st.write(f"**Profissional:** {detalhes.get('profissional','N/A')}")
-            st.write(f"**Serviço:** {detalhes.get('servico','N/A')}")
-            data_ag = detalhes.get('data')
-            hora_ag = detalhes.get('hora')
-            data_str = data_ag.strftime('%d/%m/%Y') if isinstance(data_ag, date) else "Data Inválida"
-            hora_str = hora_ag.strftime('%H:%M') if isinstance(hora_ag, time) else "Hora Inválida"
-            st.write(f"**Data:** {data_str}")
-            st.write(f"**Horário:** {hora_str}")
-
-            if detalhes.get('turma_id'):
-                st.write(f"**Modalidade:** Em Grupo / Turma")
-            # Mostra info sobre débito de pacote
-            if detalhes.get('pacote_info_msg'):
-                st.info(detalhes['pacote_info_msg'])
-
-            # Botões de Confirmar/Voltar
-            c1, c2 = st.columns(2)
-            if c1.button("✅ Confirmar Agendamento", type="primary"):
-                handle_agendamento_submission()
-            if c2.button("❌ Voltar"):
-                st.session_state.confirmando_agendamento = False
-                st.rerun()
-
-        # Se não estiver confirmando, mostra o formulário de agendamento
-        elif not profissionais_clinica or not servicos_clinica:
-            st.warning("É necessário ter ao menos um profissional e um serviço cadastrado para realizar agendamentos.")
-        else:
-            # Exibe mensagens de sucesso/erro do último agendamento
-            if st.session_state.get('last_agendamento_info'):
-                info = st.session_state.last_agendamento_info
-                if info.get('status') is True:
-                    st.success(f"Agendado para {info.get('cliente')} com sucesso!")
-                    st.markdown(f"**LINK DE GESTÃO:** `{info.get('link_gestao', 'N/A')}` (PIN: **{info.get('pin_code', 'N/A')}**)")
-                else:
-                    st.error(f"Erro ao agendar para {info.get('cliente', 'cliente não informado')}: {info.get('status', 'Erro desconhecido')}")
-                st.session_state.last_agendamento_info = None # Limpa a mensagem
-
-            # --- Formulário de Agendamento ---
-            st.subheader("1. Selecione o Cliente")
-            opcoes_clientes = ["Novo Cliente"] + sorted([c.get('nome','Nome Inválido') for c in clientes_clinica])
-            st.selectbox("Cliente:", options=opcoes_clientes, key="agenda_cliente_select", on_change=handle_selecao_cliente)
-
-            # Placeholder para mensagens sobre pacotes
-            if 'pacote_status_placeholder' not in st.session_state or st.session_state.pacote_status_placeholder is None:
-                st.session_state.pacote_status_placeholder = st.empty()
-            # Chama a verificação inicial de pacotes (caso já haja cliente/serviço selecionado)
-            # handle_verificar_pacotes() # Chamado no on_change do cliente e serviço
-
-
-            st.subheader("2. Preencha os Detalhes do Agendamento")
-
-            # Inputs para Nome (se novo cliente) e Telefone
-            if st.session_state.agenda_cliente_select == "Novo Cliente":
-                col_nome, col_tel = st.columns(2)
-                col_nome.text_input("Nome do Novo Cliente", key="c_nome_novo_cliente_input")
-                col_tel.text_input("Telefone", key="c_tel_input")
-            else:
-                st.markdown(f"**Agendando para:** {st.session_state.agenda_cliente_select}")
-                st.text_input("Telefone (edite se necessário)", key="c_tel_input")
-
-            st.divider()
-
-            # Inputs para Profissional, Data, Serviço, Hora/Turma
-            form_cols = st.columns(3)
-            # Data Input (sempre visível)
-            form_cols[1].date_input("Data:", key="form_data_selecionada", min_value=date.today())
-            # Serviço Selectbox (sempre visível)
-            servico_selecionado_nome = form_cols[2].selectbox(
-                "Serviço:",
-                [s.get('nome','Serviço Inválido') for s in servicos_clinica],
-                key="c_servico_input",
-                on_change=handle_verificar_pacotes # Verifica pacotes quando o serviço muda
-            )
-
-            # Busca dados do serviço selecionado
-            servico_data = next((s for s in servicos_clinica if s.get('nome') == servico_selecionado_nome), None)
-
-            pode_agendar = False # Flag para habilitar o botão de agendar
-
-            if servico_data:
-                tipo_servico = servico_data.get('tipo', 'Individual')
-                duracao_servico = servico_data.get('duracao_min', 30)
-
-                # Lógica para Serviço "Em Grupo"
-                if tipo_servico == 'Em Grupo':
-                    turmas_disponiveis = gerar_turmas_disponiveis(
-                        clinic_id,
-                        st.session_state.form_data_selecionada,
-                        turmas_clinica, # Lista já populada com nomes
-                    )
-
-                    # Cria dicionário {Label: (turma_id, horario_obj)} para o selectbox
-                    opcoes_turmas = {
-                        f"{t.get('horario_str','HH:MM')} - {t.get('nome','Turma Inválida')} ({t.get('profissional_nome','N/A')}) - {t.get('vagas_ocupadas',0)}/{t.get('capacidade_maxima',0)} vagas":
-                        (t.get('id'), t.get('horario_obj'))
-                        for t in turmas_disponiveis
-                    }
-                    
-                    profissional_nome_turma = "-- (Selecione uma turma) --"
-
-                    # Selectbox de Turma
-                    if opcoes_turmas:
-                        selecao_label = form_cols[1].selectbox(
-                            "Turma:",
-                            options=list(opcoes_turmas.keys()), # Garante que é uma lista
-                            key="c_hora_input_raw" # Chave diferente para o label
-                        )
-                        # Guarda a tupla (id, time_obj) no estado
-                        st.session_state.c_hora_input = opcoes_turmas.get(selecao_label)
-
-                        # Busca nome do profissional da turma selecionada
-                        if st.session_state.c_hora_input:
-                            turma_id_selecionado = st.session_state.c_hora_input[0]
-                            turma_selecionada_obj = next((t for t in turmas_clinica if t.get('id') == turma_id_selecionado), None)
-                            if turma_selecionada_obj:
-                                profissional_nome_turma = turma_selecionada_obj.get('profissional_nome', 'N/A')
-                        pode_agendar = True # Pode agendar se houver turmas
-                    else:
-                        # Mostra mensagem se não houver turmas
-                        if turmas_clinica: # Havia turmas, mas sem vagas ou não neste dia
-                             form_cols[1].selectbox("Turma:", options=["Nenhuma turma com vagas disponíveis"], key="c_hora_input", disabled=True)
-                        else: # Não havia turmas nesse dia/horário
-                             form_cols[1].selectbox("Turma:", options=["Nenhuma turma disponível para este dia"], key="c_hora_input", disabled=True)
-                        st.session_state.c_hora_input = None # Garante que o horário está limpo
-                        pode_agendar = False
-
-                    # Input (desabilitado) para mostrar o profissional da turma
-                    form_cols[0].text_input("Profissional:", value=profissional_nome_turma, disabled=True, key="c_prof_input_turma_display")
-                    st.session_state.c_prof_input = profissional_nome_turma # Guarda o nome para salvar
-
-                # Lógica para Serviço "Individual"
-                else:
-                    # Selectbox de Profissional
-                    prof_selecionado_nome = form_cols[0].selectbox(
-                        "Profissional:",
-                        [p.get('nome','Prof. Inválido') for p in profissionais_clinica],
-                        key="c_prof_input"
-                    )
-                    # Gera horários disponíveis
-                    horarios_disponiveis = gerar_horarios_disponiveis(
-                        clinic_id,
-                        prof_selecionado_nome, # Usa o nome selecionado
-                        st.session_state.form_data_selecionada,
-                        duracao_servico
-                    )
-                    # Selectbox de Hora
-                    if horarios_disponiveis:
-                        hora_selecionada = form_cols[1].selectbox(
-                            "Hora:",
-                            options=horarios_disponiveis,
-                            key="c_hora_input", # Guarda o time object
-                            format_func=lambda t: t.strftime('%H:%M') if isinstance(t, time) else "Inválido"
-                        )
-                        pode_agendar = True
-                    else:
-                        form_cols[1].selectbox("Hora:", options=["Nenhum horário disponível"], key="c_hora_input", disabled=True)
-                        pode_agendar = False
-
-            # Botão de Agendar (habilitado/desabilitado pela flag pode_agendar)
-            st.button("AGENDAR NOVA SESSÃO", type="primary", disabled=not pode_agendar, on_click=handle_pre_agendamento)
+        render_formulario_agendamento(clinic_id, profissionais_clinica, servicos_clinica, turmas_clinica)
 
         # --- Visualização da Agenda ---
         st.markdown("---")
         st.header("🗓️ Visualização da Agenda")
 
-        # Abas de Visualização
-        view_tab1, view_tab2, view_tab3 = st.tabs(["Visão Diária (Lista)", "Visão Semanal (Profissional)", "Visão Comparativa (Diária)"])
-
-        # Aba Visão Diária
-        with view_tab1:
-            st.date_input("Filtrar por data:", key='filter_data_selecionada', format="DD/MM/YYYY")
-
-            # Busca agendamentos confirmados para a data selecionada
-            agenda_do_dia = buscar_agendamentos_por_data(clinic_id, st.session_state.filter_data_selecionada)
-
-            if not agenda_do_dia.empty:
-                # Separa agendamentos de turma e individuais
-                turmas_na_agenda = {}
-                agendamentos_individuais = []
-
-                for _, row_series in agenda_do_dia.iterrows():
-                    # Converte Series para dict para facilitar acesso com .get()
-                    row = row_series.to_dict()
-
-                    # Verifica se é de turma
-                    if pd.notna(row.get('turma_id')):
-                        turma_id = row['turma_id']
-                        # Usa o horário do agendamento (que é datetime) para agrupar
-                        horario_ag = row.get('horario')
-                        if isinstance(horario_ag, datetime):
-                            horario_key = horario_ag.strftime('%H:%M') # Chave como string HH:MM
-                            key = (turma_id, horario_key) # Chave composta
-
-                            # Se for o primeiro cliente dessa turma/horário, busca infos da turma
-                            if key not in turmas_na_agenda:
-                                turma_info = next((t for t in turmas_clinica if t.get('id') == turma_id), None)
-                                turmas_na_agenda[key] = {
-                                    'nome_turma': turma_info.get('nome', 'Turma Removida') if turma_info else 'Turma Removida',
-                                    'profissional_nome': turma_info.get('profissional_nome', 'N/A') if turma_info else 'N/A',
-                                    'horario': horario_ag, # Guarda o datetime original
-                                    'capacidade': turma_info.get('capacidade_maxima', 'N/A') if turma_info else 'N/A',
-                                    'clientes': []
-                                }
-                            # Adiciona o cliente (como dict) à lista da turma
-                            turmas_na_agenda[key]['clientes'].append(row)
-                        else:
-                            print(f"WARN: Agendamento de turma ID {row.get('id')} sem horário válido.", file=sys.stderr)
-                    else:
-                        # Adiciona agendamento individual (como dict) à lista
-                        agendamentos_individuais.append(row)
-
-                # Renderiza Turmas (se houver)
-                if turmas_na_agenda:
-                    st.subheader("Aulas em Grupo")
-                    # Ordena as turmas pelo horário
-                    for (turma_id, _), turma_data in sorted(turmas_na_agenda.items(), key=lambda item: item[1]['horario']):
-                        horario_turma = turma_data['horario']
-                        horario_turma_str = horario_turma.strftime('%H:%M') if isinstance(horario_turma, datetime) else "HH:MM"
-                        expander_title = f"{horario_turma_str} - {turma_data.get('nome_turma','N/A')} ({turma_data.get('profissional_nome','N/A')}) - {len(turma_data.get('clientes',[]))}/{turma_data.get('capacidade','N/A')} vagas"
-                        with st.expander(expander_title):
-                            for cliente_row in turma_data.get('clientes',[]):
-                                # Exibe nome, serviço e telefone do cliente na turma
-                                st.write(f" - {cliente_row.get('cliente','N/A')} ({cliente_row.get('servico_nome', 'N/A')}) (Tel: {cliente_row.get('telefone', 'N/A')})")
-                    st.divider()
-
-                # Renderiza Agendamentos Individuais (se houver)
-                if agendamentos_individuais:
-                    st.subheader("Atendimentos Individuais")
-                    # Ordena agendamentos individuais pelo horário
-                    for row in sorted(agendamentos_individuais, key=lambda r: r.get('horario', datetime.min.replace(tzinfo=TZ_SAO_PAULO))):
-                        ag_id = row.get('id', f"NO_ID_{row.get('cliente')}") # Usa ID ou fallback
-                        horario_ag = row.get('horario')
-                        horario_ag_str = horario_ag.strftime('%H:%M') if isinstance(horario_ag, datetime) else "HH:MM"
-                        profissional_nome = row.get('profissional_nome', 'N/A') # Nome do profissional atual
-
-                        # Layout das colunas para cada agendamento
-                        # Ajustado para 6 colunas para incluir o botão de Troca (Shift)
-                        data_cols = st.columns([0.1, 0.35, 0.25, 0.3]) 
-
-                        # Checkbox de seleção (coluna 0)
-                        selecionado = data_cols[0].checkbox(" ", key=f"select_{ag_id}", label_visibility="collapsed")
-                        st.session_state.agendamentos_selecionados[ag_id] = selecionado
-
-                        # Info Cliente/Serviço (coluna 1)
-                        data_cols[1].write(f"**{row.get('cliente','N/A')}**<br><small>{row.get('servico_nome', 'N/A')}</small>", unsafe_allow_html=True)
-                        # Info Profissional/Hora (coluna 2)
-                        data_cols[2].write(f"{profissional_nome} - {horario_ag_str}")
-
-                        # Botões de Ação (coluna 3)
-                        with data_cols[3]:
-                            # 6 colunas internas para os botões de ação e a troca
-                            action_cols = st.columns(6) 
-
-                            # Popover Detalhes (ℹ️)
-                            detalhes_popover = action_cols[0].popover("ℹ️", help="Ver Detalhes")
-                            with detalhes_popover:
-                                pin = row.get('pin_code', 'N/A')
-                                link = f"https://agendafit.streamlit.app?pin={pin}" if pin != 'N/A' else 'N/A'
-                                st.markdown(f"**Serviço:** {row.get('servico_nome', 'N/A')}")
-                                st.markdown(f"**Telefone:** {row.get('telefone', 'N/A')}")
-                                st.markdown(f"**Profissional:** {profissional_nome}")
-                                st.markdown(f"**PIN:** `{pin}`")
-                                st.markdown(f"**Link:** `{link}`")
-                                if pd.notna(row.get('pacote_cliente_id')):
-                                    st.markdown(f"**Usou Pacote:** Sim")
-
-                            # Popover WPP (💬)
-                            wpp_popover = action_cols[1].popover("💬", help="Gerar Mensagem WhatsApp")
-                            with wpp_popover:
-                                pin = row.get('pin_code', 'N/A')
-                                link_gestao = f"https://agendafit.streamlit.app?pin={pin}" if pin != 'N/A' else 'N/A'
-                                horario_str_msg = horario_ag.strftime('%d/%m/%Y às %H:%M') if isinstance(horario_ag, datetime) else "Data/Hora Inválida"
-                                mensagem = (
-                                    f"Olá, {row.get('cliente','Cliente')}! Tudo bem?\n\n"
-                                    f"Este é um lembrete do seu agendamento na {st.session_state.clinic_name} com o(a) profissional {profissional_nome} "
-                                    f"no dia {horario_str_msg}.\n\n"
-                                    f"Para confirmar, remarcar ou cancelar, por favor, use este link: {link_gestao}"
-                                )
-                                st.text_area("Mensagem:", value=mensagem, height=200, key=f"wpp_msg_{ag_id}")
-                                st.write("Copie a mensagem acima e envie para o cliente.")
-
-                            # Botões de Ação Direta
-                            action_cols[2].button("✅", key=f"finish_{ag_id}", on_click=handle_admin_action, args=(ag_id, "finalizar"), help="Sessão Concluída")
-                            action_cols[3].button("🚫", key=f"noshow_{ag_id}", on_click=handle_admin_action, args=(ag_id, "no-show"), help="Marcar Falta")
-                            action_cols[4].button("❌", key=f"cancel_{ag_id}", on_click=handle_admin_action, args=(ag_id, "cancelar"), help="Cancelar Agendamento")
-                            
-                            # Botão de Troca de Profissional (Transferência) - SÓ PARA INDIVIDUAIS
-                            troca_popover = action_cols[5].popover("🔄", help="Trocar Profissional")
-                            with troca_popover:
-                                st.write(f"Trocar profissional de **{row.get('cliente','N/A')}**")
-                                novo_prof_select = st.selectbox(
-                                    "Novo Profissional:",
-                                    options=[p for p in profissionais_nomes if p != profissional_nome], # Exclui o atual
-                                    key=f"troca_prof_select_{ag_id}"
-                                )
-                                if st.button("Confirmar Troca", key=f"troca_btn_{ag_id}", type="primary"):
-                                    handle_troca_profissional(ag_id, profissional_nome, novo_prof_select)
-
-
-                        # Mostra se usou pacote abaixo do agendamento
-                        if row.get('pacote_cliente_id'):
-                            st.caption("💳 Agendamento via Pacote")
-
-                    # Botão para cancelar selecionados (se houver)
-                    if any(st.session_state.agendamentos_selecionados.values()):
-                        st.button("❌ Cancelar Selecionados", type="primary", on_click=handle_cancelar_selecionados)
-
-            # Mensagem se não houver agendamentos no dia
-            else:
-                st.info(f"Nenhuma consulta confirmada para {st.session_state.filter_data_selecionada.strftime('%d/%m/%Y')}.")
+        # Só a visão escolhida é montada (com st.tabs, as três consultas rodavam a cada rerun)
+        visao_agenda = st.radio("Visão da agenda", VISOES_AGENDA, key="agenda_visao", horizontal=True, label_visibility="collapsed")
+
+        # Widgets das visões ocultas não são renderizados; regravar os valores evita que o Streamlit os descarte
+        if st.session_state.get('semanal_prof_select') not in [p['nome'] for p in profissionais_clinica]:
+            st.session_state.pop('semanal_prof_select', None)
+        for chave_widget in ('filter_data_selecionada', 'semanal_prof_select', 'comparativa_data_select', 'agenda_diaria_modo'):
+            if chave_widget in st.session_state:
+                st.session_state[chave_widget] = st.session_state[chave_widget]
+
+        # Visão Diária
+        if visao_agenda == VISOES_AGENDA[0]:
+            render_agenda_diaria(clinic_id, turmas_clinica, profissionais_nomes)
 
-        # Aba Visão Semanal
-        with view_tab2:
+        # Visão Semanal
+        elif visao_agenda == VISOES_AGENDA[1]:
             st.subheader("Agenda Semanal por Profissional")
             if not profissionais_clinica:
                 st.warning("Cadastre um profissional para ver a agenda semanal.")
@@ -1453,21 +2186,22 @@ def render_backoffice_clinica():
                 today = date.today()
                 start_of_week = today - timedelta(days=today.weekday())
 
-                df_semanal = gerar_visao_semanal(clinic_id, prof_selecionado, start_of_week)
+                df_semanal = gerar_visao_semanal(clinic_id, prof_selecionado, start_of_week, obter_grade_semana(start_of_week))
 
                 if df_semanal.empty:
                     st.info(f"Nenhum agendamento para {prof_selecionado} nesta semana.")
                 else:
                     st.dataframe(df_semanal, use_container_width=True)
 
-        # Aba Visão Comparativa
-        with view_tab3:
+        # Visão Comparativa
+        elif visao_agenda == VISOES_AGENDA[2]:
             st.subheader("Agenda Comparativa do Dia")
-            data_comparativa = st.date_input("Selecione a Data", key="comparativa_data_select", value=date.today())
+            data_comparativa = st.date_input("Selecione a Data", key="comparativa_data_select")
             if not profissionais_clinica:
                 st.warning("Cadastre profissionais para comparar as agendas.")
             else:
-                df_comparativo = gerar_visao_comparativa(clinic_id, data_comparativa, [p['nome'] for p in profissionais_clinica])
+                nomes_profissionais = [p['nome'] for p in profissionais_clinica]
+                df_comparativo = gerar_visao_comparativa(clinic_id, data_comparativa, nomes_profissionais, obter_grade_semana(data_comparativa))
                 # Mostra o DataFrame com alinhamento centralizado
                 st.dataframe(df_comparativo.style.set_properties(**{'text-align': 'center'}), use_container_width=True)
 
@@ -1597,6 +2331,44 @@ def render_backoffice_clinica():
                     st.warning("Não é possível editar turmas pois não há profissionais cadastrados.")
 
 
+        st.divider()
+        st.subheader("Matrícula em Lote")
+        # A busca fica fora do formulário para atualizar as opções de cliente ao digitar
+        busca_matricula = st.text_input("Buscar cliente (início do nome)", key="matricula_cliente_busca") if turmas_clinica else ""
+        pagina_matricula = listar_clientes_pagina(clinic_id, prefixo_nome=busca_matricula) if turmas_clinica else None
+        if not turmas_clinica or not pagina_matricula['clientes']:
+            st.info("Cadastre turmas e clientes para matricular em lote." if not busca_matricula else "Nenhum cliente encontrado para a busca.")
+        else:
+            if pagina_matricula['cursor_proximo']:
+                st.caption(f"Mostrando os primeiros {len(pagina_matricula['clientes'])} clientes; refine a busca para encontrar outros.")
+            with st.form("matricula_turma_form"):
+                turmas_opcoes = {t.get('id'): f"{t.get('nome','N/A')} ({t.get('horario','HH:MM')} - {', '.join(DIAS_SEMANA.get(d, d) for d in t.get('dias_semana', []))})" for t in turmas_clinica}
+                clientes_opcoes = {c.get('id'): c.get('nome', 'Nome Inválido') for c in pagina_matricula['clientes']}
+                m1, m2 = st.columns(2)
+                m1.selectbox("Turma", options=list(turmas_opcoes.keys()), format_func=lambda t_id: turmas_opcoes.get(t_id, t_id), key="matricula_turma_id")
+                m2.selectbox("Cliente", options=list(clientes_opcoes.keys()), format_func=lambda c_id: clientes_opcoes.get(c_id, c_id), key="matricula_cliente_id")
+                m3, m4 = st.columns(2)
+                m3.date_input("Período", value=(date.today(), date.today() + timedelta(days=30)), min_value=date.today(), key="matricula_periodo", format="DD/MM/YYYY")
+                m4.checkbox("Debitar créditos de pacote válido do cliente", key="matricula_usar_pacote")
+                st.form_submit_button("Matricular", on_click=handle_matricula_turma, args=(turmas_clinica, servicos_clinica))
+
+            resultado_matricula = st.session_state.resultado_matricula_turma
+            if resultado_matricula:
+                if resultado_matricula['criados']:
+                    st.success(f"{resultado_matricula['cliente_nome']} matriculado(a) em {len(resultado_matricula['criados'])} aulas de '{resultado_matricula['turma_nome']}'.")
+                else:
+                    st.warning(f"Nenhuma aula de '{resultado_matricula['turma_nome']}' disponível no período.")
+                if resultado_matricula['creditos_debitados']:
+                    st.info(f"{resultado_matricula['creditos_debitados']} créditos debitados do pacote.")
+                elif resultado_matricula.get('sem_pacote'):
+                    st.info("Nenhum pacote válido encontrado para este serviço; as aulas foram agendadas sem pacote.")
+                if resultado_matricula['ignorados']:
+                    with st.expander(f"{len(resultado_matricula['ignorados'])} aulas ignoradas"):
+                        for ignorado in resultado_matricula['ignorados']:
+                            st.write(f"- {ignorado['data'].strftime('%d/%m/%Y')}: {ignorado['motivo']}")
+
+            st.button("Recalcular vagas ocupadas", on_click=handle_recalcular_vagas_turmas, help="Recontagem das vagas das aulas futuras a partir dos agendamentos confirmados.")
+
         st.divider()
         st.subheader("Grade de Aulas Semanal")
         # Lógica para exibir a Grade Semanal
@@ -1789,243 +2561,40 @@ def render_backoffice_clinica():
         # Mapa de Turmas (ID -> Nome) para exibir nos agendamentos
         turmas_map = {t.get('id'): t.get('nome', 'Turma Removida') for t in turmas_clinica}
 
-        if clientes_clinica:
-            # Loop por cada cliente cadastrado
-            for cliente in clientes_clinica:
+        busca_clientes = st.text_input("Buscar pelo início do nome", key="clientes_busca", on_change=handle_busca_clientes)
+        cursores_clientes = st.session_state.clientes_pagina_cursores
+        pagina_clientes = listar_clientes_pagina(clinic_id, cursor=cursores_clientes[-1], prefixo_nome=busca_clientes)
+        clientes_pagina = pagina_clientes['clientes']
+
+        if clientes_pagina:
+            ids_clientes = [c.get('id') for c in clientes_pagina if c.get('id')]
+            # Loop pelos clientes da página
+            for cliente in clientes_pagina:
                 cliente_id = cliente.get('id') # Pega o ID do cliente
                 if not cliente_id:
                     st.warning(f"Cliente '{cliente.get('nome','N/A')}' sem ID, pulando.")
                     continue
 
-                # Expander para cada cliente
-                with st.expander(f"{cliente.get('nome','Sem Nome')} - {cliente.get('telefone', 'Sem telefone')}"):
+                # Expander para cada cliente; abrir/fechar re-executa a página e só o aberto busca os detalhes
+                expander_cliente = st.expander(f"{cliente.get('nome','Sem Nome')} - {cliente.get('telefone', 'Sem telefone')}",
+                                               key=f"expander_cliente_{cliente_id}", on_change="rerun")
+                with expander_cliente:
                     # Mostra observações e botão de remover
                     st.write(f"**Observações:** {cliente.get('observacoes', 'N/A')}")
                     st.button("Remover Cliente", type="primary", key=f"del_cliente_{cliente_id}", on_click=handle_remove_cliente, args=(clinic_id, cliente_id))
 
-                    st.divider()
-                    st.subheader("Pacotes do Cliente")
-
-                    # Busca e exibe pacotes do cliente
-                    pacotes_do_cliente = listar_pacotes_do_cliente(clinic_id, cliente_id)
-                    if not pacotes_do_cliente:
-                        st.info("Cliente não possui pacotes.")
-                    else:
-                        hoje_tz = datetime.now(TZ_SAO_PAULO)
-                        data_pacotes = [] # Lista para o DataFrame
-                        for p in pacotes_do_cliente:
-                            # Determina status do pacote
-                            status = "Ativo"
-                            data_exp = p.get('data_expiracao')
-                            creditos_rest = p.get('creditos_restantes', 0)
-
-                            if isinstance(data_exp, datetime) and data_exp < hoje_tz:
-                                status = "Expirado"
-                            elif creditos_rest <= 0:
-                                status = "Esgotado"
-
-                            # Formata dados para o DataFrame
-                            data_pacotes.append({
-                                "Pacote": p.get('nome_pacote_modelo', 'Nome Indisponível'),
-                                "Créditos": f"{creditos_rest} / {p.get('creditos_total','N/A')}",
-                                "Expira em": data_exp.strftime('%d/%m/%Y') if isinstance(data_exp, datetime) else 'N/A',
-                                "Status": status
-                            })
-                        # Exibe DataFrame com os pacotes
-                        if data_pacotes:
-                            st.dataframe(pd.DataFrame(data_pacotes), use_container_width=True, hide_index=True)
-
-
-                    # Seção para Associar Novo Pacote
-                    st.subheader("Associar Novo Pacote")
-                    if not modelos_pacotes_map:
-                        st.warning("Nenhum modelo de pacote criado. Crie um na aba '🛍️ Gerenciar Pacotes'.")
-                    else:
-                        cols_assoc = st.columns([0.7, 0.3])
-                        # Selectbox para escolher o modelo de pacote
-                        pacote_nome_selecionado = cols_assoc[0].selectbox(
-                            "Selecione o Pacote Modelo:",
-                            options=[""] + sorted(list(modelos_pacotes_map.keys())), # Ordena nomes
-                            key=f"pacote_assoc_select_nome_{cliente_id}", # Chave única por cliente
-                            label_visibility="collapsed"
-                        )
-                        # Guarda o ID do pacote selecionado no estado
-                        st.session_state[f"pacote_assoc_select_{cliente_id}"] = modelos_pacotes_map.get(pacote_nome_selecionado)
-
-                        # Botão para associar o pacote selecionado
-                        cols_assoc[1].button(
-                            "Associar Pacote",
-                            key=f"btn_assoc_{cliente_id}", # Chave única
-                            on_click=handle_associar_pacote_cliente,
-                            args=(cliente_id,) # Passa o ID do cliente
-                        )
+                    if expander_cliente.open:
+                        render_detalhes_cliente(clinic_id, cliente_id, modelos_pacotes_map, turmas_map, ids_clientes)
+        elif len(cursores_clientes) == 1:
+            st.info("Nenhum cliente encontrado." if busca_clientes else "Nenhum cliente cadastrado.")
 
-                    st.divider()
-                    st.subheader("Agendamentos Futuros")
-
-                    # Busca agendamentos futuros usando o ID do cliente
-                    agendamentos_futuros = buscar_agendamentos_futuros_por_cliente(clinic_id, cliente_id)
-
-                    # Exibe mensagem se não houver agendamentos
-                    if not agendamentos_futuros:
-                        st.info("Cliente não possui agendamentos futuros confirmados.")
-                    else:
-                        # Loop para exibir cada agendamento futuro
-                        for ag in agendamentos_futuros:
-                            ag_id = ag.get('id')
-                            if not ag_id: continue # Pula se não houver ID
-
-                            horario_ag = ag.get('horario')
-                            horario_str = horario_ag.strftime('%d/%m/%Y às %H:%M') if isinstance(horario_ag, datetime) else "Horário Inválido"
-
-                            # Determina se é turma ou individual e se pode remarcar
-                            if ag.get('turma_id'):
-                                tipo_ag = f"Turma: {turmas_map.get(ag['turma_id'], 'N/A')}"
-                                pode_remarcar = False
-                            else:
-                                tipo_ag = f"Serviço: {ag.get('servico_nome', 'N/A')}"
-                                pode_remarcar = True # Só pode remarcar individual
-
-                            # Layout para infos e botões
-                            info_cols, button_cols = st.columns([0.6, 0.4])
-
-                            # Exibe informações do agendamento
-                            with info_cols:
-                                st.write(f"**{horario_str}**")
-                                st.write(f"<small>{ag.get('profissional_nome','N/A')} ({tipo_ag})</small>", unsafe_allow_html=True)
-                                if ag.get('pacote_cliente_id'):
-                                    st.caption("💳 Agendamento via Pacote")
-
-                            # Exibe botões de ação
-                            with button_cols:
-                                num_cols = 6 if pode_remarcar else 5 # 6 botões se puder remarcar
-                                action_cols = st.columns(num_cols)
-
-                                # Popover Detalhes (ℹ️) - CORRIGIDO: sem 'key'
-                                detalhes_popover = action_cols[0].popover("ℹ️", help="Ver Detalhes")
-                                with detalhes_popover:
-                                    pin = ag.get('pin_code', 'N/A')
-                                    link = f"https://agendafit.streamlit.app?pin={pin}" if pin != 'N/A' else 'N/A'
-                                    st.markdown(f"**Serviço:** {ag.get('servico_nome', 'N/A')}")
-                                    st.markdown(f"**Telefone:** {ag.get('telefone', 'N/A')}")
-                                    st.markdown(f"**PIN:** `{pin}`")
-                                    st.markdown(f"**Link:** `{link}`")
-                                    if pd.notna(ag.get('pacote_cliente_id')):
-                                        st.markdown(f"**Usou Pacote:** Sim")
-
-                                # Popover WPP (💬) - CORRIGIDO: sem 'key'
-                                wpp_popover = action_cols[1].popover("💬", help="Gerar Mensagem WhatsApp")
-                                with wpp_popover:
-                                    pin = ag.get('pin_code', 'N/A')
-                                    link_gestao = f"https://agendafit.streamlit.app?pin={pin}" if pin != 'N/A' else 'N/A'
-                                    horario_str_msg = horario_ag.strftime('%d/%m/%Y às %H:%M') if isinstance(horario_ag, datetime) else "Data/Hora Inválida"
-                                    mensagem = (
-                                        f"Olá, {ag.get('cliente','Cliente')}! Tudo bem?\n\n"
-                                        f"Este é um lembrete do seu agendamento na {st.session_state.clinic_name} com o(a) profissional {ag.get('profissional_nome','N/A')} "
-                                        f"no dia {horario_str_msg}.\n\n"
-                                        f"Para confirmar, remarcar ou cancelar, por favor, use este link: {link_gestao}"
-                                    )
-                                    st.text_area("Mensagem:", value=mensagem, height=200, key=f"cl_wpp_msg_{ag_id}") # Key aqui é necessário
-                                    st.write("Copie a mensagem acima e envie para o cliente.")
-
-                                # Botões de Ação Direta (Finalizar, No-Show, Cancelar)
-                                action_cols[2].button("✅", key=f"cl_finish_{ag_id}", on_click=handle_admin_action, args=(ag_id, "finalizar"), help="Sessão Concluída")
-                                action_cols[3].button("🚫", key=f"cl_noshow_{ag_id}", on_click=handle_admin_action, args=(ag_id, "no-show"), help="Marcar Falta")
-                                action_cols[4].button("❌", key=f"cl_cancel_{ag_id}", on_click=handle_admin_action, args=(ag_id, "cancelar"), help="Cancelar Agendamento")
-
-                                # Botão Remarcar (🔄) - Condicional
-                                if pode_remarcar:
-                                    action_cols[5].button(
-                                        "🔄",
-                                        key=f"cl_remarcar_{ag_id}",
-                                        on_click=handle_iniciar_remarcacao_cliente,
-                                        args=(ag,), # Passa o dict do agendamento
-                                        help="Remarcar Horário",
-                                        # Desabilita se já estiver remarcando este
-                                        disabled=(st.session_state.remarcando_cliente_ag_id == ag_id)
-                                    )
-
-                                # --- Formulário de Remarcação (Condicional) ---
-                                # Mostra apenas se o botão Remarcar foi clicado para ESTE agendamento
-                                if st.session_state.remarcando_cliente_ag_id == ag_id:
-                                    with st.form(key=f"form_remarcacao_cliente_{ag_id}"):
-                                        st.write(f"Remarcando agendamento de {horario_str}")
-
-                                        # Input Data Remarcação
-                                        # Usa o valor do estado ou o padrão (data atual do ag. ou hoje)
-                                        data_default_rem = st.session_state.remarcacao_cliente_form_data.get(ag_id, date.today())
-                                        nova_data = st.date_input(
-                                            "Nova Data",
-                                            key=f"rem_data_{ag_id}", # Key única
-                                            value=data_default_rem,
-                                            min_value=date.today()
-                                        )
-                                        # Atualiza o estado da data SE ela mudar no input
-                                        if nova_data != data_default_rem:
-                                            st.session_state.remarcacao_cliente_form_data[ag_id] = nova_data
-                                            # Limpa a hora selecionada se a data mudou
-                                            if ag_id in st.session_state.remarcacao_cliente_form_hora:
-                                                del st.session_state.remarcacao_cliente_form_hora[ag_id]
-
-
-                                        # Gera horários disponíveis para a nova data
-                                        horarios_disp = gerar_horarios_disponiveis(
-                                            clinic_id,
-                                            ag.get('profissional_nome','N/A'),
-                                            nova_data, # Usa a data do input
-                                            ag.get('duracao_min', 30),
-                                            agendamento_id_excluir=ag_id # Exclui o próprio agendamento
-                                        )
-
-                                        # Selectbox Hora Remarcação
-                                        hora_selecionada_rem = None
-                                        pode_confirmar = False
-                                        if horarios_disp:
-                                            # Tenta manter a hora selecionada se ainda for válida
-                                            hora_atual_rem = st.session_state.remarcacao_cliente_form_hora.get(ag_id)
-                                            default_hora_index_rem = 0
-                                            if hora_atual_rem in horarios_disp:
-                                                try:
-                                                    default_hora_index_rem = horarios_disp.index(hora_atual_rem)
-                                                except ValueError: pass # Mantém 0 se não encontrar
-
-                                            hora_selecionada_rem = st.selectbox(
-                                                "Nova Hora", options=horarios_disp,
-                                                key=f"rem_hora_sel_{ag_id}", # Key única
-                                                index=default_hora_index_rem,
-                                                format_func=lambda t: t.strftime('%H:%M') if isinstance(t, time) else "Inválido"
-                                            )
-                                            # Atualiza o estado da hora
-                                            st.session_state.remarcacao_cliente_form_hora[ag_id] = hora_selecionada_rem
-                                            pode_confirmar = True
-                                        else:
-                                            st.selectbox("Nova Hora", options=["Nenhum horário disponível"], disabled=True, key=f"rem_hora_sel_{ag_id}")
-                                            st.session_state.remarcacao_cliente_form_hora[ag_id] = None # Limpa hora no estado
-                                            pode_confirmar = False
-
-                                        # Botões Confirmar/Voltar do formulário
-                                        form_cols_rem = st.columns(2)
-                                        form_cols_rem[0].form_submit_button(
-                                            "✅ Confirmar",
-                                            on_click=handle_confirmar_remarcacao_cliente,
-                                            args=(ag,), # Passa o dict do agendamento
-                                            disabled=not pode_confirmar
-                                        )
-                                        form_cols_rem[1].form_submit_button(
-                                            "Voltar",
-                                            on_click=handle_cancelar_remarcacao_cliente,
-                                            args=(ag_id,) # Passa o ID para cancelar
-                                        )
-
-                                        # Exibe mensagens de status da remarcação
-                                        status_msg = st.session_state.remarcacao_cliente_status.get(ag_id, {})
-                                        if status_msg:
-                                            if status_msg.get('sucesso'): st.success(status_msg.get('mensagem'))
-                                            else: st.error(status_msg.get('mensagem'))
-
-                            st.divider() # Divisor entre agendamentos futuros
-        else:
-            st.info("Nenhum cliente cadastrado.")
+        if len(cursores_clientes) > 1 or pagina_clientes['cursor_proximo']:
+            p1, p2, p3 = st.columns([1, 2, 1])
+            p1.button("◀ Anterior", key="clientes_pagina_anterior", on_click=handle_pagina_clientes,
+                      disabled=len(cursores_clientes) == 1)
+            p2.caption(f"Página {len(cursores_clientes)}")
+            p3.button("Próxima ▶", key="clientes_pagina_proxima", on_click=handle_pagina_clientes,
+                      args=(pagina_clientes['cursor_proximo'],), disabled=not pagina_clientes['cursor_proximo'])
 
 
     elif active_tab == "📋 Gerenciar Serviços":
@@ -2140,6 +2709,7 @@ def render_backoffice_clinica():
         with col1:
             with st.form("add_feriado_form"):
                 st.date_input("Data do Feriado/Folga", key="nova_data_feriado", value=date.today())
+                st.date_input("Até (opcional, para períodos como recesso)", key="nova_data_fim_feriado", value=None)
                 st.text_input("Descrição", key="descricao_feriado", placeholder="Ex: Feriado Municipal")
                 st.form_submit_button("Adicionar Data Bloqueada", on_click=handle_adicionar_feriado)
         # Seção para importar feriados nacionais
@@ -2164,7 +2734,10 @@ def render_backoffice_clinica():
                 feriado_id = feriado.get('id')
                 if feriado_id: # Garante que há ID
                     data_f = feriado.get('data')
+                    data_fim_f = feriado.get('data_fim')
                     data_str = data_f.strftime('%d/%m/%Y') if isinstance(data_f, date) else "Data Inválida"
+                    if isinstance(data_fim_f, date) and data_fim_f != data_f:
+                        data_str += f" a {data_fim_f.strftime('%d/%m/%Y')}"
                     c1, c2, c3 = st.columns([0.4, 0.4, 0.2])
                     c1.write(data_str)
                     c2.write(feriado.get('descricao', 'N/A'))
@@ -2191,7 +2764,9 @@ def render_super_admin_panel():
     st.markdown("---")
     st.subheader("Clínicas Cadastradas")
 
-    clinicas = listar_clinicas()
+    cursores_clinicas = st.session_state.sa_clinicas_cursores
+    pagina_clinicas = listar_clinicas_pagina(cursores_clinicas[-1])
+    clinicas = pagina_clinicas['clinicas']
     if not clinicas:
         st.info("Nenhuma clínica cadastrada.")
     else:
@@ -2209,6 +2784,39 @@ def render_super_admin_panel():
                     button_text = "Desativar" if status else "Ativar"
                     st.button(button_text, key=f"toggle_{clinic_id_admin}", on_click=handle_toggle_status_clinica, args=(clinic_id_admin, status))
 
+        st.markdown("---")
+        st.subheader("Análise de Uso por Clínica")
+        st.caption("Contagens por agregação no servidor, guardadas em cache por 15 minutos. "
+                   f"Clientes ativos têm agendamento a partir de {DIAS_CLIENTE_ATIVO} dias atrás. Leituras/dia é uma "
+                   "estimativa: agendamentos por dia no mês atual × leituras medidas por agendamento (teste_carga.py).")
+        linhas_analise = []
+        for clinica in clinicas:
+            if not clinica.get('id'):
+                continue
+            metricas = contar_metricas_clinica_cache(clinica['id'])
+            linha = {
+                "Clínica": clinica.get('nome_fantasia', 'Nome não definido'),
+                "Ativa": bool(clinica.get('ativo', False)),
+                "Profissionais": metricas.get('profissionais'),
+                "Clientes": metricas.get('clientes'),
+                "Clientes Ativos": metricas.get('clientes_ativos'),
+                "Pacotes Ativos": metricas.get('pacotes_ativos'),
+                "Leituras/dia (est.)": metricas.get('leituras_estimadas_dia')
+            }
+            for mes, total in metricas.get('agendamentos_por_mes', {}).items():
+                linha[f"Agend. {mes[5:]}/{mes[:4]}"] = total
+            linhas_analise.append(linha)
+        st.dataframe(pd.DataFrame(linhas_analise), hide_index=True, use_container_width=True)
+        st.button("Recalcular métricas", key="sa_recalcular_metricas", on_click=invalidar_metricas_clinicas)
+
+    if len(cursores_clinicas) > 1 or pagina_clinicas['cursor_proximo']:
+        p1, p2, p3 = st.columns([1, 2, 1])
+        p1.button("◀ Anterior", key="sa_clinicas_anterior", on_click=handle_pagina_clinicas,
+                  disabled=len(cursores_clinicas) == 1)
+        p2.caption(f"Página {len(cursores_clinicas)}")
+        p3.button("Próxima ▶", key="sa_clinicas_proxima", on_click=handle_pagina_clinicas,
+                  args=(pagina_clinicas['cursor_proximo'],), disabled=not pagina_clinicas['cursor_proximo'])
+
 # --- ROTEAMENTO PRINCIPAL ---
 pin_param = st.query_params.get("pin")
 
@@ -0,0 +1,87 @@
+# cache_agenda.py (CACHE EM MEMÓRIA DO PROCESSO)
+# Dados de referência lidos em quase todo rerun (profissionais, feriados...) ficam em cache
+# no processo do Streamlit, compartilhados entre as sessões. Cada entrada expira por TTL
+# (limite de defasagem entre instâncias) e é invalidada pelas funções de escrita do `database`.
+
+import threading
+import time
+import sys
+
+
+class CacheTTL:
+    """
+    Cache simples chave -> valor com expiração por TTL.
+    As chaves são tuplas começando pelo `clinic_id`, o que permite invalidar por prefixo.
+    Os valores devolvidos são compartilhados entre sessões: não devem ser modificados.
+    """
+
+    def __init__(self, nome: str, ttl_segundos: float = 300, max_itens: int = 5000):
+        self.nome = nome
+        self.ttl_segundos = ttl_segundos
+        self.max_itens = max_itens
+        self._itens = {}
+        self._lock = threading.Lock()
+
+    def obter(self, chave: tuple, carregar):
+        """Devolve o valor em cache para `chave` ou chama `carregar()` e guarda o resultado."""
+        agora = time.monotonic()
+        with self._lock:
+            item = self._itens.get(chave)
+            if item and item[0] > agora:
+                return item[1]
+
+        valor = carregar()
+        self.guardar(chave, valor)
+        return valor
+
+    def guardar(self, chave: tuple, valor):
+        """Grava `valor` em `chave` (também usado para pré-carregar entradas)."""
+        agora = time.monotonic()
+        with self._lock:
+            if len(self._itens) >= self.max_itens:
+                self._remover_expirados(agora)
+                if len(self._itens) >= self.max_itens:
+                    # Descarta a entrada mais antiga (dicts preservam ordem de inserção)
+                    self._itens.pop(next(iter(self._itens)))
+            self._itens[chave] = (agora + self.ttl_segundos, valor)
+
+    def invalidar(self, *prefixo):
+        """Remove as entradas cuja chave começa com `prefixo` (sem argumentos, limpa tudo)."""
+        with self._lock:
+            if not prefixo:
+                self._itens.clear()
+                return
+            tamanho = len(prefixo)
+            for chave in [c for c in self._itens if c[:tamanho] == prefixo]:
+                del self._itens[chave]
+        print(f"LOG: Cache '{self.nome}' invalidado para {prefixo}.", file=sys.stderr)
+
+    def chaves_onde(self, predicado) -> list:
+        """Lista as chaves (ainda válidas) cujo valor satisfaz `predicado(valor)`."""
+        agora = time.monotonic()
+        with self._lock:
+            return [c for c, (expira, valor) in self._itens.items() if expira > agora and predicado(valor)]
+
+    def _remover_expirados(self, agora: float):
+        for chave in [c for c, (expira, _) in self._itens.items() if expira <= agora]:
+            del self._itens[chave]
+
+
+# --- Caches compartilhados ---
+PROFISSIONAIS = CacheTTL('profissionais', ttl_segundos=300)
+# Índice de feriados por (clinic_id, ano)
+FERIADOS = CacheTTL('feriados', ttl_segundos=3600)
+# Agendas de trabalho compiladas a partir de PROFISSIONAIS (mesma invalidação)
+AGENDAS = CacheTTL('agendas_compiladas', ttl_segundos=300)
+# Disponibilidade por (clinic_id, profissional_nome, data, versão do dia): as escritas de outras instâncias
+# mudam a versão (`database.versoes_agenda`); o TTL curto cobre expedientes e feriados alterados nelas.
+DISPONIBILIDADE = CacheTTL('disponibilidade', ttl_segundos=60, max_itens=20000)
+# Modelos de pacote por (clinic_id,) -> {pacote_modelo_id: modelo}
+PACOTES_MODELOS = CacheTTL('pacotes_modelos', ttl_segundos=300)
+# Páginas de clientes por (clinic_id, prefixo do nome, tamanho, cursor)
+CLIENTES = CacheTTL('clientes', ttl_segundos=120)
+# Métricas do painel do super admin por (clinic_id, meses, mês atual): contagens agregadas, mudam devagar
+ANALISE_CLINICAS = CacheTTL('analise_clinicas', ttl_segundos=900)
+# Layout dos agendamentos por (clinic_id,): True = `clinicas/{id}/agendamentos`. O TTL é o tempo máximo
+# para as outras instâncias perceberem o corte da migração.
+LAYOUT_AGENDAMENTOS = CacheTTL('layout_agendamentos', ttl_segundos=60)
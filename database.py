@@ -5,6 +5,51 @@
 # 3. [SOLUÇÃO CRÍTICA] `contar_agendamentos_turma_dia` agora requer `horario_turma` para contar agendamentos apenas no horário exato da aula.
 # 4. [NOVA FUNÇÃO] Adicionada `verificar_cliente_em_turma` para prevenir duplicidade.
 # 5. [NOVA FUNÇÃO] Adicionada `atualizar_profissional_agendamento` para troca de profissional.
+# 6. [TESTE DE CARGA] `get_firestore_client` usa o emulador local quando `FIRESTORE_EMULATOR_HOST` está definido.
+# 7. [CACHE] `listar_profissionais_cache` e `listar_feriados_cache`, invalidados nas escritas de profissionais/feriados.
+# 8. [CACHE] Escritas de agendamentos, horários de profissionais e feriados invalidam o cache de disponibilidade (bitmask por dia);
+#    as de agendamentos também incrementam a versão do dia (`versoes_agenda`), que entra na chave do cache.
+# 9. [CACHE] Escritas de profissionais também invalidam as agendas de trabalho compiladas.
+# 10. [FERIADOS] Períodos com `data_fim`, consulta por ano (`listar_feriados_do_ano`) e correção da data lida
+#     (o Timestamp é meia-noite UTC; convertê-lo para SP devolvia o dia anterior). O cache de feriados passa a ser
+#     por ano, montado em `logica_negocio.CalendarioFeriados` (substitui `listar_feriados_cache`).
+# 11. [SÉRIES] `salvar_agendamentos_em_lote`, `atualizar_agendamentos_em_lote`, `buscar_agendamentos_da_serie` e
+#     `deduzir_creditos_pacote_cliente` (débito de N créditos numa escrita).
+# 12. [TURMAS] `buscar_agendamentos_turma_intervalo`: ocupação de todas as aulas de um período numa consulta.
+# 13. [TURMAS] Contadores de vagas por aula (`ocupacao_turmas`) atualizados em transação na reserva/cancelamento;
+#     `contar_agendamentos_turma_dia` substituída por `buscar_ocupacao_turmas_dia`. Contadores ausentes são recontados
+#     na transação, e a remarcação de um agendamento de turma move a vaga entre as aulas.
+# 14. [CONCORRÊNCIA] Travas de horário por profissional (`travas_horarios`, uma por fatia de TRAVA_GRANULARIDADE_MIN
+#     da grade do profissional) criadas na transação do agendamento individual e movidas/liberadas na remarcação, troca
+#     de profissional e cancelamento, inclusive nas escritas em lote das séries; `reconstruir_travas_horarios` as
+#     grava para os agendamentos existentes.
+# 15. [PACOTES] `mapa_pacotes_modelos_cache` (modelos por ID, invalidado nas escritas de modelos) e
+#     `listar_pacotes_validos_do_cliente` (créditos, validade e serviço filtrados na consulta).
+# 16. [PACOTES] Extrato de créditos (`movimentos_creditos`) com débito/estorno por agendamento, idempotentes e na mesma
+#     transação do saldo; o débito do agendamento individual/turma é feito na transação da reserva e o cancelamento estorna.
+#     `deduzir_credito(s)_pacote_cliente` substituídas por `debitar_creditos_pacote`/`estornar_creditos_agendamentos`.
+# 17. [PACOTES] Status pré-calculado nos pacotes (`status`, `expirando`), mantido pela tarefa em lote e pelos
+#     débitos/estornos, e resumo por clínica (`clinicas/{id}/resumos/pacotes`).
+# 18. [DESEMPENHO] `buscar_agendamento_por_id` e `buscar_agendamentos_por_ids` (`get_all`): leitura direta por ID,
+#     sem recarregar o dia inteiro nos handlers do admin.
+# 19. [DESEMPENHO] Pacotes e agendamentos futuros de vários clientes em lote (`listar_pacotes_de_clientes`,
+#     `buscar_agendamentos_futuros_de_clientes`); pacotes passam a gravar `clinic_id`/`cliente_id` para a consulta
+#     de collection group.
+# 20. [DESEMPENHO] Clientes paginados no servidor (`listar_clientes_pagina`: ordem por nome, cursor com `start_after`,
+#     busca pelo início do nome), com cache de páginas e pré-carga da seguinte; `buscar_cliente_por_nome` e
+#     `buscar_clientes_por_ids` para não listar a base inteira.
+# 21. [SUPER ADMIN] Análise por clínica com agregações `count()` (`contar_metricas_clinica`, em cache) e clínicas
+#     paginadas (`listar_clinicas_pagina`). Clientes ativos contados pelo maior horário agendado de cada cliente
+#     (`atividade_clientes`, gravado junto dos agendamentos; `reconstruir_atividade_clientes` preenche os antigos) e
+#     leituras por dia estimadas a partir das leituras medidas por operação (LEITURAS_POR_OPERACAO_AGENDAMENTO).
+# 22. [PARTICIONAMENTO] Agendamentos em `clinicas/{id}/agendamentos` para as clínicas migradas (`agendamentos_por_clinica`),
+#     escolhido em `_colecao_agendamentos`/`_consulta_agendamentos`; funções pelo ID aceitam `clinic_id`. Cópia em lotes
+#     com progresso (`copiar_lote_agendamentos_para_clinica`), verificação e corte usados por `tarefas_agendadas.py`.
+# 23. [MIGRAÇÕES] Agendamentos gravam `dia`, `profissional_id` e `atualizado_em`; clientes, `telefone_normalizado` e
+#     `atualizado_em`. `ler_lote_migracao`/`atualizar_documentos_migracao` servem às migrações versionadas (`migracoes.py`).
+# 24. [DESEMPENHO] `buscar_agendamentos_no_periodo`: filtro de `horario` na consulta (lê só o período), usado pela busca
+#     dos próximos horários livres e pelos horários de "qualquer profissional"; na coleção global depende do índice
+#     composto `clinic_id` + `horario`.
 
 import streamlit as st
 import pandas as pd
@@ -13,7 +58,9 @@ import json
 from google.cloud import firestore
 from google.cloud.firestore_v1.base_query import FieldFilter
 from zoneinfo import ZoneInfo
+import os
 import sys # Importado para logs
+import cache_agenda
 
 # --- Configuração ---
 TZ_SAO_PAULO = ZoneInfo('America/Sao_Paulo')
@@ -21,9 +68,14 @@ TZ_SAO_PAULO = ZoneInfo('America/Sao_Paulo')
 # --- Inicialização da Conexão ---
 @st.cache_resource
 def get_firestore_client():
-    
+
     try:
-    
+        # Base local (emulador do Firestore), usada pelo teste de carga e em desenvolvimento
+        emulador_host = os.environ.get("FIRESTORE_EMULATOR_HOST")
+        if emulador_host:
+            print(f"LOG: Conectando ao emulador do Firestore em {emulador_host}...", file=sys.stderr)
+            return firestore.Client()
+
         json_credenciais = st.secrets["firestore"]["json_key_string"]
     
         credenciais_dict = json.loads(json_credenciais)
@@ -103,6 +155,131 @@ def toggle_status_clinica(clinic_id: str, status_atual: bool):
         print(f"ERRO AO ALTERAR STATUS DA CLÍNICA: {e}", file=sys.stderr)
         return False
 
+# --- Análise por Clínica (Super Admin) ---
+TAMANHO_PAGINA_CLINICAS = 20
+MESES_ANALISE_CLINICAS = 6
+# Cliente ativo: com algum agendamento (passado ou futuro) a partir de DIAS_CLIENTE_ATIVO dias atrás
+DIAS_CLIENTE_ATIVO = 30
+COLECAO_ATIVIDADE_CLIENTES = 'atividade_clientes'
+# Documentos lidos por operação de um agendamento, medidos pelo `teste_carga.py` (tabela "Leituras por operação", massa
+# padrão: 3 profissionais, 6 agendamentos por profissional/dia, caches vazios): horários livres do profissional no dia,
+# gravação (travas e versão do dia) e consulta pelo PIN. A estimativa diária multiplica a soma pelos agendamentos do
+# dia; medir de novo quando essas consultas mudarem.
+LEITURAS_POR_OPERACAO_AGENDAMENTO = {'disponibilidade': 47, 'gravacao': 6, 'consulta_pin': 2}
+
+def listar_clinicas_pagina(cursor: tuple = None, tamanho: int = TAMANHO_PAGINA_CLINICAS) -> dict:
+    """
+    Uma página de clínicas em ordem de ID, a partir do `cursor` (id,) da página anterior. A ordem por
+    `nome_fantasia` deixaria de fora as clínicas sem o campo (o Firestore só ordena documentos que o têm).
+    Retorna {'clinicas': [...], 'cursor_proximo': cursor da próxima página ou None}.
+    """
+    try:
+        query = db.collection('clinicas').order_by('__name__')
+        if cursor:
+            query = query.start_after(list(cursor))
+        docs = list(query.limit(tamanho + 1).stream())
+
+        clinicas = []
+        for doc in docs[:tamanho]:
+            data = doc.to_dict()
+            data['id'] = doc.id
+            clinicas.append(data)
+
+        cursor_proximo = (clinicas[-1]['id'],) if len(docs) > tamanho else None
+        return {'clinicas': clinicas, 'cursor_proximo': cursor_proximo}
+    except Exception as e:
+        print(f"ERRO AO LISTAR PÁGINA DE CLÍNICAS: {e}", file=sys.stderr)
+        return {'clinicas': [], 'cursor_proximo': None}
+
+def _contar(query) -> int:
+    """Conta os documentos da consulta com agregação no servidor (sem ler os documentos)."""
+    resultado = query.count(alias='total').get()
+    return int(resultado[0][0].value)
+
+def _inicio_do_mes(ano: int, mes: int) -> datetime:
+    return datetime(ano + (mes - 1) // 12, (mes - 1) % 12 + 1, 1, tzinfo=TZ_SAO_PAULO)
+
+def contar_metricas_clinica(clinic_id: str, meses: int = MESES_ANALISE_CLINICAS) -> dict:
+    """
+    Métricas de uso de uma clínica calculadas por agregações `count()`: agendamentos por mês (últimos `meses`,
+    incluindo o atual), clientes cadastrados e ativos, pacotes ativos, profissionais e uma estimativa de leituras por dia
+    (média diária de agendamentos do mês atual × LEITURAS_POR_OPERACAO_AGENDAMENTO). Retorna {} em caso de erro.
+    """
+    try:
+        agora = datetime.now(TZ_SAO_PAULO)
+        clinica_ref = db.collection('clinicas').document(clinic_id)
+        agendamentos_query = _consulta_agendamentos(clinic_id)
+
+        agendamentos_por_mes = {}
+        for deslocamento in range(meses - 1, -1, -1):
+            inicio = _inicio_do_mes(agora.year, agora.month - deslocamento)
+            fim = _inicio_do_mes(agora.year, agora.month - deslocamento + 1)
+            agendamentos_por_mes[inicio.strftime('%Y-%m')] = _contar(
+                agendamentos_query.where(filter=FieldFilter('horario', '>=', inicio))
+                                  .where(filter=FieldFilter('horario', '<', fim)))
+
+        pacotes_ativos = _contar(db.collection_group('pacotes_clientes')
+                                 .where(filter=FieldFilter('clinic_id', '==', clinic_id))
+                                 .where(filter=FieldFilter('status', '==', 'Ativo')))
+
+        limite_ativo = (agora - timedelta(days=DIAS_CLIENTE_ATIVO)).timestamp()
+        clientes_ativos = _contar(clinica_ref.collection(COLECAO_ATIVIDADE_CLIENTES)
+                                  .where(filter=FieldFilter('ultimo_horario', '>=', limite_ativo)))
+
+        # Média diária dos agendamentos do mês corrente até hoje
+        agendamentos_dia = agendamentos_por_mes[agora.strftime('%Y-%m')] / agora.day
+        leituras_dia = round(agendamentos_dia * sum(LEITURAS_POR_OPERACAO_AGENDAMENTO.values()))
+
+        return {
+            'agendamentos_por_mes': agendamentos_por_mes,
+            'clientes': _contar(clinica_ref.collection('clientes')),
+            'clientes_ativos': clientes_ativos,
+            'pacotes_ativos': pacotes_ativos,
+            'profissionais': _contar(clinica_ref.collection('profissionais')),
+            'leituras_estimadas_dia': leituras_dia
+        }
+    except Exception as e:
+        print(f"ERRO AO CONTAR MÉTRICAS DA CLÍNICA {clinic_id}: {e}", file=sys.stderr)
+        return {}
+
+def contar_metricas_clinica_cache(clinic_id: str, meses: int = MESES_ANALISE_CLINICAS) -> dict:
+    """`contar_metricas_clinica` com cache no processo (as contagens mudam devagar); falhas ({}) não ficam em cache."""
+    chave = (clinic_id, meses, datetime.now(TZ_SAO_PAULO).strftime('%Y-%m'))
+    metricas = cache_agenda.ANALISE_CLINICAS.obter(chave, lambda: contar_metricas_clinica(clinic_id, meses))
+    if not metricas:
+        cache_agenda.ANALISE_CLINICAS.invalidar(*chave)
+    return metricas
+
+def invalidar_metricas_clinicas():
+    """Descarta as métricas em cache (recontagem pedida no painel)."""
+    cache_agenda.ANALISE_CLINICAS.invalidar()
+
+def reconstruir_atividade_clientes(clinic_id: str, data_inicio: date = None) -> int:
+    """
+    Grava em `atividade_clientes` o maior horário agendado de cada cliente com agendamentos a partir de `data_inicio`
+    (padrão: DIAS_CLIENTE_ATIVO dias atrás), para os agendamentos anteriores à marcação na gravação.
+    Retorna a quantidade de clientes marcados.
+    """
+    data_inicio = data_inicio or (datetime.now(TZ_SAO_PAULO) - timedelta(days=DIAS_CLIENTE_ATIVO)).date()
+    inicio_dt = datetime.combine(data_inicio, time.min, tzinfo=TZ_SAO_PAULO)
+    try:
+        docs = (_consulta_agendamentos(clinic_id)
+                .where(filter=FieldFilter('horario', '>=', inicio_dt))
+                .select(['cliente_id', 'horario'])
+                .stream())
+        agendamentos = [doc.to_dict() for doc in docs]
+        clientes = {dados['cliente_id'] for dados in agendamentos if dados.get('cliente_id')}
+        for inicio_lote in range(0, len(agendamentos), TAMANHO_LOTE_ESCRITA):
+            batch = db.batch()
+            _marcar_atividade_clientes(batch, clinic_id, agendamentos[inicio_lote:inicio_lote + TAMANHO_LOTE_ESCRITA])
+            batch.commit()
+        print(f"LOG: Atividade de {len(clientes)} clientes reconstruída para {clinic_id}.", file=sys.stderr)
+        return len(clientes)
+
+    except Exception as e:
+        print(f"ERRO AO RECONSTRUIR ATIVIDADE DOS CLIENTES ({clinic_id}): {e}", file=sys.stderr)
+        return 0
+
 # --- Funções de Autenticação ---
 def buscar_clinica_por_login(username, password):
     """Busca uma clínica ativa pelo username e password."""
@@ -153,6 +330,10 @@ def listar_profissionais(clinic_id: str):
         print(f"ERRO AO LISTAR PROFISSIONAIS: {e}", file=sys.stderr)
         return []
 
+def listar_profissionais_cache(clinic_id: str):
+    """Versão em cache de `listar_profissionais` (compartilhada entre sessões; não modificar o retorno)."""
+    return cache_agenda.PROFISSIONAIS.obter((clinic_id,), lambda: listar_profissionais(clinic_id))
+
 def adicionar_profissional(clinic_id: str, nome: str):
     """Adiciona um novo profissional a uma clínica."""
     try:
@@ -160,6 +341,9 @@ def adicionar_profissional(clinic_id: str, nome: str):
         profissionais_ref = db.collection('clinicas').document(clinic_id).collection('profissionais')
     
         profissionais_ref.add({'nome': nome, 'horario_trabalho': {}})
+        cache_agenda.PROFISSIONAIS.invalidar(clinic_id)
+        cache_agenda.AGENDAS.invalidar(clinic_id)
+        cache_agenda.DISPONIBILIDADE.invalidar(clinic_id)
         return True
     
     except Exception as e:
@@ -173,7 +357,9 @@ def remover_profissional(clinic_id: str, profissional_id: str):
     try:
     
         db.collection('clinicas').document(clinic_id).collection('profissionais').document(profissional_id).delete()
-    
+        cache_agenda.PROFISSIONAIS.invalidar(clinic_id)
+        cache_agenda.AGENDAS.invalidar(clinic_id)
+        cache_agenda.DISPONIBILIDADE.invalidar(clinic_id)
         return True
     
     except Exception as e:
@@ -182,12 +368,22 @@ def remover_profissional(clinic_id: str, profissional_id: str):
         return False
 
 def atualizar_horario_profissional(clinic_id: str, prof_id: str, horarios: dict):
-    """Atualiza a configuração de horário de um profissional."""
+    """
+    Atualiza a configuração de horário de um profissional. Se o início do expediente de algum dia muda,
+    as travas dos agendamentos futuros dele são regravadas na nova grade (ver `reconstruir_travas_horarios`).
+    """
     try:
     
         prof_ref = db.collection('clinicas').document(clinic_id).collection('profissionais').document(prof_id)
+        profissional = prof_ref.get().to_dict() or {}
+        anteriores = profissional.get('horario_trabalho') or {}
     
         prof_ref.update({'horario_trabalho': horarios})
+        cache_agenda.PROFISSIONAIS.invalidar(clinic_id)
+        cache_agenda.AGENDAS.invalidar(clinic_id)
+        cache_agenda.DISPONIBILIDADE.invalidar(clinic_id)
+        if any(_origem_grade_dia(anteriores.get(dia)) != _origem_grade_dia(horarios.get(dia)) for dia in _CHAVES_DIAS_SEMANA) and profissional.get('nome'):
+            reconstruir_travas_horarios(clinic_id, profissional_nome=profissional['nome'])
         return True
     
     except Exception as e:
@@ -197,11 +393,304 @@ def atualizar_horario_profissional(clinic_id: str, prof_id: str, horarios: dict)
 
 # --- Funções de Gestão de Agendamentos ---
 
+# --- Coleção dos agendamentos: global ou por clínica ---
+# Layout antigo: coleção global `agendamentos`, filtrada por `clinic_id`. Layout novo: `clinicas/{id}/agendamentos`,
+# com os mesmos IDs e campos (inclusive `clinic_id`). A clínica passa ao layout novo quando a migração grava
+# `agendamentos_por_clinica: True` no documento dela (`tarefas_agendadas.py migrar-agendamentos --corte`); até lá a
+# coleção global continua sendo a fonte e a cópia pode ser refeita e verificada quantas vezes for preciso.
+# Índice necessário no layout novo: a busca pelo PIN (`buscar_agendamento_por_pin`) consulta o collection group
+# `agendamentos` por `pin_code`, e os índices automáticos de campo único só cobrem o escopo de coleção. Antes do
+# primeiro corte, habilite o índice crescente de `pin_code` com escopo de collection group (console do Firestore ou
+# `gcloud firestore indexes fields update pin_code --collection-group=agendamentos`); sem ele, a consulta falha
+# e os links com PIN de agendamentos criados depois do corte deixam de abrir.
+COLECAO_MIGRACOES = 'migracoes'
+MIGRACAO_AGENDAMENTOS_POR_CLINICA = 'agendamentos_por_clinica'
+
+def clinica_usa_agendamentos_por_clinica(clinic_id: str) -> bool:
+    """Indica se a clínica já lê e grava os agendamentos em `clinicas/{id}/agendamentos` (em cache por TTL)."""
+    def carregar():
+        snap = db.collection('clinicas').document(clinic_id).get()
+        return bool(snap.exists and (snap.to_dict() or {}).get('agendamentos_por_clinica'))
+    return bool(clinic_id) and cache_agenda.LAYOUT_AGENDAMENTOS.obter((clinic_id,), carregar)
+
+def _colecao_agendamentos(clinic_id: str):
+    """Coleção onde ficam (e são criados) os agendamentos da clínica."""
+    if clinica_usa_agendamentos_por_clinica(clinic_id):
+        return db.collection('clinicas').document(clinic_id).collection('agendamentos')
+    return db.collection('agendamentos')
+
+def _consulta_agendamentos(clinic_id: str):
+    """Consulta base dos agendamentos da clínica (no layout por clínica, dispensa o filtro por `clinic_id`)."""
+    if clinica_usa_agendamentos_por_clinica(clinic_id):
+        return _colecao_agendamentos(clinic_id)
+    return db.collection('agendamentos').where(filter=FieldFilter('clinic_id', '==', clinic_id))
+
+def _ref_agendamento(agendamento_id: str, clinic_id: str = None):
+    """
+    Referência do agendamento. Sem `clinic_id`, a clínica é descoberta pela cópia na coleção global
+    (uma leitura a mais): agendamentos criados depois do corte só são encontrados com o `clinic_id`.
+    """
+    if clinic_id:
+        return _colecao_agendamentos(clinic_id).document(agendamento_id)
+    ref_global = db.collection('agendamentos').document(agendamento_id)
+    snap = ref_global.get()
+    clinic_id_global = (snap.to_dict() or {}).get('clinic_id') if snap.exists else None
+    if clinic_id_global and clinica_usa_agendamentos_por_clinica(clinic_id_global):
+        return _colecao_agendamentos(clinic_id_global).document(agendamento_id)
+    return ref_global
+
+def _invalidar_disponibilidade_do_agendamento(id_agendamento: str, todas_as_datas: bool = False):
+    """
+    Invalida o cache de disponibilidade afetado por uma escrita feita só pelo ID do agendamento.
+    As entradas em cache guardam os IDs dos blocos ocupados, então localizamos a clínica/profissional
+    por elas. Com `todas_as_datas` (mudança de horário/profissional), se o agendamento não estiver
+    em cache não há como saber o destino, e o cache inteiro é descartado.
+    """
+    chaves = cache_agenda.DISPONIBILIDADE.chaves_onde(lambda v: id_agendamento in v['ids'])
+    if todas_as_datas:
+        if not chaves:
+            cache_agenda.DISPONIBILIDADE.invalidar()
+        for clinic_id in {c[0] for c in chaves}:
+            cache_agenda.DISPONIBILIDADE.invalidar(clinic_id)
+        return
+    for chave in chaves:
+        cache_agenda.DISPONIBILIDADE.invalidar(*chave)
+
+# --- Versão da agenda por dia (cache de disponibilidade entre instâncias) ---
+# clinicas/{clinic_id}/versoes_agenda/{AAAA-MM-DD}: {'versao', 'atualizado_em'}, incrementada na mesma transação de toda
+# escrita que muda os agendamentos individuais confirmados do dia. A disponibilidade em cache (`logica_negocio`) leva a
+# versão na chave, então uma gravação feita em outra instância faz a próxima leitura recarregar o dia sem esperar o TTL.
+# Mudanças de expediente e feriados continuam valendo nas outras instâncias só após o TTL do cache.
+
+def _ref_versao_agenda_dia(clinic_id: str, dia: str):
+    return db.collection('clinicas').document(clinic_id).collection('versoes_agenda').document(dia)
+
+def _marcar_dias_alterados(escritor, clinic_id: str, horarios: list):
+    """Incrementa (no batch ou na transação `escritor`) a versão dos dias dos `horarios`."""
+    for dia in {chave_dia(horario) for horario in horarios if isinstance(horario, datetime)}:
+        escritor.set(_ref_versao_agenda_dia(clinic_id, dia), {'versao': firestore.Increment(1), 'atualizado_em': firestore.SERVER_TIMESTAMP}, merge=True)
+
+def _marcar_atividade_clientes(escritor, clinic_id: str, agendamentos: list):
+    """
+    Guarda (no batch ou na transação `escritor`) o maior `horario` agendado de cada cliente dos `agendamentos`, em
+    segundos; o `Maximum` dispensa ler o documento. Base da contagem de clientes ativos da análise por clínica.
+    """
+    ultimos = {}
+    for dados in agendamentos:
+        if dados.get('cliente_id') and isinstance(dados.get('horario'), datetime):
+            ultimos[dados['cliente_id']] = max(ultimos.get(dados['cliente_id'], 0), dados['horario'].timestamp())
+    atividade_ref = db.collection('clinicas').document(clinic_id).collection(COLECAO_ATIVIDADE_CLIENTES)
+    for cliente_id, ultimo_horario in ultimos.items():
+        escritor.set(atividade_ref.document(cliente_id), {'ultimo_horario': firestore.Maximum(ultimo_horario)}, merge=True)
+
+def ler_versao_agenda_dia(clinic_id: str, data: date):
+    """Versão atual da agenda do dia (0 se nunca alterada), ou None se a leitura falhar."""
+    try:
+        snap = _ref_versao_agenda_dia(clinic_id, data.strftime('%Y-%m-%d')).get()
+        return (snap.to_dict() or {}).get('versao', 0)
+
+    except Exception as e:
+        print(f"ERRO AO LER VERSÃO DA AGENDA ({clinic_id}, {data}): {e}", file=sys.stderr)
+        return None
+
+# --- Campos derivados dos agendamentos ---
+# `dia` (AAAA-MM-DD em SP), `profissional_id` e `atualizado_em` são gravados em toda escrita de agendamento;
+# nos documentos antigos, são preenchidos pelas migrações (`migracoes.py`).
+
+def chave_dia(horario: datetime) -> str:
+    """Dia do agendamento no fuso da clínica (AAAA-MM-DD), para filtros por igualdade."""
+    return horario.astimezone(TZ_SAO_PAULO).strftime('%Y-%m-%d')
+
+def normalizar_telefone(telefone) -> str:
+    """Só os dígitos do telefone, para busca e deduplicação."""
+    return ''.join(caractere for caractere in str(telefone or '') if caractere.isdigit())
+
+def mapa_ids_profissionais(clinic_id: str) -> dict:
+    """{nome do profissional: id}, a partir do cache de profissionais."""
+    return {p.get('nome'): p.get('id') for p in listar_profissionais_cache(clinic_id)}
+
+def _campos_derivados_agendamento(clinic_id: str, campos: dict) -> dict:
+    """Campos derivados a gravar junto com `campos` (criação ou atualização de um agendamento)."""
+    derivados = {'atualizado_em': firestore.SERVER_TIMESTAMP}
+    if isinstance(campos.get('horario'), datetime):
+        derivados['dia'] = chave_dia(campos['horario'])
+    if campos.get('profissional_nome') and clinic_id:
+        derivados['profissional_id'] = mapa_ids_profissionais(clinic_id).get(campos['profissional_nome'])
+    return derivados
+
+# --- Travas de horário (agendamentos individuais) ---
+# clinicas/{clinic_id}/travas_horarios/{profissional}_{AAAAMMDDHHMM UTC}: uma trava por fatia de
+# TRAVA_GRANULARIDADE_MIN minutos coberta pelo agendamento, com {'agendamento_id', 'profissional_nome', 'horario'}.
+# As fatias seguem a grade de horários do profissional no dia (a partir do início do expediente, no passo de
+# `intervalo_minimo` de logica_negocio), então dois horários da grade só disputam uma trava se de fato se sobrepõem.
+# Duas sessões que reservam o mesmo horário disputam as mesmas travas na transação, e só uma grava; as escritas em
+# lote (séries) fazem o mesmo, item a item. Uma trava cujo agendamento não está mais confirmado naquele
+# horário/profissional é considerada abandonada e pode ser reaproveitada.
+# `reconstruir_travas_horarios` grava as travas dos agendamentos anteriores a elas (tarefa `reconstruir-travas`) e é
+# chamada quando o início do expediente de um profissional muda (a grade, e com ela as chaves, se desloca).
+
+TRAVA_GRANULARIDADE_MIN = 15
+_CHAVES_DIAS_SEMANA = ['seg', 'ter', 'qua', 'qui', 'sex', 'sab', 'dom']
+
+def _origem_grade_dia(horario_dia: dict) -> int:
+    """Início do expediente (`horario_trabalho` de um dia), em minutos desde a meia-noite (0 se não trabalha nele)."""
+    if not (horario_dia or {}).get('ativo'):
+        return 0
+    try:
+        inicio = datetime.strptime(horario_dia['inicio'], "%H:%M")
+    except (ValueError, KeyError, TypeError):
+        return 0
+    return inicio.hour * 60 + inicio.minute
+
+def _origem_grade_profissional(clinic_id: str, profissional_nome: str, dia: date) -> int:
+    """Origem da grade de horários do profissional no dia (início do expediente)."""
+    profissional = next((p for p in listar_profissionais_cache(clinic_id) if p.get('nome') == profissional_nome), {})
+    return _origem_grade_dia((profissional.get('horario_trabalho') or {}).get(_CHAVES_DIAS_SEMANA[dia.weekday()]))
+
+def _refs_travas_horario(clinic_id: str, profissional_nome: str, horario: datetime, duracao_min: int) -> list:
+    """Referências das travas que cobrem [horario, horario + duracao_min), em fatias alinhadas à grade do profissional."""
+    inicio = horario.astimezone(TZ_SAO_PAULO)
+    meia_noite = datetime.combine(inicio.date(), time.min, tzinfo=TZ_SAO_PAULO)
+    inicio_min = inicio.hour * 60 + inicio.minute
+    fim_min = inicio_min + int(duracao_min or 0)
+    origem = _origem_grade_profissional(clinic_id, profissional_nome, inicio.date())
+    travas_ref = db.collection('clinicas').document(clinic_id).collection('travas_horarios')
+    chave_profissional = str(profissional_nome).replace('/', '_')
+    refs = []
+    fatia = origem + (inicio_min - origem) // TRAVA_GRANULARIDADE_MIN * TRAVA_GRANULARIDADE_MIN
+    while fatia < fim_min or not refs:
+        horario_fatia = (meia_noite + timedelta(minutes=fatia)).astimezone(ZoneInfo('UTC'))
+        refs.append(travas_ref.document(f"{chave_profissional}_{horario_fatia.strftime('%Y%m%d%H%M')}"))
+        fatia += TRAVA_GRANULARIDADE_MIN
+    return refs
+
+def _horario_trava(ref) -> datetime:
+    return datetime.strptime(ref.id.rsplit('_', 1)[1], '%Y%m%d%H%M').replace(tzinfo=ZoneInfo('UTC'))
+
+def _trava_ativa(trava: dict, agendamento: dict) -> bool:
+    """A trava só vale enquanto o agendamento dono dela continua confirmado cobrindo a fatia."""
+    if not agendamento or agendamento.get('status') != 'Confirmado':
+        return False
+    if agendamento.get('profissional_nome') != trava.get('profissional_nome'):
+        return False
+    inicio = agendamento.get('horario')
+    if not isinstance(inicio, datetime) or not isinstance(trava.get('horario'), datetime):
+        return False
+    fim = inicio + timedelta(minutes=int(agendamento.get('duracao_min', 0) or 0))
+    fatia = trava['horario']
+    return inicio < fatia + timedelta(minutes=TRAVA_GRANULARIDADE_MIN) and fatia < fim
+
+def _ler_travas_em_lote(transaction, clinic_id: str, refs_por_agendamento: dict):
+    """
+    Lê na transação as travas de vários agendamentos ({agendamento_id: refs}) e os donos delas.
+    Retorna (conflitos, travas_existentes): `conflitos` é {agendamento_id: horário da primeira fatia presa por
+    outro agendamento ativo}, contando como presa a fatia já pedida por um item anterior do lote;
+    `travas_existentes` é {doc_id: dados}.
+    """
+    todas_refs = list({ref.id: ref for refs in refs_por_agendamento.values() for ref in refs}.values())
+    travas = {snap.id: snap.to_dict() for snap in transaction.get_all(todas_refs) if snap.exists} if todas_refs else {}
+    donos_ids = {t.get('agendamento_id') for t in travas.values()} - {None}
+    donos = {}
+    if donos_ids:
+        donos_refs = [_colecao_agendamentos(clinic_id).document(ag_id) for ag_id in donos_ids]
+        donos = {snap.id: snap.to_dict() for snap in transaction.get_all(donos_refs) if snap.exists}
+    conflitos, pedidas = {}, set()
+    for agendamento_id, refs in refs_por_agendamento.items():
+        for ref in refs:
+            trava = travas.get(ref.id)
+            if ref.id in pedidas:
+                conflitos[agendamento_id] = _horario_trava(ref)
+                break
+            if trava and trava.get('agendamento_id') != agendamento_id and _trava_ativa(trava, donos.get(trava.get('agendamento_id'))):
+                conflitos[agendamento_id] = trava['horario']
+                break
+        else:
+            pedidas.update(ref.id for ref in refs)
+    return conflitos, travas
+
+def _ler_travas(transaction, clinic_id: str, refs: list, agendamento_id: str = None):
+    """
+    Lê as travas de um agendamento na transação. Retorna (horario_em_conflito, travas_existentes): o conflito
+    é a primeira fatia presa por outro agendamento ativo (ou None); `travas_existentes` é {doc_id: dados}.
+    """
+    conflitos, travas = _ler_travas_em_lote(transaction, clinic_id, {agendamento_id: refs})
+    return conflitos.get(agendamento_id), travas
+
+def _gravar_travas(transaction, refs: list, travas_existentes: dict, agendamento_id: str, profissional_nome: str):
+    for ref in refs:
+        dados_trava = {
+            'agendamento_id': agendamento_id,
+            'profissional_nome': profissional_nome,
+            'horario': _horario_trava(ref)
+        }
+        if ref.id in travas_existentes:
+            transaction.set(ref, dados_trava) # Trava abandonada (ou do próprio agendamento): reaproveitada
+        else:
+            transaction.create(ref, dados_trava)
+
+def _liberar_travas(transaction, refs: list, travas_existentes: dict, agendamento_id: str):
+    for ref in refs:
+        if travas_existentes.get(ref.id, {}).get('agendamento_id') == agendamento_id:
+            transaction.delete(ref)
+
+def _mensagem_conflito_trava(horario: datetime) -> str:
+    return f"Horário indisponível: já reservado por outro agendamento ({horario.astimezone(TZ_SAO_PAULO).strftime('%H:%M')})."
+
+def reconstruir_travas_horarios(clinic_id: str, data_inicio: date = None, profissional_nome: str = None) -> dict:
+    """
+    Grava as travas dos agendamentos individuais confirmados a partir de `data_inicio` (padrão: hoje), opcionalmente
+    de um só profissional: agendamentos anteriores às travas, ou com as chaves deslocadas por uma mudança no início
+    do expediente. Um agendamento que se sobrepõe a outro já travado fica sem travas e vai para o relatório.
+    Retorna {'travas': n, 'sobrepostos': [ids]}.
+    """
+    data_inicio = data_inicio or datetime.now(TZ_SAO_PAULO).date()
+    inicio_dt = datetime.combine(data_inicio, time.min, tzinfo=TZ_SAO_PAULO)
+    relatorio = {'travas': 0, 'sobrepostos': []}
+    try:
+        query = _consulta_agendamentos(clinic_id).where(filter=FieldFilter('status', '==', 'Confirmado'))
+        if profissional_nome:
+            query = query.where(filter=FieldFilter('profissional_nome', '==', profissional_nome))
+        agendamentos = []
+        for doc in query.stream():
+            item = doc.to_dict()
+            if not item.get('turma_id') and isinstance(item.get('horario'), datetime) and item['horario'] >= inicio_dt:
+                agendamentos.append((item['horario'], doc.id, item))
+
+        travas = {}
+        for _, ag_id, item in sorted(agendamentos, key=lambda a: (a[0], a[1])):
+            refs = _refs_travas_horario(clinic_id, item.get('profissional_nome'), item['horario'], item.get('duracao_min'))
+            if any(ref.id in travas for ref in refs):
+                relatorio['sobrepostos'].append(ag_id)
+                continue
+            travas.update({ref.id: (ref, ag_id, item.get('profissional_nome')) for ref in refs})
+
+        itens = list(travas.values())
+        for inicio_lote in range(0, len(itens), TAMANHO_LOTE_ESCRITA):
+            batch = db.batch()
+            for ref, ag_id, nome in itens[inicio_lote:inicio_lote + TAMANHO_LOTE_ESCRITA]:
+                batch.set(ref, {'agendamento_id': ag_id, 'profissional_nome': nome, 'horario': _horario_trava(ref)})
+            batch.commit()
+        relatorio['travas'] = len(itens)
+        print(f"LOG: Travas de horário reconstruídas para {clinic_id}{f' ({profissional_nome})' if profissional_nome else ''}: "
+              f"{len(itens)} travas, {len(relatorio['sobrepostos'])} agendamentos sobrepostos.", file=sys.stderr)
+        return relatorio
+
+    except Exception as e:
+        print(f"ERRO AO RECONSTRUIR TRAVAS DE HORÁRIO ({clinic_id}): {e}", file=sys.stderr)
+        return relatorio
+
 def salvar_agendamento(clinic_id: str, dados: dict, pin_code: str):
-    """Cria um novo agendamento para uma clínica."""
+    """
+    Cria um novo agendamento para uma clínica.
+    Agendamentos de turma passam por `salvar_agendamento_turma` (reserva de vaga transacional);
+    os individuais criam, na mesma transação, as travas do horário do profissional.
+    Com `pacote_cliente_id`, o crédito é debitado (com lançamento no extrato) na mesma transação.
+    """
+    if dados.get('turma_id'):
+        return salvar_agendamento_turma(clinic_id, dados, pin_code)
     try:
     
-        agendamentos_ref = db.collection('agendamentos')
+        agendamentos_ref = _colecao_agendamentos(clinic_id)
     
         cliente_id_val = dados.get('cliente_id')
     
@@ -221,8 +710,32 @@ def salvar_agendamento(clinic_id: str, dados: dict, pin_code: str):
             'turma_id': dados.get('turma_id'),
             'pacote_cliente_id': dados.get('pacote_cliente_id')
         }
+        data_para_salvar.update(_campos_derivados_agendamento(clinic_id, data_para_salvar))
         print(f"LOG: Dados a serem salvos no agendamento: {data_para_salvar}", file=sys.stderr) # Log Dados
-        agendamentos_ref.add(data_para_salvar)
+        agendamento_ref = agendamentos_ref.document()
+        travas_refs = _refs_travas_horario(clinic_id, dados['profissional_nome'], dados['horario'], dados['duracao_min'])
+
+        @firestore.transactional
+        def _reservar(transaction):
+            conflito, travas = _ler_travas(transaction, clinic_id, travas_refs)
+            if conflito:
+                return _mensagem_conflito_trava(conflito)
+            debito = _ler_debito_pacote(transaction, clinic_id, dados, [agendamento_ref.id])
+            if isinstance(debito, str):
+                return debito
+            _gravar_travas(transaction, travas_refs, travas, agendamento_ref.id, dados['profissional_nome'])
+            transaction.create(agendamento_ref, data_para_salvar)
+            _marcar_dias_alterados(transaction, clinic_id, [dados['horario']])
+            _marcar_atividade_clientes(transaction, clinic_id, [data_para_salvar])
+            _gravar_debito_pacote(transaction, debito)
+            return True
+
+        resultado = _reservar(db.transaction())
+        if resultado is not True:
+            print(f"LOG: Agendamento recusado: {resultado}", file=sys.stderr)
+            return resultado
+        if isinstance(dados['horario'], datetime):
+            cache_agenda.DISPONIBILIDADE.invalidar(clinic_id, dados['profissional_nome'], dados['horario'].astimezone(TZ_SAO_PAULO).date())
         print("LOG: Agendamento salvo com sucesso.", file=sys.stderr) # Log Sucesso
         return True
     
@@ -232,20 +745,26 @@ def salvar_agendamento(clinic_id: str, dados: dict, pin_code: str):
         return str(e)
 
 def buscar_agendamento_por_pin(pin_code: str):
-    """Busca um agendamento pelo PIN."""
+    """
+    Busca um agendamento pelo PIN: primeiro na coleção global (layout antigo e cópias anteriores ao corte;
+    de clínica já migrada, relê a versão atual em `clinicas/{id}/agendamentos`) e, se não achar, em todas
+    as coleções `agendamentos` das clínicas (collection group; requer o índice de `pin_code` nesse escopo,
+    ver a seção do layout dos agendamentos).
+    """
     try:
     
         query = db.collection('agendamentos').where(filter=FieldFilter('pin_code', '==', pin_code)).limit(1)
     
-        docs = query.stream()
-    
-        for doc in docs:
-    
-            data = doc.to_dict()
-            data['id'] = doc.id
-            if 'horario' in data and isinstance(data['horario'], datetime):
-                data['horario'] = data['horario'].astimezone(TZ_SAO_PAULO)
-            return data
+        docs = list(query.stream())
+        if docs:
+            clinic_id = docs[0].to_dict().get('clinic_id')
+            if clinic_id and clinica_usa_agendamentos_por_clinica(clinic_id):
+                return _agendamento_do_snapshot(_colecao_agendamentos(clinic_id).document(docs[0].id).get()) or _agendamento_do_snapshot(docs[0])
+            return _agendamento_do_snapshot(docs[0])
+
+        query = db.collection_group('agendamentos').where(filter=FieldFilter('pin_code', '==', pin_code)).limit(1)
+        for doc in query.stream():
+            return _agendamento_do_snapshot(doc)
     
         return None
     
@@ -254,6 +773,50 @@ def buscar_agendamento_por_pin(pin_code: str):
         print(f"ERRO NA BUSCA POR PIN: {e}", file=sys.stderr)
         return None
 
+def _agendamento_do_snapshot(snap, clinic_id: str = None):
+    # Converte o documento para o formato das buscas; com `clinic_id`, ignora agendamentos de outra clínica
+    if not snap.exists:
+        return None
+    data = snap.to_dict()
+    if clinic_id and data.get('clinic_id') != clinic_id:
+        print(f"WARN: Agendamento {snap.id} não pertence à clínica {clinic_id}.", file=sys.stderr)
+        return None
+    data['id'] = snap.id
+    if 'horario' in data and isinstance(data['horario'], datetime):
+        data['horario'] = data['horario'].astimezone(TZ_SAO_PAULO)
+    return data
+
+def buscar_agendamento_por_id(agendamento_id: str, clinic_id: str = None):
+    """Busca um agendamento pelo ID (uma leitura). Com `clinic_id`, só o devolve se for dessa clínica."""
+    if not agendamento_id:
+        return None
+    try:
+        return _agendamento_do_snapshot(_ref_agendamento(agendamento_id, clinic_id).get(), clinic_id)
+    except Exception as e:
+        print(f"ERRO NA BUSCA DE AGENDAMENTO POR ID: {e}", file=sys.stderr)
+        return None
+
+def buscar_agendamentos_por_ids(agendamento_ids: list, clinic_id: str = None) -> dict:
+    """
+    Busca vários agendamentos pelo ID numa única chamada (`get_all`); sem `clinic_id`, só na coleção global.
+    Retorna {id: agendamento}; IDs inexistentes (ou de outra clínica, com `clinic_id`) ficam de fora.
+    """
+    ids = list(dict.fromkeys(ag_id for ag_id in agendamento_ids if ag_id))
+    if not ids:
+        return {}
+    try:
+        agendamentos_ref = _colecao_agendamentos(clinic_id) if clinic_id else db.collection('agendamentos')
+        refs = [agendamentos_ref.document(ag_id) for ag_id in ids]
+        agendamentos = {}
+        for snap in db.get_all(refs):
+            agendamento = _agendamento_do_snapshot(snap, clinic_id)
+            if agendamento:
+                agendamentos[snap.id] = agendamento
+        return agendamentos
+    except Exception as e:
+        print(f"ERRO NA BUSCA DE AGENDAMENTOS POR IDS: {e}", file=sys.stderr)
+        return {}
+
 def buscar_agendamentos_por_intervalo(clinic_id: str, start_date: date, end_date: date):
     
     """Busca todos os agendamentos de uma clínica em um intervalo de datas."""
@@ -264,7 +827,7 @@ def buscar_agendamentos_por_intervalo(clinic_id: str, start_date: date, end_date
         end_dt = datetime.combine(end_date, time.max, tzinfo=TZ_SAO_PAULO)
     
     
-        query = db.collection('agendamentos').where(filter=FieldFilter('clinic_id', '==', clinic_id))
+        query = _consulta_agendamentos(clinic_id)
     
         # REMOVIDO FILTRO DE HORARIO DA QUERY - FILTRADO EM PYTHON ABAIXO
         # Isso evita a necessidade de um índice composto clinic_id + horario
@@ -307,13 +870,40 @@ def buscar_agendamentos_por_intervalo(clinic_id: str, start_date: date, end_date
         print(f"ERRO NA BUSCA DE AGENDAMENTOS POR INTERVALO: {e}", file=sys.stderr)
         return pd.DataFrame()
 
+def buscar_agendamentos_no_periodo(clinic_id: str, start_date: date, end_date: date):
+    """
+    Agendamentos da clínica entre `start_date` e `end_date` (inclusive), com o filtro de `horario` na consulta:
+    só os documentos do período são lidos. No layout por clínica basta o índice automático de `horario`; na
+    coleção global a consulta exige o índice composto `clinic_id` + `horario` e, sem ele (consulta recusada),
+    recorre a `buscar_agendamentos_por_intervalo`, que lê todos os agendamentos da clínica.
+    """
+    try:
+        start_dt = datetime.combine(start_date, time.min, tzinfo=TZ_SAO_PAULO)
+        end_dt = datetime.combine(end_date, time.max, tzinfo=TZ_SAO_PAULO)
+        query = _consulta_agendamentos(clinic_id) \
+                    .where(filter=FieldFilter('horario', '>=', start_dt)) \
+                    .where(filter=FieldFilter('horario', '<=', end_dt))
+
+        data = []
+        for doc in query.stream():
+            item = doc.to_dict()
+            item['id'] = doc.id
+            item['horario'] = item['horario'].astimezone(TZ_SAO_PAULO)
+            data.append(item)
+        print(f"LOG: buscar_agendamentos_no_periodo ({clinic_id}, {start_date} a {end_date}): {len(data)} docs lidos.", file=sys.stderr)
+        return pd.DataFrame(data)
+
+    except Exception as e:
+        print(f"ERRO NA BUSCA DE AGENDAMENTOS NO PERÍODO (lendo todos os da clínica): {e}", file=sys.stderr)
+        return buscar_agendamentos_por_intervalo(clinic_id, start_date, end_date)
+
 def buscar_agendamentos_por_data_e_profissional(clinic_id: str, profissional_nome: str, data_selecionada: date):
     """Busca agendamentos para um profissional específico em uma data específica."""
     try:
         start_dt = datetime.combine(data_selecionada, time.min, tzinfo=TZ_SAO_PAULO)
         end_dt = datetime.combine(data_selecionada, time.max, tzinfo=TZ_SAO_PAULO)
 
-        query = db.collection('agendamentos').where(filter=FieldFilter('clinic_id', '==', clinic_id)) \
+        query = _consulta_agendamentos(clinic_id) \
                                         .where(filter=FieldFilter('profissional_nome', '==', profissional_nome))
         # REMOVIDO FILTRO DE HORARIO DA QUERY - FILTRADO EM PYTHON ABAIXO
 
@@ -353,13 +943,49 @@ def buscar_agendamentos_por_data_e_profissional(clinic_id: str, profissional_nom
         print(f"ERRO NA BUSCA POR DATA E PROFISSIONAL: {e}", file=sys.stderr)
         return pd.DataFrame()
 
-def atualizar_status_agendamento(id_agendamento: str, novo_status: str):
-    """Atualiza o status de um agendamento específico."""
+def atualizar_status_agendamento(id_agendamento: str, novo_status: str, clinic_id: str = None, somente_confirmado: bool = False):
+    """
+    Atualiza o status de um agendamento específico (`clinic_id` localiza a coleção, ver `_ref_agendamento`).
+    Se o agendamento deixa de estar 'Confirmado', as travas do horário (individual) ou a vaga
+    no contador da aula (turma) são liberadas na mesma transação; num cancelamento, o crédito
+    de pacote debitado para ele é estornado (uma única vez).
+    Com `somente_confirmado`, um agendamento que não está confirmado (ou é de outra clínica) não é alterado
+    e a função retorna False; a conferência é feita na própria transação.
+    """
     try:
 
-        doc_ref = db.collection('agendamentos').document(id_agendamento)
-
-        doc_ref.update({'status': novo_status})
+        doc_ref = _ref_agendamento(id_agendamento, clinic_id)
+
+        @firestore.transactional
+        def _atualizar(transaction):
+            snapshot = doc_ref.get(transaction=transaction)
+            agendamento = snapshot.to_dict() or {}
+            if somente_confirmado and (agendamento.get('status') != 'Confirmado' or (clinic_id and agendamento.get('clinic_id') != clinic_id)):
+                return False
+            saindo_de_confirmado = agendamento.get('status') == 'Confirmado' and novo_status != 'Confirmado'
+            travas_refs, travas = [], {}
+            if saindo_de_confirmado and not agendamento.get('turma_id') and isinstance(agendamento.get('horario'), datetime):
+                travas_refs = _refs_travas_horario(agendamento['clinic_id'], agendamento['profissional_nome'], agendamento['horario'], agendamento.get('duracao_min'))
+                travas = {snap.id: snap.to_dict() for snap in transaction.get_all(travas_refs) if snap.exists}
+            contador_ref = None
+            if saindo_de_confirmado and agendamento.get('turma_id') and isinstance(agendamento.get('horario'), datetime):
+                contador_ref = _ref_ocupacao_turma(agendamento['clinic_id'], agendamento['turma_id'], agendamento['horario'])
+                confirmados = _ler_contadores_turma(transaction, agendamento['clinic_id'], agendamento['turma_id'], [agendamento['horario']])[contador_ref.id]
+            estornos = None
+            if saindo_de_confirmado and novo_status.startswith('Cancelado'):
+                estornos = _ler_estornos_pacote(transaction, agendamento.get('clinic_id'), agendamento.get('cliente_id'), agendamento.get('pacote_cliente_id'), [id_agendamento])
+            transaction.update(doc_ref, {'status': novo_status, 'atualizado_em': firestore.SERVER_TIMESTAMP})
+            _liberar_travas(transaction, travas_refs, travas, id_agendamento)
+            if travas_refs:
+                _marcar_dias_alterados(transaction, agendamento['clinic_id'], [agendamento['horario']])
+            _gravar_estornos_pacote(transaction, estornos)
+            if contador_ref:
+                transaction.set(contador_ref, _dados_ocupacao_turma(agendamento['turma_id'], agendamento['horario'], max(confirmados - 1, 0)))
+
+        if _atualizar(db.transaction()) is False:
+            return False
+        # O status só sai de 'Confirmado', então basta invalidar o dia que continha o agendamento
+        _invalidar_disponibilidade_do_agendamento(id_agendamento)
 
         return True
 
@@ -368,14 +994,69 @@ def atualizar_status_agendamento(id_agendamento: str, novo_status: str):
         print(f"ERRO AO ATUALIZAR STATUS ({id_agendamento} para {novo_status}): {e}", file=sys.stderr)
         return False
 
-def atualizar_horario_agendamento(id_agendamento: str, novo_horario: datetime):
-    """Atualiza o horário de um agendamento (usado na remarcação)."""
-    try:
+def _remanejar_agendamento(id_agendamento: str, novos_campos: dict, clinic_id: str = None):
+    """
+    Altera horário e/ou profissional de um agendamento numa transação, movendo as travas de horário:
+    as novas fatias são conferidas e reservadas, e as antigas, liberadas. Retorna True ou a mensagem do conflito.
+    Agendamentos de turma não usam travas: a vaga passa do contador da aula antiga para o da nova (se houver vaga).
+    """
+    doc_ref = _ref_agendamento(id_agendamento, clinic_id)
+
+    @firestore.transactional
+    def _remanejar(transaction):
+        agendamento = doc_ref.get(transaction=transaction).to_dict() or {}
+        campos = {**novos_campos, **_campos_derivados_agendamento(agendamento.get('clinic_id'), novos_campos)}
+        if agendamento.get('status') != 'Confirmado' or not isinstance(agendamento.get('horario'), datetime):
+            transaction.update(doc_ref, campos)
+            return True
+        if agendamento.get('turma_id'):
+            return _mover_vaga_turma(transaction, doc_ref, agendamento, campos)
+        atualizado = {**agendamento, **novos_campos}
+        refs_antigas = _refs_travas_horario(agendamento['clinic_id'], agendamento['profissional_nome'], agendamento['horario'], agendamento.get('duracao_min'))
+        refs_novas = _refs_travas_horario(atualizado['clinic_id'], atualizado['profissional_nome'], atualizado['horario'], atualizado.get('duracao_min'))
+        conflito, travas_novas = _ler_travas(transaction, atualizado['clinic_id'], refs_novas, id_agendamento)
+        if conflito:
+            return _mensagem_conflito_trava(conflito)
+        ids_novas = {ref.id for ref in refs_novas}
+        refs_antigas = [ref for ref in refs_antigas if ref.id not in ids_novas]
+        travas_antigas = {snap.id: snap.to_dict() for snap in transaction.get_all(refs_antigas) if snap.exists}
+        transaction.update(doc_ref, campos)
+        _liberar_travas(transaction, refs_antigas, travas_antigas, id_agendamento)
+        _gravar_travas(transaction, refs_novas, travas_novas, id_agendamento, atualizado['profissional_nome'])
+        _marcar_dias_alterados(transaction, atualizado['clinic_id'], [agendamento['horario'], atualizado['horario']])
+        _marcar_atividade_clientes(transaction, atualizado['clinic_id'], [atualizado])
+        return True
 
-        doc_ref = db.collection('agendamentos').document(id_agendamento)
+    return _remanejar(db.transaction())
+
+def _mover_vaga_turma(transaction, doc_ref, agendamento: dict, campos: dict):
+    """Remarcação de um agendamento de turma: libera a vaga da aula antiga e reserva a da nova, se não estiver lotada."""
+    clinic_id, turma_id = agendamento['clinic_id'], agendamento['turma_id']
+    horario_antigo, horario_novo = agendamento['horario'], campos.get('horario', agendamento['horario'])
+    ref_antiga, ref_nova = _ref_ocupacao_turma(clinic_id, turma_id, horario_antigo), _ref_ocupacao_turma(clinic_id, turma_id, horario_novo)
+    if ref_antiga.id == ref_nova.id:
+        transaction.update(doc_ref, campos)
+        return True
+    turma_ref = db.collection('clinicas').document(clinic_id).collection('turmas').document(turma_id)
+    capacidade = (turma_ref.get(transaction=transaction).to_dict() or {}).get('capacidade_maxima', 0)
+    contadores = _ler_contadores_turma(transaction, clinic_id, turma_id, [horario_antigo, horario_novo])
+    if contadores[ref_nova.id] >= capacidade:
+        return "Turma lotada: não há mais vagas nesta aula."
+    transaction.update(doc_ref, campos)
+    transaction.set(ref_antiga, _dados_ocupacao_turma(turma_id, horario_antigo, max(contadores[ref_antiga.id] - 1, 0)))
+    transaction.set(ref_nova, _dados_ocupacao_turma(turma_id, horario_novo, contadores[ref_nova.id] + 1))
+    return True
+
+def atualizar_horario_agendamento(id_agendamento: str, novo_horario: datetime, clinic_id: str = None):
+    """Atualiza o horário de um agendamento (usado na remarcação), movendo as travas de horário."""
+    try:
 
         novo_horario_utc = novo_horario.astimezone(ZoneInfo('UTC'))
-        doc_ref.update({'horario': novo_horario_utc})
+        resultado = _remanejar_agendamento(id_agendamento, {'horario': novo_horario_utc}, clinic_id)
+        if resultado is not True:
+            print(f"ERRO AO ATUALIZAR HORÁRIO ({id_agendamento} para {novo_horario}): {resultado}", file=sys.stderr)
+            return False
+        _invalidar_disponibilidade_do_agendamento(id_agendamento, todas_as_datas=True)
         return True
 
     except Exception as e:
@@ -383,16 +1064,18 @@ def atualizar_horario_agendamento(id_agendamento: str, novo_horario: datetime):
         print(f"ERRO AO ATUALIZAR HORÁRIO ({id_agendamento} para {novo_horario}): {e}", file=sys.stderr)
         return False
 
-def atualizar_profissional_agendamento(id_agendamento: str, novo_profissional_nome: str):
+def atualizar_profissional_agendamento(id_agendamento: str, novo_profissional_nome: str, clinic_id: str = None):
     """
     Atualiza o nome do profissional de um agendamento.
-    Usado para realocação de compromissos individuais.
+    Usado para realocação de compromissos individuais; as travas passam para o novo profissional.
     """
     try:
 
-        doc_ref = db.collection('agendamentos').document(id_agendamento)
-
-        doc_ref.update({'profissional_nome': novo_profissional_nome})
+        resultado = _remanejar_agendamento(id_agendamento, {'profissional_nome': novo_profissional_nome}, clinic_id)
+        if resultado is not True:
+            print(f"ERRO AO ATUALIZAR PROFISSIONAL ({id_agendamento} para {novo_profissional_nome}): {resultado}", file=sys.stderr)
+            return False
+        _invalidar_disponibilidade_do_agendamento(id_agendamento, todas_as_datas=True)
 
         print(f"LOG: Agendamento {id_agendamento} realocado para {novo_profissional_nome}.", file=sys.stderr)
         return True
@@ -402,6 +1085,201 @@ def atualizar_profissional_agendamento(id_agendamento: str, novo_profissional_no
         print(f"ERRO AO ATUALIZAR PROFISSIONAL ({id_agendamento} para {novo_profissional_nome}): {e}", file=sys.stderr)
         return False
 
+# --- Séries e escritas em lote de agendamentos ---
+
+# Limite de operações por batch/transação do Firestore é 500; mantemos folga.
+TAMANHO_LOTE_ESCRITA = 450
+# Agendamentos lidos por transação em `atualizar_agendamentos_em_lote` (o lote fecha antes se as escritas,
+# com as travas, passarem de TAMANHO_LOTE_ESCRITA) e aulas por transação em `salvar_matricula_turma`.
+TAMANHO_LOTE_TRAVAS = 100
+
+def _lotes_por_escritas(itens: list, escritas_por_item) -> list:
+    """Agrupa os itens em ordem, em lotes de até TAMANHO_LOTE_ESCRITA escritas (`escritas_por_item(item)`)."""
+    lotes, lote, escritas = [], [], 0
+    for item in itens:
+        escritas_item = escritas_por_item(item)
+        if lote and escritas + escritas_item > TAMANHO_LOTE_ESCRITA:
+            lotes.append(lote)
+            lote, escritas = [], 0
+        lote.append(item)
+        escritas += escritas_item
+    if lote:
+        lotes.append(lote)
+    return lotes
+
+def salvar_agendamentos_em_lote(clinic_id: str, lista_dados: list):
+    """
+    Cria vários agendamentos em transações de até TAMANHO_LOTE_ESCRITA escritas. Os individuais conferem e criam
+    as travas do horário na mesma transação, como em `salvar_agendamento`: um item cujo horário já está preso por
+    outro agendamento é recusado sem impedir os demais.
+    Cada item tem os mesmos campos de `salvar_agendamento` mais `pin_code` e, opcionalmente, `serie_id`.
+    Retorna (ids_criados, conflitos, erro): {índice em `lista_dados`: id} dos gravados, {índice: motivo} dos
+    recusados e a mensagem da falha que interrompeu a gravação (os itens seguintes ficam sem ID).
+    """
+    agendamentos_ref = _colecao_agendamentos(clinic_id)
+    itens = [
+        (indice, dados, agendamentos_ref.document(),
+         [] if dados.get('turma_id') else _refs_travas_horario(clinic_id, dados['profissional_nome'], dados['horario'], dados['duracao_min']))
+        for indice, dados in enumerate(lista_dados)
+    ]
+    ids_criados, conflitos = {}, {}
+
+    @firestore.transactional
+    def _gravar_lote(transaction, lote):
+        conflitos_lote, travas = _ler_travas_em_lote(transaction, clinic_id, {doc_ref.id: refs for _, _, doc_ref, refs in lote if refs})
+        criados, recusados = {}, {}
+        for indice, dados, doc_ref, travas_refs in lote:
+            if doc_ref.id in conflitos_lote:
+                recusados[indice] = _mensagem_conflito_trava(conflitos_lote[doc_ref.id])
+                continue
+            _gravar_travas(transaction, travas_refs, travas, doc_ref.id, dados['profissional_nome'])
+            transaction.create(doc_ref, _dados_agendamento(clinic_id, dados, dados['pin_code']))
+            criados[indice] = doc_ref.id
+        _marcar_dias_alterados(transaction, clinic_id, [dados['horario'] for indice, dados, _, refs in lote if refs and indice in criados])
+        _marcar_atividade_clientes(transaction, clinic_id, [dados for indice, dados, _, _ in lote if indice in criados])
+        return criados, recusados
+
+    try:
+        # Por item: o agendamento, as travas e (no máximo) a versão do dia e a atividade do cliente
+        for lote in _lotes_por_escritas(itens, lambda item: 3 + len(item[3])):
+            criados, recusados = _gravar_lote(db.transaction(), lote)
+            ids_criados.update(criados)
+            conflitos.update(recusados)
+        print(f"LOG: {len(ids_criados)} agendamentos salvos em lote para a clínica {clinic_id} ({len(conflitos)} recusados por conflito).", file=sys.stderr)
+        return ids_criados, conflitos, None
+
+    except Exception as e:
+
+        print(f"ERRO AO SALVAR AGENDAMENTOS EM LOTE ({len(ids_criados)} de {len(lista_dados)} gravados): {e}", file=sys.stderr)
+        return ids_criados, conflitos, str(e)
+
+    finally:
+        cache_agenda.DISPONIBILIDADE.invalidar(clinic_id)
+
+def atualizar_agendamentos_em_lote(clinic_id: str, atualizacoes: list):
+    """
+    Aplica [(id_agendamento, campos)] em transações de até TAMANHO_LOTE_TRAVAS agendamentos (`horario` é convertido
+    para UTC), com as regras das escritas unitárias: mudar horário/profissional confere e move as travas (como
+    `_remanejar_agendamento`), e sair de 'Confirmado' libera as travas ou a vaga no contador da aula (como
+    `atualizar_status_agendamento`). Um item em conflito é recusado sem impedir os demais; agendamentos de turma
+    não mudam de aula em lote. Retorna (ids_atualizados, conflitos {id_agendamento: motivo}).
+    """
+    agendamentos_ref = _colecao_agendamentos(clinic_id)
+    pendentes = []
+    for id_agendamento, campos in atualizacoes:
+        campos = dict(campos)
+        if isinstance(campos.get('horario'), datetime):
+            campos['horario'] = campos['horario'].astimezone(ZoneInfo('UTC'))
+        pendentes.append((id_agendamento, campos))
+    ids_atualizados, conflitos = [], {}
+
+    @firestore.transactional
+    def _atualizar_lote(transaction, lote):
+        atuais = {snap.id: snap.to_dict() for snap in transaction.get_all([agendamentos_ref.document(ag_id) for ag_id, _ in lote]) if snap.exists}
+        planos, recusados = [], {}
+        for id_agendamento, campos in lote:
+            agendamento = atuais.get(id_agendamento)
+            if agendamento is None:
+                recusados[id_agendamento] = "Agendamento não encontrado."
+                continue
+            atualizado = {**agendamento, **campos}
+            confirmado = agendamento.get('status') == 'Confirmado' and isinstance(agendamento.get('horario'), datetime)
+            continua_confirmado = confirmado and atualizado.get('status') == 'Confirmado'
+            refs_antigas, refs_novas, vaga_liberada = [], [], None
+            if confirmado and agendamento.get('turma_id'):
+                if continua_confirmado and _ref_ocupacao_turma(clinic_id, agendamento['turma_id'], atualizado['horario']).id \
+                        != _ref_ocupacao_turma(clinic_id, agendamento['turma_id'], agendamento['horario']).id:
+                    recusados[id_agendamento] = "Agendamentos de turma não mudam de aula em lote."
+                    continue
+                if not continua_confirmado:
+                    vaga_liberada = (agendamento['turma_id'], agendamento['horario'])
+            elif confirmado:
+                refs_antigas = _refs_travas_horario(clinic_id, agendamento['profissional_nome'], agendamento['horario'], agendamento.get('duracao_min'))
+                if continua_confirmado:
+                    refs_novas = _refs_travas_horario(clinic_id, atualizado['profissional_nome'], atualizado['horario'], atualizado.get('duracao_min'))
+                    ids_novas = {ref.id for ref in refs_novas}
+                    if ids_novas == {ref.id for ref in refs_antigas}:
+                        refs_antigas, refs_novas = [], []
+                    else:
+                        refs_antigas = [ref for ref in refs_antigas if ref.id not in ids_novas]
+            planos.append((id_agendamento, campos, atualizado, refs_antigas, refs_novas, vaga_liberada))
+
+        conflitos_lote, travas_novas = _ler_travas_em_lote(transaction, clinic_id, {plano[0]: plano[4] for plano in planos if plano[4]})
+        refs_antigas = [ref for plano in planos for ref in plano[3]]
+        travas_antigas = {snap.id: snap.to_dict() for snap in transaction.get_all(refs_antigas) if snap.exists} if refs_antigas else {}
+        contadores = {}
+        for turma_id in {plano[5][0] for plano in planos if plano[5]}:
+            contadores.update(_ler_contadores_turma(transaction, clinic_id, turma_id, [plano[5][1] for plano in planos if plano[5] and plano[5][0] == turma_id]))
+
+        # Itens que não cabem no orçamento de escritas (a partir de `processados`) voltam para o próximo lote
+        planos = {plano[0]: plano for plano in planos}
+        processados, escritas, atualizados, vagas, dias_alterados = len(lote), 0, [], {}, set()
+        for indice, (id_agendamento, _) in enumerate(lote):
+            if id_agendamento not in planos:
+                continue
+            _, campos, atualizado, refs_antigas, refs_novas, vaga_liberada = planos[id_agendamento]
+            if id_agendamento in conflitos_lote:
+                recusados[id_agendamento] = _mensagem_conflito_trava(conflitos_lote[id_agendamento])
+                continue
+            # Travas mudando: os dias de origem e destino ganham nova versão
+            dias_item = {chave_dia(atualizado['horario']), chave_dia(atuais[id_agendamento]['horario'])} if refs_antigas or refs_novas else set()
+            escritas_item = 1 + len(refs_antigas) + len(refs_novas) + bool(vaga_liberada) + len(dias_item - dias_alterados)
+            if escritas + escritas_item > TAMANHO_LOTE_ESCRITA:
+                processados = indice
+                break
+            escritas += escritas_item
+            dias_alterados |= dias_item
+            transaction.update(agendamentos_ref.document(id_agendamento), {**campos, **_campos_derivados_agendamento(clinic_id, campos)})
+            _liberar_travas(transaction, refs_antigas, travas_antigas, id_agendamento)
+            _gravar_travas(transaction, refs_novas, travas_novas, id_agendamento, atualizado['profissional_nome'])
+            if vaga_liberada:
+                contador_ref = _ref_ocupacao_turma(clinic_id, *vaga_liberada)
+                vagas[contador_ref.id] = (vaga_liberada, vagas.get(contador_ref.id, (None, 0))[1] + 1)
+            atualizados.append(id_agendamento)
+        for (turma_id, horario), liberadas in vagas.values():
+            contador_ref = _ref_ocupacao_turma(clinic_id, turma_id, horario)
+            transaction.set(contador_ref, _dados_ocupacao_turma(turma_id, horario, max(contadores[contador_ref.id] - liberadas, 0)))
+        for dia in dias_alterados:
+            transaction.set(_ref_versao_agenda_dia(clinic_id, dia), {'versao': firestore.Increment(1), 'atualizado_em': firestore.SERVER_TIMESTAMP}, merge=True)
+        ids_processados = {ag_id for ag_id, _ in lote[:processados]}
+        return processados, atualizados, {ag_id: motivo for ag_id, motivo in recusados.items() if ag_id in ids_processados}
+
+    try:
+        while pendentes:
+            processados, atualizados, recusados = _atualizar_lote(db.transaction(), pendentes[:TAMANHO_LOTE_TRAVAS])
+            ids_atualizados.extend(atualizados)
+            conflitos.update(recusados)
+            pendentes = pendentes[processados:]
+        return ids_atualizados, conflitos
+
+    except Exception as e:
+
+        print(f"ERRO AO ATUALIZAR AGENDAMENTOS EM LOTE ({len(ids_atualizados)} de {len(atualizacoes)} atualizados): {e}", file=sys.stderr)
+        return ids_atualizados, conflitos
+
+    finally:
+        cache_agenda.DISPONIBILIDADE.invalidar(clinic_id)
+
+def buscar_agendamentos_da_serie(clinic_id: str, serie_id: str):
+    """Busca todos os agendamentos de uma série recorrente (qualquer status), ordenados por horário."""
+    try:
+        query = _consulta_agendamentos(clinic_id) \
+                                        .where(filter=FieldFilter('serie_id', '==', serie_id))
+        data = []
+        for doc in query.stream():
+            item = doc.to_dict()
+            item['id'] = doc.id
+            if isinstance(item.get('horario'), datetime):
+                item['horario'] = item['horario'].astimezone(TZ_SAO_PAULO)
+                data.append(item)
+        df = pd.DataFrame(data)
+        return df.sort_values(by='horario') if not df.empty else df
+
+    except Exception as e:
+
+        print(f"ERRO NA BUSCA DA SÉRIE {serie_id}: {e}", file=sys.stderr)
+        return pd.DataFrame()
+
 
 # <-- FUNÇÃO COM LOGS ADICIONADOS -->
 def buscar_agendamentos_futuros_por_cliente(clinic_id: str, cliente_id: str):
@@ -425,8 +1303,7 @@ def buscar_agendamentos_futuros_por_cliente(clinic_id: str, cliente_id: str):
     
         # Log 3: Detalhes da Query
         print(f"LOG: Executando query: collection='agendamentos', where clinic_id=='{clinic_id}', cliente_id=='{cliente_id}', status=='Confirmado', horario>='{inicio_do_dia_hoje}'", file=sys.stderr)
-        query = db.collection('agendamentos') \
-                .where(filter=FieldFilter('clinic_id', '==', clinic_id)) \
+        query = _consulta_agendamentos(clinic_id) \
                 .where(filter=FieldFilter('cliente_id', '==', cliente_id)) \
                 .where(filter=FieldFilter('status', '==', 'Confirmado')) \
                 .where(filter=FieldFilter('horario', '>=', inicio_do_dia_hoje))
@@ -467,16 +1344,74 @@ def buscar_agendamentos_futuros_por_cliente(clinic_id: str, cliente_id: str):
         return []
 # <-- FIM DA FUNÇÃO COM LOGS -->
 
+def buscar_agendamentos_futuros_de_clientes(clinic_id: str, cliente_ids: list) -> dict:
+    """
+    Agendamentos futuros (Confirmados) de vários clientes, uma consulta a cada LIMITE_FILTRO_IN clientes:
+    {cliente_id: [agendamentos]} em ordem de horário, como `buscar_agendamentos_futuros_por_cliente`.
+    """
+    agendamentos_por_cliente = {cliente_id: [] for cliente_id in cliente_ids if cliente_id}
+    try:
+        inicio_do_dia_hoje = datetime.combine(datetime.now(TZ_SAO_PAULO).date(), time.min, tzinfo=TZ_SAO_PAULO)
+        for lote in _lotes_filtro_in(cliente_ids):
+            query = _consulta_agendamentos(clinic_id) \
+                    .where(filter=FieldFilter('cliente_id', 'in', lote)) \
+                    .where(filter=FieldFilter('status', '==', 'Confirmado')) \
+                    .where(filter=FieldFilter('horario', '>=', inicio_do_dia_hoje))
+            for doc in query.stream():
+                data = doc.to_dict()
+                data['id'] = doc.id
+                if isinstance(data.get('horario'), datetime):
+                    data['horario'] = data['horario'].astimezone(TZ_SAO_PAULO)
+                    agendamentos_por_cliente.setdefault(data['cliente_id'], []).append(data)
+
+        for agendamentos in agendamentos_por_cliente.values():
+            agendamentos.sort(key=lambda x: x['horario'])
+        print(f"LOG: buscar_agendamentos_futuros_de_clientes ({clinic_id}): {len(agendamentos_por_cliente)} clientes, "
+              f"{sum(len(a) for a in agendamentos_por_cliente.values())} agendamentos.", file=sys.stderr)
+        return agendamentos_por_cliente
+
+    except Exception as e:
+        print(f"ERRO AO BUSCAR AGENDAMENTOS FUTUROS DE CLIENTES EM LOTE: {e}", file=sys.stderr)
+        return {}
+
 # --- Funções de Gestão de Feriados ---
-def adicionar_feriado(clinic_id: str, data_feriado: date, descricao: str):
-    """Adiciona um feriado ou folga para uma clínica."""
+# Períodos (ex.: recesso de 24/12 a 02/01) são limitados para que a consulta por ano
+# possa ser um intervalo simples sobre `data` (sem índice composto).
+DURACAO_MAXIMA_PERIODO_FERIADO_DIAS = 62
+
+def _data_feriado(valor):
+    """Converte o Timestamp salvo (meia-noite UTC) de volta para a data do feriado."""
+    if isinstance(valor, datetime):
+        return valor.astimezone(ZoneInfo('UTC')).date()
+    return valor
+
+def _documento_para_feriado(doc) -> dict:
+    feriado = doc.to_dict()
+    feriado['id'] = doc.id
+    feriado['data'] = _data_feriado(feriado.get('data'))
+    # Documentos antigos não têm `data_fim`: um único dia
+    feriado['data_fim'] = _data_feriado(feriado.get('data_fim')) or feriado['data']
+    return feriado
+
+def adicionar_feriado(clinic_id: str, data_feriado: date, descricao: str, data_fim: date = None):
+    """
+    Adiciona um feriado ou folga para uma clínica.
+    Com `data_fim`, bloqueia o período inteiro [data_feriado, data_fim] (até DURACAO_MAXIMA_PERIODO_FERIADO_DIAS dias).
+    """
+    data_fim = data_fim or data_feriado
+    if data_fim < data_feriado or (data_fim - data_feriado).days >= DURACAO_MAXIMA_PERIODO_FERIADO_DIAS:
+        print(f"ERRO AO ADICIONAR FERIADO: período inválido ({data_feriado} a {data_fim}).", file=sys.stderr)
+        return False
     try:
     
         feriados_ref = db.collection('clinicas').document(clinic_id).collection('feriados')
     
         # Salva como Timestamp (meia-noite UTC para consistência, embora só a data importe)
         data_dt_utc = datetime.combine(data_feriado, time.min, tzinfo=ZoneInfo('UTC'))
-        feriados_ref.add({'data': data_dt_utc, 'descricao': descricao, 'clinic_id': clinic_id})
+        data_fim_dt_utc = datetime.combine(data_fim, time.min, tzinfo=ZoneInfo('UTC'))
+        feriados_ref.add({'data': data_dt_utc, 'data_fim': data_fim_dt_utc, 'descricao': descricao, 'clinic_id': clinic_id})
+        cache_agenda.FERIADOS.invalidar(clinic_id)
+        cache_agenda.DISPONIBILIDADE.invalidar(clinic_id)
         return True
     
     except Exception as e:
@@ -485,34 +1420,44 @@ def adicionar_feriado(clinic_id: str, data_feriado: date, descricao: str):
         return False
 
 def listar_feriados(clinic_id: str):
-    """Lista todos os feriados de uma clínica, ordenados por data."""
+    """Lista todos os feriados de uma clínica, ordenados por data (`data_fim` igual a `data` para dias únicos)."""
     try:
     
         feriados_ref = db.collection('clinicas').document(clinic_id).collection('feriados')
     
         docs = feriados_ref.order_by('data').stream()
     
-        feriados = []
-        for doc in docs:
-            feriado = doc.to_dict()
-            feriado['id'] = doc.id
-            # Converte Timestamp do Firestore para objeto date local
-            if 'data' in feriado and isinstance(feriado['data'], datetime):
-    
-                # Assume que foi salvo como UTC meia-noite, converte para SP e pega a data
-                feriado['data'] = feriado['data'].astimezone(TZ_SAO_PAULO).date()
-            feriados.append(feriado)
-        return feriados
+        return [_documento_para_feriado(doc) for doc in docs]
     except Exception as e:
         print(f"Erro ao listar feriados: {e}", file=sys.stderr)
         return []
 
+def listar_feriados_do_ano(clinic_id: str, ano: int):
+    """
+    Feriados/períodos que tocam o `ano`: uma consulta por intervalo em `data`, recuando
+    DURACAO_MAXIMA_PERIODO_FERIADO_DIAS para pegar períodos que começam no ano anterior.
+    """
+    try:
+        inicio = datetime.combine(date(ano, 1, 1) - timedelta(days=DURACAO_MAXIMA_PERIODO_FERIADO_DIAS), time.min, tzinfo=ZoneInfo('UTC'))
+        fim = datetime.combine(date(ano, 12, 31), time.min, tzinfo=ZoneInfo('UTC'))
+
+        query = db.collection('clinicas').document(clinic_id).collection('feriados') \
+                  .where(filter=FieldFilter('data', '>=', inicio)) \
+                  .where(filter=FieldFilter('data', '<=', fim))
+
+        feriados = [_documento_para_feriado(doc) for doc in query.stream()]
+        return [f for f in feriados if f['data_fim'] and f['data_fim'].year >= ano]
+    except Exception as e:
+        print(f"Erro ao listar feriados do ano {ano}: {e}", file=sys.stderr)
+        return []
+
 def remover_feriado(clinic_id: str, feriado_id: str):
     """Remove um feriado de uma clínica."""
     try:
     
         db.collection('clinicas').document(clinic_id).collection('feriados').document(feriado_id).delete()
-    
+        cache_agenda.FERIADOS.invalidar(clinic_id)
+        cache_agenda.DISPONIBILIDADE.invalidar(clinic_id)
         return True
     
     except Exception as e:
@@ -546,6 +1491,102 @@ def listar_clientes(clinic_id: str):
         print(f"ERRO AO LISTAR CLIENTES: {e}", file=sys.stderr)
         return []
 
+TAMANHO_PAGINA_CLIENTES = 50
+# Cada consulta traz a página pedida e a seguinte (pré-carregada no cache)
+PAGINAS_POR_CONSULTA_CLIENTES = 2
+
+def _consultar_paginas_clientes(clinic_id: str, prefixo_nome: str, cursor: tuple, tamanho: int) -> list:
+    """
+    Lê até PAGINAS_POR_CONSULTA_CLIENTES páginas de clientes ordenados por nome (e ID, para desempatar homônimos),
+    a partir do `cursor` (nome, id) do último cliente da página anterior. Retorna [(cursor_da_pagina, pagina)],
+    onde `pagina` = {'clientes': [...], 'cursor_proximo': (nome, id) ou None}.
+    """
+    query = db.collection('clinicas').document(clinic_id).collection('clientes')
+    if prefixo_nome:
+        query = query.where(filter=FieldFilter('nome', '>=', prefixo_nome)).where(filter=FieldFilter('nome', '<', prefixo_nome + '\uf8ff'))
+    query = query.order_by('nome').order_by('__name__')
+    if cursor:
+        query = query.start_after(list(cursor))
+    # Um registro a mais indica se existe página depois da última lida
+    docs = list(query.limit(tamanho * PAGINAS_POR_CONSULTA_CLIENTES + 1).stream())
+
+    clientes = []
+    for doc in docs:
+        cliente = doc.to_dict()
+        cliente['id'] = doc.id
+        clientes.append(cliente)
+
+    paginas = []
+    cursor_pagina = cursor
+    for inicio in range(0, tamanho * PAGINAS_POR_CONSULTA_CLIENTES, tamanho):
+        pagina = clientes[inicio:inicio + tamanho]
+        if not pagina and paginas:
+            break
+        tem_proxima = len(clientes) > inicio + tamanho
+        cursor_proximo = (pagina[-1].get('nome', ''), pagina[-1]['id']) if pagina and tem_proxima else None
+        paginas.append((cursor_pagina, {'clientes': pagina, 'cursor_proximo': cursor_proximo}))
+        if not cursor_proximo:
+            break
+        cursor_pagina = cursor_proximo
+    return paginas
+
+def listar_clientes_pagina(clinic_id: str, cursor: tuple = None, prefixo_nome: str = "", tamanho: int = TAMANHO_PAGINA_CLIENTES) -> dict:
+    """
+    Uma página de clientes (ordenados por nome) a partir do `cursor` devolvido na página anterior, opcionalmente
+    filtrada pelo início do nome. As páginas ficam em cache por clínica, invalidado na inclusão/remoção de clientes;
+    a consulta já pré-carrega a página seguinte.
+    Retorna {'clientes': [...], 'cursor_proximo': cursor da próxima página ou None}.
+    """
+    prefixo_nome = (prefixo_nome or "").strip()
+    chave = (clinic_id, prefixo_nome, tamanho, cursor)
+    carregadas = {}
+
+    def carregar():
+        try:
+            paginas = _consultar_paginas_clientes(clinic_id, prefixo_nome, cursor, tamanho)
+        except Exception as e:
+            print(f"ERRO AO LISTAR PÁGINA DE CLIENTES: {e}", file=sys.stderr)
+            return {'clientes': [], 'cursor_proximo': None}
+        carregadas.update(paginas[1:])
+        return paginas[0][1]
+
+    pagina = cache_agenda.CLIENTES.obter(chave, carregar)
+    for cursor_pagina, pagina_seguinte in carregadas.items():
+        cache_agenda.CLIENTES.guardar((clinic_id, prefixo_nome, tamanho, cursor_pagina), pagina_seguinte)
+    return pagina
+
+def buscar_cliente_por_nome(clinic_id: str, nome: str):
+    """Busca um cliente pelo nome exato (o primeiro, se houver homônimos). Retorna o dict com 'id' ou None."""
+    try:
+        docs = list(db.collection('clinicas').document(clinic_id).collection('clientes')
+                    .where(filter=FieldFilter('nome', '==', nome)).limit(1).stream())
+        if not docs:
+            return None
+        cliente = docs[0].to_dict()
+        cliente['id'] = docs[0].id
+        return cliente
+    except Exception as e:
+        print(f"ERRO AO BUSCAR CLIENTE '{nome}': {e}", file=sys.stderr)
+        return None
+
+def buscar_clientes_por_ids(clinic_id: str, cliente_ids: list) -> dict:
+    """Lê vários clientes por ID numa única chamada (`get_all`). Retorna {cliente_id: cliente}."""
+    ids = list(dict.fromkeys(i for i in cliente_ids if i))
+    if not ids:
+        return {}
+    try:
+        clientes_ref = db.collection('clinicas').document(clinic_id).collection('clientes')
+        clientes = {}
+        for snap in db.get_all([clientes_ref.document(cliente_id) for cliente_id in ids]):
+            if snap.exists:
+                cliente = snap.to_dict()
+                cliente['id'] = snap.id
+                clientes[snap.id] = cliente
+        return clientes
+    except Exception as e:
+        print(f"ERRO AO BUSCAR CLIENTES POR ID: {e}", file=sys.stderr)
+        return {}
+
 def adicionar_cliente(clinic_id: str, nome: str, telefone: str, observacoes: str):
     """Adiciona um novo cliente a uma clínica e retorna o ID."""
     try:
@@ -562,10 +1603,12 @@ def adicionar_cliente(clinic_id: str, nome: str, telefone: str, observacoes: str
             # Por ora, vamos permitir, mas logamos
             pass # Permite adicionar mesmo assim
     
-        doc_ref = clientes_ref.add({'nome': nome, 'telefone': telefone, 'observacoes': observacoes})
+        doc_ref = clientes_ref.add({'nome': nome, 'telefone': telefone, 'observacoes': observacoes,
+                                    'telefone_normalizado': normalizar_telefone(telefone), 'atualizado_em': firestore.SERVER_TIMESTAMP})
         # doc_ref é uma tupla (timestamp, document_reference)
         # O ID está em doc_ref[1].id
         novo_id = doc_ref[1].id
+        cache_agenda.CLIENTES.invalidar(clinic_id)
         print(f"LOG: Cliente '{nome}' adicionado com ID: {novo_id}", file=sys.stderr)
         return True, novo_id # Retorna sucesso e o ID
     except Exception as e:
@@ -577,6 +1620,8 @@ def remover_cliente(clinic_id: str, cliente_id: str):
     try:
         # Adicionar lógica para remover/anonimizar agendamentos associados?
         db.collection('clinicas').document(clinic_id).collection('clientes').document(cliente_id).delete()
+        db.collection('clinicas').document(clinic_id).collection(COLECAO_ATIVIDADE_CLIENTES).document(cliente_id).delete()
+        cache_agenda.CLIENTES.invalidar(clinic_id)
     
         return True
     
@@ -740,8 +1785,7 @@ def verificar_cliente_em_turma(clinic_id: str, cliente_id: str, turma_id: str, d
         horario_exato_utc = horario_exato_sp.astimezone(ZoneInfo('UTC'))
         
         # Filtros de Query
-        query = db.collection('agendamentos') \
-            .where(filter=FieldFilter('clinic_id', '==', clinic_id)) \
+        query = _consulta_agendamentos(clinic_id) \
             .where(filter=FieldFilter('cliente_id', '==', cliente_id)) \
             .where(filter=FieldFilter('turma_id', '==', turma_id)) \
             .where(filter=FieldFilter('status', '==', 'Confirmado')) \
@@ -760,31 +1804,254 @@ def verificar_cliente_em_turma(clinic_id: str, cliente_id: str, turma_id: str, d
         return True # Falha na verificação, melhor prevenir e bloquear (assumindo conflito)
         
 
-def contar_agendamentos_turma_dia(clinic_id: str, turma_id: str, data: date, horario_turma: time): # MODIFICADO
+# --- Ocupação de turmas (um contador por aula) ---
+# clinicas/{clinic_id}/ocupacao_turmas/{turma_id}_{AAAAMMDDHHMM UTC}:
+# {'turma_id', 'horario' (UTC), 'data' ('AAAA-MM-DD' local), 'confirmados'}.
+# Reservas incrementam e conferem `capacidade_maxima` numa transação; saídas de 'Confirmado' decrementam.
+# Aulas sem contador (agendamentos anteriores aos contadores) são recontadas na própria transação; a tarefa
+# `reconstruir-ocupacao` (tarefas_agendadas.py) grava os contadores de uma vez, para a listagem de vagas.
+
+def _ref_ocupacao_turma(clinic_id: str, turma_id: str, horario: datetime):
+    horario_utc = horario.astimezone(ZoneInfo('UTC'))
+    return db.collection('clinicas').document(clinic_id).collection('ocupacao_turmas') \
+             .document(f"{turma_id}_{horario_utc.strftime('%Y%m%d%H%M')}")
+
+def _dados_ocupacao_turma(turma_id: str, horario: datetime, confirmados) -> dict:
+    return {
+        'turma_id': turma_id,
+        'horario': horario.astimezone(ZoneInfo('UTC')),
+        'data': horario.astimezone(TZ_SAO_PAULO).strftime('%Y-%m-%d'),
+        'confirmados': confirmados
+    }
+
+def _ler_contadores_turma(transaction, clinic_id: str, turma_id: str, horarios: list) -> dict:
     """
-    Conta quantos agendamentos confirmados existem para uma turma específica 
-    em um dia E HORÁRIO (exato).
+    Vagas ocupadas das aulas da turma, lidas na transação: {doc_id do contador: confirmados}. Um contador
+    ausente é recontado a partir dos agendamentos confirmados da turma (consulta só com igualdades).
     """
-    try:
-        # Cria o datetime exato que deve ser buscado
-        horario_exato_sp = datetime.combine(data, horario_turma, tzinfo=TZ_SAO_PAULO)
-        horario_exato_utc = horario_exato_sp.astimezone(ZoneInfo('UTC'))
-        
-        # A busca por igualdade exata de Timestamp funciona bem no Firestore
-        query = db.collection('agendamentos').where(filter=FieldFilter('clinic_id', '==', clinic_id)) \
+    refs = [_ref_ocupacao_turma(clinic_id, turma_id, horario) for horario in horarios]
+    contadores, ausentes = {}, set()
+    for snap in transaction.get_all(refs):
+        if snap.exists:
+            contadores[snap.id] = (snap.to_dict() or {}).get('confirmados', 0)
+        else:
+            ausentes.add(snap.id)
+    if ausentes:
+        query = _consulta_agendamentos(clinic_id) \
             .where(filter=FieldFilter('turma_id', '==', turma_id)) \
-            .where(filter=FieldFilter('status', '==', 'Confirmado')) \
-            .where(filter=FieldFilter('horario', '==', horario_exato_utc))
-            
-        count = sum(1 for _ in query.stream())
+            .where(filter=FieldFilter('status', '==', 'Confirmado'))
+        contadores.update({doc_id: 0 for doc_id in ausentes})
+        for doc in transaction.get(query):
+            horario = doc.to_dict().get('horario')
+            doc_id = _ref_ocupacao_turma(clinic_id, turma_id, horario).id if isinstance(horario, datetime) else None
+            if doc_id in ausentes:
+                contadores[doc_id] += 1
+        print(f"LOG: {len(ausentes)} contadores de ocupação recontados (Turma: {turma_id}).", file=sys.stderr)
+    return contadores
+
+def _dados_agendamento(clinic_id: str, dados: dict, pin_code: str) -> dict:
+    return {
+        **_campos_derivados_agendamento(clinic_id, dados),
+        'clinic_id': clinic_id,
+        'pin_code': pin_code,
+        'profissional_nome': dados['profissional_nome'],
+        'cliente': dados['cliente'],
+        'cliente_id': dados.get('cliente_id'),
+        'telefone': dados['telefone'],
+        'horario': dados['horario'],
+        'servico_nome': dados['servico_nome'],
+        'duracao_min': dados['duracao_min'],
+        'status': "Confirmado",
+        'turma_id': dados.get('turma_id'),
+        'pacote_cliente_id': dados.get('pacote_cliente_id'),
+        'serie_id': dados.get('serie_id')
+    }
+
+def salvar_agendamento_turma(clinic_id: str, dados: dict, pin_code: str):
+    """
+    Cria um agendamento de turma reservando a vaga numa transação: lê a capacidade da turma e o
+    contador da aula, e só grava se ainda houver vaga (debitando o pacote, se houver, na mesma transação).
+    Retorna True ou a mensagem de erro.
+    """
+    try:
+        turma_ref = db.collection('clinicas').document(clinic_id).collection('turmas').document(dados['turma_id'])
+        contador_ref = _ref_ocupacao_turma(clinic_id, dados['turma_id'], dados['horario'])
+        agendamento_ref = _colecao_agendamentos(clinic_id).document()
+
+        @firestore.transactional
+        def _reservar(transaction):
+            turma = turma_ref.get(transaction=transaction).to_dict() or {}
+            confirmados = _ler_contadores_turma(transaction, clinic_id, dados['turma_id'], [dados['horario']])[contador_ref.id]
+            if confirmados >= turma.get('capacidade_maxima', 0):
+                return "Turma lotada: não há mais vagas nesta aula."
+            debito = _ler_debito_pacote(transaction, clinic_id, dados, [agendamento_ref.id])
+            if isinstance(debito, str):
+                return debito
+            transaction.set(contador_ref, _dados_ocupacao_turma(dados['turma_id'], dados['horario'], confirmados + 1))
+            transaction.create(agendamento_ref, _dados_agendamento(clinic_id, dados, pin_code))
+            _marcar_atividade_clientes(transaction, clinic_id, [dados])
+            _gravar_debito_pacote(transaction, debito)
+            return True
+
+        resultado = _reservar(db.transaction())
+        if resultado is True and isinstance(dados['horario'], datetime):
+            cache_agenda.DISPONIBILIDADE.invalidar(clinic_id, dados['profissional_nome'], dados['horario'].astimezone(TZ_SAO_PAULO).date())
+        print(f"LOG: Reserva na turma {dados['turma_id']} ({dados['horario']}): {resultado}", file=sys.stderr)
+        return resultado
+
+    except Exception as e:
+
+        print(f"ERRO AO SALVAR AGENDAMENTO DE TURMA: {e}", file=sys.stderr)
+        return str(e)
+
+def salvar_matricula_turma(clinic_id: str, turma_id: str, lista_dados: list):
+    """
+    Grava vários agendamentos da mesma turma em transações de até TAMANHO_LOTE_TRAVAS aulas, conferindo a vaga
+    de cada aula no contador. Os créditos do pacote (`pacote_cliente_id` dos itens) são debitados na mesma
+    transação das reservas, com os lançamentos do extrato; aulas além do saldo do pacote são gravadas sem pacote.
+    `lista_dados` segue `salvar_agendamentos_em_lote`. Retorna (ids_criados, lotados, creditos_debitados, erro):
+    {índice em `lista_dados`: id} dos gravados, os índices das aulas lotadas, os créditos debitados e a mensagem
+    da falha que interrompeu a gravação (os lotes seguintes ficam sem ID).
+    """
+    turma_ref = db.collection('clinicas').document(clinic_id).collection('turmas').document(turma_id)
+    agendamentos_ref = _colecao_agendamentos(clinic_id)
+    itens = [(indice, dados, agendamentos_ref.document(), _ref_ocupacao_turma(clinic_id, turma_id, dados['horario']))
+             for indice, dados in enumerate(lista_dados)]
+    ids_criados, lotados, creditos_debitados = {}, set(), 0
+
+    @firestore.transactional
+    def _matricular(transaction, lote):
+        capacidade = (turma_ref.get(transaction=transaction).to_dict() or {}).get('capacidade_maxima', 0)
+        contadores = _ler_contadores_turma(transaction, clinic_id, turma_id, [dados['horario'] for _, dados, _, _ in lote])
+        reservas, lotados_lote = [], set()
+        for indice, dados, doc_ref, contador_ref in lote:
+            confirmados = contadores.get(contador_ref.id, 0)
+            if confirmados >= capacidade:
+                lotados_lote.add(indice)
+                continue
+            contadores[contador_ref.id] = confirmados + 1
+            reservas.append((indice, dados, doc_ref, contador_ref, confirmados + 1))
+
+        com_pacote = [(dados, doc_ref) for _, dados, doc_ref, _, _ in reservas if dados.get('pacote_cliente_id')]
+        debito = _ler_debito_pacote(transaction, clinic_id, com_pacote[0][0], [doc_ref.id for _, doc_ref in com_pacote], parcial=True) if com_pacote else None
+        if isinstance(debito, str):
+            return debito
+        debitados = set(debito['pendentes']) if debito else set()
+
+        criados = {}
+        for indice, dados, doc_ref, contador_ref, confirmados in reservas:
+            if dados.get('pacote_cliente_id') and doc_ref.id not in debitados:
+                dados = {**dados, 'pacote_cliente_id': None}  # Além do saldo do pacote
+            transaction.set(contador_ref, _dados_ocupacao_turma(turma_id, dados['horario'], confirmados))
+            transaction.create(doc_ref, _dados_agendamento(clinic_id, dados, dados['pin_code']))
+            criados[indice] = doc_ref.id
+        _marcar_atividade_clientes(transaction, clinic_id, [dados for _, dados, _, _, _ in reservas])
+        _gravar_debito_pacote(transaction, debito)
+        return criados, lotados_lote, len(debitados)
+
+    try:
+        # Por aula: o contador, o agendamento e o débito; o lote limita o tamanho (e os conflitos) de cada transação
+        for inicio in range(0, len(itens), TAMANHO_LOTE_TRAVAS):
+            resultado = _matricular(db.transaction(), itens[inicio:inicio + TAMANHO_LOTE_TRAVAS])
+            if isinstance(resultado, str):
+                print(f"ERRO NA MATRÍCULA EM LOTE (Turma: {turma_id}): {resultado}", file=sys.stderr)
+                return ids_criados, lotados, creditos_debitados, resultado
+            criados, lotados_lote, debitados = resultado
+            ids_criados.update(criados)
+            lotados |= lotados_lote
+            creditos_debitados += debitados
+        return ids_criados, lotados, creditos_debitados, None
+
+    except Exception as e:
+
+        print(f"ERRO NA MATRÍCULA EM LOTE (Turma: {turma_id}, {len(ids_criados)} de {len(lista_dados)} gravados): {e}", file=sys.stderr)
+        return ids_criados, lotados, creditos_debitados, str(e)
+
+    finally:
+        if ids_criados:
+            cache_agenda.DISPONIBILIDADE.invalidar(clinic_id)
+
+def buscar_ocupacao_turmas_dia(clinic_id: str, data: date) -> dict:
+    """Vagas ocupadas de todas as aulas do dia, numa consulta: {(turma_id, horario SP): confirmados}."""
+    try:
+        query = db.collection('clinicas').document(clinic_id).collection('ocupacao_turmas') \
+                  .where(filter=FieldFilter('data', '==', data.strftime('%Y-%m-%d')))
+        ocupacao = {}
+        for doc in query.stream():
+            item = doc.to_dict()
+            if isinstance(item.get('horario'), datetime):
+                ocupacao[(item.get('turma_id'), item['horario'].astimezone(TZ_SAO_PAULO))] = item.get('confirmados', 0)
+        return ocupacao
+
+    except Exception as e:
+        print(f"ERRO AO BUSCAR OCUPAÇÃO DAS TURMAS ({data}): {e}", file=sys.stderr)
+        return {}
+
+def reconstruir_ocupacao_turmas(clinic_id: str, data_inicio: date = None):
+    """
+    Recalcula os contadores das aulas a partir de `data_inicio` (padrão: hoje) contando os
+    agendamentos de turma confirmados. Usado para dados anteriores aos contadores ou correções.
+    Retorna a quantidade de contadores gravados.
+    """
+    data_inicio = data_inicio or datetime.now(TZ_SAO_PAULO).date()
+    inicio_dt = datetime.combine(data_inicio, time.min, tzinfo=TZ_SAO_PAULO)
+    try:
+        query = _consulta_agendamentos(clinic_id) \
+            .where(filter=FieldFilter('status', '==', 'Confirmado'))
+        contagens = {}
+        for doc in query.stream():
+            item = doc.to_dict()
+            if item.get('turma_id') and isinstance(item.get('horario'), datetime) and item['horario'] >= inicio_dt:
+                chave = (item['turma_id'], item['horario'].astimezone(ZoneInfo('UTC')))
+                contagens[chave] = contagens.get(chave, 0) + 1
 
-        print(f"LOG: Contagem Turma ID {turma_id} em {data} @ {horario_turma}: {count} agendamentos.", file=sys.stderr)
-        return count
+        # Contadores existentes sem agendamentos confirmados voltam a zero
+        ocupacao_ref = db.collection('clinicas').document(clinic_id).collection('ocupacao_turmas')
+        for doc in ocupacao_ref.where(filter=FieldFilter('data', '>=', data_inicio.strftime('%Y-%m-%d'))).stream():
+            item = doc.to_dict()
+            if isinstance(item.get('horario'), datetime):
+                contagens.setdefault((item.get('turma_id'), item['horario'].astimezone(ZoneInfo('UTC'))), 0)
+
+        itens = list(contagens.items())
+        for inicio_lote in range(0, len(itens), TAMANHO_LOTE_ESCRITA):
+            batch = db.batch()
+            for (turma_id, horario), confirmados in itens[inicio_lote:inicio_lote + TAMANHO_LOTE_ESCRITA]:
+                batch.set(_ref_ocupacao_turma(clinic_id, turma_id, horario), _dados_ocupacao_turma(turma_id, horario, confirmados))
+            batch.commit()
+        print(f"LOG: Ocupação de turmas reconstruída para {clinic_id}: {len(itens)} aulas.", file=sys.stderr)
+        return len(itens)
 
     except Exception as e:
-        print(f"ERRO AO CONTAR AGENDAMENTOS DA TURMA (ID: {turma_id}, Data: {data}, Hora: {horario_turma}): {e}", file=sys.stderr)
+        print(f"ERRO AO RECONSTRUIR OCUPAÇÃO DAS TURMAS ({clinic_id}): {e}", file=sys.stderr)
         return 0
 
+def buscar_agendamentos_turma_intervalo(clinic_id: str, turma_id: str, start_date: date, end_date: date):
+    """
+    Agendamentos confirmados de uma turma num intervalo de datas, numa única consulta.
+    Só filtros de igualdade na query; o intervalo é filtrado em Python (sem índice composto).
+    """
+    try:
+        start_dt = datetime.combine(start_date, time.min, tzinfo=TZ_SAO_PAULO)
+        end_dt = datetime.combine(end_date, time.max, tzinfo=TZ_SAO_PAULO)
+
+        query = _consulta_agendamentos(clinic_id) \
+            .where(filter=FieldFilter('turma_id', '==', turma_id)) \
+            .where(filter=FieldFilter('status', '==', 'Confirmado'))
+
+        data = []
+        for doc in query.stream():
+            item = doc.to_dict()
+            item['id'] = doc.id
+            if isinstance(item.get('horario'), datetime):
+                item['horario'] = item['horario'].astimezone(TZ_SAO_PAULO)
+                if start_dt <= item['horario'] <= end_dt:
+                    data.append(item)
+        return pd.DataFrame(data)
+
+    except Exception as e:
+        print(f"ERRO AO BUSCAR AGENDAMENTOS DA TURMA (ID: {turma_id}, {start_date} a {end_date}): {e}", file=sys.stderr)
+        return pd.DataFrame()
+
 
 # --- NOVAS FUNÇÕES - Gestão de Pacotes ---
 
@@ -809,6 +2076,10 @@ def listar_pacotes_modelos(clinic_id: str):
         print(f"ERRO AO LISTAR MODELOS DE PACOTES: {e}", file=sys.stderr)
         return []
 
+def mapa_pacotes_modelos_cache(clinic_id: str) -> dict:
+    """Modelos de pacote indexados por ID, em cache (compartilhado entre sessões; não modificar o retorno)."""
+    return cache_agenda.PACOTES_MODELOS.obter((clinic_id,), lambda: {m['id']: m for m in listar_pacotes_modelos(clinic_id)})
+
 def adicionar_pacote_modelo(clinic_id: str, dados_pacote: dict):
     """Adiciona um novo modelo de pacote."""
     try:
@@ -816,6 +2087,7 @@ def adicionar_pacote_modelo(clinic_id: str, dados_pacote: dict):
         pacotes_ref = db.collection('clinicas').document(clinic_id).collection('pacotes')
     
         pacotes_ref.add(dados_pacote)
+        cache_agenda.PACOTES_MODELOS.invalidar(clinic_id)
         return True
     
     except Exception as e:
@@ -829,7 +2101,7 @@ def remover_pacote_modelo(clinic_id: str, pacote_id: str):
     try:
         # Adicionar verificação se este modelo está em uso por algum pacote de cliente?
         db.collection('clinicas').document(clinic_id).collection('pacotes').document(pacote_id).delete()
-    
+        cache_agenda.PACOTES_MODELOS.invalidar(clinic_id)
         return True
     
     except Exception as e:
@@ -876,6 +2148,38 @@ def listar_pacotes_do_cliente(clinic_id: str, cliente_id: str):
         print(f"ERRO AO LISTAR PACOTES DO CLIENTE (ID: {cliente_id}): {e}", file=sys.stderr)
         return []
 
+def listar_pacotes_validos_do_cliente(clinic_id: str, cliente_id: str, servico_id: str, agora: datetime):
+    """
+    Pacotes do cliente com créditos, não expirados em `agora` e válidos para `servico_id`, filtrados na
+    própria consulta (usa `servicos_validos_ids`, desnormalizado na venda). Ordenados pela expiração.
+    Requer índice composto em pacotes_clientes: servicos_validos_ids (array) + data_expiracao + creditos_restantes.
+    """
+    try:
+
+        pacotes_ref = db.collection('clinicas').document(clinic_id) \
+                        .collection('clientes').document(cliente_id) \
+                        .collection('pacotes_clientes')
+
+        query = pacotes_ref.where(filter=FieldFilter('servicos_validos_ids', 'array_contains', servico_id)) \
+                           .where(filter=FieldFilter('data_expiracao', '>=', agora)) \
+                           .where(filter=FieldFilter('creditos_restantes', '>', 0)) \
+                           .order_by('data_expiracao')
+
+        pacotes = []
+        for doc in query.stream():
+            pacote = doc.to_dict()
+            pacote['id'] = doc.id
+            for campo in ('data_inicio', 'data_expiracao'):
+                if isinstance(pacote.get(campo), datetime):
+                    pacote[campo] = pacote[campo].astimezone(TZ_SAO_PAULO)
+            pacotes.append(pacote)
+        return pacotes
+
+    except Exception as e:
+
+        print(f"ERRO AO LISTAR PACOTES VÁLIDOS DO CLIENTE (ID: {cliente_id}, Serviço: {servico_id}): {e}", file=sys.stderr)
+        return []
+
 def associar_pacote_ao_cliente(clinic_id: str, cliente_id: str, dados_pacote_cliente: dict):
     """Associa/vende um pacote a um cliente."""
     try:
@@ -884,7 +2188,8 @@ def associar_pacote_ao_cliente(clinic_id: str, cliente_id: str, dados_pacote_cli
                         .collection('clientes').document(cliente_id) \
                         .collection('pacotes_clientes')
     
-        pacotes_ref.add(dados_pacote_cliente)
+        # IDs no próprio documento: permitem buscar os pacotes de vários clientes numa consulta de collection group
+        pacotes_ref.add({**dados_pacote_cliente, 'clinic_id': clinic_id, 'cliente_id': cliente_id})
         return True
     
     except Exception as e:
@@ -892,25 +2197,499 @@ def associar_pacote_ao_cliente(clinic_id: str, cliente_id: str, dados_pacote_cli
         print(f"ERRO AO ASSOCIAR PACOTE AO CLIENTE (Cliente ID: {cliente_id}): {e}", file=sys.stderr)
         return False
 
-def deduzir_credito_pacote_cliente(clinic_id: str, cliente_id: str, pacote_cliente_id: str):
-    """Deduz 1 crédito de um pacote específico do cliente usando Increment."""
-    if not cliente_id or not pacote_cliente_id:
-    
-        print(f"ERRO: Tentativa de deduzir crédito com IDs inválidos. Cliente: '{cliente_id}', Pacote: '{pacote_cliente_id}'", file=sys.stderr)
+# Máximo de valores num filtro `in` do Firestore
+LIMITE_FILTRO_IN = 30
+
+def _lotes_filtro_in(valores: list):
+    valores = list(dict.fromkeys(v for v in valores if v))
+    for inicio in range(0, len(valores), LIMITE_FILTRO_IN):
+        yield valores[inicio:inicio + LIMITE_FILTRO_IN]
+
+def listar_pacotes_de_clientes(clinic_id: str, cliente_ids: list) -> dict:
+    """
+    Pacotes de vários clientes (collection group, uma consulta a cada LIMITE_FILTRO_IN clientes):
+    {cliente_id: [pacotes]}, cada lista com a expiração mais recente primeiro, como `listar_pacotes_do_cliente`.
+    Depende do `cliente_id` gravado no pacote (pacotes antigos recebem o campo em `tarefas_agendadas.py atualizar-pacotes`);
+    quem chama relê por `listar_pacotes_do_cliente` os clientes que ficarem sem pacotes.
+    Índices: as igualdades em `clinic_id` e `cliente_id` dispensam índice composto, mas no escopo de collection group
+    os índices de campo único não são automáticos; habilite os de `clinic_id` e `cliente_id` de `pacotes_clientes`
+    com escopo de collection group (console ou `gcloud firestore indexes fields update`), senão a consulta falha.
+    """
+    pacotes_por_cliente = {cliente_id: [] for cliente_id in cliente_ids if cliente_id}
+    try:
+        for lote in _lotes_filtro_in(cliente_ids):
+            query = db.collection_group('pacotes_clientes') \
+                        .where(filter=FieldFilter('clinic_id', '==', clinic_id)) \
+                        .where(filter=FieldFilter('cliente_id', 'in', lote))
+            for doc in query.stream():
+                pacote = doc.to_dict()
+                pacote['id'] = doc.id
+                for campo in ('data_inicio', 'data_expiracao'):
+                    if isinstance(pacote.get(campo), datetime):
+                        pacote[campo] = pacote[campo].astimezone(TZ_SAO_PAULO)
+                pacotes_por_cliente.setdefault(pacote['cliente_id'], []).append(pacote)
+
+        data_minima = datetime.min.replace(tzinfo=TZ_SAO_PAULO)
+        for pacotes in pacotes_por_cliente.values():
+            pacotes.sort(key=lambda p: p.get('data_expiracao') or data_minima, reverse=True)
+        print(f"LOG: listar_pacotes_de_clientes ({clinic_id}): {len(pacotes_por_cliente)} clientes, "
+              f"{sum(len(p) for p in pacotes_por_cliente.values())} pacotes.", file=sys.stderr)
+        return pacotes_por_cliente
+
+    except Exception as e:
+        print(f"ERRO AO LISTAR PACOTES DE CLIENTES EM LOTE: {e}", file=sys.stderr)
+        return {}
+
+# --- Status pré-calculado dos pacotes ---
+# `status` ('Ativo', 'Expirado', 'Esgotado') e `expirando` (ativo que vence em até DIAS_AVISO_EXPIRACAO_PACOTE dias)
+# são gravados no pacote pela tarefa em lote (`tarefas_agendadas.py atualizar-pacotes`) e nos débitos/estornos.
+
+DIAS_AVISO_EXPIRACAO_PACOTE = 7
+
+def calcular_status_pacote(pacote: dict, agora: datetime, dias_aviso: int = DIAS_AVISO_EXPIRACAO_PACOTE) -> dict:
+    """Campos de status de um pacote em `agora`: {'status', 'expirando'}."""
+    data_exp = pacote.get('data_expiracao')
+    if isinstance(data_exp, datetime) and data_exp < agora:
+        status = "Expirado"
+    elif pacote.get('creditos_restantes', 0) <= 0:
+        status = "Esgotado"
+    else:
+        status = "Ativo"
+    expirando = status == "Ativo" and isinstance(data_exp, datetime) and data_exp < agora + timedelta(days=dias_aviso)
+    return {'status': status, 'expirando': expirando}
+
+def atualizar_pacotes_em_lote(atualizacoes: dict) -> int:
+    """Aplica {caminho_do_pacote: campos} com commits em lote. Retorna a quantidade de pacotes atualizados."""
+    itens = list(atualizacoes.items())
+    atualizados = 0
+    try:
+        for inicio_lote in range(0, len(itens), TAMANHO_LOTE_ESCRITA):
+            lote = itens[inicio_lote:inicio_lote + TAMANHO_LOTE_ESCRITA]
+            batch = db.batch()
+            for caminho, campos in lote:
+                batch.update(db.document(caminho), campos)
+            batch.commit()
+            atualizados += len(lote)
+        return atualizados
+    except Exception as e:
+        print(f"ERRO AO ATUALIZAR PACOTES EM LOTE ({atualizados} já atualizados): {e}", file=sys.stderr)
+        return atualizados
+
+def salvar_resumos_pacotes(resumos: dict):
+    """Grava {clinic_id: resumo} em `clinicas/{clinic_id}/resumos/pacotes`, em lote."""
+    itens = list(resumos.items())
+    try:
+        for inicio_lote in range(0, len(itens), TAMANHO_LOTE_ESCRITA):
+            batch = db.batch()
+            for clinic_id, resumo in itens[inicio_lote:inicio_lote + TAMANHO_LOTE_ESCRITA]:
+                resumo_ref = db.collection('clinicas').document(clinic_id).collection('resumos').document('pacotes')
+                batch.set(resumo_ref, {**resumo, 'atualizado_em': firestore.SERVER_TIMESTAMP})
+            batch.commit()
+        return True
+    except Exception as e:
+        print(f"ERRO AO SALVAR RESUMOS DE PACOTES: {e}", file=sys.stderr)
         return False
+
+def buscar_resumo_pacotes(clinic_id: str):
+    """Resumo de pacotes da clínica gravado pela tarefa em lote (ou None se ainda não foi gerado)."""
     try:
-        pacote_ref = db.collection('clinicas').document(clinic_id) \
-                        .collection('clientes').document(cliente_id) \
-                        .collection('pacotes_clientes').document(pacote_cliente_id)
-    
-        # Usa firestore.Increment para uma dedução atômica e segura
-        pacote_ref.update({
-            'creditos_restantes': firestore.Increment(-1)
-        })
-        print(f"LOG: Crédito deduzido com sucesso do Pacote Cliente ID: {pacote_cliente_id}", file=sys.stderr)
+        doc = db.collection('clinicas').document(clinic_id).collection('resumos').document('pacotes').get()
+        if not doc.exists:
+            return None
+        resumo = doc.to_dict()
+        for item in resumo.get('pacotes_expirando', []):
+            if isinstance(item.get('data_expiracao'), datetime):
+                item['data_expiracao'] = item['data_expiracao'].astimezone(TZ_SAO_PAULO)
+        if isinstance(resumo.get('atualizado_em'), datetime):
+            resumo['atualizado_em'] = resumo['atualizado_em'].astimezone(TZ_SAO_PAULO)
+        return resumo
+    except Exception as e:
+        print(f"ERRO AO BUSCAR RESUMO DE PACOTES ({clinic_id}): {e}", file=sys.stderr)
+        return None
+
+# --- Extrato de créditos dos pacotes ---
+# .../pacotes_clientes/{pacote}/movimentos_creditos/{tipo}_{agendamento_id}, com tipo 'debito' ou 'estorno':
+# o ID do documento torna cada lançamento idempotente (clique duplo ou nova tentativa não debita de novo).
+# Pacotes anteriores ao extrato recebem um lançamento 'abertura' com o que já havia sido consumido, no
+# primeiro débito. Saldo esperado = creditos_total - abertura - débitos + estornos (ver `tarefas_agendadas`).
+
+COLECAO_MOVIMENTOS_CREDITOS = 'movimentos_creditos'
+
+def _ref_pacote_cliente(clinic_id: str, cliente_id: str, pacote_cliente_id: str):
+    return db.collection('clinicas').document(clinic_id) \
+             .collection('clientes').document(cliente_id) \
+             .collection('pacotes_clientes').document(pacote_cliente_id)
+
+def _ref_movimento_credito(pacote_ref, tipo: str, agendamento_id: str):
+    return pacote_ref.collection(COLECAO_MOVIMENTOS_CREDITOS).document(f"{tipo}_{agendamento_id}")
+
+def _dados_movimento_credito(tipo: str, quantidade: int, agendamento_id: str = None) -> dict:
+    return {'tipo': tipo, 'quantidade': quantidade, 'agendamento_id': agendamento_id, 'criado_em': firestore.SERVER_TIMESTAMP}
+
+def _ler_debito_pacote(transaction, clinic_id: str, dados: dict, agendamento_ids: list, parcial: bool = False):
+    """
+    Fase de leitura do débito na transação. Retorna None (sem pacote), a mensagem de erro (pacote
+    inexistente ou sem créditos) ou o estado para `_gravar_debito_pacote`. Com `parcial`, créditos
+    insuficientes não são erro: só os primeiros agendamentos que o saldo cobre ficam em 'pendentes'.
+    """
+    if not dados.get('pacote_cliente_id') or not dados.get('cliente_id'):
+        return None
+    pacote_ref = _ref_pacote_cliente(clinic_id, dados['cliente_id'], dados['pacote_cliente_id'])
+    debitos_refs = [_ref_movimento_credito(pacote_ref, 'debito', ag_id) for ag_id in agendamento_ids]
+    snaps = {snap.reference.path: snap for snap in transaction.get_all([pacote_ref] + debitos_refs)}
+    pacote_snap = snaps.get(pacote_ref.path)
+    if not pacote_snap or not pacote_snap.exists:
+        return "Pacote do cliente não encontrado."
+    pendentes = [ag_id for ag_id, ref in zip(agendamento_ids, debitos_refs) if not snaps.get(ref.path) or not snaps[ref.path].exists]
+    pacote = pacote_snap.to_dict()
+    if pacote.get('creditos_restantes', 0) < len(pendentes):
+        if not parcial:
+            return "Pacote sem créditos suficientes."
+        pendentes = pendentes[:max(pacote.get('creditos_restantes', 0), 0)]
+    return {'pacote_ref': pacote_ref, 'pacote': pacote, 'pendentes': pendentes}
+
+def _gravar_debito_pacote(transaction, debito: dict):
+    """Fase de escrita: um lançamento por agendamento pendente e o saldo decrementado no mesmo commit."""
+    if not debito or not debito['pendentes']:
+        return
+    pacote_ref, pacote = debito['pacote_ref'], debito['pacote']
+    campos = {'creditos_restantes': firestore.Increment(-len(debito['pendentes']))}
+    if not pacote.get('extrato_aberto'):
+        consumido = pacote.get('creditos_total', 0) - pacote.get('creditos_restantes', 0)
+        transaction.set(pacote_ref.collection(COLECAO_MOVIMENTOS_CREDITOS).document('abertura'), _dados_movimento_credito('abertura', consumido))
+        campos['extrato_aberto'] = True
+    for ag_id in debito['pendentes']:
+        transaction.create(_ref_movimento_credito(pacote_ref, 'debito', ag_id), _dados_movimento_credito('debito', 1, ag_id))
+    saldo_final = pacote.get('creditos_restantes', 0) - len(debito['pendentes'])
+    campos.update(calcular_status_pacote({**pacote, 'creditos_restantes': saldo_final}, datetime.now(TZ_SAO_PAULO)))
+    transaction.update(pacote_ref, campos)
+
+def _ler_estornos_pacote(transaction, clinic_id: str, cliente_id: str, pacote_cliente_id: str, agendamento_ids: list):
+    """
+    Fase de leitura do estorno: agendamentos com débito lançado e ainda sem estorno.
+    Retorna None (nada a estornar) ou o estado para `_gravar_estornos_pacote`.
+    """
+    if not clinic_id or not cliente_id or not pacote_cliente_id:
+        return None
+    pacote_ref = _ref_pacote_cliente(clinic_id, cliente_id, pacote_cliente_id)
+    refs = [pacote_ref]
+    for ag_id in agendamento_ids:
+        refs += [_ref_movimento_credito(pacote_ref, 'debito', ag_id), _ref_movimento_credito(pacote_ref, 'estorno', ag_id)]
+    snaps = {snap.reference.path: snap for snap in transaction.get_all(refs) if snap.exists}
+    existentes = {path.rsplit('/', 1)[1] for path in snaps if path != pacote_ref.path}
+    pendentes = [ag_id for ag_id in agendamento_ids if f"debito_{ag_id}" in existentes and f"estorno_{ag_id}" not in existentes]
+    if not pendentes or pacote_ref.path not in snaps:
+        return None
+    return {'pacote_ref': pacote_ref, 'pacote': snaps[pacote_ref.path].to_dict(), 'pendentes': pendentes}
+
+def _gravar_estornos_pacote(transaction, estorno: dict):
+    if not estorno:
+        return
+    pacote_ref, pacote = estorno['pacote_ref'], estorno['pacote']
+    for ag_id in estorno['pendentes']:
+        transaction.create(_ref_movimento_credito(pacote_ref, 'estorno', ag_id), _dados_movimento_credito('estorno', 1, ag_id))
+    campos = {'creditos_restantes': firestore.Increment(len(estorno['pendentes']))}
+    saldo_final = pacote.get('creditos_restantes', 0) + len(estorno['pendentes'])
+    campos.update(calcular_status_pacote({**pacote, 'creditos_restantes': saldo_final}, datetime.now(TZ_SAO_PAULO)))
+    transaction.update(pacote_ref, campos)
+
+def debitar_creditos_pacote(clinic_id: str, cliente_id: str, pacote_cliente_id: str, agendamento_ids: list) -> int:
+    """
+    Debita um crédito por agendamento (já gravado) numa transação com os lançamentos do extrato.
+    Agendamentos já debitados são ignorados. Retorna a quantidade debitada agora (0 em erro ou sem créditos).
+    """
+    if not cliente_id or not pacote_cliente_id or not agendamento_ids:
+        print(f"ERRO: Tentativa de debitar créditos com IDs inválidos. Cliente: '{cliente_id}', Pacote: '{pacote_cliente_id}'", file=sys.stderr)
+        return 0
+    try:
+
+        @firestore.transactional
+        def _debitar(transaction):
+            debito = _ler_debito_pacote(transaction, clinic_id, {'cliente_id': cliente_id, 'pacote_cliente_id': pacote_cliente_id}, agendamento_ids)
+            if isinstance(debito, str):
+                return debito
+            _gravar_debito_pacote(transaction, debito)
+            return len(debito['pendentes'])
+
+        resultado = _debitar(db.transaction())
+        if isinstance(resultado, str):
+            print(f"ERRO AO DEBITAR CRÉDITOS (Pacote Cliente ID: {pacote_cliente_id}): {resultado}", file=sys.stderr)
+            return 0
+        print(f"LOG: {resultado} crédito(s) debitado(s) do Pacote Cliente ID: {pacote_cliente_id}", file=sys.stderr)
+        return resultado
+
+    except Exception as e:
+
+        print(f"ERRO AO DEBITAR CRÉDITOS DO PACOTE (Cliente ID: {cliente_id}, Pacote Cliente ID: {pacote_cliente_id}): {e}", file=sys.stderr)
+        return 0
+
+def estornar_creditos_agendamentos(clinic_id: str, agendamentos: list) -> int:
+    """
+    Estorna os créditos de agendamentos cancelados fora de `atualizar_status_agendamento` (ex.: séries em lote).
+    `agendamentos` são dicts com 'id', 'cliente_id' e 'pacote_cliente_id'; uma transação por pacote.
+    Retorna a quantidade estornada.
+    """
+    por_pacote = {}
+    for ag in agendamentos:
+        if ag.get('pacote_cliente_id') and ag.get('cliente_id'):
+            por_pacote.setdefault((ag['cliente_id'], ag['pacote_cliente_id']), []).append(ag['id'])
+
+    estornados = 0
+    for (cliente_id, pacote_cliente_id), ids in por_pacote.items():
+        try:
+
+            @firestore.transactional
+            def _estornar(transaction):
+                estorno = _ler_estornos_pacote(transaction, clinic_id, cliente_id, pacote_cliente_id, ids)
+                _gravar_estornos_pacote(transaction, estorno)
+                return len(estorno['pendentes']) if estorno else 0
+
+            estornados += _estornar(db.transaction())
+
+        except Exception as e:
+
+            print(f"ERRO AO ESTORNAR CRÉDITOS (Pacote Cliente ID: {pacote_cliente_id}): {e}", file=sys.stderr)
+    return estornados
+
+def listar_pacotes_clientes_todos(campos: list = None):
+    """
+    Todos os pacotes de clientes (collection group), como [(caminho, dados)]. Usado pelas tarefas em lote;
+    `campos` restringe os campos lidos (projeção).
+    """
+    try:
+        query = db.collection_group('pacotes_clientes')
+        if campos:
+            query = query.select(campos)
+        return [(doc.reference.path, doc.to_dict()) for doc in query.stream()]
+    except Exception as e:
+        print(f"ERRO AO LISTAR PACOTES DE CLIENTES: {e}", file=sys.stderr)
+        return []
+
+def somar_movimentos_creditos_por_pacote() -> dict:
+    """
+    Soma os lançamentos de todos os extratos numa consulta (collection group):
+    {caminho_do_pacote: {'abertura': n, 'debito': n, 'estorno': n}}.
+    """
+    somas = {}
+    try:
+        for doc in db.collection_group(COLECAO_MOVIMENTOS_CREDITOS).stream():
+            movimento = doc.to_dict()
+            caminho_pacote = doc.reference.parent.parent.path
+            soma = somas.setdefault(caminho_pacote, {'abertura': 0, 'debito': 0, 'estorno': 0})
+            if movimento.get('tipo') in soma:
+                soma[movimento['tipo']] += movimento.get('quantidade', 0)
+        return somas
+    except Exception as e:
+        print(f"ERRO AO SOMAR MOVIMENTOS DE CRÉDITOS: {e}", file=sys.stderr)
+        return None
+
+def saldo_esperado_pacote(pacote: dict, movimentos: dict) -> int:
+    return pacote.get('creditos_total', 0) - movimentos.get('abertura', 0) - movimentos.get('debito', 0) + movimentos.get('estorno', 0)
+
+def reconciliar_pacote(caminho_pacote: str, aplicar: bool = False) -> dict:
+    """
+    Confere (e, com `aplicar`, corrige) um pacote numa transação, relendo o pacote e o extrato.
+    Pacotes sem extrato têm o extrato aberto com o consumo atual. Retorna
+    {'caminho', 'saldo', 'esperado', 'acao'} com acao em 'ok', 'divergente', 'corrigido', 'sem_extrato', 'extrato_aberto'.
+    """
+    pacote_ref = db.document(caminho_pacote)
+
+    @firestore.transactional
+    def _reconciliar(transaction):
+        pacote = pacote_ref.get(transaction=transaction).to_dict() or {}
+        saldo = pacote.get('creditos_restantes', 0)
+        if not pacote.get('extrato_aberto'):
+            if aplicar:
+                consumido = pacote.get('creditos_total', 0) - saldo
+                transaction.set(pacote_ref.collection(COLECAO_MOVIMENTOS_CREDITOS).document('abertura'), _dados_movimento_credito('abertura', consumido))
+                transaction.update(pacote_ref, {'extrato_aberto': True})
+            return {'caminho': caminho_pacote, 'saldo': saldo, 'esperado': saldo, 'acao': 'extrato_aberto' if aplicar else 'sem_extrato'}
+        movimentos = {}
+        for doc in transaction.get(pacote_ref.collection(COLECAO_MOVIMENTOS_CREDITOS)):
+            movimento = doc.to_dict()
+            movimentos[movimento.get('tipo')] = movimentos.get(movimento.get('tipo'), 0) + movimento.get('quantidade', 0)
+        esperado = saldo_esperado_pacote(pacote, movimentos)
+        if esperado == saldo:
+            return {'caminho': caminho_pacote, 'saldo': saldo, 'esperado': esperado, 'acao': 'ok'}
+        if aplicar:
+            transaction.update(pacote_ref, {'creditos_restantes': esperado})
+        return {'caminho': caminho_pacote, 'saldo': saldo, 'esperado': esperado, 'acao': 'corrigido' if aplicar else 'divergente'}
+
+    try:
+        return _reconciliar(db.transaction())
+    except Exception as e:
+        print(f"ERRO AO RECONCILIAR PACOTE ({caminho_pacote}): {e}", file=sys.stderr)
+        return {'caminho': caminho_pacote, 'saldo': None, 'esperado': None, 'acao': f"erro: {e}"}
+
+# --- Migração dos agendamentos para `clinicas/{id}/agendamentos` ---
+# A cópia percorre a coleção global em ordem de ID, lote a lote; o progresso fica em
+# `clinicas/{id}/migracoes/{migracao}` para uma execução interrompida continuar de onde parou.
+
+def ler_checkpoint_migracao(clinic_id: str, migracao: str) -> dict:
+    """Progresso gravado de uma migração da clínica ({} se ainda não começou)."""
+    try:
+        snap = db.collection('clinicas').document(clinic_id).collection(COLECAO_MIGRACOES).document(migracao).get()
+        return (snap.to_dict() or {}) if snap.exists else {}
+    except Exception as e:
+        print(f"ERRO AO LER PROGRESSO DA MIGRAÇÃO {migracao} ({clinic_id}): {e}", file=sys.stderr)
+        return {}
+
+def salvar_checkpoint_migracao(clinic_id: str, migracao: str, dados: dict) -> bool:
+    """Grava (merge) o progresso de uma migração da clínica."""
+    try:
+        db.collection('clinicas').document(clinic_id).collection(COLECAO_MIGRACOES).document(migracao).set(
+            {**dados, 'atualizado_em': firestore.SERVER_TIMESTAMP}, merge=True)
         return True
-    
     except Exception as e:
-    
-        print(f"ERRO AO DEDUZIR CRÉDITO DO PACOTE (Cliente ID: {cliente_id}, Pacote Cliente ID: {pacote_cliente_id}): {e}", file=sys.stderr)
+        print(f"ERRO AO GRAVAR PROGRESSO DA MIGRAÇÃO {migracao} ({clinic_id}): {e}", file=sys.stderr)
         return False
+
+def _lotes_por_id(query, tamanho: int, apos_id: str = None):
+    """Percorre a consulta em ordem de ID, `tamanho` documentos por vez (gerador de listas de snapshots)."""
+    while True:
+        pagina = query.order_by('__name__')
+        if apos_id:
+            pagina = pagina.start_after([apos_id])
+        docs = list(pagina.limit(tamanho).stream())
+        if docs:
+            yield docs
+        if len(docs) < tamanho:
+            return
+        apos_id = docs[-1].id
+
+def _alterado_depois(dados: dict, referencia: datetime) -> bool:
+    # Compara `atualizado_em` (gravado em toda escrita de agendamento) com a referência; sem o campo, não é posterior
+    atualizado_em = dados.get('atualizado_em')
+    return isinstance(atualizado_em, datetime) and referencia is not None and atualizado_em >= referencia
+
+def copiar_lote_agendamentos_para_clinica(clinic_id: str, apos_id: str = None, tamanho: int = TAMANHO_LOTE_ESCRITA,
+                                          sobrescrever: bool = True, alterados_desde: datetime = None):
+    """
+    Copia um lote de agendamentos da clínica da coleção global (os `tamanho` seguintes a `apos_id`, em ordem de ID)
+    para `clinicas/{id}/agendamentos`, gravando só os ausentes ou diferentes. Com `sobrescrever=False` (clínica já
+    migrada, coleção dela é a fonte) grava só os ausentes e lista os divergentes para conferência; com `alterados_desde`
+    (o instante do corte), também sobrescreve os que a coleção global recebeu depois dele e a da clínica ainda não
+    (gravações de instâncias com o layout antigo em cache).
+    Retorna {'lidos', 'copiados', 'divergentes_mantidos', 'ultimo_id'} (`ultimo_id` None no último lote) ou None em erro.
+    """
+    try:
+        origem = db.collection('agendamentos').where(filter=FieldFilter('clinic_id', '==', clinic_id)).order_by('__name__')
+        if apos_id:
+            origem = origem.start_after([apos_id])
+        docs = list(origem.limit(tamanho).stream())
+
+        destino_ref = db.collection('clinicas').document(clinic_id).collection('agendamentos')
+        destino = {snap.id: snap.to_dict() for snap in db.get_all([destino_ref.document(doc.id) for doc in docs]) if snap.exists} if docs else {}
+
+        batch = db.batch()
+        copiados, divergentes = 0, []
+        for doc in docs:
+            dados = doc.to_dict()
+            posterior_ao_corte = doc.id in destino and _alterado_depois(dados, alterados_desde) \
+                and not _alterado_depois(destino[doc.id], dados['atualizado_em'])
+            if doc.id not in destino or (destino[doc.id] != dados and (sobrescrever or posterior_ao_corte)):
+                batch.set(destino_ref.document(doc.id), dados)
+                copiados += 1
+            elif destino[doc.id] != dados:
+                divergentes.append(doc.id)
+        if copiados:
+            batch.commit()
+
+        return {'lidos': len(docs), 'copiados': copiados, 'divergentes_mantidos': divergentes,
+                'ultimo_id': docs[-1].id if len(docs) == tamanho else None}
+    except Exception as e:
+        print(f"ERRO AO COPIAR LOTE DE AGENDAMENTOS ({clinic_id}, após {apos_id}): {e}", file=sys.stderr)
+        return None
+
+def verificar_agendamentos_da_clinica(clinic_id: str, tamanho: int = TAMANHO_LOTE_ESCRITA) -> dict:
+    """
+    Compara a coleção global (agendamentos da clínica) com `clinicas/{id}/agendamentos`: contagens por agregação
+    e, em lotes de `get_all`, os IDs ausentes ou divergentes no destino e os que só existem nele.
+    Retorna {'origem', 'destino', 'ausentes', 'divergentes', 'extras'} ou None em erro.
+    """
+    try:
+        origem_query = db.collection('agendamentos').where(filter=FieldFilter('clinic_id', '==', clinic_id))
+        destino_ref = db.collection('clinicas').document(clinic_id).collection('agendamentos')
+        resultado = {'origem': _contar(origem_query), 'destino': _contar(destino_ref),
+                     'ausentes': [], 'divergentes': [], 'extras': []}
+
+        for docs in _lotes_por_id(origem_query, tamanho):
+            destino = {snap.id: snap.to_dict() for snap in db.get_all([destino_ref.document(doc.id) for doc in docs]) if snap.exists}
+            for doc in docs:
+                if doc.id not in destino:
+                    resultado['ausentes'].append(doc.id)
+                elif destino[doc.id] != doc.to_dict():
+                    resultado['divergentes'].append(doc.id)
+
+        origem_ref = db.collection('agendamentos')
+        for docs in _lotes_por_id(destino_ref, tamanho):
+            existentes = {snap.id for snap in db.get_all([origem_ref.document(doc.id) for doc in docs]) if snap.exists}
+            resultado['extras'].extend(doc.id for doc in docs if doc.id not in existentes)
+
+        print(f"LOG: Verificação dos agendamentos de {clinic_id}: {resultado['origem']} na origem, {resultado['destino']} no destino, "
+              f"{len(resultado['ausentes'])} ausentes, {len(resultado['divergentes'])} divergentes, {len(resultado['extras'])} extras.", file=sys.stderr)
+        return resultado
+    except Exception as e:
+        print(f"ERRO AO VERIFICAR AGENDAMENTOS ({clinic_id}): {e}", file=sys.stderr)
+        return None
+
+def definir_agendamentos_por_clinica(clinic_id: str, ativo: bool) -> bool:
+    """Corte (ou volta) da clínica para o layout `clinicas/{id}/agendamentos`."""
+    try:
+        db.collection('clinicas').document(clinic_id).update({'agendamentos_por_clinica': ativo})
+        cache_agenda.LAYOUT_AGENDAMENTOS.invalidar(clinic_id)
+        cache_agenda.DISPONIBILIDADE.invalidar(clinic_id)
+        print(f"LOG: Clínica {clinic_id} {'passou a usar' if ativo else 'deixou de usar'} a coleção de agendamentos própria.", file=sys.stderr)
+        return True
+    except Exception as e:
+        print(f"ERRO AO ALTERAR LAYOUT DOS AGENDAMENTOS ({clinic_id}): {e}", file=sys.stderr)
+        return False
+
+# --- Leitura e escrita em lote para as migrações de dados (`migracoes.py`) ---
+COLECOES_MIGRACAO = ('agendamentos', 'clientes')
+
+def _colecao_migracao(colecao: str, clinic_id: str):
+    """(consulta, coleção) da clínica para a migração; agendamentos seguem o layout atual da clínica."""
+    if colecao == 'agendamentos':
+        return _consulta_agendamentos(clinic_id), _colecao_agendamentos(clinic_id)
+    if colecao not in COLECOES_MIGRACAO:
+        raise ValueError(f"Coleção sem suporte a migração: {colecao}")
+    colecao_ref = db.collection('clinicas').document(clinic_id).collection(colecao)
+    return colecao_ref, colecao_ref
+
+def ler_lote_migracao(colecao: str, clinic_id: str, apos_id: str = None, tamanho: int = TAMANHO_LOTE_ESCRITA, campos: list = None):
+    """
+    Os `tamanho` documentos seguintes a `apos_id` (ordem de ID) da coleção da clínica, só com `campos` se informados.
+    Cada chamada é uma consulta curta com cursor, sem stream longo. Retorna [(id, dados)] ou None em erro.
+    """
+    try:
+        query, _ = _colecao_migracao(colecao, clinic_id)
+        if campos:
+            query = query.select(campos)
+        query = query.order_by('__name__')
+        if apos_id:
+            query = query.start_after([apos_id])
+        return [(doc.id, doc.to_dict() or {}) for doc in query.limit(tamanho).stream()]
+    except Exception as e:
+        print(f"ERRO AO LER LOTE DA MIGRAÇÃO ({colecao}, {clinic_id}, após {apos_id}): {e}", file=sys.stderr)
+        return None
+
+def atualizar_documentos_migracao(colecao: str, clinic_id: str, atualizacoes: dict):
+    """Aplica {doc_id: campos} na coleção da clínica em batches de TAMANHO_LOTE_ESCRITA. Retorna o total ou None em erro."""
+    atualizados = 0
+    try:
+        _, colecao_ref = _colecao_migracao(colecao, clinic_id)
+        itens = list(atualizacoes.items())
+        for inicio_lote in range(0, len(itens), TAMANHO_LOTE_ESCRITA):
+            batch = db.batch()
+            lote = itens[inicio_lote:inicio_lote + TAMANHO_LOTE_ESCRITA]
+            for doc_id, campos in lote:
+                batch.update(colecao_ref.document(doc_id), campos)
+            batch.commit()
+            atualizados += len(lote)
+        if colecao == 'clientes' and atualizados:
+            cache_agenda.CLIENTES.invalidar(clinic_id)
+        return atualizados
+    except Exception as e:
+        print(f"ERRO AO GRAVAR LOTE DA MIGRAÇÃO ({colecao}, {clinic_id}; {atualizados} de {len(atualizacoes)} gravados): {e}", file=sys.stderr)
+        return None
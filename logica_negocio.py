@@ -5,30 +5,65 @@
 # 3. Nova função: associar_pacote_cliente
 # 4. [CORREÇÃO CRÍTICA] `gerar_turmas_disponiveis` agora passa o horário exato da turma para `contar_agendamentos_turma_dia`.
 # 5. [AJUSTE] Adicionado `agendamento_id_excluir` para garantir que a checagem de disponibilidade ignore o agendamento que está sendo remarcado/transferido.
+# 6. [DESEMPENHO] `gerar_horarios_disponiveis` usa varredura de intervalos livres (sweep-line) em minutos, com granularidade configurável.
+# 7. [NOVA FUNÇÃO] `buscar_proximos_horarios_disponiveis`: próximos horários livres em N dias, para um ou todos os profissionais.
+# 8. [NOVA FUNÇÃO] `gerar_horarios_disponiveis_clinica`: horários de "qualquer profissional" com uma consulta para o dia.
+# 9. [DESEMPENHO] Disponibilidade do dia como bitmask por minuto, em cache por (clínica, profissional, data);
+#    `verificar_disponibilidade_com_duracao` e `gerar_horarios_disponiveis` passam a usar operações de bits.
+# 10. [DESEMPENHO] Agendas de trabalho compiladas (weekday -> intervalos em minutos) por nome/ID: `obter_agendas_profissionais`.
+# 11. [DESEMPENHO] `ContextoDia`: catálogo, feriado e agendas do dia compartilhados entre listagem, verificação e submissão.
+# 12. [FERIADOS] `CalendarioFeriados`: índice por ano em cache (set + tupla ordenada), com suporte a períodos.
+# 13. [SÉRIES] `criar_serie_agendamentos`, `cancelar_serie_agendamentos` e `alterar_serie_agendamentos`:
+#     checagem de conflitos numa passada (uma consulta por intervalo) e escritas em lote, que conferem as travas de horário.
+# 14. [TURMAS] `matricular_cliente_em_turma`: matrícula em lote num período (ocupação numa consulta; vagas e débito de créditos
+#     na mesma transação, em lotes de aulas).
+# 15. [TURMAS] Vagas lidas dos contadores `ocupacao_turmas` (uma consulta por dia); matrícula em lote reserva as vagas
+#     numa transação e o cancelamento de séries de turma libera as vagas.
+# 16. [PACOTES] `buscar_pacotes_validos_cliente` filtra créditos/validade/serviço na consulta e usa o mapa de modelos em cache.
+# 17. [PACOTES] Débitos de séries/matrículas lançados no extrato por agendamento; cancelamento de série estorna os créditos.
+# 18. [PACOTES] Pacote vendido já nasce com `status`/`expirando` (mantidos pela tarefa em lote).
+# 19. [DESEMPENHO] Grade da semana (`carregar_grade_semana`) numa consulta, com cada agendamento expandido pela duração
+#     em células de GRADE_INTERVALO_MIN; visões semanal e comparativa derivam dela e mostram agendamentos sobrepostos.
+# 20. [DESEMPENHO] `processar_remarcacao` lê o agendamento pelo ID (conferindo o PIN) em vez de consultar pelo PIN.
+# 21. [UI] Mapa `STATUS_ACOES_ADMIN` exposto para a agenda mostrar o novo status sem recarregar o dia.
+# 22. [PARTICIONAMENTO] Ações sobre agendamentos repassam o `clinic_id` (coleção global ou da clínica); a remarcação
+#     pelo link e a da tela do cliente leem o agendamento pelo ID na coleção da clínica e conferem o PIN.
 
 import uuid
 from datetime import datetime, date, time, timedelta
 import pandas as pd
+import numpy as np
 import random
 from zoneinfo import ZoneInfo
 import requests # Para buscar feriados
 import sys
+from bisect import bisect_left, bisect_right
 
 # Importações de funções de DB
 from database import (
     atualizar_status_agendamento, 
     buscar_agendamento_por_pin,
+    buscar_agendamento_por_id,
     atualizar_horario_agendamento,
-    listar_profissionais,
     adicionar_feriado,
     buscar_agendamentos_por_intervalo,
+    buscar_agendamentos_no_periodo,
     # Funções para turmas
-    contar_agendamentos_turma_dia, # USADA ABAIXO
+    buscar_ocupacao_turmas_dia,
+    salvar_matricula_turma,
     # <-- NOVAS IMPORTAÇÕES PARA PACOTES -->
-    listar_pacotes_modelos,
-    listar_pacotes_do_cliente,
+    mapa_pacotes_modelos_cache,
+    listar_pacotes_validos_do_cliente,
     associar_pacote_ao_cliente as db_associar_pacote_ao_cliente,
-    listar_servicos # Necessário para buscar_pacotes_validos
+    listar_servicos, # Necessário para buscar_pacotes_validos
+    # Séries recorrentes
+    salvar_agendamentos_em_lote,
+    atualizar_agendamentos_em_lote,
+    buscar_agendamentos_da_serie,
+    debitar_creditos_pacote,
+    calcular_status_pacote,
+    estornar_creditos_agendamentos,
+    buscar_agendamentos_turma_intervalo
 )
 
 TZ_SAO_PAULO = ZoneInfo('America/Sao_Paulo')
@@ -39,101 +74,68 @@ def gerar_token_unico():
     """Gera um código PIN numérico de 6 dígitos."""
     return str(random.randint(100000, 999999))
 
-def verificar_disponibilidade_com_duracao(clinic_id: str, profissional_nome: str, data_hora_inicio: datetime, duracao: int, agendamento_id_excluir: str = None):
+def verificar_disponibilidade_com_duracao(clinic_id: str, profissional_nome: str, data_hora_inicio: datetime, duracao: int, agendamento_id_excluir: str = None, contexto: 'ContextoDia' = None):
     """
     Verifica se um slot de tempo específico está disponível para agendamento INDIVIDUAL.
     Adicionado agendamento_id_excluir para ignorar o próprio agendamento (usado em remarcação/transferência).
+    A checagem é feita sobre a máscara de bits do dia (ver `_disponibilidade_dia`).
+    `contexto` reaproveita os dados já carregados para a listagem de horários do mesmo dia.
     """
-    from database import buscar_agendamentos_por_data_e_profissional, listar_profissionais, listar_feriados
-    
-    profissionais = listar_profissionais(clinic_id)
-    profissional_data = next((p for p in profissionais if p['nome'] == profissional_nome), None)
+    if data_hora_inicio.tzinfo:
+        data_hora_inicio = data_hora_inicio.astimezone(TZ_SAO_PAULO)
 
-    if not profissional_data:
+    disponibilidade = _disponibilidade_dia(clinic_id, profissional_nome, data_hora_inicio.date(), contexto)
+    if not disponibilidade:
     
         return False, "Profissional não encontrado."
 
-    horarios_trabalho = profissional_data.get('horario_trabalho', {})
-    dia_key = DIAS_MAP_WEEKDAY_TO_KEY[data_hora_inicio.weekday()]
-
-    horario_dia = horarios_trabalho.get(dia_key)
+    horario_dia = disponibilidade['horario_dia']
+    if disponibilidade['mal_configurado']:
+        return False, "Horário de trabalho do profissional não configurado corretamente."
 
-    if not horario_dia or not horario_dia.get('ativo'):
+    if not disponibilidade['intervalos']:
     
         dia_semana_nome = DIAS_SEMANA_PT.get(data_hora_inicio.weekday(), '')
         return False, f"O profissional não trabalha neste dia da semana ({dia_semana_nome})."
 
-    try:
-        inicio_expediente = datetime.strptime(horario_dia['inicio'], "%H:%M").time()
-        fim_expediente = datetime.strptime(horario_dia['fim'], "%H:%M").time()
-        
-        dt_inicio_novo = data_hora_inicio
-        dt_fim_novo = dt_inicio_novo + timedelta(minutes=duracao)
-
-        if not (inicio_expediente <= dt_inicio_novo.time() and dt_fim_novo.time() <= fim_expediente):
-            return False, f"Fora do horário de expediente ({horario_dia['inicio']} - {horario_dia['fim']})."
-    except (ValueError, KeyError):
-        return False, "Horário de trabalho do profissional não configurado corretamente."
+    inicio_novo = _minutos_do_dia(data_hora_inicio.time())
+    if not any(inicio <= inicio_novo and inicio_novo + duracao <= fim for inicio, fim in disponibilidade['intervalos']):
+        return False, f"Fora do horário de expediente ({horario_dia['inicio']} - {horario_dia['fim']})."
 
-    feriados = listar_feriados(clinic_id)
-    if any(f['data'] == data_hora_inicio.date() for f in feriados):
+    if disponibilidade['feriado']:
     
         return False, "O dia selecionado é um feriado ou folga."
 
-    # Busca agendamentos do profissional na data
-    agendamentos_existentes = buscar_agendamentos_por_data_e_profissional(clinic_id, profissional_nome, data_hora_inicio.date())
-    
-    
-    if agendamentos_existentes.empty or 'turma_id' not in agendamentos_existentes.columns:
-        agendamentos_individuais = agendamentos_existentes.copy()
-    else:
-        # Filtra apenas agendamentos individuais (sem turma_id)
-        agendamentos_individuais = agendamentos_existentes[agendamentos_existentes['turma_id'].isnull()]
-
-    # Exclui o próprio agendamento se for uma operação de remarcação/transferência
-    if agendamento_id_excluir and not agendamentos_individuais.empty:
-        agendamentos_individuais = agendamentos_individuais[agendamentos_individuais['id'] != agendamento_id_excluir]
-
-    if not agendamentos_individuais.empty:
-    
-        for _, ag in agendamentos_individuais.iterrows():
-    
-            if ag['status'] == 'Confirmado':
-    
-                dt_inicio_existente = ag['horario']
-                duracao_existente = int(ag.get('duracao_min', 30))
-                dt_fim_existente = dt_inicio_existente + timedelta(minutes=duracao_existente)
-                
-                # Verifica sobreposição
-                if data_hora_inicio < dt_fim_existente and dt_inicio_existente < dt_fim_novo:
-    
-                    return False, f"Conflito com agendamento das {dt_inicio_existente.strftime('%H:%M')}."
+    livre = _mascara_livre(disponibilidade, agendamento_id_excluir)
+    if not _slot_livre(livre, inicio_novo, duracao):
+        # Localiza o agendamento em conflito apenas para a mensagem
+        for inicio, fim, ag_id in disponibilidade['blocos']:
+            if ag_id != agendamento_id_excluir and inicio < inicio_novo + duracao and inicio_novo < fim:
+                return False, f"Conflito com agendamento das {inicio // 60:02d}:{inicio % 60:02d}."
+        return False, "Horário indisponível."
 
     return True, "Horário disponível."
 
 def processar_cancelamento_seguro(pin_code: str) -> bool:
     agendamento = buscar_agendamento_por_pin(pin_code)
     if agendamento and agendamento['status'] == "Confirmado":
-        return atualizar_status_agendamento(agendamento['id'], "Cancelado pelo Cliente")
+        return atualizar_status_agendamento(agendamento['id'], "Cancelado pelo Cliente", agendamento.get('clinic_id'))
     return False
 
-def acao_admin_agendamento(agendamento_id: str, acao: str) -> bool:
-    
-    status_map = {
-    
-        "cancelar": "Cancelado (Admin)",
-    
-        "finalizar": "Finalizado",
-    
-        "no-show": "No-Show",
-    
-    }
+# Ação do admin -> status gravado no agendamento
+STATUS_ACOES_ADMIN = {
+    "cancelar": "Cancelado (Admin)",
+    "finalizar": "Finalizado",
+    "no-show": "No-Show",
+}
+
+def acao_admin_agendamento(agendamento_id: str, acao: str, clinic_id: str = None, somente_confirmado: bool = False) -> bool:
     
-    novo_status = status_map.get(acao)
+    novo_status = STATUS_ACOES_ADMIN.get(acao)
     
     if novo_status:
     
-        return atualizar_status_agendamento(agendamento_id, novo_status)
+        return atualizar_status_agendamento(agendamento_id, novo_status, clinic_id, somente_confirmado)
     
     return False
 
@@ -162,9 +164,10 @@ def buscar_agendamentos_por_data(clinic_id: str, data_selecionada: date):
     
     return agendamentos_do_dia.sort_values(by='horario')
 
-def processar_remarcacao(pin: str, agendamento_id: str, profissional_nome: str, novo_horario: datetime):
-    agendamento_atual = buscar_agendamento_por_pin(pin)
-    if not agendamento_atual:
+def processar_remarcacao(pin: str, agendamento_id: str, profissional_nome: str, novo_horario: datetime, clinic_id: str = None):
+    # Leitura direta pelo ID (com `clinic_id`, na coleção da clínica); o PIN confirma que é o agendamento do link
+    agendamento_atual = buscar_agendamento_por_id(agendamento_id, clinic_id)
+    if not agendamento_atual or agendamento_atual.get('pin_code') != pin:
         return False, "Agendamento original não encontrado."
 
     clinic_id = agendamento_atual['clinic_id']
@@ -180,7 +183,7 @@ def processar_remarcacao(pin: str, agendamento_id: str, profissional_nome: str,
     if not disponivel:
         return False, f"Não foi possível remarcar: {msg}"
     
-    if atualizar_horario_agendamento(agendamento_id, novo_horario):
+    if atualizar_horario_agendamento(agendamento_id, novo_horario, clinic_id):
         return True, "Agendamento remarcado com sucesso!"
     else:
         return False, "Ocorreu um erro ao tentar remarcar no banco de dados."
@@ -210,101 +213,583 @@ def importar_feriados_nacionais(clinic_id: str, ano: int):
         print(f"Erro ao buscar feriados da API: {e}", file=sys.stderr)
         return 0
 
-def gerar_horarios_disponiveis(clinic_id: str, profissional_nome: str, data_selecionada: date, duracao_servico: int, agendamento_id_excluir: str = None):
+class CalendarioFeriados:
     """
-    Gera uma lista de horários disponíveis para atendimentos individuais.
+    Calendário de feriados/folgas de uma clínica: responde se uma data (ou um intervalo) está
+    bloqueada a partir de um índice por ano — set para pertinência e tupla ordenada para intervalos.
+    Cada ano é carregado com uma consulta (`listar_feriados_do_ano`) e fica em cache, invalidado
+    pelas escritas de feriados. Períodos com `data_fim` são expandidos dia a dia no índice.
     """
-    from database import buscar_agendamentos_por_data_e_profissional, listar_profissionais, listar_feriados
 
-    feriados = listar_feriados(clinic_id)
-    if any(f['data'] == data_selecionada for f in feriados):
-    
+    def __init__(self, clinic_id: str):
+        self.clinic_id = clinic_id
+
+    def _indice_do_ano(self, ano: int) -> dict:
+        """{'datas': frozenset, 'ordenadas': tuple, 'descricoes': {data: descricao}} do ano."""
+        from database import listar_feriados_do_ano
+        import cache_agenda
+
+        def indexar():
+            descricoes = {}
+            for feriado in listar_feriados_do_ano(self.clinic_id, ano):
+                dia = max(feriado['data'], date(ano, 1, 1))
+                ultimo = min(feriado['data_fim'], date(ano, 12, 31))
+                while dia <= ultimo:
+                    descricoes.setdefault(dia, feriado.get('descricao', ''))
+                    dia += timedelta(days=1)
+            return {'datas': frozenset(descricoes), 'ordenadas': tuple(sorted(descricoes)), 'descricoes': descricoes}
+
+        return cache_agenda.FERIADOS.obter((self.clinic_id, ano), indexar)
+
+    def eh_feriado(self, data: date) -> bool:
+        return data in self._indice_do_ano(data.year)['datas']
+
+    def descricao(self, data: date):
+        """Descrição do feriado na data, ou None."""
+        return self._indice_do_ano(data.year)['descricoes'].get(data)
+
+    def datas_no_intervalo(self, inicio: date, fim: date) -> list:
+        """Datas bloqueadas em [inicio, fim], ordenadas."""
+        datas = []
+        for ano in range(inicio.year, fim.year + 1):
+            ordenadas = self._indice_do_ano(ano)['ordenadas']
+            datas.extend(ordenadas[bisect_left(ordenadas, inicio):bisect_right(ordenadas, fim)])
+        return datas
+
+def _minutos_do_dia(valor: time) -> int:
+    """Converte um horário em minutos desde a meia-noite."""
+    return valor.hour * 60 + valor.minute
+
+def _blocos_ocupados_em_minutos(agendamentos_df: pd.DataFrame, data_base: date) -> list:
+    """
+    Converte os agendamentos confirmados em intervalos [inicio, fim) medidos em
+    minutos a partir da meia-noite de `data_base`.
+    """
+    if agendamentos_df.empty:
         return []
 
-    profissionais = listar_profissionais(clinic_id)
-    profissional_data = next((p for p in profissionais if p['nome'] == profissional_nome), None)
-
-    if not profissional_data:
-    
+    df_confirmados = agendamentos_df[agendamentos_df['status'] == 'Confirmado']
+    if df_confirmados.empty:
         return []
 
-    horarios_trabalho = profissional_data.get('horario_trabalho', {})
-    dia_key = DIAS_MAP_WEEKDAY_TO_KEY[data_selecionada.weekday()]
-
-    horario_dia = horarios_trabalho.get(dia_key)
+    inicio_dia = datetime.combine(data_base, time.min, tzinfo=TZ_SAO_PAULO)
+    if 'duracao_min' in df_confirmados.columns:
+        duracoes = df_confirmados['duracao_min'].fillna(30).astype(int).tolist()
+    else:
+        duracoes = [30] * len(df_confirmados)
+
+    blocos = []
+    for horario, duracao in zip(df_confirmados['horario'], duracoes):
+        inicio = int((horario - inicio_dia).total_seconds() // 60)
+        blocos.append((inicio, inicio + duracao))
+    return blocos
+
+def _blocos_por_profissional_e_dia(agendamentos_df: pd.DataFrame) -> dict:
+    """Agrupa os blocos ocupados (individuais e confirmados) por (profissional_nome, data)."""
+    individuais_df = _agendamentos_individuais(agendamentos_df)
+    blocos = {}
+    if individuais_df.empty:
+        return blocos
+    for (nome, dia), grupo in individuais_df.groupby([individuais_df['profissional_nome'], individuais_df['horario'].dt.date]):
+        blocos[(nome, dia)] = _blocos_ocupados_em_minutos(grupo, dia)
+    return blocos
+
+def _compilar_agenda_profissional(profissional_data: dict) -> dict:
+    """
+    Pré-processa o `horario_trabalho` de um profissional (o parse de "HH:MM" acontece só aqui):
+    {'id', 'nome', 'dados', 'intervalos': {weekday: [(inicio, fim)]}, 'mal_configurados': {weekday}},
+    com os intervalos de trabalho em minutos desde a meia-noite.
+    """
+    intervalos = {}
+    mal_configurados = set()
+    horarios_trabalho = profissional_data.get('horario_trabalho') or {}
+    for weekday, dia_key in DIAS_MAP_WEEKDAY_TO_KEY.items():
+        horario_dia = horarios_trabalho.get(dia_key)
+        if not horario_dia or not horario_dia.get('ativo'):
+            continue
+        try:
+            inicio = _minutos_do_dia(datetime.strptime(horario_dia['inicio'], "%H:%M").time())
+            fim = _minutos_do_dia(datetime.strptime(horario_dia['fim'], "%H:%M").time())
+        except (ValueError, KeyError, TypeError):
+            mal_configurados.add(weekday)
+            continue
+        intervalos[weekday] = [(inicio, fim)]
+
+    return {
+        'id': profissional_data.get('id'),
+        'nome': profissional_data.get('nome'),
+        'dados': profissional_data,
+        'intervalos': intervalos,
+        'mal_configurados': mal_configurados,
+    }
 
-    if not horario_dia or not horario_dia.get('ativo'):
-    
-        return []
+def obter_agendas_profissionais(clinic_id: str) -> dict:
+    """
+    Agendas de trabalho compiladas dos profissionais da clínica, indexadas por nome e por ID:
+    {'por_nome': {nome: agenda}, 'por_id': {id: agenda}}.
+    Compiladas uma vez por carga dos profissionais e mantidas em cache (invalidado junto com eles).
+    """
+    from database import listar_profissionais_cache
+    import cache_agenda
+
+    def compilar():
+        agendas = [_compilar_agenda_profissional(p) for p in listar_profissionais_cache(clinic_id)]
+        return {
+            'por_nome': {a['nome']: a for a in agendas},
+            'por_id': {a['id']: a for a in agendas},
+        }
+
+    return cache_agenda.AGENDAS.obter((clinic_id,), compilar)
+
+def _intervalos_de_trabalho(agenda: dict, data: date) -> list:
+    """Intervalos de trabalho [(inicio, fim)] em minutos da agenda compilada na data."""
+    return agenda['intervalos'].get(data.weekday(), [])
+
+def _agendamentos_individuais(agendamentos_df: pd.DataFrame, agendamento_id_excluir: str = None) -> pd.DataFrame:
+    """Mantém apenas agendamentos individuais (sem turma), opcionalmente excluindo um ID."""
+    if agendamentos_df.empty or 'turma_id' not in agendamentos_df.columns:
+        individuais_df = agendamentos_df.copy()
+    else:
+        individuais_df = agendamentos_df[agendamentos_df['turma_id'].isnull()]
 
-    try:
-        inicio_expediente = datetime.strptime(horario_dia['inicio'], "%H:%M").time()
-        fim_expediente = datetime.strptime(horario_dia['fim'], "%H:%M").time()
-        inicio_expediente_dt = datetime.combine(data_selecionada, inicio_expediente, tzinfo=TZ_SAO_PAULO)
-        fim_expediente_dt = datetime.combine(data_selecionada, fim_expediente, tzinfo=TZ_SAO_PAULO)
-    except (ValueError, KeyError):
-        return []
+    if agendamento_id_excluir and not individuais_df.empty:
+        individuais_df = individuais_df[individuais_df['id'] != agendamento_id_excluir]
+    return individuais_df
 
-    agendamentos_existentes_df = buscar_agendamentos_por_data_e_profissional(clinic_id, profissional_nome, data_selecionada)
-    
-    
-    if agendamentos_existentes_df.empty or 'turma_id' not in agendamentos_existentes_df.columns:
-        agendamentos_individuais_df = agendamentos_existentes_df.copy()
-    else:
-        # Filtra apenas agendamentos individuais (turma_id é nulo)
-        agendamentos_individuais_df = agendamentos_existentes_df[agendamentos_existentes_df['turma_id'].isnull()]
-    
-    if agendamento_id_excluir and not agendamentos_individuais_df.empty:
-        agendamentos_individuais_df = agendamentos_individuais_df[agendamentos_individuais_df['id'] != agendamento_id_excluir]
+def _intervalos_livres(inicio_expediente: int, fim_expediente: int, blocos_ocupados: list) -> list:
+    """
+    Varredura (sweep-line) sobre os blocos ocupados ordenados: devolve os intervalos
+    livres [inicio, fim) dentro do expediente, já ordenados e sem sobreposição.
+    """
+    livres = []
+    cursor = inicio_expediente
+    for inicio, fim in sorted(blocos_ocupados):
+        if fim <= cursor:
+            continue
+        if inicio >= fim_expediente:
+            break
+        if inicio > cursor:
+            livres.append((cursor, inicio))
+        cursor = max(cursor, fim)
+    if cursor < fim_expediente:
+        livres.append((cursor, fim_expediente))
+    return livres
+
+def _slots_em_intervalos_livres(intervalos_livres: list, duracao: int, intervalo_minimo: int, origem_grade: int) -> list:
+    """
+    Gera os inícios de slot alinhados à grade (`origem_grade` + k * `intervalo_minimo`)
+    em que um atendimento de `duracao` minutos cabe inteiro num intervalo livre.
+    O resultado sai ordenado, pois os intervalos livres já estão ordenados.
+    """
+    slots = []
+    for inicio, fim in intervalos_livres:
+        # Primeiro ponto da grade >= inicio (divisão com teto)
+        primeiro = origem_grade + -(-(inicio - origem_grade) // intervalo_minimo) * intervalo_minimo
+        ultimo = fim - duracao
+        if primeiro <= ultimo:
+            slots.extend(range(primeiro, ultimo + 1, intervalo_minimo))
+    return slots
+
+def _mascara_intervalo(inicio: int, fim: int) -> int:
+    """Bitmask com os bits [inicio, fim) ligados: um bit por minuto do dia."""
+    inicio = max(inicio, 0)
+    if fim <= inicio:
+        return 0
+    return ((1 << (fim - inicio)) - 1) << inicio
 
-    blocos_ocupados = []
-    if not agendamentos_individuais_df.empty:
-        df_confirmados = agendamentos_individuais_df[agendamentos_individuais_df['status'] == 'Confirmado']
-        for _, ag in df_confirmados.iterrows():
-    
-            inicio = ag['horario']
-            duracao = int(ag.get('duracao_min', 30))
-            fim = inicio + timedelta(minutes=duracao)
-            blocos_ocupados.append((inicio, fim))
+def _slot_livre(mascara_livre: int, inicio: int, duracao: int) -> bool:
+    """True se todos os minutos [inicio, inicio + duracao) estão livres na máscara."""
+    mascara_slot = _mascara_intervalo(inicio, inicio + duracao)
+    return mascara_livre & mascara_slot == mascara_slot
 
-    horarios_disponiveis = []
-    intervalo_minimo = 15
-    slot_candidato = inicio_expediente_dt
+def _disponibilidade_dia(clinic_id: str, profissional_nome: str, data: date, contexto: 'ContextoDia' = None):
+    """
+    Disponibilidade compacta de um profissional num dia, em cache por (clínica, profissional, data, versão do dia):
+    {'horario_dia', 'intervalos', 'mal_configurado', 'feriado', 'blocos': [(inicio, fim, id)], 'ids', 'livre'},
+    onde 'livre' é o bitmask dos minutos de expediente sem agendamento individual confirmado.
+    Retorna None se o profissional não existe. O cache é invalidado pelas escritas desta instância, e a versão
+    do dia (lida a cada chamada, ver `database.ler_versao_agenda_dia`) descarta o que outras instâncias alteraram.
+    Com um `contexto` do mesmo dia, agendas e feriados vêm dele em vez de novas consultas.
+    """
+    if contexto is not None and (contexto.clinic_id, contexto.data) != (clinic_id, data):
+        contexto = None
+    from database import buscar_agendamentos_por_data_e_profissional, ler_versao_agenda_dia
+    import cache_agenda
+
+    def carregar():
+        agendas = contexto.agendas if contexto else obter_agendas_profissionais(clinic_id)
+        agenda = agendas['por_nome'].get(profissional_nome)
+        if not agenda:
+            return None
+
+        horario_dia = (agenda['dados'].get('horario_trabalho') or {}).get(DIAS_MAP_WEEKDAY_TO_KEY[data.weekday()])
+        intervalos = _intervalos_de_trabalho(agenda, data)
+        feriado = contexto.feriado if contexto else CalendarioFeriados(clinic_id).eh_feriado(data)
+
+        blocos = []
+        if intervalos and not feriado:
+            individuais_df = _agendamentos_individuais(buscar_agendamentos_por_data_e_profissional(clinic_id, profissional_nome, data))
+            if not individuais_df.empty:
+                confirmados_df = individuais_df[individuais_df['status'] == 'Confirmado']
+                for (inicio, fim), ag_id in zip(_blocos_ocupados_em_minutos(confirmados_df, data), confirmados_df['id']):
+                    blocos.append((inicio, fim, ag_id))
+
+        disponibilidade = {
+            'horario_dia': horario_dia,
+            'intervalos': intervalos,
+            'mal_configurado': data.weekday() in agenda['mal_configurados'],
+            'feriado': feriado,
+            'blocos': sorted(blocos),
+            'ids': frozenset(b[2] for b in blocos),
+        }
+        disponibilidade['livre'] = _mascara_livre(disponibilidade)
+        return disponibilidade
+
+    versao = ler_versao_agenda_dia(clinic_id, data)
+    if versao is None:
+        return carregar()
+    return cache_agenda.DISPONIBILIDADE.obter((clinic_id, profissional_nome, data, versao), carregar)
+
+def _mascara_livre(disponibilidade: dict, agendamento_id_excluir: str = None) -> int:
+    """Bitmask livre do dia; com `agendamento_id_excluir`, o bloco desse agendamento volta a ficar livre."""
+    if 'livre' in disponibilidade and agendamento_id_excluir not in disponibilidade['ids']:
+        return disponibilidade['livre']
+    if disponibilidade['feriado']:
+        return 0
+    expediente = 0
+    for inicio, fim in disponibilidade['intervalos']:
+        expediente |= _mascara_intervalo(inicio, fim)
+    ocupado = 0
+    for inicio, fim, ag_id in disponibilidade['blocos']:
+        if ag_id != agendamento_id_excluir:
+            ocupado |= _mascara_intervalo(inicio, fim)
+    return expediente & ~ocupado
+
+class ContextoDia:
+    """
+    Dados de um dia de agendamento compartilhados entre a listagem de horários, a verificação
+    e a submissão: catálogo de serviços, feriado do dia e agendas compiladas, cada um carregado
+    no máximo uma vez. Os agendamentos do profissional no dia vêm de `_disponibilidade_dia`,
+    cujo cache é invalidado pelas escritas — assim a verificação final não usa dados vencidos.
+    """
 
-    while slot_candidato + timedelta(minutes=duracao_servico) <= fim_expediente_dt:
-        fim_slot_candidato = slot_candidato + timedelta(minutes=duracao_servico)
-        conflito = False
-        for inicio_ocupado, fim_ocupado in blocos_ocupados:
-            if slot_candidato < fim_ocupado and fim_slot_candidato > inicio_ocupado:
-                conflito = True
-    
-                break
-    
-        
-    
-        if not conflito:
+    def __init__(self, clinic_id: str, data: date, servicos: list = None):
+        self.clinic_id = clinic_id
+        self.data = data
+        self._servicos = servicos
+        self._feriado = None
+        self._agendas = None
+
+    @property
+    def servicos(self) -> list:
+        if self._servicos is None:
+            self._servicos = listar_servicos(self.clinic_id)
+        return self._servicos
+
+    def servico(self, nome: str):
+        """Serviço do catálogo pelo nome, ou None."""
+        return next((s for s in self.servicos if s.get('nome') == nome), None)
+
+    @property
+    def feriado(self) -> bool:
+        if self._feriado is None:
+            self._feriado = CalendarioFeriados(self.clinic_id).eh_feriado(self.data)
+        return self._feriado
+
+    @property
+    def agendas(self) -> dict:
+        if self._agendas is None:
+            self._agendas = obter_agendas_profissionais(self.clinic_id)
+        return self._agendas
+
+def gerar_horarios_disponiveis(clinic_id: str, profissional_nome: str, data_selecionada: date, duracao_servico: int, agendamento_id_excluir: str = None, intervalo_minimo: int = 15, contexto: ContextoDia = None):
+    """
+    Gera uma lista de horários disponíveis para atendimentos individuais.
+    `intervalo_minimo` define a granularidade da grade de horários (em minutos).
+    Cada ponto da grade é testado com uma operação de bits sobre a máscara livre do dia.
+    """
+    disponibilidade = _disponibilidade_dia(clinic_id, profissional_nome, data_selecionada, contexto)
+    if not disponibilidade or disponibilidade['feriado'] or not disponibilidade['intervalos']:
     
-            horarios_disponiveis.append(slot_candidato.time())
-        
-        slot_candidato += timedelta(minutes=intervalo_minimo)
+        return []
 
-    horarios_unicos = sorted(list(set(horarios_disponiveis)))
+    livre = _mascara_livre(disponibilidade, agendamento_id_excluir)
+
+    slots = []
+    for inicio_expediente, fim_expediente in disponibilidade['intervalos']:
+        slots.extend(
+            minuto for minuto in range(inicio_expediente, fim_expediente - duracao_servico + 1, intervalo_minimo)
+            if _slot_livre(livre, minuto, duracao_servico)
+        )
+    horarios_disponiveis = [time(m // 60, m % 60) for m in slots]
     
     if data_selecionada == datetime.now(TZ_SAO_PAULO).date():
         hora_atual = datetime.now(TZ_SAO_PAULO).time()
-        horarios_futuros = [h for h in horarios_unicos if h >= hora_atual]
+        horarios_futuros = [h for h in horarios_disponiveis if h >= hora_atual]
         return horarios_futuros
     
-    return horarios_unicos
+    return horarios_disponiveis
+
+def buscar_proximos_horarios_disponiveis(clinic_id: str, duracao_servico: int, profissional_nome: str = None, data_inicio: date = None, dias: int = 14, limite: int = 5, intervalo_minimo: int = 15):
+    """
+    Procura os próximos horários livres para um atendimento individual, varrendo até `dias`
+    dias a partir de `data_inicio` (padrão: hoje), para um profissional ou para todos.
+    Usa uma única consulta de agendamentos no intervalo e os profissionais/feriados em cache.
+    Retorna até `limite` opções ordenadas: [{'data', 'hora', 'profissional_nome'}].
+    """
+    agora = datetime.now(TZ_SAO_PAULO)
+    data_inicio = max(data_inicio or agora.date(), agora.date())
+    data_fim = data_inicio + timedelta(days=dias - 1)
+
+    agendas = obter_agendas_profissionais(clinic_id)['por_nome']
+    if profissional_nome:
+        agendas = {profissional_nome: agendas[profissional_nome]} if profissional_nome in agendas else {}
+    if not agendas:
+        return []
+
+    datas_feriados = set(CalendarioFeriados(clinic_id).datas_no_intervalo(data_inicio, data_fim))
+
+    # Uma única consulta filtrada pelo intervalo; os blocos são agrupados por profissional e dia
+    blocos_por_prof_dia = _blocos_por_profissional_e_dia(buscar_agendamentos_no_periodo(clinic_id, data_inicio, data_fim))
+
+    opcoes = []
+    for deslocamento in range(dias):
+        dia = data_inicio + timedelta(days=deslocamento)
+        if dia in datas_feriados:
+            continue
+
+        minimo_hoje = _minutos_do_dia(agora.time()) if dia == agora.date() else None
+        opcoes_do_dia = []
+        for nome, agenda in agendas.items():
+            blocos = blocos_por_prof_dia.get((nome, dia), [])
+            for inicio_expediente, fim_expediente in _intervalos_de_trabalho(agenda, dia):
+                livres = _intervalos_livres(inicio_expediente, fim_expediente, blocos)
+                for minuto in _slots_em_intervalos_livres(livres, duracao_servico, intervalo_minimo, inicio_expediente):
+                    if minimo_hoje is not None and minuto < minimo_hoje:
+                        continue
+                    opcoes_do_dia.append((minuto, nome))
+
+        for minuto, nome in sorted(opcoes_do_dia):
+            opcoes.append({'data': dia, 'hora': time(minuto // 60, minuto % 60), 'profissional_nome': nome})
+            if len(opcoes) >= limite:
+                return opcoes
+
+    return opcoes
+
+def gerar_horarios_disponiveis_clinica(clinic_id: str, data_selecionada: date, duracao_servico: int, intervalo_minimo: int = 15):
+    """
+    Horários disponíveis para "qualquer profissional": união dos slots livres de todos os
+    profissionais na data, com uma única consulta (filtrada pelo dia) dos agendamentos da clínica inteira.
+    Retorna [{'hora': time, 'profissionais': [nomes]}] ordenado por hora.
+    """
+    if CalendarioFeriados(clinic_id).eh_feriado(data_selecionada):
+        return []
+
+    agendas = obter_agendas_profissionais(clinic_id)['por_nome']
+    if not agendas:
+        return []
+
+    blocos_por_prof_dia = _blocos_por_profissional_e_dia(buscar_agendamentos_no_periodo(clinic_id, data_selecionada, data_selecionada))
+
+    agora = datetime.now(TZ_SAO_PAULO)
+    minimo_hoje = _minutos_do_dia(agora.time()) if data_selecionada == agora.date() else None
+
+    profissionais_por_minuto = {}
+    for nome, agenda in agendas.items():
+        blocos = blocos_por_prof_dia.get((nome, data_selecionada), [])
+        for inicio_expediente, fim_expediente in _intervalos_de_trabalho(agenda, data_selecionada):
+            livres = _intervalos_livres(inicio_expediente, fim_expediente, blocos)
+            for minuto in _slots_em_intervalos_livres(livres, duracao_servico, intervalo_minimo, inicio_expediente):
+                if minimo_hoje is not None and minuto < minimo_hoje:
+                    continue
+                profissionais_por_minuto.setdefault(minuto, []).append(nome)
+
+    return [
+        {'hora': time(minuto // 60, minuto % 60), 'profissionais': nomes}
+        for minuto, nomes in sorted(profissionais_por_minuto.items())
+    ]
+
+# --- Séries recorrentes ---
+
+MAXIMO_OCORRENCIAS_SERIE = 52
+
+def gerar_datas_recorrencia(data_inicio: date, intervalo_semanas: int = 1, data_fim: date = None, ocorrencias: int = None) -> list:
+    """
+    Datas de uma série semanal (`intervalo_semanas=1`) ou quinzenal (2), até `data_fim` e/ou
+    `ocorrencias`, limitadas a MAXIMO_OCORRENCIAS_SERIE.
+    """
+    limite = min(ocorrencias or MAXIMO_OCORRENCIAS_SERIE, MAXIMO_OCORRENCIAS_SERIE)
+    datas = []
+    dia = data_inicio
+    while len(datas) < limite and (data_fim is None or dia <= data_fim):
+        datas.append(dia)
+        dia += timedelta(weeks=intervalo_semanas)
+    return datas
+
+def _motivo_indisponivel(agenda: dict, calendario: CalendarioFeriados, inicio: datetime, duracao: int, blocos: list):
+    """
+    Mesmas regras de `verificar_disponibilidade_com_duracao` sobre dados já carregados.
+    Retorna None se o horário está livre, ou o motivo da indisponibilidade.
+    """
+    if inicio <= datetime.now(TZ_SAO_PAULO):
+        return "Horário no passado."
+    dia = inicio.date()
+    if dia.weekday() in agenda['mal_configurados']:
+        return "Horário de trabalho do profissional não configurado corretamente."
+    intervalos = _intervalos_de_trabalho(agenda, dia)
+    if not intervalos:
+        return f"O profissional não trabalha neste dia da semana ({DIAS_SEMANA_PT.get(dia.weekday(), '')})."
+    inicio_min = _minutos_do_dia(inicio.time())
+    fim_min = inicio_min + duracao
+    if not any(ini <= inicio_min and fim_min <= fim for ini, fim in intervalos):
+        return "Fora do horário de expediente."
+    if calendario.eh_feriado(dia):
+        return "O dia selecionado é um feriado ou folga."
+    for ini, fim in blocos:
+        if ini < fim_min and inicio_min < fim:
+            return f"Conflito com agendamento das {ini // 60:02d}:{ini % 60:02d}."
+    return None
+
+def _verificar_ocorrencias(clinic_id: str, profissional_nome: str, inicios: list, duracao: int, ids_ignorar: set = None) -> dict:
+    """
+    Verifica todas as ocorrências de uma vez: uma única consulta de agendamentos no intervalo
+    coberto pela série, agenda compilada e calendário de feriados em cache.
+    Retorna {inicio: motivo ou None}. `ids_ignorar` exclui os próprios agendamentos (edição da série).
+    """
+    agenda = obter_agendas_profissionais(clinic_id)['por_nome'].get(profissional_nome)
+    if not agenda:
+        return {inicio: "Profissional não encontrado." for inicio in inicios}
+    if not inicios:
+        return {}
+
+    dias = [inicio.date() for inicio in inicios]
+    agendamentos_df = buscar_agendamentos_por_intervalo(clinic_id, min(dias), max(dias))
+    if ids_ignorar and not agendamentos_df.empty:
+        agendamentos_df = agendamentos_df[~agendamentos_df['id'].isin(ids_ignorar)]
+    blocos_por_prof_dia = _blocos_por_profissional_e_dia(agendamentos_df)
+
+    calendario = CalendarioFeriados(clinic_id)
+    return {
+        inicio: _motivo_indisponivel(agenda, calendario, inicio, duracao, blocos_por_prof_dia.get((profissional_nome, inicio.date()), []))
+        for inicio in inicios
+    }
+
+def criar_serie_agendamentos(clinic_id: str, dados: dict, data_inicio: date, hora: time, intervalo_semanas: int = 1, data_fim: date = None, ocorrencias: int = None, creditos_pacote: int = None):
+    """
+    Cria uma série recorrente de agendamentos individuais com o mesmo `serie_id`.
+    `dados` segue `salvar_agendamento` (sem `horario`). Os conflitos de todas as datas são checados numa
+    passada e as ocorrências livres são gravadas em lote. Com `pacote_cliente_id`, só as primeiras
+    `creditos_pacote` ocorrências usam o pacote, e os créditos são debitados numa única escrita.
+    Retorna {'serie_id', 'criados': [{'data', 'id', 'pin_code'}], 'falhas': [{'data', 'motivo'}], 'creditos_debitados'}.
+    """
+    serie_id = str(uuid.uuid4())
+    inicios = [datetime.combine(dia, hora, tzinfo=TZ_SAO_PAULO) for dia in gerar_datas_recorrencia(data_inicio, intervalo_semanas, data_fim, ocorrencias)]
+    motivos = _verificar_ocorrencias(clinic_id, dados['profissional_nome'], inicios, dados['duracao_min'])
+
+    resultado = {'serie_id': serie_id, 'criados': [], 'falhas': [], 'creditos_debitados': 0}
+    pacote_cliente_id = dados.get('pacote_cliente_id')
+    creditos_disponiveis = creditos_pacote if creditos_pacote is not None else len(inicios)
+
+    novos = []
+    usos_pacote = 0
+    for inicio in inicios:
+        if motivos[inicio]:
+            resultado['falhas'].append({'data': inicio.date(), 'motivo': motivos[inicio]})
+            continue
+        usa_pacote = bool(pacote_cliente_id) and usos_pacote < creditos_disponiveis
+        usos_pacote += usa_pacote
+        novos.append({
+            **dados,
+            'horario': inicio,
+            'pin_code': gerar_token_unico(),
+            'serie_id': serie_id,
+            'pacote_cliente_id': pacote_cliente_id if usa_pacote else None,
+        })
+
+    # As travas de horário são conferidas de novo na gravação: uma ocorrência reservada por outra sessão depois da checagem é recusada
+    ids_criados, conflitos, erro = salvar_agendamentos_em_lote(clinic_id, novos) if novos else ({}, {}, None)
+    for indice, novo in enumerate(novos):
+        if indice in ids_criados:
+            resultado['criados'].append({'data': novo['horario'].date(), 'id': ids_criados[indice], 'pin_code': novo['pin_code']})
+        else:
+            resultado['falhas'].append({'data': novo['horario'].date(), 'motivo': conflitos.get(indice) or f"Erro ao gravar: {erro}"})
+
+    ids_com_pacote = [ids_criados[indice] for indice, novo in enumerate(novos) if indice in ids_criados and novo.get('pacote_cliente_id')]
+    if ids_com_pacote:
+        resultado['creditos_debitados'] = debitar_creditos_pacote(clinic_id, dados.get('cliente_id'), pacote_cliente_id, ids_com_pacote)
+
+    resultado['falhas'].sort(key=lambda f: f['data'])
+    print(f"LOG: Série {serie_id}: {len(resultado['criados'])} criados, {len(resultado['falhas'])} falhas.", file=sys.stderr)
+    return resultado
+
+def _ocorrencias_confirmadas_da_serie(clinic_id: str, serie_id: str, a_partir_de: date = None) -> pd.DataFrame:
+    serie_df = buscar_agendamentos_da_serie(clinic_id, serie_id)
+    if serie_df.empty:
+        return serie_df
+    filtro = serie_df['status'] == 'Confirmado'
+    if a_partir_de:
+        filtro &= serie_df['horario'].dt.date >= a_partir_de
+    return serie_df[filtro]
+
+def cancelar_serie_agendamentos(clinic_id: str, serie_id: str, a_partir_de: date = None, novo_status: str = STATUS_ACOES_ADMIN["cancelar"]) -> int:
+    """
+    Cancela (em lote) as ocorrências confirmadas da série a partir de `a_partir_de` e estorna os créditos
+    de pacote debitados para elas. Retorna quantas foram canceladas.
+    """
+    ocorrencias_df = _ocorrencias_confirmadas_da_serie(clinic_id, serie_id, a_partir_de)
+    if ocorrencias_df.empty:
+        return 0
+    # As travas (individuais) e as vagas das aulas (turma) são liberadas na mesma transação do status
+    ids_cancelados, _ = atualizar_agendamentos_em_lote(clinic_id, [(ag_id, {'status': novo_status}) for ag_id in ocorrencias_df['id']])
+    if ids_cancelados and novo_status.startswith('Cancelado') and 'pacote_cliente_id' in ocorrencias_df.columns:
+        estornar_creditos_agendamentos(clinic_id, ocorrencias_df[ocorrencias_df['id'].isin(ids_cancelados)].to_dict('records'))
+    return len(ids_cancelados)
+
+def alterar_serie_agendamentos(clinic_id: str, serie_id: str, nova_hora: time = None, novo_profissional: str = None, a_partir_de: date = None) -> dict:
+    """
+    Altera horário e/ou profissional das ocorrências confirmadas da série a partir de `a_partir_de`.
+    Conflitos são checados numa passada (ignorando a própria série) e as ocorrências livres são
+    atualizadas em lote, movendo as travas de horário. Retorna {'alterados': int, 'falhas': [{'data', 'motivo'}]}.
+    """
+    ocorrencias_df = _ocorrencias_confirmadas_da_serie(clinic_id, serie_id, a_partir_de)
+    if ocorrencias_df.empty:
+        return {'alterados': 0, 'falhas': []}
+    if 'turma_id' in ocorrencias_df.columns and ocorrencias_df['turma_id'].notna().any():
+        # O horário de uma aula é o da turma; mover a matrícula exige cancelar e matricular novamente
+        return {'alterados': 0, 'falhas': [{'data': None, 'motivo': "Matrículas em turma não podem ser remarcadas como série."}]}
+
+    profissional = novo_profissional or ocorrencias_df.iloc[0]['profissional_nome']
+    duracao = int(ocorrencias_df.iloc[0].get('duracao_min', 30) or 30)
+    novos_inicios = {
+        ag_id: datetime.combine(horario.date(), nova_hora or horario.time(), tzinfo=TZ_SAO_PAULO)
+        for ag_id, horario in zip(ocorrencias_df['id'], ocorrencias_df['horario'])
+    }
+    motivos = _verificar_ocorrencias(clinic_id, profissional, list(novos_inicios.values()), duracao, ids_ignorar=set(ocorrencias_df['id']))
+
+    atualizacoes = []
+    falhas = []
+    for ag_id, inicio in novos_inicios.items():
+        if motivos[inicio]:
+            falhas.append({'data': inicio.date(), 'motivo': motivos[inicio]})
+            continue
+        campos = {'horario': inicio}
+        if novo_profissional:
+            campos['profissional_nome'] = novo_profissional
+        atualizacoes.append((ag_id, campos))
+
+    # As travas do novo horário são conferidas de novo na gravação (outra sessão pode ter reservado depois da checagem)
+    ids_alterados, conflitos = atualizar_agendamentos_em_lote(clinic_id, atualizacoes) if atualizacoes else ([], {})
+    for ag_id, _ in atualizacoes:
+        if ag_id not in ids_alterados:
+            falhas.append({'data': novos_inicios[ag_id].date(), 'motivo': conflitos.get(ag_id, "Erro ao gravar a alteração.")})
+    falhas.sort(key=lambda f: f['data'])
+    return {'alterados': len(ids_alterados), 'falhas': falhas}
 
 def gerar_turmas_disponiveis(clinic_id: str, data_selecionada: date, turmas_clinica: list):
     """
     Verifica as turmas do dia e retorna uma lista com as vagas disponíveis.
     """
-    from database import listar_feriados
-    
-    feriados = listar_feriados(clinic_id)
-    if any(f['data'] == data_selecionada for f in feriados):
+    if CalendarioFeriados(clinic_id).eh_feriado(data_selecionada):
     
         return []
 
@@ -317,7 +802,12 @@ def gerar_turmas_disponiveis(clinic_id: str, data_selecionada: date, turmas_clin
         return []
 
     turmas_do_dia = [t for t in turmas_clinica if dia_semana_key in t.get('dias_semana', [])]
-    
+    if not turmas_do_dia:
+        return []
+
+    # Vagas ocupadas de todas as aulas do dia numa única consulta aos contadores
+    ocupacao_dia = buscar_ocupacao_turmas_dia(clinic_id, data_selecionada)
+
     turmas_disponiveis = []
     for turma in turmas_do_dia:
         horario_str = turma['horario'] # string HH:MM
@@ -331,13 +821,8 @@ def gerar_turmas_disponiveis(clinic_id: str, data_selecionada: date, turmas_clin
             if horario_obj <= (datetime.now(TZ_SAO_PAULO) + timedelta(minutes=5)).time(): # Adiciona 5 min de buffer
                 continue
 
-        # CHAMA A FUNÇÃO AGORA COM O HORÁRIO EXATO DA TURMA
-        vagas_ocupadas = contar_agendamentos_turma_dia(
-            clinic_id, 
-            turma['id'], 
-            data_selecionada, 
-            horario_obj # <-- NOVO ARGUMENTO
-        )
+        horario_aula = datetime.combine(data_selecionada, horario_obj, tzinfo=TZ_SAO_PAULO)
+        vagas_ocupadas = ocupacao_dia.get((turma['id'], horario_aula), 0)
         capacidade = turma.get('capacidade_maxima', 0)
         vagas_disponiveis = capacidade - vagas_ocupadas
         
@@ -351,90 +836,176 @@ def gerar_turmas_disponiveis(clinic_id: str, data_selecionada: date, turmas_clin
             
     return sorted(turmas_disponiveis, key=lambda t: t['horario_obj'])
 
+MAXIMO_DIAS_MATRICULA_TURMA = 186
+
+def matricular_cliente_em_turma(clinic_id: str, turma: dict, cliente_id: str, cliente_nome: str, telefone: str, data_inicio: date, data_fim: date, duracao_min: int = 60, pacote_cliente_id: str = None, creditos_pacote: int = None):
+    """
+    Matrícula em lote de um cliente em todas as aulas de uma turma no período [data_inicio, data_fim].
+    Feriados, aulas já passadas e aulas em que o cliente já está agendado (uma consulta no período) são
+    ignoradas; as demais são reservadas em transações (lotes de aulas) que conferem a vaga de cada aula no
+    contador (aulas lotadas ficam de fora) e debitam os créditos do pacote, com o extrato, junto das reservas.
+    Todas levam um `serie_id` comum (cancelável como série).
+    `turma` deve vir de `listar_turmas` com `profissional_nome`/`servico_nome` populados.
+    Retorna {'serie_id', 'criados': [{'data', 'id', 'pin_code'}], 'ignorados': [{'data', 'motivo'}], 'creditos_debitados'}.
+    """
+    data_fim = min(data_fim, data_inicio + timedelta(days=MAXIMO_DIAS_MATRICULA_TURMA - 1))
+    resultado = {'serie_id': str(uuid.uuid4()), 'criados': [], 'ignorados': [], 'creditos_debitados': 0}
+    try:
+        horario_turma = datetime.strptime(turma['horario'], '%H:%M').time()
+    except (KeyError, ValueError):
+        print(f"WARN: Horário da turma {turma.get('id')} inválido: {turma.get('horario')}", file=sys.stderr)
+        return resultado
+
+    dias_turma = set(turma.get('dias_semana', []))
+    aulas = []
+    dia = data_inicio
+    while dia <= data_fim:
+        if DIAS_MAP_WEEKDAY_TO_KEY[dia.weekday()] in dias_turma:
+            aulas.append(datetime.combine(dia, horario_turma, tzinfo=TZ_SAO_PAULO))
+        dia += timedelta(days=1)
+    if not aulas:
+        return resultado
+
+    # Aulas em que o cliente já está agendado, numa única consulta para o período
+    aulas_do_cliente = set()
+    agendamentos_df = buscar_agendamentos_turma_intervalo(clinic_id, turma['id'], data_inicio, data_fim) if cliente_id else pd.DataFrame()
+    if not agendamentos_df.empty and 'cliente_id' in agendamentos_df.columns:
+        aulas_do_cliente = set(agendamentos_df.loc[agendamentos_df['cliente_id'] == cliente_id, 'horario'])
+
+    calendario = CalendarioFeriados(clinic_id)
+    agora = datetime.now(TZ_SAO_PAULO)
+    creditos_disponiveis = creditos_pacote if creditos_pacote is not None else len(aulas)
+
+    novos = []
+    usos_pacote = 0
+    for aula in aulas:
+        if aula <= agora:
+            motivo = "Aula já realizada."
+        elif calendario.eh_feriado(aula.date()):
+            motivo = "Feriado ou folga."
+        elif aula in aulas_do_cliente:
+            motivo = "Cliente já agendado nesta aula."
+        else:
+            motivo = None
+        if motivo:
+            resultado['ignorados'].append({'data': aula.date(), 'motivo': motivo})
+            continue
+
+        usa_pacote = bool(pacote_cliente_id) and usos_pacote < creditos_disponiveis
+        usos_pacote += usa_pacote
+        novos.append({
+            'profissional_nome': turma.get('profissional_nome', 'N/A'),
+            'cliente': cliente_nome,
+            'cliente_id': cliente_id,
+            'telefone': telefone,
+            'horario': aula,
+            'servico_nome': turma.get('servico_nome', 'N/A'),
+            'duracao_min': duracao_min,
+            'turma_id': turma['id'],
+            'pacote_cliente_id': pacote_cliente_id if usa_pacote else None,
+            'pin_code': gerar_token_unico(),
+            'serie_id': resultado['serie_id'],
+        })
+
+    ids_criados, lotadas, creditos_debitados, erro = salvar_matricula_turma(clinic_id, turma['id'], novos) if novos else ({}, set(), 0, None)
+    for indice, novo in enumerate(novos):
+        if indice in ids_criados:
+            resultado['criados'].append({'data': novo['horario'].date(), 'id': ids_criados[indice], 'pin_code': novo['pin_code']})
+        elif indice in lotadas:
+            resultado['ignorados'].append({'data': novo['horario'].date(), 'motivo': "Turma lotada."})
+        else:
+            resultado['ignorados'].append({'data': novo['horario'].date(), 'motivo': f"Erro ao gravar: {erro}"})
+    resultado['creditos_debitados'] = creditos_debitados
+
+    resultado['ignorados'].sort(key=lambda f: f['data'])
+    print(f"LOG: Matrícula em lote na turma {turma['id']}: {len(resultado['criados'])} aulas, {len(resultado['ignorados'])} ignoradas.", file=sys.stderr)
+    return resultado
+
 # --- Funções para Visões de Agenda ---
-def gerar_visao_semanal(clinic_id: str, profissional_nome: str, start_of_week: date):
-    
-    end_of_week = start_of_week + timedelta(days=6)
-    
-    df_agendamentos = buscar_agendamentos_por_intervalo(clinic_id, start_of_week, end_of_week)
-    
-    
-    
-    if df_agendamentos.empty:
-    
-        return pd.DataFrame()
+# Grade das visões: cada agendamento ocupa todas as células de GRADE_INTERVALO_MIN cobertas pela sua duração
+GRADE_INTERVALO_MIN = 15
+COLUNAS_GRADE = ['data', 'dia_semana', 'hora', 'profissional_nome', 'cliente', 'id', 'inicio', 'texto']
 
-    
-    df_prof = df_agendamentos[
-        (df_agendamentos['profissional_nome'] == profissional_nome) &
-        (df_agendamentos['turma_id'].isnull()) & 
-        (df_agendamentos['status'] == 'Confirmado')
-    ].copy()
-    
-    if df_prof.empty:
-    
+def expandir_agendamentos_em_celulas(df_agendamentos: pd.DataFrame, intervalo_min: int = GRADE_INTERVALO_MIN) -> pd.DataFrame:
+    """
+    Expande os agendamentos individuais confirmados em células da grade (uma linha por célula ocupada),
+    com operações vetorizadas. `texto` é o cliente na célula inicial e "↳ cliente" nas de continuação.
+    """
+    if df_agendamentos.empty or 'horario' not in df_agendamentos.columns:
+        return pd.DataFrame(columns=COLUNAS_GRADE)
+
+    filtro = df_agendamentos['status'] == 'Confirmado'
+    if 'turma_id' in df_agendamentos.columns:
+        filtro &= df_agendamentos['turma_id'].isnull()
+    df = df_agendamentos[filtro]
+    if df.empty:
+        return pd.DataFrame(columns=COLUNAS_GRADE)
+
+    minuto_inicio = (df['horario'].dt.hour * 60 + df['horario'].dt.minute).to_numpy()
+    duracao = pd.to_numeric(df.get('duracao_min', pd.Series(intervalo_min, index=df.index)), errors='coerce') \
+                .fillna(intervalo_min).clip(lower=1).to_numpy()
+    primeira_celula = minuto_inicio // intervalo_min
+    celulas_por_agendamento = np.maximum(np.ceil((minuto_inicio + duracao) / intervalo_min).astype(int) - primeira_celula, 1)
+
+    # Uma linha por célula: repete cada agendamento e numera as células a partir do início
+    expandido = df.loc[df.index.repeat(celulas_por_agendamento)].reset_index(drop=True)
+    deslocamento = np.arange(len(expandido)) - np.repeat(np.cumsum(celulas_por_agendamento) - celulas_por_agendamento, celulas_por_agendamento)
+    minuto_celula = np.repeat(primeira_celula, celulas_por_agendamento) * intervalo_min + deslocamento * intervalo_min
+    dentro_do_dia = minuto_celula < 24 * 60
+    expandido, deslocamento, minuto_celula = expandido[dentro_do_dia], deslocamento[dentro_do_dia], minuto_celula[dentro_do_dia]
+
+    celulas = pd.DataFrame({
+        'data': expandido['horario'].dt.date.to_numpy(),
+        'dia_semana': expandido['horario'].dt.weekday.map(DIAS_SEMANA_PT).to_numpy(),
+        'hora': pd.Series(minuto_celula // 60).astype(str).str.zfill(2).to_numpy() + ':' + pd.Series(minuto_celula % 60).astype(str).str.zfill(2).to_numpy(),
+        'profissional_nome': expandido['profissional_nome'].to_numpy(),
+        'cliente': expandido['cliente'].fillna('').to_numpy(),
+        'id': expandido['id'].to_numpy(),
+        'inicio': deslocamento == 0,
+    })
+    celulas['texto'] = np.where(celulas['inicio'], celulas['cliente'], '↳ ' + celulas['cliente'])
+    return celulas
+
+def carregar_grade_semana(clinic_id: str, start_of_week: date, intervalo_min: int = GRADE_INTERVALO_MIN) -> pd.DataFrame:
+    """
+    Células ocupadas da semana (segunda a domingo) numa única consulta; base das visões semanal e comparativa.
+    A lista diária não deriva dela: precisa dos agendamentos completos (status, PIN, pacote) de um só dia, e a
+    consulta do dia é menor que a da semana.
+    """
+    df_agendamentos = buscar_agendamentos_por_intervalo(clinic_id, start_of_week, start_of_week + timedelta(days=6))
+    return expandir_agendamentos_em_celulas(df_agendamentos, intervalo_min)
+
+def _pivotar_grade(celulas: pd.DataFrame, coluna: str) -> pd.DataFrame:
+    # Agendamentos sobrepostos na mesma célula aparecem juntos, em vez de só o primeiro
+    return celulas.groupby(['hora', coluna], sort=False)['texto'].agg(' | '.join).unstack(fill_value='').sort_index()
+
+def gerar_visao_semanal(clinic_id: str, profissional_nome: str, start_of_week: date, grade_semana: pd.DataFrame = None):
+    """Grade hora x dia da semana do profissional. `grade_semana` (de `carregar_grade_semana`) evita uma nova consulta."""
+    if grade_semana is None:
+        grade_semana = carregar_grade_semana(clinic_id, start_of_week)
+
+    celulas = grade_semana[grade_semana['profissional_nome'] == profissional_nome]
+    if celulas.empty:
         return pd.DataFrame()
 
-        
-    
-    df_prof['hora'] = df_prof['horario'].dt.strftime('%H:%M')
-    
-    df_prof['dia_semana'] = df_prof['horario'].dt.weekday.map(DIAS_SEMANA_PT)
-    
-    
-    
-    pivot_table = df_prof.pivot_table(
-    
-        index='hora', 
-        columns='dia_semana', 
-        values='cliente', 
-    
-        aggfunc='first'
-    
-    ).fillna('')
-    
-    
-    
+    pivot_table = _pivotar_grade(celulas, 'dia_semana')
     dias_ordem = [DIAS_SEMANA_PT[i] for i in range(7)]
     cols_presentes = [col for col in dias_ordem if col in pivot_table.columns]
-    
     return pivot_table[cols_presentes]
 
-def gerar_visao_comparativa(clinic_id: str, data: date, nomes_profissionais: list):
-    df_agendamentos = buscar_agendamentos_por_intervalo(clinic_id, data, data)
+def gerar_visao_comparativa(clinic_id: str, data: date, nomes_profissionais: list, grade_semana: pd.DataFrame = None):
+    """Grade hora x profissional do dia. `grade_semana` deve ser a da semana que contém `data`."""
+    if grade_semana is None:
+        grade_semana = carregar_grade_semana(clinic_id, data - timedelta(days=data.weekday()))
 
-    if df_agendamentos.empty:
+    celulas = grade_semana[grade_semana['data'] == data]
+    if celulas.empty:
         return pd.DataFrame(index=[], columns=nomes_profissionais).fillna('')
-    
-    df_dia = df_agendamentos[
-        (df_agendamentos['status'] == 'Confirmado') &
-        (df_agendamentos['turma_id'].isnull())
-    ].copy()
-
-
-    if df_dia.empty:
-    
-        return pd.DataFrame(index=[], columns=nomes_profissionais).fillna('')
-
-    df_dia['hora'] = df_dia['horario'].dt.strftime('%H:%M')
-    
-    pivot = df_dia.pivot_table(
-    
-        index='hora',
-        columns='profissional_nome',
-        values='cliente',
-    
-        aggfunc='first'
-    
-    ).fillna('')
-
 
+    pivot = _pivotar_grade(celulas, 'profissional_nome')
     for prof in nomes_profissionais:
-    
         if prof not in pivot.columns:
-    
             pivot[prof] = ''
-            
     return pivot[nomes_profissionais]
 
 # <-- INÍCIO DAS NOVAS FUNÇÕES DE LÓGICA DE PACOTES -->
@@ -442,62 +1013,34 @@ def gerar_visao_comparativa(clinic_id: str, data: date, nomes_profissionais: lis
 def buscar_pacotes_validos_cliente(clinic_id: str, cliente_id: str, servico_id: str):
     """
     Busca pacotes ativos de um cliente que sejam válidos para um serviço específico.
+    Créditos, validade e serviço são filtrados na consulta; o nome vem do mapa de modelos em cache.
     """
 
     if not cliente_id or not servico_id:
     
         return []
 
-    # 1. Busca todos os modelos de pacotes da clínica (cacheável se necessário, mas por enquanto busca direto)
-    modelos_pacotes = listar_pacotes_modelos(clinic_id)
-    if not modelos_pacotes:
-        return []
-    
-    # 2. Busca todos os pacotes adquiridos pelo cliente
-    pacotes_cliente = listar_pacotes_do_cliente(clinic_id, cliente_id)
-    if not pacotes_cliente:
-    
+    modelos_por_id = mapa_pacotes_modelos_cache(clinic_id)
+    if not modelos_por_id:
         return []
 
-    
-    
-    # 3. Filtra os pacotes válidos
-    hoje = datetime.now(TZ_SAO_PAULO)
     pacotes_validos = []
-
-    for pc in pacotes_cliente:
-        # Filtro 1: Créditos restantes
-        if pc.get('creditos_restantes', 0) <= 0:
-            continue
-        
-        # Filtro 2: Data de expiração
-        if pc.get('data_expiracao') < hoje:
-            continue
-        
-        # Filtro 3: Serviço válido
-        # Encontra o modelo do pacote do cliente
-        modelo_id = pc.get('pacote_modelo_id')
-        modelo_correspondente = next((m for m in modelos_pacotes if m['id'] == modelo_id), None)
-        
+    for pc in listar_pacotes_validos_do_cliente(clinic_id, cliente_id, servico_id, datetime.now(TZ_SAO_PAULO)):
+        modelo_correspondente = modelos_por_id.get(pc.get('pacote_modelo_id'))
         if not modelo_correspondente:
             continue # Pacote do cliente aponta para um modelo que não existe mais
+        pc['nome_pacote'] = modelo_correspondente.get('nome', pc.get('nome_pacote_modelo', 'Pacote'))
+        pacotes_validos.append(pc)
 
-        servicos_validos_pacote = modelo_correspondente.get('servicos_validos', [])
-        if servico_id in servicos_validos_pacote:
-            # Pacote válido! Adiciona informação útil do modelo.
-            pc['nome_pacote'] = modelo_correspondente.get('nome', 'Pacote')
-            pacotes_validos.append(pc)
-
-    # Retorna os pacotes válidos, talvez ordenados pelo que expira primeiro?
-    return sorted(pacotes_validos, key=lambda p: p['data_expiracao'])
+    # Já vêm ordenados pela expiração (o que expira primeiro é sugerido primeiro)
+    return pacotes_validos
 
 def associar_pacote_cliente(clinic_id: str, cliente_id: str, pacote_modelo_id: str):
     """
     Associa um modelo de pacote a um cliente, calculando datas e créditos.
     """
     # 1. Busca o modelo do pacote
-    modelos_pacotes = listar_pacotes_modelos(clinic_id)
-    modelo_pacote = next((m for m in modelos_pacotes if m['id'] == pacote_modelo_id), None)
+    modelo_pacote = mapa_pacotes_modelos_cache(clinic_id).get(pacote_modelo_id)
 
     
     
@@ -518,8 +1061,10 @@ def associar_pacote_cliente(clinic_id: str, cliente_id: str, pacote_modelo_id: s
         'data_expiracao': data_expiracao,
         'creditos_total': modelo_pacote.get('creditos_sessoes', 0),
         'creditos_restantes': modelo_pacote.get('creditos_sessoes', 0),
-        'servicos_validos_ids': modelo_pacote.get('servicos_validos', []) # Salva para referência
+        'servicos_validos_ids': modelo_pacote.get('servicos_validos', []), # Salva para referência
+        'extrato_aberto': True, # Débitos/estornos lançados em `movimentos_creditos` desde a venda
     }
+    dados_pacote_cliente.update(calcular_status_pacote(dados_pacote_cliente, data_inicio))
     
     # 4. Salva no banco
     sucesso = db_associar_pacote_ao_cliente(clinic_id, cliente_id, dados_pacote_cliente)
@@ -0,0 +1,180 @@
+# migracoes.py (MIGRAÇÕES DE DADOS VERSIONADAS)
+# Preenchem campos novos nos documentos já existentes, clínica a clínica, em lotes curtos com cursor.
+# O progresso de cada migração fica em `clinicas/{id}/migracoes/{chave}` (último ID, lidos, alterados, concluída):
+# uma execução interrompida continua de onde parou, e as já concluídas são puladas.
+#
+# Uso (via tarefas_agendadas.py):
+#   python tarefas_agendadas.py migracoes listar
+#   python tarefas_agendadas.py migracoes executar [--clinica ID] [--versao N] [--simular] [--escritas-por-segundo 200]
+#                                                  [--lote 450] [--max-lotes N] [--reiniciar]
+#   python tarefas_agendadas.py migracoes verificar [--clinica ID] [--versao N]
+#
+# Para criar uma migração: acrescente um `Migracao` em MIGRACOES com a próxima versão. `transformar(dados, contexto)`
+# devolve só os campos a gravar no documento (ou {} se ele já está migrado); por isso rodar de novo não altera nada,
+# e a verificação conta os documentos para os quais `transformar` ainda devolve algo.
+
+import sys
+import time
+from datetime import datetime
+from google.cloud import firestore
+
+import database
+
+
+class Migracao:
+    """Uma migração versionada sobre uma coleção das clínicas (`agendamentos` ou `clientes`)."""
+
+    def __init__(self, versao: int, nome: str, colecao: str, descricao: str, campos: list, transformar, preparar=None):
+        self.versao = versao
+        self.nome = nome
+        self.colecao = colecao
+        self.descricao = descricao
+        self.campos = campos  # Campos lidos de cada documento (projeção)
+        self.transformar = transformar
+        self.preparar = preparar or (lambda clinic_id: None)  # Contexto da clínica, calculado uma vez
+
+    @property
+    def chave(self) -> str:
+        return f"v{self.versao:03d}_{self.nome}"
+
+
+# --- Migrações ---
+def _dia_do_agendamento(dados: dict, contexto) -> dict:
+    horario = dados.get('horario')
+    if not isinstance(horario, datetime):
+        return {}
+    dia = database.chave_dia(horario)
+    return {'dia': dia} if dados.get('dia') != dia else {}
+
+def _profissional_id_do_agendamento(dados: dict, ids_profissionais: dict) -> dict:
+    # Nomes sem profissional cadastrado (removido) ficam sem ID e não contam como pendentes
+    profissional_id = ids_profissionais.get(dados.get('profissional_nome'))
+    return {'profissional_id': profissional_id} if profissional_id and dados.get('profissional_id') != profissional_id else {}
+
+def _telefone_normalizado_do_cliente(dados: dict, contexto) -> dict:
+    telefone = database.normalizar_telefone(dados.get('telefone'))
+    return {'telefone_normalizado': telefone} if dados.get('telefone_normalizado') != telefone else {}
+
+def _atualizado_em(dados: dict, contexto) -> dict:
+    # Documentos antigos recebem a data da migração como última atualização conhecida
+    return {} if dados.get('atualizado_em') else {'atualizado_em': firestore.SERVER_TIMESTAMP}
+
+MIGRACOES = [
+    Migracao(1, 'agendamentos_dia', 'agendamentos', "Chave do dia (AAAA-MM-DD, SP) nos agendamentos.",
+             ['horario', 'dia'], _dia_do_agendamento),
+    Migracao(2, 'agendamentos_profissional_id', 'agendamentos', "ID do profissional nos agendamentos (pelo nome).",
+             ['profissional_nome', 'profissional_id'], _profissional_id_do_agendamento, database.mapa_ids_profissionais),
+    Migracao(3, 'clientes_telefone_normalizado', 'clientes', "Telefone só com dígitos nos clientes.",
+             ['telefone', 'telefone_normalizado'], _telefone_normalizado_do_cliente),
+    Migracao(4, 'agendamentos_atualizado_em', 'agendamentos', "Data da última atualização nos agendamentos.",
+             ['atualizado_em'], _atualizado_em),
+    Migracao(5, 'clientes_atualizado_em', 'clientes', "Data da última atualização nos clientes.",
+             ['atualizado_em'], _atualizado_em),
+]
+
+
+def selecionar_migracoes(versao: int = None) -> list:
+    """As migrações em ordem de versão (ou só a `versao` pedida)."""
+    migracoes = sorted(MIGRACOES, key=lambda m: m.versao)
+    return [m for m in migracoes if versao is None or m.versao == versao]
+
+
+# --- Execução ---
+def executar_migracao(migracao: Migracao, clinic_id: str, tamanho_lote: int = database.TAMANHO_LOTE_ESCRITA,
+                      escritas_por_segundo: float = None, simular: bool = False, max_lotes: int = None,
+                      reiniciar: bool = False) -> dict:
+    """
+    Executa (ou, com `simular`, só conta) uma migração numa clínica, lote a lote a partir do progresso gravado.
+    `escritas_por_segundo` limita a taxa de gravação; `max_lotes` encerra a execução antes do fim (a próxima continua).
+    A simulação não grava nada, nem o progresso. Retorna
+    {'clinic_id', 'migracao', 'lidos', 'alterados', 'concluida', 'erro'}.
+    """
+    checkpoint = {} if reiniciar or simular else database.ler_checkpoint_migracao(clinic_id, migracao.chave)
+    relatorio = {'clinic_id': clinic_id, 'migracao': migracao.chave, 'lidos': 0, 'alterados': 0, 'concluida': False, 'erro': None}
+    if checkpoint.get('concluida'):
+        relatorio['concluida'] = True
+        return relatorio
+
+    apos_id = checkpoint.get('ultimo_id')
+    lidos, alterados = checkpoint.get('lidos', 0), checkpoint.get('alterados', 0)
+    contexto = migracao.preparar(clinic_id)
+    lotes = 0
+    while max_lotes is None or lotes < max_lotes:
+        inicio_lote = time.monotonic()
+        documentos = database.ler_lote_migracao(migracao.colecao, clinic_id, apos_id, tamanho_lote, migracao.campos)
+        if documentos is None:
+            relatorio['erro'] = "Falha ao ler um lote; execute novamente para continuar."
+            break
+        atualizacoes = {}
+        for doc_id, dados in documentos:
+            campos = migracao.transformar(dados, contexto)
+            if campos:
+                atualizacoes[doc_id] = campos
+        if atualizacoes and not simular:
+            if database.atualizar_documentos_migracao(migracao.colecao, clinic_id, atualizacoes) is None:
+                relatorio['erro'] = "Falha ao gravar um lote; execute novamente para continuar."
+                break
+
+        lotes += 1
+        lidos += len(documentos)
+        alterados += len(atualizacoes)
+        relatorio['lidos'] += len(documentos)
+        relatorio['alterados'] += len(atualizacoes)
+        concluida = len(documentos) < tamanho_lote
+        if documentos:
+            apos_id = documentos[-1][0]
+        if not simular:
+            database.salvar_checkpoint_migracao(clinic_id, migracao.chave, {
+                'versao': migracao.versao, 'ultimo_id': apos_id, 'lidos': lidos, 'alterados': alterados, 'concluida': concluida
+            })
+        if concluida:
+            relatorio['concluida'] = True
+            break
+        # Limite de taxa: o lote seguinte só começa quando as escritas deste couberem no limite
+        if escritas_por_segundo and atualizacoes:
+            time.sleep(max(0.0, len(atualizacoes) / escritas_por_segundo - (time.monotonic() - inicio_lote)))
+
+    print(f"LOG: Migração {migracao.chave} em {clinic_id}{' (simulação)' if simular else ''}: {relatorio['lidos']} lidos, "
+          f"{relatorio['alterados']} {'a alterar' if simular else 'alterados'}{', concluída' if relatorio['concluida'] else ''}.", file=sys.stderr)
+    return relatorio
+
+def executar_migracoes(clinicas: list, versao: int = None, **opcoes) -> list:
+    """
+    Executa as migrações pendentes em ordem de versão em cada clínica. Numa clínica, uma migração que não termina
+    (erro ou `max_lotes`) interrompe as seguintes, que podem depender dela. Retorna a lista de relatórios.
+    """
+    relatorios = []
+    for clinic_id in clinicas:
+        for migracao in selecionar_migracoes(versao):
+            relatorio = executar_migracao(migracao, clinic_id, **opcoes)
+            relatorios.append(relatorio)
+            if not relatorio['concluida'] and not opcoes.get('simular'):
+                break
+    return relatorios
+
+
+# --- Verificação ---
+def verificar_migracao(migracao: Migracao, clinic_id: str, tamanho_lote: int = database.TAMANHO_LOTE_ESCRITA,
+                       limite_exemplos: int = 10) -> dict:
+    """
+    Relê a coleção da clínica e conta os documentos ainda pendentes (para os quais `transformar` devolve campos).
+    Retorna {'clinic_id', 'migracao', 'lidos', 'pendentes', 'exemplos', 'progresso', 'erro'}.
+    """
+    relatorio = {'clinic_id': clinic_id, 'migracao': migracao.chave, 'lidos': 0, 'pendentes': 0, 'exemplos': [],
+                 'progresso': database.ler_checkpoint_migracao(clinic_id, migracao.chave), 'erro': None}
+    contexto = migracao.preparar(clinic_id)
+    apos_id = None
+    while True:
+        documentos = database.ler_lote_migracao(migracao.colecao, clinic_id, apos_id, tamanho_lote, migracao.campos)
+        if documentos is None:
+            relatorio['erro'] = "Falha ao ler um lote."
+            return relatorio
+        relatorio['lidos'] += len(documentos)
+        for doc_id, dados in documentos:
+            if migracao.transformar(dados, contexto):
+                relatorio['pendentes'] += 1
+                if len(relatorio['exemplos']) < limite_exemplos:
+                    relatorio['exemplos'].append(doc_id)
+        if len(documentos) < tamanho_lote:
+            return relatorio
+        apos_id = documentos[-1][0]
@@ -0,0 +1,314 @@
+# tarefas_agendadas.py (TAREFAS EM LOTE / MANUTENÇÃO)
+# Rotinas executadas fora do app (cron, Cloud Scheduler ou manualmente) sobre todas as clínicas.
+#
+# Uso:
+#   python tarefas_agendadas.py reconciliar-creditos [--clinica ID] [--aplicar]
+#   python tarefas_agendadas.py atualizar-pacotes [--dias-aviso 7]   (diária; também grava `clinic_id`/`cliente_id`
+#                                                                     nos pacotes antigos, usados pela busca em lote)
+#   python tarefas_agendadas.py migrar-agendamentos [--clinica ID] [--lote 450] [--pausa 0.5] [--reiniciar] [--corte]
+#   python tarefas_agendadas.py reconstruir-ocupacao [--clinica ID] [--desde AAAA-MM-DD]
+#                                                                     (contadores de vagas das turmas; rodar na implantação)
+#   python tarefas_agendadas.py reconstruir-travas [--clinica ID] [--desde AAAA-MM-DD]
+#                                                                     (travas de horário dos agendamentos futuros; idem)
+#   python tarefas_agendadas.py reconstruir-atividade [--clinica ID] [--desde AAAA-MM-DD]
+#                                                                     (clientes ativos da análise do super admin; idem)
+#   python tarefas_agendadas.py migracoes {listar,executar,verificar} [--clinica ID] [--versao N] [--simular] ...
+#                                                                     (migrações de dados versionadas, ver migracoes.py)
+#
+# Sem `--aplicar`, a reconciliação apenas relata o que seria alterado.
+# A migração copia os agendamentos para `clinicas/{id}/agendamentos` sem tirar o app da coleção global; só o `--corte`
+# (com a verificação sem diferenças) muda a clínica de layout. Pode ser interrompida e executada de novo.
+
+import argparse
+import sys
+import time
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import cache_agenda
+import database
+import migracoes
+
+
+# --- Reconciliação dos créditos de pacotes ---
+def reconciliar_creditos_pacotes(clinic_id: str = None, aplicar: bool = False) -> dict:
+    """
+    Recalcula os saldos de todos os pacotes a partir dos extratos (`movimentos_creditos`).
+    A varredura usa duas consultas de collection group (pacotes e lançamentos); só os pacotes
+    divergentes ou ainda sem extrato são relidos e corrigidos, um a um, em transação.
+    Retorna {'verificados': n, 'ok': n, 'divergentes': [resultado de `reconciliar_pacote`], 'sem_extrato': n}.
+    """
+    pacotes = database.listar_pacotes_clientes_todos()
+    movimentos = database.somar_movimentos_creditos_por_pacote()
+    if movimentos is None:
+        return {'verificados': 0, 'ok': 0, 'divergentes': [], 'sem_extrato': 0}
+    if clinic_id:
+        pacotes = [(caminho, pacote) for caminho, pacote in pacotes if caminho.startswith(f"clinicas/{clinic_id}/")]
+
+    relatorio = {'verificados': len(pacotes), 'ok': 0, 'divergentes': [], 'sem_extrato': 0}
+    for caminho, pacote in pacotes:
+        if not pacote.get('extrato_aberto'):
+            relatorio['sem_extrato'] += 1
+            if aplicar:
+                database.reconciliar_pacote(caminho, aplicar=True)
+            continue
+        esperado = database.saldo_esperado_pacote(pacote, movimentos.get(caminho, {}))
+        if esperado == pacote.get('creditos_restantes', 0):
+            relatorio['ok'] += 1
+            continue
+        # A varredura não é atômica: a transação confirma a divergência antes de corrigir
+        resultado = database.reconciliar_pacote(caminho, aplicar=aplicar)
+        if resultado['acao'] == 'ok':
+            relatorio['ok'] += 1
+        else:
+            relatorio['divergentes'].append(resultado)
+
+    print(f"LOG: Reconciliação de créditos: {relatorio['verificados']} pacotes, {len(relatorio['divergentes'])} divergentes, "
+          f"{relatorio['sem_extrato']} sem extrato.", file=sys.stderr)
+    return relatorio
+
+
+# --- Status e resumo dos pacotes ---
+MAXIMO_PACOTES_EXPIRANDO_NO_RESUMO = 50
+CAMPOS_PACOTE_STATUS = ['nome_pacote_modelo', 'data_expiracao', 'creditos_restantes', 'creditos_total', 'status', 'expirando',
+                        'clinic_id', 'cliente_id']
+
+def atualizar_status_pacotes(dias_aviso: int = database.DIAS_AVISO_EXPIRACAO_PACOTE) -> dict:
+    """
+    Varre todos os pacotes numa consulta de collection group (só os campos de status), grava `status`/`expirando`
+    (e `clinic_id`/`cliente_id` nos pacotes antigos) apenas onde mudaram (em lote) e escreve um resumo por clínica
+    em `clinicas/{id}/resumos/pacotes`.
+    Retorna {'verificados': n, 'atualizados': n, 'clinicas': n}.
+    """
+    agora = datetime.now(ZoneInfo('America/Sao_Paulo'))
+    atualizacoes = {}
+    resumos = {}
+    for caminho, pacote in database.listar_pacotes_clientes_todos(CAMPOS_PACOTE_STATUS):
+        # clinicas/{clinic_id}/clientes/{cliente_id}/pacotes_clientes/{pacote_id}
+        partes = caminho.split('/')
+        if len(partes) != 6 or partes[0] != 'clinicas':
+            continue
+        clinic_id, cliente_id, pacote_id = partes[1], partes[3], partes[5]
+
+        campos = database.calcular_status_pacote(pacote, agora, dias_aviso)
+        # Pacotes vendidos antes de os IDs serem gravados no documento
+        campos.update({'clinic_id': clinic_id, 'cliente_id': cliente_id})
+        if any(pacote.get(campo) != valor for campo, valor in campos.items()):
+            atualizacoes[caminho] = campos
+
+        resumo = resumos.setdefault(clinic_id, {
+            'total': 0, 'ativos': 0, 'expirados': 0, 'esgotados': 0, 'expirando': 0,
+            'creditos_ativos': 0, 'dias_aviso': dias_aviso, 'pacotes_expirando': []
+        })
+        resumo['total'] += 1
+        resumo[{'Ativo': 'ativos', 'Expirado': 'expirados', 'Esgotado': 'esgotados'}[campos['status']]] += 1
+        if campos['status'] == 'Ativo':
+            resumo['creditos_ativos'] += pacote.get('creditos_restantes', 0)
+        if campos['expirando']:
+            resumo['expirando'] += 1
+            resumo['pacotes_expirando'].append({
+                'cliente_id': cliente_id,
+                'pacote_id': pacote_id,
+                'nome_pacote': pacote.get('nome_pacote_modelo', 'Pacote'),
+                'data_expiracao': pacote.get('data_expiracao'),
+                'creditos_restantes': pacote.get('creditos_restantes', 0)
+            })
+
+    for resumo in resumos.values():
+        resumo['pacotes_expirando'] = sorted(resumo['pacotes_expirando'], key=lambda p: p['data_expiracao'])[:MAXIMO_PACOTES_EXPIRANDO_NO_RESUMO]
+
+    atualizados = database.atualizar_pacotes_em_lote(atualizacoes) if atualizacoes else 0
+    database.salvar_resumos_pacotes(resumos)
+    verificados = sum(r['total'] for r in resumos.values())
+    print(f"LOG: Status de pacotes: {verificados} verificados, {atualizados} atualizados, {len(resumos)} clínicas.", file=sys.stderr)
+    return {'verificados': verificados, 'atualizados': atualizados, 'clinicas': len(resumos)}
+
+
+# --- Migração dos agendamentos para a coleção da clínica ---
+def _copiar_agendamentos(clinic_id: str, apos_id: str, tamanho_lote: int, pausa_segundos: float,
+                         sobrescrever: bool, progresso: dict, alterados_desde: datetime = None) -> bool:
+    """Copia lote a lote a partir de `apos_id`, gravando o progresso após cada lote. Retorna False se um lote falhar."""
+    while True:
+        lote = database.copiar_lote_agendamentos_para_clinica(clinic_id, apos_id, tamanho_lote, sobrescrever, alterados_desde)
+        if lote is None:
+            return False
+        apos_id = lote['ultimo_id']
+        progresso['lidos'] += lote['lidos']
+        progresso['copiados'] += lote['copiados']
+        progresso['divergentes_mantidos'].extend(lote['divergentes_mantidos'])
+        database.salvar_checkpoint_migracao(clinic_id, database.MIGRACAO_AGENDAMENTOS_POR_CLINICA, {
+            'ultimo_id': apos_id, 'lidos': progresso['lidos'], 'copiados': progresso['copiados'], 'copia_concluida': apos_id is None
+        })
+        if apos_id is None:
+            return True
+        if pausa_segundos:
+            time.sleep(pausa_segundos)
+
+def migrar_agendamentos_clinica(clinic_id: str, tamanho_lote: int = database.TAMANHO_LOTE_ESCRITA, pausa_segundos: float = 0.0,
+                                reiniciar: bool = False, corte: bool = False) -> dict:
+    """
+    Copia os agendamentos da clínica da coleção global para `clinicas/{id}/agendamentos` e verifica as duas coleções.
+    Uma cópia interrompida continua do último ID gravado no progresso (`reiniciar` recomeça do início); uma cópia já
+    concluída é refeita por inteiro, regravando só o que mudou desde a anterior.
+    Com `corte` e a verificação sem diferenças, a clínica passa ao layout novo; depois de esperar o TTL do layout
+    em cache, uma última passada copia os agendamentos que outras instâncias ainda gravaram na coleção global:
+    os ausentes e os alterados lá depois do corte (`atualizado_em`) e não na coleção da clínica, que já é a fonte;
+    as demais divergências ficam no relatório.
+    Retorna {'clinic_id', 'lidos', 'copiados', 'divergentes_mantidos', 'verificacao', 'corte', 'erro'}.
+    """
+    ja_migrada = database.clinica_usa_agendamentos_por_clinica(clinic_id)
+    progresso_salvo = database.ler_checkpoint_migracao(clinic_id, database.MIGRACAO_AGENDAMENTOS_POR_CLINICA)
+    checkpoint = {} if reiniciar else progresso_salvo
+    # Clínica já migrada: as novas passadas também trazem o que a coleção global recebeu depois do corte
+    instante_corte = progresso_salvo.get('instante_corte') if ja_migrada else None
+    continuar = bool(checkpoint.get('ultimo_id')) and not checkpoint.get('copia_concluida')
+    progresso = {
+        'clinic_id': clinic_id,
+        'lidos': checkpoint.get('lidos', 0) if continuar else 0,
+        'copiados': checkpoint.get('copiados', 0) if continuar else 0,
+        'divergentes_mantidos': [], 'verificacao': None, 'corte': False, 'erro': None
+    }
+    if continuar:
+        print(f"LOG: Migração de {clinic_id} retomada após {checkpoint['ultimo_id']} ({progresso['lidos']} já lidos).", file=sys.stderr)
+
+    if not _copiar_agendamentos(clinic_id, checkpoint.get('ultimo_id') if continuar else None, tamanho_lote, pausa_segundos,
+                                not ja_migrada, progresso, instante_corte):
+        progresso['erro'] = "Falha ao copiar um lote; execute novamente para continuar."
+        return progresso
+
+    verificacao = database.verificar_agendamentos_da_clinica(clinic_id, tamanho_lote)
+    progresso['verificacao'] = verificacao
+    if verificacao is None:
+        progresso['erro'] = "Falha na verificação."
+        return progresso
+    sem_diferencas = not (verificacao['ausentes'] or verificacao['divergentes'] or verificacao['extras'])
+    database.salvar_checkpoint_migracao(clinic_id, database.MIGRACAO_AGENDAMENTOS_POR_CLINICA, {
+        'verificada': sem_diferencas, 'origem': verificacao['origem'], 'destino': verificacao['destino']
+    })
+
+    if corte and not ja_migrada:
+        if not sem_diferencas:
+            progresso['erro'] = "Corte não realizado: a verificação encontrou diferenças (execute a cópia novamente)."
+            return progresso
+        # Margem para a diferença entre o relógio local e o do servidor (`atualizado_em` é SERVER_TIMESTAMP)
+        instante_corte = datetime.now(database.TZ_SAO_PAULO) - timedelta(minutes=1)
+        if not database.definir_agendamentos_por_clinica(clinic_id, True):
+            progresso['erro'] = "Falha ao gravar o corte."
+            return progresso
+        progresso['corte'] = True
+        database.salvar_checkpoint_migracao(clinic_id, database.MIGRACAO_AGENDAMENTOS_POR_CLINICA, {'corte': True, 'instante_corte': instante_corte})
+        time.sleep(cache_agenda.LAYOUT_AGENDAMENTOS.ttl_segundos)
+        if not _copiar_agendamentos(clinic_id, None, tamanho_lote, pausa_segundos, False, progresso, instante_corte):
+            progresso['erro'] = "Corte feito, mas a passada final falhou; execute a migração novamente."
+
+    print(f"LOG: Migração dos agendamentos de {clinic_id}: {progresso['lidos']} lidos, {progresso['copiados']} copiados, "
+          f"verificação {'sem diferenças' if sem_diferencas else 'com diferenças'}{', corte feito' if progresso['corte'] else ''}.", file=sys.stderr)
+    return progresso
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tarefas em lote do AgendaFit.")
+    subparsers = parser.add_subparsers(dest="tarefa", required=True)
+
+    parser_creditos = subparsers.add_parser("reconciliar-creditos", help="Recalcula os saldos dos pacotes a partir dos extratos.")
+    parser_creditos.add_argument("--clinica", help="Restringe a uma clínica (ID).")
+    parser_creditos.add_argument("--aplicar", action="store_true", help="Grava as correções (padrão: só relata).")
+
+    parser_status = subparsers.add_parser("atualizar-pacotes", help="Atualiza status/expiração dos pacotes e os resumos por clínica.")
+    parser_status.add_argument("--dias-aviso", type=int, default=database.DIAS_AVISO_EXPIRACAO_PACOTE,
+                               help="Pacotes ativos que vencem nesse prazo são marcados como 'expirando'.")
+
+    parser_migracao = subparsers.add_parser("migrar-agendamentos", help="Copia os agendamentos para a coleção de cada clínica e verifica.")
+    parser_migracao.add_argument("--clinica", help="Restringe a uma clínica (ID); padrão: todas.")
+    parser_migracao.add_argument("--lote", type=int, default=database.TAMANHO_LOTE_ESCRITA, help="Documentos por lote (máx. 500).")
+    parser_migracao.add_argument("--pausa", type=float, default=0.0, help="Segundos de espera entre lotes (limita a taxa de escrita).")
+    parser_migracao.add_argument("--reiniciar", action="store_true", help="Ignora o progresso gravado e recomeça a cópia.")
+    parser_migracao.add_argument("--corte", action="store_true", help="Após verificar sem diferenças, passa a clínica ao layout novo.")
+
+    parser_ocupacao = subparsers.add_parser("reconstruir-ocupacao", help="Recalcula os contadores de vagas das aulas das turmas.")
+    parser_ocupacao.add_argument("--clinica", help="Restringe a uma clínica (ID); padrão: todas.")
+    parser_ocupacao.add_argument("--desde", type=date.fromisoformat, default=None, help="Primeiro dia recalculado (padrão: hoje).")
+
+    parser_travas = subparsers.add_parser("reconstruir-travas", help="Grava as travas de horário dos agendamentos individuais futuros.")
+    parser_travas.add_argument("--clinica", help="Restringe a uma clínica (ID); padrão: todas.")
+    parser_travas.add_argument("--desde", type=date.fromisoformat, default=None, help="Primeiro dia considerado (padrão: hoje).")
+
+    parser_atividade = subparsers.add_parser("reconstruir-atividade", help="Grava o último horário agendado dos clientes (clientes ativos).")
+    parser_atividade.add_argument("--clinica", help="Restringe a uma clínica (ID); padrão: todas.")
+    parser_atividade.add_argument("--desde", type=date.fromisoformat, default=None,
+                                  help=f"Primeiro dia considerado (padrão: {database.DIAS_CLIENTE_ATIVO} dias atrás).")
+
+    parser_migracoes = subparsers.add_parser("migracoes", help="Migrações de dados versionadas (preenchimento de campos novos).")
+    parser_migracoes.add_argument("acao", choices=["listar", "executar", "verificar"])
+    parser_migracoes.add_argument("--clinica", help="Restringe a uma clínica (ID); padrão: todas.")
+    parser_migracoes.add_argument("--versao", type=int, help="Só esta migração (padrão: todas as pendentes, em ordem).")
+    parser_migracoes.add_argument("--simular", action="store_true", help="Conta o que seria alterado, sem gravar.")
+    parser_migracoes.add_argument("--lote", type=int, default=database.TAMANHO_LOTE_ESCRITA, help="Documentos por lote (máx. 500).")
+    parser_migracoes.add_argument("--escritas-por-segundo", type=float, default=None, help="Limite da taxa de gravação.")
+    parser_migracoes.add_argument("--max-lotes", type=int, default=None, help="Encerra após N lotes por migração (continua na próxima execução).")
+    parser_migracoes.add_argument("--reiniciar", action="store_true", help="Ignora o progresso gravado e recomeça.")
+
+    args = parser.parse_args()
+
+    if args.tarefa == "reconciliar-creditos":
+        relatorio = reconciliar_creditos_pacotes(args.clinica, args.aplicar)
+        print(f"Pacotes verificados: {relatorio['verificados']} | OK: {relatorio['ok']} | "
+              f"Sem extrato{' (abertos agora)' if args.aplicar else ''}: {relatorio['sem_extrato']}")
+        for item in relatorio['divergentes']:
+            print(f"  {item['caminho']}: saldo {item['saldo']} -> esperado {item['esperado']} ({item['acao']})")
+    elif args.tarefa == "atualizar-pacotes":
+        relatorio = atualizar_status_pacotes(args.dias_aviso)
+        print(f"Pacotes verificados: {relatorio['verificados']} | Atualizados: {relatorio['atualizados']} | Clínicas: {relatorio['clinicas']}")
+    elif args.tarefa == "migrar-agendamentos":
+        clinicas = [args.clinica] if args.clinica else [c['id'] for c in database.listar_clinicas()]
+        for clinic_id in clinicas:
+            relatorio = migrar_agendamentos_clinica(clinic_id, min(args.lote, 500), args.pausa, args.reiniciar, args.corte)
+            verificacao = relatorio['verificacao'] or {}
+            print(f"{clinic_id}: lidos {relatorio['lidos']} | copiados {relatorio['copiados']} | "
+                  f"origem {verificacao.get('origem', '-')} / destino {verificacao.get('destino', '-')} | "
+                  f"ausentes {len(verificacao.get('ausentes', []))} | divergentes {len(verificacao.get('divergentes', []))} | "
+                  f"extras {len(verificacao.get('extras', []))}{' | CORTE FEITO' if relatorio['corte'] else ''}")
+            for ag_id in relatorio['divergentes_mantidos']:
+                print(f"  divergente após o corte (mantida a versão da clínica): {ag_id}")
+            if relatorio['erro']:
+                print(f"  {relatorio['erro']}")
+    elif args.tarefa == "reconstruir-ocupacao":
+        clinicas = [args.clinica] if args.clinica else [c['id'] for c in database.listar_clinicas()]
+        for clinic_id in clinicas:
+            print(f"{clinic_id}: {database.reconstruir_ocupacao_turmas(clinic_id, args.desde)} aulas com contador gravado")
+    elif args.tarefa == "reconstruir-travas":
+        clinicas = [args.clinica] if args.clinica else [c['id'] for c in database.listar_clinicas()]
+        for clinic_id in clinicas:
+            relatorio = database.reconstruir_travas_horarios(clinic_id, args.desde)
+            print(f"{clinic_id}: {relatorio['travas']} travas gravadas | {len(relatorio['sobrepostos'])} agendamentos sobrepostos")
+            for ag_id in relatorio['sobrepostos']:
+                print(f"  sobreposto a outro agendamento (sem trava): {ag_id}")
+    elif args.tarefa == "reconstruir-atividade":
+        clinicas = [args.clinica] if args.clinica else [c['id'] for c in database.listar_clinicas()]
+        for clinic_id in clinicas:
+            print(f"{clinic_id}: {database.reconstruir_atividade_clientes(clinic_id, args.desde)} clientes com atividade gravada")
+    elif args.tarefa == "migracoes":
+        if args.acao == "listar":
+            for migracao in migracoes.selecionar_migracoes():
+                print(f"{migracao.chave} [{migracao.colecao}]: {migracao.descricao}")
+            return
+        clinicas = [args.clinica] if args.clinica else [c['id'] for c in database.listar_clinicas()]
+        if args.acao == "executar":
+            relatorios = migracoes.executar_migracoes(clinicas, args.versao, tamanho_lote=min(args.lote, 500),
+                                                      escritas_por_segundo=args.escritas_por_segundo, simular=args.simular,
+                                                      max_lotes=args.max_lotes, reiniciar=args.reiniciar)
+            for relatorio in relatorios:
+                situacao = relatorio['erro'] or ("concluída" if relatorio['concluida'] else "parcial (execute novamente)")
+                print(f"{relatorio['clinic_id']} {relatorio['migracao']}: lidos {relatorio['lidos']} | "
+                      f"{'a alterar' if args.simular else 'alterados'} {relatorio['alterados']} | {situacao}")
+        else:
+            for clinic_id in clinicas:
+                for migracao in migracoes.selecionar_migracoes(args.versao):
+                    relatorio = migracoes.verificar_migracao(migracao, clinic_id, min(args.lote, 500))
+                    situacao = relatorio['erro'] or ("ok" if not relatorio['pendentes'] else f"{relatorio['pendentes']} pendentes")
+                    print(f"{clinic_id} {migracao.chave}: lidos {relatorio['lidos']} | {situacao}"
+                          f"{' | ex.: ' + ', '.join(relatorio['exemplos']) if relatorio['exemplos'] else ''}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,454 @@
+# teste_carga.py (HARNESS DE CARGA MULTI-SESSÃO)
+# Simula várias sessões de recepção por clínica, em paralelo, executando o `app.py` real
+# via `streamlit.testing.v1.AppTest` contra o emulador local do Firestore.
+#
+# Uso:
+#   1. Inicie o emulador:  gcloud emulators firestore start --host-port=localhost:8080
+#   2. export FIRESTORE_EMULATOR_HOST=localhost:8080
+#   3. python teste_carga.py --clinicas 20 --sessoes 3 --reruns 5 --concorrencia 16
+#
+# Para cada cenário (agendamento, agenda diária, dashboard e página do PIN) são reportados:
+# latência de renderização p50/p95/p99, leituras de documentos por rerun e pico de memória por sessão.
+# A tabela "Leituras por operação" (um agendamento, caches vazios) é a base de `database.LEITURAS_POR_OPERACAO_AGENDAMENTO`.
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time as time_mod
+import tracemalloc
+import types
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+from streamlit.testing.v1 import AppTest
+
+database = None  # Importado por `_carregar_database`, depois de conferir o emulador
+
+TZ_SAO_PAULO = ZoneInfo('America/Sao_Paulo')
+CAMINHO_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+CENARIOS = ["agendamento", "agenda_diaria", "dashboard", "pin"]
+DIAS_TRABALHO = ["seg", "ter", "qua", "qui", "sex", "sab"]
+
+
+def _carregar_database():
+    """Importa `database` só com o emulador configurado (o cliente do Firestore é criado na importação)."""
+    global database
+    if database is None:
+        if not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+            print("ERRO: defina FIRESTORE_EMULATOR_HOST para rodar o teste de carga contra a base local.", file=sys.stderr)
+            sys.exit(1)
+        import database as modulo_database
+        database = modulo_database
+    return database
+
+
+# --- Contagem de leituras ---
+class ContadorLeituras:
+    """Contador de documentos lidos no processo (o AppTest executa o script em uma thread própria)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.total = 0
+
+    def somar(self, quantidade: int):
+        with self._lock:
+            self.total += quantidade
+
+
+# Tipos do Firestore que são envolvidos pelo proxy. Transações e batches também: recebem as referências
+# envolvidas (desembrulhadas na chamada) e as leituras feitas dentro das transações entram na contagem.
+_TIPOS_ENVOLVIDOS = {
+    "Client", "CollectionReference", "DocumentReference", "Query",
+    "CollectionGroup", "AggregationQuery", "Transaction", "WriteBatch",
+}
+
+
+def _desembrulhar(valor):
+    if isinstance(valor, ProxyLeituras):
+        return valor._alvo
+    if isinstance(valor, list):
+        return [_desembrulhar(v) for v in valor]
+    if isinstance(valor, tuple):
+        return tuple(_desembrulhar(v) for v in valor)
+    return valor
+
+
+class ProxyLeituras:
+    """
+    Envolve o cliente do Firestore (e as referências/queries derivadas dele)
+    contando os documentos devolvidos por `stream`, `get` e `get_all`.
+    """
+
+    def __init__(self, alvo, contador: ContadorLeituras):
+        self._alvo = alvo
+        self._contador = contador
+
+    def _envolver(self, resultado):
+        if type(resultado).__name__ in _TIPOS_ENVOLVIDOS:
+            return ProxyLeituras(resultado, self._contador)
+        return resultado
+
+    def __getattr__(self, nome):
+        atributo = getattr(self._alvo, nome)
+        if not callable(atributo):
+            return self._envolver(atributo)
+
+        contador = self._contador
+
+        def contar_itens(iteravel):
+            for doc in iteravel:
+                contador.somar(1)
+                yield doc
+
+        if nome in ("stream", "get_all"):
+            def iterar(*args, **kwargs):
+                return contar_itens(atributo(*_desembrulhar(args), **{k: _desembrulhar(v) for k, v in kwargs.items()}))
+            return iterar
+
+        if nome == "get":
+            def obter(*args, **kwargs):
+                resultado = atributo(*_desembrulhar(args), **{k: _desembrulhar(v) for k, v in kwargs.items()})
+                if isinstance(resultado, types.GeneratorType):
+                    # Transaction.get devolve um gerador (de snapshots do documento ou da query)
+                    return contar_itens(resultado)
+                if isinstance(resultado, list):
+                    # Query.get devolve lista de snapshots; agregações devolvem lista de resultados (1 leitura)
+                    contador.somar(len(resultado) if resultado and hasattr(resultado[0], "exists") else 1)
+                else:
+                    contador.somar(1)
+                return resultado
+            return obter
+
+        def chamar(*args, **kwargs):
+            resultado = atributo(*_desembrulhar(args), **{k: _desembrulhar(v) for k, v in kwargs.items()})
+            return self._envolver(resultado)
+        return chamar
+
+
+# --- Massa de dados ---
+def popular_clinica(indice: int, prefixo: str, profissionais: int, clientes: int, agendamentos_por_dia: int):
+    """Cria uma clínica completa no emulador usando as próprias funções de `database`."""
+    username = f"carga_{prefixo}_{indice}"
+    password = "carga"
+    database.adicionar_clinica(f"Clínica Carga {indice}", username, password)
+    clinica = database.buscar_clinica_por_login(username, password)
+    clinic_id = clinica['id']
+
+    horarios = {dia: {"ativo": dia in DIAS_TRABALHO, "inicio": "08:00", "fim": "18:00"}
+                for dia in ["seg", "ter", "qua", "qui", "sex", "sab", "dom"]}
+    for p in range(profissionais):
+        database.adicionar_profissional(clinic_id, f"Profissional {p + 1}")
+    nomes_profissionais = []
+    for prof in database.listar_profissionais(clinic_id):
+        database.atualizar_horario_profissional(clinic_id, prof['id'], horarios)
+        nomes_profissionais.append(prof['nome'])
+
+    database.adicionar_servico(clinic_id, "Avaliação", 60, "Individual")
+    database.adicionar_servico(clinic_id, "Sessão", 30, "Individual")
+
+    ids_clientes = []
+    for c in range(clientes):
+        _, cliente_id = database.adicionar_cliente(clinic_id, f"Cliente {c + 1:04d}", f"1199{indice:03d}{c:04d}", "")
+        ids_clientes.append((f"Cliente {c + 1:04d}", cliente_id))
+
+    pins = []
+    hoje = datetime.now(TZ_SAO_PAULO).date()
+    for d in range(7):
+        dia = hoje + timedelta(days=d)
+        for prof_nome in nomes_profissionais:
+            for a in range(agendamentos_por_dia):
+                nome_cliente, cliente_id = random.choice(ids_clientes)
+                pin = str(random.randint(100000, 999999))
+                dados = {
+                    'profissional_nome': prof_nome,
+                    'cliente': nome_cliente,
+                    'cliente_id': cliente_id,
+                    'telefone': "11999999999",
+                    'horario': datetime.combine(dia, time(8 + a % 10, 0), tzinfo=TZ_SAO_PAULO),
+                    'servico_nome': "Sessão",
+                    'duracao_min': 30,
+                }
+                database.salvar_agendamento(clinic_id, dados, pin)
+                pins.append(pin)
+
+    return {'clinic_id': clinic_id, 'nome': f"Clínica Carga {indice}", 'profissionais': nomes_profissionais, 'pins': pins}
+
+
+# --- Leituras por operação ---
+def medir_leituras_por_operacao(clinica: dict) -> dict:
+    """
+    Documentos lidos por cada operação de um agendamento novo, com os caches vazios: horários livres do profissional
+    no dia, gravação e consulta pelo PIN. Mesmas chaves de `database.LEITURAS_POR_OPERACAO_AGENDAMENTO`.
+    """
+    import cache_agenda
+    import logica_negocio
+
+    contador = ContadorLeituras()
+    db_original = database.db
+    database.db = ProxyLeituras(db_original, contador)
+    leituras = {}
+
+    def medir(operacao, funcao):
+        for cache in vars(cache_agenda).values():
+            if isinstance(cache, cache_agenda.CacheTTL):
+                cache.invalidar()
+        antes = contador.total
+        resultado = funcao()
+        leituras[operacao] = contador.total - antes
+        return resultado
+
+    try:
+        prof_nome = clinica['profissionais'][0]
+        dia = datetime.now(TZ_SAO_PAULO).date() + timedelta(days=1)
+        livres = medir('disponibilidade', lambda: logica_negocio.gerar_horarios_disponiveis(clinica['clinic_id'], prof_nome, dia, 30))
+        if not livres:
+            return leituras
+        pin = str(random.randint(100000, 999999))
+        dados = {
+            'profissional_nome': prof_nome,
+            'cliente': "Cliente Medição",
+            'cliente_id': None,
+            'telefone': "11999999999",
+            'horario': datetime.combine(dia, livres[-1], tzinfo=TZ_SAO_PAULO),
+            'servico_nome': "Sessão",
+            'duracao_min': 30,
+        }
+        medir('gravacao', lambda: database.salvar_agendamento(clinica['clinic_id'], dados, pin))
+        medir('consulta_pin', lambda: database.buscar_agendamento_por_pin(pin))
+        return leituras
+    finally:
+        database.db = db_original
+
+
+# --- Sessões simuladas ---
+# O AppTest usa um Runtime global por processo, então cada sessão simulada roda em um
+# processo do pool; a concorrência vem dos processos executando ao mesmo tempo.
+_contador_worker = None
+
+
+def _inicializar_worker():
+    """Prepara o processo do pool: contador de leituras no cliente e rastreamento de memória."""
+    global _contador_worker
+    _carregar_database()
+    _contador_worker = ContadorLeituras()
+    database.db = ProxyLeituras(database.db, _contador_worker)
+    tracemalloc.start()
+
+
+def _botao(at: AppTest, rotulo: str):
+    return next((b for b in at.button if b.label == rotulo), None)
+
+
+def _nova_sessao(clinica: dict, timeout: float) -> AppTest:
+    at = AppTest.from_file(CAMINHO_APP, default_timeout=timeout)
+    at.session_state["clinic_id"] = clinica['clinic_id']
+    at.session_state["clinic_name"] = clinica['nome']
+    return at
+
+
+class Medicoes:
+    """Latências e leituras de cada rerun de uma sessão simulada."""
+
+    def __init__(self):
+        self.latencias = []
+        self.leituras = []
+        self.erros = []
+
+    def rerun(self, at: AppTest, acao=None):
+        """Executa um rerun (opcionalmente disparado por `acao`) e registra latência e leituras."""
+        leituras_antes = _contador_worker.total
+        inicio = time_mod.perf_counter()
+        if acao is None:
+            at.run()
+        else:
+            acao().run()
+        self.latencias.append(time_mod.perf_counter() - inicio)
+        self.leituras.append(_contador_worker.total - leituras_antes)
+        if at.exception:
+            self.erros.append(str(at.exception[0].value))
+
+
+def sessao_agendamento(clinica: dict, reruns: int, timeout: float, m: Medicoes):
+    """Fluxo de agendamento: serviço, profissional, cliente novo, horário, agendar e confirmar."""
+    at = _nova_sessao(clinica, timeout)
+    m.rerun(at)
+    for _ in range(reruns):
+        prof_nome = random.choice(clinica['profissionais'])
+        dia = datetime.now(TZ_SAO_PAULO).date() + timedelta(days=random.randint(1, 6))
+        m.rerun(at, lambda: at.selectbox(key="c_servico_input").set_value("Sessão"))
+        m.rerun(at, lambda: at.selectbox(key="c_prof_input").set_value(prof_nome))
+        m.rerun(at, lambda: at.date_input(key="form_data_selecionada").set_value(dia))
+        at.text_input(key="c_nome_novo_cliente_input").input(f"Cliente Carga {uuid.uuid4().hex[:6]}")
+        at.text_input(key="c_tel_input").input("11988887777")
+        agendar = _botao(at, "AGENDAR NOVA SESSÃO")
+        if agendar is None or agendar.disabled:
+            continue
+        m.rerun(at, agendar.click)
+        confirmar = _botao(at, "✅ Confirmar Agendamento")
+        if confirmar is not None:
+            m.rerun(at, confirmar.click)
+
+
+def sessao_agenda_diaria(clinica: dict, reruns: int, timeout: float, m: Medicoes):
+    """Navegação pela visão diária da agenda, trocando a data filtrada."""
+    at = _nova_sessao(clinica, timeout)
+    m.rerun(at)
+    hoje = datetime.now(TZ_SAO_PAULO).date()
+    for i in range(reruns):
+        dia = hoje + timedelta(days=i % 7)
+        m.rerun(at, lambda: at.date_input(key="filter_data_selecionada").set_value(dia))
+
+
+def sessao_dashboard(clinica: dict, reruns: int, timeout: float, m: Medicoes):
+    """Abre o dashboard e força reruns sucessivos (como cliques em outros widgets)."""
+    at = _nova_sessao(clinica, timeout)
+    at.session_state["active_tab"] = "📈 Dashboard"
+    m.rerun(at)
+    for _ in range(reruns):
+        m.rerun(at)
+
+
+def sessao_pin(clinica: dict, reruns: int, timeout: float, m: Medicoes):
+    """Página pública do PIN: abre o agendamento e entra no modo de remarcação."""
+    if not clinica['pins']:
+        return
+    for _ in range(reruns):
+        at = AppTest.from_file(CAMINHO_APP, default_timeout=timeout)
+        at.query_params["pin"] = random.choice(clinica['pins'])
+        m.rerun(at)
+        remarcar = _botao(at, "🔄 REMARCAR HORÁRIO")
+        if remarcar is not None:
+            m.rerun(at, remarcar.click)
+
+
+SESSOES = {
+    "agendamento": sessao_agendamento,
+    "agenda_diaria": sessao_agenda_diaria,
+    "dashboard": sessao_dashboard,
+    "pin": sessao_pin,
+}
+
+
+def executar_sessao(cenario: str, clinica: dict, reruns: int, timeout: float):
+    """Roda uma sessão simulada no processo do pool e devolve suas medições."""
+    m = Medicoes()
+    tracemalloc.reset_peak()
+    memoria_base, _ = tracemalloc.get_traced_memory()
+    try:
+        SESSOES[cenario](clinica, reruns, timeout, m)
+    except Exception as e:
+        m.erros.append(repr(e))
+    _, memoria_pico = tracemalloc.get_traced_memory()
+    return {
+        'latencias': m.latencias,
+        'leituras': m.leituras,
+        'erros': m.erros,
+        'pico_memoria': max(0, memoria_pico - memoria_base),
+    }
+
+
+# --- Execução e relatório ---
+def percentil(valores: list, p: float) -> float:
+    """Percentil pelo método nearest-rank."""
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = max(0, min(len(ordenados) - 1, math.ceil(p / 100 * len(ordenados)) - 1))
+    return ordenados[indice]
+
+
+def executar_cenario(executor, cenario: str, clinicas: list, sessoes_por_clinica: int, reruns: int, timeout: float):
+    tarefas = [clinica for clinica in clinicas for _ in range(sessoes_por_clinica)]
+    inicio = time_mod.perf_counter()
+    futuros = [executor.submit(executar_sessao, cenario, clinica, reruns, timeout) for clinica in tarefas]
+
+    latencias, leituras, erros, picos = [], [], [], []
+    for futuro in futuros:
+        try:
+            resultado = futuro.result()
+        except Exception as e:
+            erros.append(repr(e))
+            continue
+        latencias.extend(resultado['latencias'])
+        leituras.extend(resultado['leituras'])
+        erros.extend(resultado['erros'])
+        picos.append(resultado['pico_memoria'])
+
+    return {
+        'cenario': cenario,
+        'sessoes': len(tarefas),
+        'reruns': len(latencias),
+        'p50_ms': percentil(latencias, 50) * 1000,
+        'p95_ms': percentil(latencias, 95) * 1000,
+        'p99_ms': percentil(latencias, 99) * 1000,
+        'leituras_por_rerun': sum(leituras) / len(leituras) if leituras else 0.0,
+        'leituras_p95': percentil(leituras, 95),
+        'pico_memoria_por_sessao_mb': (max(picos) if picos else 0) / (1024 * 1024),
+        'duracao_total_s': time_mod.perf_counter() - inicio,
+        'erros': len(erros),
+        'exemplos_erros': erros[:3],
+    }
+
+
+def imprimir_relatorio(resultados: list, leituras_operacao: dict):
+    cabecalho = (f"{'Cenário':<15}{'Sessões':>8}{'Reruns':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+                 f"{'Leit./rerun':>13}{'Leit. p95':>11}{'Mem./sessão MB':>16}{'Erros':>7}")
+    print(cabecalho)
+    print("-" * len(cabecalho))
+    for r in resultados:
+        print(f"{r['cenario']:<15}{r['sessoes']:>8}{r['reruns']:>8}{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}"
+              f"{r['leituras_por_rerun']:>13.1f}{r['leituras_p95']:>11}{r['pico_memoria_por_sessao_mb']:>16.2f}{r['erros']:>7}")
+        for erro in r['exemplos_erros']:
+            print(f"    ERRO: {erro}")
+    print()
+    print("Leituras por operação (um agendamento, caches vazios): "
+          + " | ".join(f"{operacao} {leituras}" for operacao, leituras in leituras_operacao.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga multi-sessão do Agenda Fit (emulador do Firestore).")
+    parser.add_argument("--clinicas", type=int, default=5, help="Número de clínicas criadas na base local.")
+    parser.add_argument("--sessoes", type=int, default=3, help="Sessões simuladas por clínica em cada cenário.")
+    parser.add_argument("--reruns", type=int, default=5, help="Iterações de interação por sessão.")
+    parser.add_argument("--concorrencia", type=int, default=8, help="Sessões executando ao mesmo tempo.")
+    parser.add_argument("--profissionais", type=int, default=3, help="Profissionais por clínica.")
+    parser.add_argument("--clientes", type=int, default=50, help="Clientes por clínica.")
+    parser.add_argument("--agendamentos-por-dia", type=int, default=6, help="Agendamentos por profissional/dia (próximos 7 dias).")
+    parser.add_argument("--cenarios", nargs="+", choices=CENARIOS, default=CENARIOS)
+    parser.add_argument("--timeout", type=float, default=60.0, help="Timeout (s) de cada rerun.")
+    parser.add_argument("--json", dest="saida_json", help="Arquivo para salvar os resultados em JSON.")
+    args = parser.parse_args()
+    _carregar_database()
+
+    prefixo = uuid.uuid4().hex[:8]
+    print(f"LOG: Populando {args.clinicas} clínicas (prefixo {prefixo})...", file=sys.stderr)
+    clinicas = [
+        popular_clinica(i, prefixo, args.profissionais, args.clientes, args.agendamentos_por_dia)
+        for i in range(args.clinicas)
+    ]
+
+    leituras_operacao = medir_leituras_por_operacao(clinicas[0])
+
+    resultados = []
+    # "spawn" evita herdar canais gRPC do processo pai
+    contexto = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=args.concorrencia, mp_context=contexto, initializer=_inicializar_worker) as executor:
+        for cenario in args.cenarios:
+            print(f"LOG: Executando cenário '{cenario}'...", file=sys.stderr)
+            resultados.append(executar_cenario(executor, cenario, clinicas, args.sessoes, args.reruns, args.timeout))
+
+    imprimir_relatorio(resultados, leituras_operacao)
+    if args.saida_json:
+        with open(args.saida_json, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+# Os módulos do app criam o cliente do Firestore na importação: apontá-lo para o emulador evita exigir
+# as credenciais de `st.secrets`. Os testes daqui não fazem consultas; as de banco são substituídas por fakes.
+import os
+import sys
+
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "agenda-fit-testes")
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
@@ -0,0 +1,79 @@
+from logica_negocio import (
+    _intervalos_livres,
+    _mascara_intervalo,
+    _mascara_livre,
+    _slot_livre,
+    _slots_em_intervalos_livres,
+)
+
+
+# --- _intervalos_livres ---
+def test_intervalos_livres_sem_blocos_devolve_o_expediente():
+    assert _intervalos_livres(480, 1080, []) == [(480, 1080)]
+
+def test_intervalos_livres_com_blocos_fora_de_ordem_e_sobrepostos():
+    blocos = [(600, 660), (540, 570), (630, 690)]
+    assert _intervalos_livres(480, 1080, blocos) == [(480, 540), (570, 600), (690, 1080)]
+
+def test_intervalos_livres_ignora_blocos_fora_do_expediente():
+    blocos = [(420, 470), (1080, 1140), (1020, 1100)]
+    assert _intervalos_livres(480, 1080, blocos) == [(480, 1020)]
+
+def test_intervalos_livres_dia_todo_ocupado():
+    assert _intervalos_livres(480, 1080, [(450, 1100)]) == []
+
+def test_intervalos_livres_blocos_encostados_nao_deixam_intervalo_vazio():
+    assert _intervalos_livres(480, 600, [(480, 540), (540, 600)]) == []
+
+
+# --- _slots_em_intervalos_livres ---
+def test_slots_alinhados_a_grade_e_cabendo_no_intervalo():
+    # Intervalo 08:10-09:30, grade de 30 min a partir das 08:00, atendimentos de 30 min
+    assert _slots_em_intervalos_livres([(490, 570)], 30, 30, 480) == [510, 540]
+
+def test_slots_em_intervalo_menor_que_a_duracao():
+    assert _slots_em_intervalos_livres([(480, 500)], 30, 15, 480) == []
+
+
+# --- Bitmask ---
+def test_mascara_intervalo():
+    assert _mascara_intervalo(2, 5) == 0b11100
+    assert _mascara_intervalo(5, 5) == 0
+    assert _mascara_intervalo(-3, 2) == 0b11
+
+def test_slot_livre():
+    livre = _mascara_intervalo(480, 600)
+    assert _slot_livre(livre, 480, 60)
+    assert _slot_livre(livre, 540, 60)
+    assert not _slot_livre(livre, 570, 60)
+    assert not _slot_livre(livre, 470, 20)
+
+def _disponibilidade(blocos, intervalos=((480, 720), (780, 1080)), feriado=False):
+    disponibilidade = {'intervalos': list(intervalos), 'feriado': feriado, 'blocos': blocos,
+                       'ids': frozenset(b[2] for b in blocos)}
+    disponibilidade['livre'] = _mascara_livre(disponibilidade)
+    return disponibilidade
+
+def test_mascara_livre_tira_almoco_e_agendamentos():
+    livre = _disponibilidade([(540, 600, 'a')])['livre']
+    assert _slot_livre(livre, 480, 60)
+    assert not _slot_livre(livre, 570, 30)
+    assert not _slot_livre(livre, 720, 30)  # Almoço fora dos intervalos de trabalho
+    assert _slot_livre(livre, 780, 300)
+
+def test_mascara_livre_excluindo_o_proprio_agendamento():
+    disponibilidade = _disponibilidade([(540, 600, 'a'), (600, 630, 'b')])
+    assert not _slot_livre(_mascara_livre(disponibilidade), 540, 60)
+    assert _slot_livre(_mascara_livre(disponibilidade, agendamento_id_excluir='a'), 540, 60)
+    assert not _slot_livre(_mascara_livre(disponibilidade, agendamento_id_excluir='a'), 540, 90)
+
+def test_mascara_livre_em_feriado():
+    assert _disponibilidade([], feriado=True)['livre'] == 0
+
+def test_mascara_livre_concorda_com_os_intervalos_livres():
+    blocos = [(500, 530, 'a'), (515, 560, 'b'), (900, 960, 'c')]
+    livre = _disponibilidade(blocos, intervalos=((480, 1080),))['livre']
+    intervalos = _intervalos_livres(480, 1080, [(inicio, fim) for inicio, fim, _ in blocos])
+    for minuto in range(0, 24 * 60):
+        dentro = any(inicio <= minuto < fim for inicio, fim in intervalos)
+        assert bool(livre >> minuto & 1) == dentro
@@ -0,0 +1,50 @@
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pandas as pd
+
+from logica_negocio import COLUNAS_GRADE, expandir_agendamentos_em_celulas
+
+TZ_SAO_PAULO = ZoneInfo('America/Sao_Paulo')
+
+
+def _agendamento(ag_id, dia, hora, minuto, duracao_min=30, status='Confirmado', turma_id=None, profissional='P1', cliente=None):
+    return {'id': ag_id, 'horario': datetime(2026, 10, dia, hora, minuto, tzinfo=TZ_SAO_PAULO), 'duracao_min': duracao_min,
+            'status': status, 'turma_id': turma_id, 'profissional_nome': profissional, 'cliente': cliente or ag_id}
+
+def _celulas(*agendamentos):
+    return expandir_agendamentos_em_celulas(pd.DataFrame(list(agendamentos)))
+
+
+def test_agendamento_ocupa_as_celulas_da_duracao():
+    celulas = _celulas(_agendamento('a', 19, 9, 0, duracao_min=60))
+    assert celulas['hora'].tolist() == ['09:00', '09:15', '09:30', '09:45']
+    assert celulas['texto'].tolist() == ['a', '↳ a', '↳ a', '↳ a']
+    assert celulas['inicio'].tolist() == [True, False, False, False]
+    assert celulas['dia_semana'].unique().tolist() == ['Segunda']
+
+def test_inicio_fora_da_grade_ocupa_as_celulas_tocadas():
+    # 10:10 por 30 min cobre as células de 10:00, 10:15 e 10:30
+    celulas = _celulas(_agendamento('c', 20, 10, 10, duracao_min=30))
+    assert celulas['hora'].tolist() == ['10:00', '10:15', '10:30']
+
+def test_duracao_ausente_ocupa_uma_celula():
+    celulas = _celulas(_agendamento('c', 20, 10, 0, duracao_min=None))
+    assert celulas['hora'].tolist() == ['10:00']
+
+def test_ignora_cancelados_e_turmas():
+    celulas = _celulas(_agendamento('d', 20, 11, 0, status='Cancelado'), _agendamento('e', 20, 12, 0, turma_id='t1'))
+    assert celulas.empty
+    assert list(celulas.columns) == COLUNAS_GRADE
+
+def test_agendamentos_sobrepostos_mantem_as_duas_linhas():
+    celulas = _celulas(_agendamento('a', 19, 9, 0, duracao_min=60), _agendamento('b', 19, 9, 30))
+    na_celula = celulas[celulas['hora'] == '09:30']
+    assert sorted(na_celula['texto']) == ['b', '↳ a']
+
+def test_nao_passa_da_meia_noite():
+    celulas = _celulas(_agendamento('n', 19, 23, 30, duracao_min=90))
+    assert celulas['hora'].tolist() == ['23:30', '23:45']
+
+def test_dataframe_vazio():
+    assert list(expandir_agendamentos_em_celulas(pd.DataFrame()).columns) == COLUNAS_GRADE
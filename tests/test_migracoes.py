@@ -0,0 +1,119 @@
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import database
+import migracoes
+
+
+# --- Campos derivados ---
+def test_chave_dia_no_fuso_de_sao_paulo():
+    assert database.chave_dia(datetime(2026, 10, 19, 23, 30, tzinfo=ZoneInfo('America/Sao_Paulo'))) == '2026-10-19'
+    # 01:30 UTC ainda é o dia anterior em São Paulo
+    assert database.chave_dia(datetime(2026, 10, 20, 1, 30, tzinfo=timezone.utc)) == '2026-10-19'
+
+def test_normalizar_telefone():
+    assert database.normalizar_telefone('(11) 99999-0000') == '11999990000'
+    assert database.normalizar_telefone('+55 11 3333 4444') == '551133334444'
+    assert database.normalizar_telefone(11999990000) == '11999990000'
+    assert database.normalizar_telefone(None) == ''
+
+
+# --- Execução em lotes ---
+class ColecaoFake:
+    """Coleção de uma clínica e progresso das migrações em memória, no lugar das funções de `database`."""
+
+    def __init__(self, documentos: dict):
+        self.documentos = documentos
+        self.checkpoints = {}
+        self.gravacoes = []
+        self.falhar_gravacao_no_lote = None
+
+    def ler_lote_migracao(self, colecao, clinic_id, apos_id=None, tamanho=database.TAMANHO_LOTE_ESCRITA, campos=None):
+        ids = sorted(doc_id for doc_id in self.documentos if apos_id is None or doc_id > apos_id)[:tamanho]
+        return [(doc_id, {campo: self.documentos[doc_id].get(campo) for campo in campos} if campos else dict(self.documentos[doc_id]))
+                for doc_id in ids]
+
+    def atualizar_documentos_migracao(self, colecao, clinic_id, atualizacoes):
+        if self.falhar_gravacao_no_lote == len(self.gravacoes) + 1:
+            return None
+        self.gravacoes.append(dict(atualizacoes))
+        for doc_id, campos in atualizacoes.items():
+            self.documentos[doc_id].update(campos)
+        return len(atualizacoes)
+
+    def ler_checkpoint_migracao(self, clinic_id, chave):
+        return dict(self.checkpoints.get(chave, {}))
+
+    def salvar_checkpoint_migracao(self, clinic_id, chave, dados):
+        self.checkpoints.setdefault(chave, {}).update(dados)
+        return True
+
+@pytest.fixture
+def clientes(monkeypatch):
+    # 10 clientes; os pares ainda sem telefone normalizado
+    fake = ColecaoFake({
+        f"c{i:02d}": {'telefone': f"(11) 9000-00{i:02d}", 'telefone_normalizado': None if i % 2 == 0 else f"11900000{i:02d}"}
+        for i in range(10)
+    })
+    for nome in ('ler_lote_migracao', 'atualizar_documentos_migracao', 'ler_checkpoint_migracao', 'salvar_checkpoint_migracao'):
+        monkeypatch.setattr(database, nome, getattr(fake, nome))
+    return fake
+
+MIGRACAO_TELEFONE = next(m for m in migracoes.MIGRACOES if m.nome == 'clientes_telefone_normalizado')
+
+
+def test_executa_em_lotes_e_conclui(clientes):
+    relatorio = migracoes.executar_migracao(MIGRACAO_TELEFONE, 'clinica', tamanho_lote=4)
+    assert relatorio == {'clinic_id': 'clinica', 'migracao': MIGRACAO_TELEFONE.chave, 'lidos': 10, 'alterados': 5,
+                         'concluida': True, 'erro': None}
+    assert len(clientes.gravacoes) == 3
+    assert all(doc['telefone_normalizado'] == database.normalizar_telefone(doc['telefone']) for doc in clientes.documentos.values())
+    assert clientes.checkpoints[MIGRACAO_TELEFONE.chave]['concluida'] is True
+
+def test_simulacao_nao_grava_nada(clientes):
+    relatorio = migracoes.executar_migracao(MIGRACAO_TELEFONE, 'clinica', tamanho_lote=4, simular=True)
+    assert (relatorio['lidos'], relatorio['alterados'], relatorio['concluida']) == (10, 5, True)
+    assert clientes.gravacoes == []
+    assert clientes.checkpoints == {}
+
+def test_max_lotes_para_e_a_proxima_execucao_continua_do_checkpoint(clientes):
+    relatorio = migracoes.executar_migracao(MIGRACAO_TELEFONE, 'clinica', tamanho_lote=4, max_lotes=1)
+    assert (relatorio['lidos'], relatorio['alterados'], relatorio['concluida']) == (4, 2, False)
+    assert clientes.checkpoints[MIGRACAO_TELEFONE.chave] == {'versao': MIGRACAO_TELEFONE.versao, 'ultimo_id': 'c03',
+                                                             'lidos': 4, 'alterados': 2, 'concluida': False}
+
+    relatorio = migracoes.executar_migracao(MIGRACAO_TELEFONE, 'clinica', tamanho_lote=4)
+    assert (relatorio['lidos'], relatorio['alterados'], relatorio['concluida']) == (6, 3, True)
+    # Os totais do checkpoint somam as duas execuções
+    assert clientes.checkpoints[MIGRACAO_TELEFONE.chave]['lidos'] == 10
+    assert clientes.checkpoints[MIGRACAO_TELEFONE.chave]['alterados'] == 5
+
+def test_migracao_concluida_e_pulada(clientes):
+    migracoes.executar_migracao(MIGRACAO_TELEFONE, 'clinica', tamanho_lote=4)
+    gravacoes = len(clientes.gravacoes)
+    relatorio = migracoes.executar_migracao(MIGRACAO_TELEFONE, 'clinica', tamanho_lote=4)
+    assert (relatorio['lidos'], relatorio['concluida']) == (0, True)
+    assert len(clientes.gravacoes) == gravacoes
+
+def test_falha_na_gravacao_preserva_o_checkpoint_anterior(clientes):
+    clientes.falhar_gravacao_no_lote = 2
+    relatorio = migracoes.executar_migracao(MIGRACAO_TELEFONE, 'clinica', tamanho_lote=4)
+    assert relatorio['erro'] and not relatorio['concluida']
+    assert clientes.checkpoints[MIGRACAO_TELEFONE.chave]['ultimo_id'] == 'c03'
+
+    clientes.falhar_gravacao_no_lote = None
+    relatorio = migracoes.executar_migracao(MIGRACAO_TELEFONE, 'clinica', tamanho_lote=4)
+    assert relatorio['concluida'] and relatorio['erro'] is None
+    assert migracoes.verificar_migracao(MIGRACAO_TELEFONE, 'clinica', tamanho_lote=4)['pendentes'] == 0
+
+def test_reiniciar_ignora_o_checkpoint(clientes):
+    migracoes.executar_migracao(MIGRACAO_TELEFONE, 'clinica', tamanho_lote=4)
+    relatorio = migracoes.executar_migracao(MIGRACAO_TELEFONE, 'clinica', tamanho_lote=4, reiniciar=True)
+    # Tudo já migrado: relê a coleção e não altera nada
+    assert (relatorio['lidos'], relatorio['alterados'], relatorio['concluida']) == (10, 0, True)
+
+def test_verificacao_conta_pendentes(clientes):
+    relatorio = migracoes.verificar_migracao(MIGRACAO_TELEFONE, 'clinica', tamanho_lote=3, limite_exemplos=2)
+    assert (relatorio['lidos'], relatorio['pendentes'], relatorio['exemplos']) == (10, 5, ['c00', 'c02'])
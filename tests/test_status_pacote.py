@@ -0,0 +1,29 @@
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from database import DIAS_AVISO_EXPIRACAO_PACOTE, calcular_status_pacote
+
+AGORA = datetime(2026, 10, 19, 12, 0, tzinfo=ZoneInfo('America/Sao_Paulo'))
+
+
+def _pacote(dias_para_expirar, creditos):
+    return {'data_expiracao': AGORA + timedelta(days=dias_para_expirar), 'creditos_restantes': creditos}
+
+
+def test_ativo_longe_da_expiracao():
+    assert calcular_status_pacote(_pacote(30, 5), AGORA) == {'status': 'Ativo', 'expirando': False}
+
+def test_ativo_dentro_do_aviso_esta_expirando():
+    assert calcular_status_pacote(_pacote(DIAS_AVISO_EXPIRACAO_PACOTE - 1, 5), AGORA) == {'status': 'Ativo', 'expirando': True}
+    assert calcular_status_pacote(_pacote(3, 5), AGORA, dias_aviso=2)['expirando'] is False
+
+def test_expirado_prevalece_sobre_creditos():
+    assert calcular_status_pacote(_pacote(-1, 5), AGORA) == {'status': 'Expirado', 'expirando': False}
+    assert calcular_status_pacote(_pacote(-1, 0), AGORA)['status'] == 'Expirado'
+
+def test_esgotado_sem_creditos():
+    assert calcular_status_pacote(_pacote(3, 0), AGORA) == {'status': 'Esgotado', 'expirando': False}
+    assert calcular_status_pacote({'data_expiracao': AGORA + timedelta(days=3)}, AGORA)['status'] == 'Esgotado'
+
+def test_sem_data_de_expiracao():
+    assert calcular_status_pacote({'creditos_restantes': 2}, AGORA) == {'status': 'Ativo', 'expirando': False}